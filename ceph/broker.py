@@ -13,14 +13,25 @@
 # limitations under the License.
 
 import collections
+import hashlib
 import json
 import os
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
 from tempfile import NamedTemporaryFile
 
+from ceph.executor import (
+    CephCommand,
+    get_executor,
+)
 from ceph.utils import (
     get_cephfs,
-    get_osd_weight
+    get_cluster_epochs,
+    get_osd_weight,
+    list_pools,
+    write_json_atomically,
 )
 from ceph.crush_utils import Crushmap
 
@@ -29,6 +40,7 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     INFO,
     ERROR,
+    WARNING,
 )
 from charmhelpers.contrib.storage.linux.ceph import (
     create_erasure_profile,
@@ -97,6 +109,502 @@ CEPH_BUCKET_TYPES = [
     'root'
 ]
 
+# The maximum number of broker ops to run concurrently
+MAX_BROKER_WORKERS = 4
+
+# All of the ops understood by the broker
+BROKER_OPS = [
+    'create-pool',
+    'create-cephfs',
+    'create-cache-tier',
+    'remove-cache-tier',
+    'create-erasure-profile',
+    'delete-pool',
+    'rename-pool',
+    'snapshot-pool',
+    'remove-pool-snapshot',
+    'set-pool-value',
+    'rgw-region-set',
+    'rgw-zone-set',
+    'rgw-regionmap-update',
+    'rgw-regionmap-default',
+    'rgw-create-user',
+    'move-osd-to-bucket',
+    'add-permissions-to-key',
+]
+
+# Where responses to completed requests are remembered between hooks
+BROKER_CACHE_FILE = '/var/lib/ceph/broker-responses.json'
+# How long, in seconds, a remembered response may be replayed for
+BROKER_CACHE_TTL = 3600
+# The maximum number of responses remembered
+BROKER_CACHE_SIZE = 256
+
+# The config-keys which hold the cephx groups and services
+CEPHX_KEY_PREFIXES = ('cephx.groups.', 'cephx.services.')
+
+# Ops which look up or change the set of pools in the cluster
+POOL_OPS = [
+    'create-pool',
+    'create-cephfs',
+    'create-cache-tier',
+    'remove-cache-tier',
+    'delete-pool',
+    'rename-pool',
+]
+
+
+class CephxGroupStore(object):
+    """An in-memory copy of the cephx groups and services.
+
+    Every cephx.groups.* and cephx.services.* config-key is loaded with a
+    single 'config-key dump' the first time any of them is needed, so that
+    looking up a group or service no longer costs a monitor round trip.
+    Writes are kept in memory and only the keys whose value changed are
+    written back, in order, when the store is flushed.
+
+    If the dump fails the store reads keys one at a time instead, still at
+    most once each.
+
+    :param service: str. The cephx id to read and write keys as
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self._values = None
+        self._complete = False
+        self._dirty = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Load every cephx group and service key from the cluster."""
+        with self._lock:
+            self._values = {}
+            self._complete = False
+            try:
+                dump = json.loads(get_executor().check_output(
+                    CephCommand('config-key dump', service=self.service)))
+            except (CalledProcessError, OSError, ValueError) as e:
+                log("Unable to dump config-keys, reading cephx keys one at "
+                    "a time: {}".format(e), level=WARNING)
+                return
+            for key, value in dump.items():
+                if key.startswith(CEPHX_KEY_PREFIXES):
+                    self._values[key] = value
+            self._complete = True
+
+    def get(self, key):
+        """Return the value of a config-key, or None if it is not set."""
+        with self._lock:
+            if self._values is None:
+                self.load()
+            if key not in self._values:
+                if self._complete:
+                    return None
+                self._values[key] = monitor_key_get(service=self.service,
+                                                    key=key)
+            return self._values[key]
+
+    def set(self, key, value):
+        """Record the value of a config-key, to be written on flush."""
+        with self._lock:
+            if self._values is None:
+                self.load()
+            if key in self._values and self._values[key] == value:
+                return
+            self._values[key] = value
+            self._dirty[key] = value
+
+    def dirty(self):
+        """Return the keys which have changed since they were loaded."""
+        with self._lock:
+            return list(self._dirty)
+
+    def flush(self):
+        """Write the changed keys back to the monitor cluster.
+
+        :raises: CalledProcessError if a write fails, leaving that key and
+                 any later ones dirty.
+        """
+        with self._lock:
+            while self._dirty:
+                key, value = next(iter(self._dirty.items()))
+                monitor_key_set(service=self.service, key=key, value=value)
+                del self._dirty[key]
+
+
+class BrokerState(object):
+    """A snapshot of the cluster state that broker handlers run against.
+
+    The state a request needs is planned from its ops and read once, before
+    any op runs: the pool list, the OSD list and the erasure profiles. cephx
+    groups and services are held in a CephxGroupStore. Handlers record their
+    changes here as they go, and the config-key writes and key capability
+    updates are coalesced and flushed as one ordered batch at the end of the
+    request.
+
+    While the state is active (used as a context manager) the broker helpers
+    consult it instead of querying the cluster directly. The state may be
+    shared by ops running on several threads, each of which must activate it.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, service):
+        self.service = service
+        self._pools = None
+        self._osds = None
+        self._erasure_profiles = None
+        self.cephx = CephxGroupStore(service)
+        self._caps = None
+        self._crushmap = None
+        self.crushmap_error = None
+        self._pending_caps = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def current(cls):
+        """Return the state active in this thread, or None."""
+        return getattr(cls._local, 'state', None)
+
+    def activate(self):
+        """Make this the active state of the calling thread."""
+        BrokerState._local.state = self
+
+    @staticmethod
+    def deactivate():
+        """Clear the active state of the calling thread."""
+        BrokerState._local.state = None
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+                return
+            # Keep the changes made by the ops which ran before the failure,
+            # as they would have been persisted already without batching.
+            try:
+                self.flush()
+            except Exception as e:
+                log("Failed to flush broker changes: {}".format(e),
+                    level=ERROR)
+        finally:
+            self.deactivate()
+
+    def plan(self, reqs):
+        """Read the cluster state which the ops in reqs will need.
+
+        :param reqs: list of broker ops
+        """
+        for req in reqs:
+            op = req.get('op')
+            if op in POOL_OPS:
+                self.pools()
+            if op == 'create-pool':
+                if req.get('pool-type') == 'erasure':
+                    self.erasure_profiles()
+                elif req.get('pg_num'):
+                    self.osds()
+
+    def pools(self):
+        """Return the set of pool names in the cluster."""
+        with self._lock:
+            if self._pools is None:
+                try:
+                    self._pools = set(list_pools(service=self.service))
+                except CalledProcessError:
+                    self._pools = set()
+            return self._pools
+
+    def add_pool(self, name):
+        with self._lock:
+            self.pools().add(name)
+
+    def remove_pool(self, name):
+        with self._lock:
+            self.pools().discard(name)
+
+    def osds(self):
+        """Return the list of OSD ids in the cluster."""
+        with self._lock:
+            if self._osds is None:
+                self._osds = get_osds(self.service)
+            return self._osds
+
+    def erasure_profiles(self):
+        """Return the set of erasure profile names in the cluster."""
+        with self._lock:
+            if self._erasure_profiles is None:
+                try:
+                    self._erasure_profiles = set(json.loads(
+                        get_executor().check_output(CephCommand(
+                            'osd erasure-code-profile ls',
+                            service=self.service, fmt='json'))))
+                except (CalledProcessError, ValueError) as e:
+                    log("Unable to list erasure profiles: {}".format(e),
+                        level=ERROR)
+                    self._erasure_profiles = set()
+            return self._erasure_profiles
+
+    def add_erasure_profile(self, name):
+        with self._lock:
+            self.erasure_profiles().add(name)
+
+    def key_get(self, key):
+        """Return the value of a cephx group or service config-key."""
+        return self.cephx.get(key)
+
+    def key_set(self, key, value):
+        """Record a cephx group or service config-key write."""
+        self.cephx.set(key, value)
+
+    def set_caps(self, client, namespace=None):
+        """Record that the capabilities of a client key need updating.
+
+        The capabilities are computed when the state is flushed, from the
+        groups as every op of the request left them.
+        """
+        with self._lock:
+            self._pending_caps[client] = namespace
+
+    def crushmap(self):
+        """Return the CRUSH map, with a transaction begun on it.
+
+        The transaction is committed when the state is flushed, so that
+        every CRUSH change of the request is saved at once.
+        """
+        with self._lock:
+            if self._crushmap is None:
+                self._crushmap = Crushmap()
+                self._crushmap.begin()
+            return self._crushmap
+
+    def commit_crushmap(self):
+        """Commit the CRUSH map transaction, if there is one.
+
+        A failure is recorded in crushmap_error rather than raised, as the
+        ops which queued the changes have already returned.
+        """
+        with self._lock:
+            if self._crushmap is None:
+                return
+            crushmap, self._crushmap = self._crushmap, None
+            try:
+                crushmap.commit()
+            except Exception as e:
+                msg = "Failed to update the CRUSH map: {}".format(e)
+                log(msg, level=ERROR)
+                self.crushmap_error = {'exit-code': 1, 'stderr': msg}
+
+    def applied_caps(self):
+        """Return the capabilities of every key, read once.
+
+        :returns: dict of entity to its caps. Example:
+                  {'client.nova': {'mon': 'allow r', 'osd': 'allow rwx'}}
+        """
+        with self._lock:
+            if self._caps is None:
+                try:
+                    dump = json.loads(get_executor().check_output(
+                        CephCommand('auth list', service=self.service,
+                                    fmt='json')))
+                    self._caps = dict(
+                        (entry['entity'], entry.get('caps', {}))
+                        for entry in dump.get('auth_dump', []))
+                except (CalledProcessError, OSError, ValueError) as e:
+                    log("Unable to list key capabilities, updating every "
+                        "key: {}".format(e), level=WARNING)
+                    self._caps = {}
+            return self._caps
+
+    def flush(self):
+        """Persist the recorded config-key writes and capabilities.
+
+        Capabilities are only set on the keys whose capabilities actually
+        change, and those updates are run concurrently.
+
+        Must be called with the state active.
+
+        :raises: CalledProcessError if a config-key write fails
+        """
+        with self._lock:
+            changed = []
+            while self._pending_caps:
+                client, namespace = self._pending_caps.popitem(last=False)
+                permissions = pool_permission_list_for_service(
+                    get_service_groups(service=client, namespace=namespace))
+                entity = 'client.{}'.format(client)
+                caps = dict(zip(permissions[::2], permissions[1::2]))
+                if self.applied_caps().get(entity) == caps:
+                    log("Capabilities of {} are unchanged".format(entity),
+                        level=DEBUG)
+                    continue
+                changed.append((client, permissions, entity, caps))
+            self.cephx.flush()
+            self.commit_crushmap()
+            if len(changed) > 1:
+                pool = ThreadPool(min(MAX_BROKER_WORKERS, len(changed)))
+                try:
+                    applied = pool.map(lambda change: _apply_caps(*change[:2]),
+                                       changed)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                applied = [_apply_caps(*change[:2]) for change in changed]
+            for (_, _, entity, caps), ok in zip(changed, applied):
+                if ok:
+                    self._caps[entity] = caps
+
+
+def _pool_exists(service, name):
+    state = BrokerState.current()
+    if state is None:
+        return pool_exists(service=service, name=name)
+    return name in state.pools()
+
+
+def _get_osds(service):
+    state = BrokerState.current()
+    if state is None:
+        return get_osds(service)
+    return state.osds()
+
+
+def _erasure_profile_exists(service, name):
+    state = BrokerState.current()
+    if state is None:
+        return erasure_profile_exists(service=service, name=name)
+    return name in state.erasure_profiles()
+
+
+def _monitor_key_get(key):
+    state = BrokerState.current()
+    if state is None:
+        return monitor_key_get(service='admin', key=key)
+    return state.key_get(key)
+
+
+def _pool_created(name):
+    state = BrokerState.current()
+    if state is not None:
+        state.add_pool(name)
+
+
+def _monitor_key_set(key, value):
+    state = BrokerState.current()
+    if state is None:
+        return monitor_key_set(service='admin', key=key, value=value)
+    state.key_set(key, value)
+
+
+class ResponseCache(object):
+    """Remembers the responses to broker requests which have completed.
+
+    Clients resend the same request on every relation change until they see
+    a response, so a request is frequently processed again after it already
+    succeeded. Responses are keyed by the request-id and a digest of the ops
+    and are replayed while the cluster maps are at the epochs they were at
+    when the request completed; any change to the cluster invalidates them.
+
+    Entries expire after ttl seconds and the least recently used entries are
+    evicted beyond size entries. The cache is persisted to path as JSON.
+
+    :param path: str. The file to persist the cache to, defaults to
+                 BROKER_CACHE_FILE
+    :param ttl: int. Seconds an entry may be replayed for
+    :param size: int. The maximum number of entries to keep
+    """
+
+    def __init__(self, path=None, ttl=BROKER_CACHE_TTL,
+                 size=BROKER_CACHE_SIZE):
+        self.path = path or BROKER_CACHE_FILE
+        self.ttl = ttl
+        self.size = size
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def key(request_id, ops):
+        """Return the cache key for a request.
+
+        :param request_id: str. The id the client sent with the request
+        :param ops: list. The ops of the request
+        :returns: str
+        """
+        digest = hashlib.sha256(
+            json.dumps(ops, sort_keys=True).encode('UTF-8')).hexdigest()
+        return '{}:{}'.format(request_id, digest)
+
+    def load(self):
+        """Load the persisted entries, starting empty if there are none."""
+        self._entries = collections.OrderedDict()
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                log("Ignoring unreadable broker cache {}: {}".format(
+                    self.path, e), level=WARNING)
+            return
+        for key, entry in sorted(entries.items(),
+                                 key=lambda item: item[1].get('used', 0)):
+            self._entries[key] = entry
+
+    def save(self):
+        """Persist the entries, replacing the previous file atomically."""
+        write_json_atomically(self.path, self._entries, 'broker cache')
+
+    def get(self, key, epochs):
+        """Return the response remembered for key, or None.
+
+        Entries which have expired or which were recorded at other cluster
+        epochs are dropped.
+
+        :param key: str. As returned by key()
+        :param epochs: dict. The current cluster epochs
+        :returns: dict or None
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        now = time.time()
+        if now - entry['time'] > self.ttl or entry['epochs'] != epochs:
+            return None
+        entry['used'] = now
+        self._entries[key] = entry
+        return entry['response']
+
+    def put(self, key, epochs, response):
+        """Remember the response to a request.
+
+        :param key: str. As returned by key()
+        :param epochs: dict. The cluster epochs after the request completed
+        :param response: dict. The response to replay
+        """
+        now = time.time()
+        self._entries.pop(key, None)
+        self._entries[key] = {'response': response, 'epochs': epochs,
+                              'time': now, 'used': now}
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _cluster_epochs():
+    """Return the cluster epochs, or None if they can't be read."""
+    try:
+        return get_cluster_epochs()
+    except (CalledProcessError, OSError, ValueError) as e:
+        log("Unable to read cluster epochs, not using the broker cache: "
+            "{}".format(e), level=WARNING)
+        return None
+
 
 def decode_req_encode_rsp(f):
     """Decorator to decode incoming requests and encode responses."""
@@ -121,11 +629,29 @@ def process_requests(reqs):
     try:
         version = reqs.get('api-version')
         if version == 1:
+            cache = key = None
+            epochs = _cluster_epochs() if request_id else None
+            if epochs:
+                cache = ResponseCache()
+                cache.load()
+                key = cache.key(request_id, reqs['ops'])
+                resp = cache.get(key, epochs)
+                if resp is not None:
+                    log('Replaying response to request {}'.format(
+                        request_id), level=DEBUG)
+                    return resp
+
             log('Processing request {}'.format(request_id), level=DEBUG)
             resp = process_requests_v1(reqs['ops'])
             if request_id:
                 resp['request-id'] = request_id
 
+            if cache is not None and resp.get('exit-code') == 0:
+                epochs = _cluster_epochs()
+                if epochs:
+                    cache.put(key, epochs, resp)
+                    cache.save()
+
             return resp
 
     except Exception as exc:
@@ -167,6 +693,9 @@ def handle_create_erasure_profile(request, service):
     create_erasure_profile(service=service, erasure_plugin_name=erasure_type,
                            profile_name=name, failure_domain=failure_domain,
                            data_chunks=k, coding_chunks=m, locality=l)
+    state = BrokerState.current()
+    if state is not None:
+        state.add_erasure_profile(name)
 
 
 def handle_add_permissions_to_key(request, service):
@@ -209,14 +738,28 @@ def handle_add_permissions_to_key(request, service):
 
 def update_service_permissions(service, service_obj=None, namespace=None):
     """Update the key permissions for the named client in Ceph"""
+    state = BrokerState.current()
+    if state is not None:
+        state.set_caps(service, namespace)
+        return
     if not service_obj:
         service_obj = get_service_groups(service=service, namespace=namespace)
     permissions = pool_permission_list_for_service(service_obj)
+    _apply_caps(service, permissions)
+
+
+def _apply_caps(service, permissions):
+    """Set the capabilities of the named client key
+
+    :returns: bool. True if the capabilities were set
+    """
     call = ['ceph', 'auth', 'caps', 'client.{}'.format(service)] + permissions
     try:
         check_call(call)
     except CalledProcessError as e:
         log("Error updating key capabilities: {}".format(e))
+        return False
+    return True
 
 
 def add_pool_to_group(pool, group, namespace=None):
@@ -272,8 +815,7 @@ def get_service_groups(service, namespace=None):
         }
     }
     """
-    service_json = monitor_key_get(service='admin',
-                                   key="cephx.services.{}".format(service))
+    service_json = _monitor_key_get(key="cephx.services.{}".format(service))
     try:
         service = json.loads(service_json)
     except (TypeError, ValueError):
@@ -320,7 +862,7 @@ def get_group(group_name):
     }
     """
     group_key = get_group_key(group_name=group_name)
-    group_json = monitor_key_get(service='admin', key=group_key)
+    group_json = _monitor_key_get(key=group_key)
     try:
         group = json.loads(group_json)
     except (TypeError, ValueError):
@@ -336,17 +878,15 @@ def get_group(group_name):
 def save_service(service_name, service):
     """Persist a service in the monitor cluster"""
     service['groups'] = {}
-    return monitor_key_set(service='admin',
-                           key="cephx.services.{}".format(service_name),
-                           value=json.dumps(service, sort_keys=True))
+    return _monitor_key_set(key="cephx.services.{}".format(service_name),
+                            value=json.dumps(service, sort_keys=True))
 
 
 def save_group(group, group_name):
     """Persist a group in the monitor cluster"""
     group_key = get_group_key(group_name=group_name)
-    return monitor_key_set(service='admin',
-                           key=group_key,
-                           value=json.dumps(group, sort_keys=True))
+    return _monitor_key_set(key=group_key,
+                            value=json.dumps(group, sort_keys=True))
 
 
 def get_group_key(group_name):
@@ -384,7 +924,7 @@ def handle_erasure_pool(request, service):
                           namespace=group_namespace)
 
     # TODO: Default to 3/2 erasure coding. I believe this requires min 5 osds
-    if not erasure_profile_exists(service=service, name=erasure_profile):
+    if not _erasure_profile_exists(service=service, name=erasure_profile):
         # TODO: Fail and tell them to create the profile or default
         msg = ("erasure-profile {} does not exist.  Please create it with: "
                "create-erasure-profile".format(erasure_profile))
@@ -395,10 +935,11 @@ def handle_erasure_pool(request, service):
                        erasure_code_profile=erasure_profile,
                        percent_data=weight)
     # Ok make the erasure pool
-    if not pool_exists(service=service, name=pool_name):
+    if not _pool_exists(service=service, name=pool_name):
         log("Creating pool '{}' (erasure_profile={})"
             .format(pool.name, erasure_profile), level=INFO)
         pool.create()
+        _pool_created(pool_name)
 
     # Set a quota if requested
     if quota is not None:
@@ -422,7 +963,7 @@ def handle_replicated_pool(request, service):
     pg_num = request.get('pg_num')
     if pg_num:
         # Cap pg_num to max allowed just in case.
-        osds = get_osds(service)
+        osds = _get_osds(service)
         if osds:
             pg_num = min(pg_num, (len(osds) * 100 // replicas))
 
@@ -449,10 +990,11 @@ def handle_replicated_pool(request, service):
 
     pool = ReplicatedPool(service=service,
                           name=pool_name, **kwargs)
-    if not pool_exists(service=service, name=pool_name):
+    if not _pool_exists(service=service, name=pool_name):
         log("Creating pool '{}' (replicas={})".format(pool.name, replicas),
             level=INFO)
         pool.create()
+        _pool_created(pool_name)
     else:
         log("Pool '{}' already exists - skipping create".format(pool.name),
             level=DEBUG)
@@ -479,8 +1021,8 @@ def handle_create_cache_tier(request, service):
         cache_mode = "writeback"
 
     # cache and storage pool must exist first
-    if not pool_exists(service=service, name=storage_pool) or not pool_exists(
-            service=service, name=cache_pool):
+    if not _pool_exists(service=service, name=storage_pool) or \
+            not _pool_exists(service=service, name=cache_pool):
         msg = ("cold-pool: {} and hot-pool: {} must exist. Please create "
                "them first".format(storage_pool, cache_pool))
         log(msg, level=ERROR)
@@ -500,8 +1042,8 @@ def handle_remove_cache_tier(request, service):
     storage_pool = request.get('cold-pool')
     cache_pool = request.get('hot-pool')
     # cache and storage pool must exist first
-    if not pool_exists(service=service, name=storage_pool) or not pool_exists(
-            service=service, name=cache_pool):
+    if not _pool_exists(service=service, name=storage_pool) or \
+            not _pool_exists(service=service, name=cache_pool):
         msg = ("cold-pool: {} or hot-pool: {} doesn't exist. Not "
                "deleting cache tier".format(storage_pool, cache_pool))
         log(msg, level=ERROR)
@@ -638,21 +1180,23 @@ def handle_put_osd_in_bucket(request, service):
         msg = "Missing OSD ID or Bucket"
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
-    crushmap = Crushmap()
+    name = str(osd_id)
+    if not name.startswith('osd.'):
+        name = 'osd.{}'.format(name)
+    state = BrokerState.current()
     try:
-        crushmap.ensure_bucket_is_present(target_bucket)
-        check_output(
-            [
-                'ceph',
-                '--id', service,
-                'osd',
-                'crush',
-                'set',
-                str(osd_id),
-                str(get_osd_weight(osd_id)),
-                "root={}".format(target_bucket)
-            ]
-        )
+        if state is None:
+            crushmap = Crushmap()
+            crushmap.begin()
+        else:
+            crushmap = state.crushmap()
+        weight = crushmap.item_weight(name)
+        if weight is None:
+            weight = get_osd_weight(name)
+        crushmap.queue_add_bucket(target_bucket)
+        crushmap.queue_move_item(name, target_bucket, weight)
+        if state is None:
+            crushmap.commit()
 
     except Exception as exc:
         msg = "Failed to move OSD " \
@@ -717,11 +1261,11 @@ def handle_create_cephfs(request, service):
         return {'exit-code': 1, 'stderr': msg}
 
     # Sanity check that the required pools exist
-    if not pool_exists(service=service, name=data_pool):
+    if not _pool_exists(service=service, name=data_pool):
         msg = "CephFS data pool does not exist.  Cannot create CephFS"
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
-    if not pool_exists(service=service, name=metadata_pool):
+    if not _pool_exists(service=service, name=metadata_pool):
         msg = "CephFS metadata pool does not exist.  Cannot create CephFS"
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
@@ -784,78 +1328,322 @@ def handle_rgw_region_set(request, service):
     os.unlink(infile.name)
 
 
+def handle_create_pool(request, service):
+    """Create a new pool, replicated unless an erasure pool is requested.
+
+    :param request: dict of request operations and params.
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and reason if not 0.
+    """
+    pool_type = request.get('pool-type')  # "replicated" | "erasure"
+
+    # Default to replicated if pool_type isn't given
+    if pool_type == 'erasure':
+        return handle_erasure_pool(request=request, service=service)
+    return handle_replicated_pool(request=request, service=service)
+
+
+def handle_delete_pool(request, service):
+    """Delete a pool.
+
+    :param request: dict of request operations and params.
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and reason if not 0.
+    """
+    pool = request.get('name')
+    ret = delete_pool(service=service, name=pool)
+    state = BrokerState.current()
+    if state is not None:
+        state.remove_pool(pool)
+    return ret
+
+
+def handle_rename_pool(request, service):
+    """Rename a pool.
+
+    :param request: dict of request operations and params.
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and reason if not 0.
+    """
+    old_name = request.get('name')
+    new_name = request.get('new-name')
+    ret = rename_pool(service=service, old_name=old_name, new_name=new_name)
+    state = BrokerState.current()
+    if state is not None:
+        state.remove_pool(old_name)
+        state.add_pool(new_name)
+    return ret
+
+
+def handle_snapshot_pool(request, service):
+    """Snapshot a pool.
+
+    :param request: dict of request operations and params.
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and reason if not 0.
+    """
+    return snapshot_pool(service=service, pool_name=request.get('name'),
+                         snapshot_name=request.get('snapshot-name'))
+
+
+def handle_remove_pool_snapshot(request, service):
+    """Remove a snapshot of a pool.
+
+    :param request: dict of request operations and params.
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and reason if not 0.
+    """
+    return remove_pool_snapshot(service=service,
+                                pool_name=request.get('name'),
+                                snapshot_name=request.get('snapshot-name'))
+
+
+def op_resources(req):
+    """Return the cluster resources a broker op reads and writes.
+
+    Resources are named strings such as 'pool:glance' or 'group:images'.
+    Two ops conflict if one writes a resource that the other reads or
+    writes.
+
+    :param req: dict. The broker op
+    :returns: tuple of (reads, writes) sets
+    """
+    op = req.get('op')
+    reads = set()
+    writes = set()
+    if op == "create-pool":
+        writes.add('pool:{}'.format(req.get('name')))
+        if req.get('pool-type') == 'erasure':
+            reads.add('erasure-profile:{}'.format(
+                req.get('erasure-profile') or 'default-canonical'))
+        if req.get('group'):
+            writes.add('group:{}'.format(_namespaced_group(
+                req.get('group'), req.get('group-namespace'))))
+    elif op == "create-cephfs":
+        reads.add('pool:{}'.format(req.get('data_pool')))
+        reads.add('pool:{}'.format(req.get('metadata_pool')))
+        writes.add('cephfs')
+    elif op in ("create-cache-tier", "remove-cache-tier"):
+        writes.add('pool:{}'.format(req.get('cold-pool')))
+        writes.add('pool:{}'.format(req.get('hot-pool')))
+    elif op == "create-erasure-profile":
+        writes.add('erasure-profile:{}'.format(req.get('name')))
+    elif op == "rename-pool":
+        writes.add('pool:{}'.format(req.get('name')))
+        writes.add('pool:{}'.format(req.get('new-name')))
+    elif op in ("delete-pool", "snapshot-pool", "remove-pool-snapshot",
+                "set-pool-value"):
+        writes.add('pool:{}'.format(req.get('name')))
+    elif op in ("rgw-region-set", "rgw-zone-set", "rgw-regionmap-update",
+                "rgw-regionmap-default"):
+        writes.add('rgw')
+    elif op == "rgw-create-user":
+        reads.add('rgw')
+        writes.add('rgw-user:{}'.format(req.get('rgw-uid')))
+    elif op == "move-osd-to-bucket":
+        writes.add('crushmap')
+    elif op == "add-permissions-to-key":
+        writes.add('group:{}'.format(_namespaced_group(
+            req.get('group'), req.get('group-namespace'))))
+        writes.add('service:{}'.format(req.get('name')))
+    return reads, writes
+
+
+def _namespaced_group(group, namespace=None):
+    if namespace:
+        return "{}-{}".format(namespace, group)
+    return group
+
+
+def op_dependencies(reqs):
+    """Build the dependency graph of a list of broker ops.
+
+    An op depends on every earlier op it conflicts with (see op_resources),
+    so running the ops in any order which respects the graph gives the same
+    result as running them one after another.
+
+    :param reqs: list of broker ops
+    :returns: list. For each op, the set of indexes of the ops it depends on
+    """
+    resources = [op_resources(req) for req in reqs]
+    deps = []
+    for index, (reads, writes) in enumerate(resources):
+        parents = set()
+        for parent in range(index):
+            parent_reads, parent_writes = resources[parent]
+            if (writes & (parent_reads | parent_writes) or
+                    reads & parent_writes):
+                parents.add(parent)
+        deps.append(parents)
+    return deps
+
+
+def _is_error(ret):
+    return isinstance(ret, dict) and ret.get('exit-code', 0) != 0
+
+
+def dispatch_op(req, service):
+    """Run a single broker op.
+
+    :param req: dict. The broker op
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and reason if not 0
+    """
+    op = req.get('op')
+    log("Processing op='{}'".format(op), level=DEBUG)
+    if op == "create-pool":
+        return handle_create_pool(request=req, service=service)
+    elif op == "create-cephfs":
+        return handle_create_cephfs(request=req, service=service)
+    elif op == "create-cache-tier":
+        return handle_create_cache_tier(request=req, service=service)
+    elif op == "remove-cache-tier":
+        return handle_remove_cache_tier(request=req, service=service)
+    elif op == "create-erasure-profile":
+        return handle_create_erasure_profile(request=req, service=service)
+    elif op == "delete-pool":
+        return handle_delete_pool(request=req, service=service)
+    elif op == "rename-pool":
+        return handle_rename_pool(request=req, service=service)
+    elif op == "snapshot-pool":
+        return handle_snapshot_pool(request=req, service=service)
+    elif op == "remove-pool-snapshot":
+        return handle_remove_pool_snapshot(request=req, service=service)
+    elif op == "set-pool-value":
+        return handle_set_pool_value(request=req, service=service)
+    elif op == "rgw-region-set":
+        return handle_rgw_region_set(request=req, service=service)
+    elif op == "rgw-zone-set":
+        return handle_rgw_zone_set(request=req, service=service)
+    elif op == "rgw-regionmap-update":
+        return handle_rgw_regionmap_update(request=req, service=service)
+    elif op == "rgw-regionmap-default":
+        return handle_rgw_regionmap_default(request=req, service=service)
+    elif op == "rgw-create-user":
+        return handle_rgw_create_user(request=req, service=service)
+    elif op == "move-osd-to-bucket":
+        return handle_put_osd_in_bucket(request=req, service=service)
+    elif op == "add-permissions-to-key":
+        return handle_add_permissions_to_key(request=req, service=service)
+
+    msg = "Unknown operation '{}'".format(op)
+    log(msg, level=ERROR)
+    return {'exit-code': 1, 'stderr': msg}
+
+
+def run_ops(reqs, service, state, max_workers=MAX_BROKER_WORKERS):
+    """Run broker ops concurrently, respecting their dependencies.
+
+    Independent ops run on a pool of at most max_workers threads. Once an op
+    fails no ops after it are started, though ops which are already running
+    are allowed to finish. Ops before it are still run, as they would have
+    been had the ops run one at a time.
+
+    :param reqs: list of broker ops
+    :param service: The ceph client to run the commands under.
+    :param state: BrokerState. The state shared by the ops
+    :param max_workers: int. The maximum number of ops to run at once
+    :returns: dict. The result of each op which ran, keyed by index
+    :raises: the exception raised by the earliest op which failed
+    """
+    deps = op_dependencies(reqs)
+    results = {}
+    if max_workers <= 1 or len(reqs) <= 1:
+        for index, req in enumerate(reqs):
+            results[index] = dispatch_op(req, service)
+            if _is_error(results[index]):
+                break
+        return results
+
+    waiting = [len(parents) for parents in deps]
+    dependents = collections.defaultdict(list)
+    for index, parents in enumerate(deps):
+        for parent in parents:
+            dependents[parent].append(index)
+    ready = [index for index, count in enumerate(waiting) if count == 0]
+    errors = {}
+    running = [0]
+    done = threading.Condition()
+
+    def run(index):
+        state.activate()
+        ret = exc = None
+        try:
+            ret = dispatch_op(reqs[index], service)
+        except Exception as e:
+            exc = e
+        finally:
+            state.deactivate()
+        with done:
+            running[0] -= 1
+            results[index] = ret
+            if exc is not None or _is_error(ret):
+                errors[index] = exc
+            for child in dependents[index]:
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    ready.append(child)
+            done.notify()
+
+    pool = ThreadPool(processes=min(max_workers, len(reqs)))
+    try:
+        with done:
+            while True:
+                # Ops are only ever ready once the earlier ops they
+                # depend on have run, so any op before the first failure
+                # still gets its turn
+                limit = min(errors) if errors else len(reqs)
+                for index in sorted(ready):
+                    if index < limit:
+                        running[0] += 1
+                        pool.apply_async(run, (index,))
+                del ready[:]
+                if not running[0]:
+                    break
+                done.wait()
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors and errors[min(errors)] is not None:
+        raise errors[min(errors)]
+    return results
+
+
 def process_requests_v1(reqs):
     """Process v1 requests.
 
     Takes a list of requests (dicts) and processes each one. If an error is
     found, processing stops and the client is notified in the response.
 
+    The cluster state the ops need is read once up front into a BrokerState,
+    and the config-key and key capability changes they make are written in
+    one batch once the ops have run. Ops which do not depend on each other
+    are run concurrently.
+
     Returns a response dict containing the exit code (non-zero if any
     operation failed along with an explanation).
     """
-    ret = None
     log("Processing {} ceph broker requests".format(len(reqs)), level=INFO)
-    for req in reqs:
-        op = req.get('op')
-        log("Processing op='{}'".format(op), level=DEBUG)
-        # Use admin client since we do not have other client key locations
-        # setup to use them for these operations.
-        svc = 'admin'
-        if op == "create-pool":
-            pool_type = req.get('pool-type')  # "replicated" | "erasure"
-
-            # Default to replicated if pool_type isn't given
-            if pool_type == 'erasure':
-                ret = handle_erasure_pool(request=req, service=svc)
-            else:
-                ret = handle_replicated_pool(request=req, service=svc)
-        elif op == "create-cephfs":
-            ret = handle_create_cephfs(request=req, service=svc)
-        elif op == "create-cache-tier":
-            ret = handle_create_cache_tier(request=req, service=svc)
-        elif op == "remove-cache-tier":
-            ret = handle_remove_cache_tier(request=req, service=svc)
-        elif op == "create-erasure-profile":
-            ret = handle_create_erasure_profile(request=req, service=svc)
-        elif op == "delete-pool":
-            pool = req.get('name')
-            ret = delete_pool(service=svc, name=pool)
-        elif op == "rename-pool":
-            old_name = req.get('name')
-            new_name = req.get('new-name')
-            ret = rename_pool(service=svc, old_name=old_name,
-                              new_name=new_name)
-        elif op == "snapshot-pool":
-            pool = req.get('name')
-            snapshot_name = req.get('snapshot-name')
-            ret = snapshot_pool(service=svc, pool_name=pool,
-                                snapshot_name=snapshot_name)
-        elif op == "remove-pool-snapshot":
-            pool = req.get('name')
-            snapshot_name = req.get('snapshot-name')
-            ret = remove_pool_snapshot(service=svc, pool_name=pool,
-                                       snapshot_name=snapshot_name)
-        elif op == "set-pool-value":
-            ret = handle_set_pool_value(request=req, service=svc)
-        elif op == "rgw-region-set":
-            ret = handle_rgw_region_set(request=req, service=svc)
-        elif op == "rgw-zone-set":
-            ret = handle_rgw_zone_set(request=req, service=svc)
-        elif op == "rgw-regionmap-update":
-            ret = handle_rgw_regionmap_update(request=req, service=svc)
-        elif op == "rgw-regionmap-default":
-            ret = handle_rgw_regionmap_default(request=req, service=svc)
-        elif op == "rgw-create-user":
-            ret = handle_rgw_create_user(request=req, service=svc)
-        elif op == "move-osd-to-bucket":
-            ret = handle_put_osd_in_bucket(request=req, service=svc)
-        elif op == "add-permissions-to-key":
-            ret = handle_add_permissions_to_key(request=req, service=svc)
-        else:
-            msg = "Unknown operation '{}'".format(op)
-            log(msg, level=ERROR)
-            return {'exit-code': 1, 'stderr': msg}
-
+    # An unknown op ends the request, after the ops before it have run.
+    for index, req in enumerate(reqs):
+        if req.get('op') not in BROKER_OPS:
+            reqs = reqs[:index + 1]
+            break
+    # Use admin client since we do not have other client key locations
+    # setup to use them for these operations.
+    svc = 'admin'
+    with BrokerState(service=svc) as state:
+        state.plan(reqs)
+        results = run_ops(reqs, svc, state)
+
+    for index in sorted(results):
+        if _is_error(results[index]):
+            return results[index]
+    if state.crushmap_error:
+        return state.crushmap_error
+
+    ret = results.get(len(reqs) - 1)
     if type(ret) == dict and 'exit-code' in ret:
         return ret
 
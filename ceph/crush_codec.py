@@ -0,0 +1,659 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Encode and decode compiled CRUSH maps.
+
+This reads and writes the format of 'ceph osd getcrushmap' and
+'ceph osd setcrushmap' (CrushWrapper::encode), so that a CRUSH map can be
+inspected and extended without shelling out to crushtool.
+"""
+
+import collections
+import struct
+
+CRUSH_MAGIC = 0x00010000
+
+BUCKET_UNIFORM = 1
+BUCKET_LIST = 2
+BUCKET_TREE = 3
+BUCKET_STRAW = 4
+BUCKET_STRAW2 = 5
+
+BUCKET_ALGS = {
+    BUCKET_UNIFORM: 'uniform',
+    BUCKET_LIST: 'list',
+    BUCKET_TREE: 'tree',
+    BUCKET_STRAW: 'straw',
+    BUCKET_STRAW2: 'straw2',
+}
+
+HASHES = {0: 'rjenkins1'}
+
+RULE_TYPES = {1: 'replicated', 2: 'raid4', 3: 'erasure'}
+
+STEP_NOOP = 0
+STEP_TAKE = 1
+STEP_CHOOSE_FIRSTN = 2
+STEP_CHOOSE_INDEP = 3
+STEP_EMIT = 4
+STEP_CHOOSELEAF_FIRSTN = 6
+STEP_CHOOSELEAF_INDEP = 7
+
+# Steps which choose items of a type: op -> (verb, mode)
+CHOOSE_STEPS = {
+    STEP_CHOOSE_FIRSTN: ('choose', 'firstn'),
+    STEP_CHOOSE_INDEP: ('choose', 'indep'),
+    STEP_CHOOSELEAF_FIRSTN: ('chooseleaf', 'firstn'),
+    STEP_CHOOSELEAF_INDEP: ('chooseleaf', 'indep'),
+}
+
+# Steps which set a tunable for the rest of the rule
+SET_STEPS = {
+    8: 'set_choose_tries',
+    9: 'set_chooseleaf_tries',
+    10: 'set_choose_local_tries',
+    11: 'set_choose_local_fallback_tries',
+    12: 'set_chooseleaf_vary_r',
+    13: 'set_chooseleaf_stable',
+}
+
+# The tunables in the order they are encoded, with their struct format.
+# Each group is optional at the end of the map, for older encodings.
+TUNABLE_GROUPS = [
+    [('choose_local_tries', 'I'),
+     ('choose_local_fallback_tries', 'I'),
+     ('choose_total_tries', 'I')],
+    [('chooseleaf_descend_once', 'I')],
+    [('chooseleaf_vary_r', 'B')],
+    [('straw_calc_version', 'B')],
+    [('allowed_bucket_algs', 'I')],
+    [('chooseleaf_stable', 'B')],
+]
+
+# The values crushtool assumes for tunables, which it does not print
+LEGACY_TUNABLES = collections.OrderedDict([
+    ('choose_local_tries', 2),
+    ('choose_local_fallback_tries', 5),
+    ('choose_total_tries', 19),
+    ('chooseleaf_descend_once', 0),
+    ('chooseleaf_vary_r', 0),
+    ('chooseleaf_stable', 0),
+    ('straw_calc_version', 0),
+    ('allowed_bucket_algs', 22),
+])
+
+
+def to_fixed(weight):
+    """Convert a weight to the 16.16 fixed point CRUSH stores."""
+    return int(round(float(weight) * 0x10000))
+
+
+def from_fixed(value):
+    """Format a 16.16 fixed point weight as crushtool does."""
+    return "{:.3f}".format(value / float(0x10000))
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        fmt = '<' + fmt
+        try:
+            values = struct.unpack_from(fmt, self.data, self.offset)
+        except struct.error:
+            raise ValueError("Truncated CRUSH map at offset {}".format(
+                self.offset))
+        self.offset += struct.calcsize(fmt)
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    def array(self, fmt, count):
+        if not count:
+            return []
+        values = self.unpack('{}{}'.format(count, fmt))
+        return list(values) if count > 1 else [values]
+
+    def string(self):
+        length = self.unpack('I')
+        if self.offset + length > len(self.data):
+            raise ValueError("Truncated CRUSH map at offset {}".format(
+                self.offset))
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return value.decode('UTF-8')
+
+    def end(self):
+        return self.offset >= len(self.data)
+
+
+class _Writer(object):
+    def __init__(self):
+        self.parts = []
+
+    def pack(self, fmt, *values):
+        self.parts.append(struct.pack('<' + fmt, *values))
+
+    def array(self, fmt, values):
+        if values:
+            self.pack('{}{}'.format(len(values), fmt), *values)
+
+    def string(self, value):
+        value = value.encode('UTF-8')
+        self.pack('I', len(value))
+        self.parts.append(value)
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class BinaryBucket(object):
+    """A bucket of a compiled CRUSH map.
+
+    Weights are 16.16 fixed point. Only the weight lists which the
+    bucket algorithm encodes are used.
+
+    :param id: int. The bucket id, which is negative
+    :param type: int. The id of the bucket type
+    :param alg: int. One of BUCKET_ALGS
+    :param hash: int. The hash function
+    :param weight: int. The total weight of the items
+    :param items: list of int. The ids of the items in the bucket
+    """
+
+    def __init__(self, id, type, alg, hash=0, weight=0, items=None):
+        self.id = id
+        self.type = type
+        self.alg = alg
+        self.hash = hash
+        self.weight = weight
+        self.items = items or []
+        # uniform
+        self.item_weight = 0
+        # list, straw and straw2
+        self.item_weights = []
+        # list
+        self.sum_weights = []
+        # tree
+        self.node_weights = []
+        # straw
+        self.straws = []
+
+    def weight_of(self, index):
+        """Return the weight of the item at index."""
+        if self.alg == BUCKET_UNIFORM:
+            return self.item_weight
+        if self.alg == BUCKET_TREE:
+            return self.node_weights[((index + 1) << 1) - 1]
+        return self.item_weights[index]
+
+    @classmethod
+    def decode(cls, reader):
+        id, type, alg, hash, weight, size = reader.unpack('iHBBII')
+        bucket = cls(id, type, alg, hash, weight, reader.array('i', size))
+        if alg == BUCKET_UNIFORM:
+            bucket.item_weight = reader.unpack('I')
+        elif alg == BUCKET_LIST:
+            for _ in range(size):
+                item_weight, sum_weight = reader.unpack('II')
+                bucket.item_weights.append(item_weight)
+                bucket.sum_weights.append(sum_weight)
+        elif alg == BUCKET_TREE:
+            bucket.node_weights = reader.array('I', reader.unpack('B'))
+        elif alg == BUCKET_STRAW:
+            for _ in range(size):
+                item_weight, straw = reader.unpack('II')
+                bucket.item_weights.append(item_weight)
+                bucket.straws.append(straw)
+        elif alg == BUCKET_STRAW2:
+            bucket.item_weights = reader.array('I', size)
+        else:
+            raise ValueError("Unknown algorithm {} for bucket {}".format(
+                alg, id))
+        return bucket
+
+    def encode(self, writer):
+        writer.pack('iHBBII', self.id, self.type, self.alg, self.hash,
+                    self.weight, len(self.items))
+        writer.array('i', self.items)
+        if self.alg == BUCKET_UNIFORM:
+            writer.pack('I', self.item_weight)
+        elif self.alg == BUCKET_LIST:
+            for pair in zip(self.item_weights, self.sum_weights):
+                writer.pack('II', *pair)
+        elif self.alg == BUCKET_TREE:
+            writer.pack('B', len(self.node_weights))
+            writer.array('I', self.node_weights)
+        elif self.alg == BUCKET_STRAW:
+            for pair in zip(self.item_weights, self.straws):
+                writer.pack('II', *pair)
+        elif self.alg == BUCKET_STRAW2:
+            writer.array('I', self.item_weights)
+
+
+class BinaryRule(object):
+    """A rule of a compiled CRUSH map.
+
+    :param ruleset: int. The ruleset the rule belongs to
+    :param type: int. One of RULE_TYPES
+    :param min_size: int. The smallest pool size the rule applies to
+    :param max_size: int. The largest pool size the rule applies to
+    :param steps: list of (op, arg1, arg2) tuples
+    """
+
+    def __init__(self, ruleset, type, min_size, max_size, steps=None):
+        self.ruleset = ruleset
+        self.type = type
+        self.min_size = min_size
+        self.max_size = max_size
+        self.steps = steps or []
+
+    @classmethod
+    def decode(cls, reader):
+        length = reader.unpack('I')
+        rule = cls(*reader.unpack('BBBB'))
+        for _ in range(length):
+            rule.steps.append(reader.unpack('Iii'))
+        return rule
+
+    def encode(self, writer):
+        writer.pack('I', len(self.steps))
+        writer.pack('BBBB', self.ruleset, self.type, self.min_size,
+                    self.max_size)
+        for step in self.steps:
+            writer.pack('Iii', *step)
+
+
+class BinaryCrushmap(object):
+    """A compiled CRUSH map.
+
+    Everything which is decoded is encoded again unchanged, so that
+    decode(blob).encode() == blob. Sections which were missing from the
+    end of an older map are left out again when it is encoded.
+    """
+
+    def __init__(self):
+        self.max_devices = 0
+        self.buckets = []
+        self.rules = []
+        self.type_map = {}
+        self.name_map = {}
+        self.rule_name_map = {}
+        self.tunables = collections.OrderedDict()
+        self.class_map = None
+        self.class_name = None
+        self.class_bucket = None
+        self.choose_args = None
+
+    @classmethod
+    def decode(cls, data):
+        """Decode a compiled CRUSH map.
+
+        :param data: bytes. As written by 'ceph osd getcrushmap'
+        :returns: BinaryCrushmap
+        :raises: ValueError if data is not a valid CRUSH map
+        """
+        reader = _Reader(data)
+        crushmap = cls()
+        magic = reader.unpack('I')
+        if magic != CRUSH_MAGIC:
+            raise ValueError("Bad CRUSH map magic {:#x}".format(magic))
+        max_buckets, max_rules, crushmap.max_devices = reader.unpack('iIi')
+        for _ in range(max_buckets):
+            if reader.unpack('I'):
+                crushmap.buckets.append(BinaryBucket.decode(reader))
+            else:
+                crushmap.buckets.append(None)
+        for _ in range(max_rules):
+            if reader.unpack('I'):
+                crushmap.rules.append(BinaryRule.decode(reader))
+            else:
+                crushmap.rules.append(None)
+        crushmap.type_map = cls._decode_names(reader)
+        crushmap.name_map = cls._decode_names(reader)
+        crushmap.rule_name_map = cls._decode_names(reader)
+        for group in TUNABLE_GROUPS:
+            if reader.end():
+                break
+            for name, fmt in group:
+                crushmap.tunables[name] = reader.unpack(fmt)
+        if not reader.end():
+            crushmap.class_map = dict(
+                reader.unpack('ii') for _ in range(reader.unpack('I')))
+            crushmap.class_name = cls._decode_names(reader)
+            crushmap.class_bucket = {}
+            for _ in range(reader.unpack('I')):
+                bucket_id = reader.unpack('i')
+                crushmap.class_bucket[bucket_id] = dict(
+                    reader.unpack('ii') for _ in range(reader.unpack('I')))
+        if not reader.end():
+            crushmap.choose_args = cls._decode_choose_args(reader)
+        if not reader.end():
+            raise ValueError("Unexpected data at the end of the CRUSH map, "
+                             "offset {}".format(reader.offset))
+        return crushmap
+
+    @staticmethod
+    def _decode_names(reader):
+        return dict((reader.unpack('i'), reader.string())
+                    for _ in range(reader.unpack('I')))
+
+    @staticmethod
+    def _decode_choose_args(reader):
+        choose_args = []
+        for _ in range(reader.unpack('I')):
+            key = reader.unpack('q')
+            args = []
+            for _ in range(reader.unpack('I')):
+                index = reader.unpack('I')
+                weight_sets = []
+                for _ in range(reader.unpack('I')):
+                    weight_sets.append(reader.array('I', reader.unpack('I')))
+                ids = reader.array('i', reader.unpack('I'))
+                args.append((index, weight_sets, ids))
+            choose_args.append((key, args))
+        return choose_args
+
+    def encode(self):
+        """Encode the CRUSH map.
+
+        :returns: bytes. As read by 'ceph osd setcrushmap'
+        """
+        writer = _Writer()
+        writer.pack('IiIi', CRUSH_MAGIC, len(self.buckets), len(self.rules),
+                    self.max_devices)
+        for bucket in self.buckets:
+            if bucket is None:
+                writer.pack('I', 0)
+                continue
+            writer.pack('I', bucket.alg)
+            bucket.encode(writer)
+        for rule in self.rules:
+            writer.pack('I', 0 if rule is None else 1)
+            if rule is not None:
+                rule.encode(writer)
+        for names in [self.type_map, self.name_map, self.rule_name_map]:
+            self._encode_names(writer, names)
+        for group in TUNABLE_GROUPS:
+            if group[0][0] not in self.tunables:
+                break
+            for name, fmt in group:
+                writer.pack(fmt, self.tunables[name])
+        if self.class_map is not None:
+            writer.pack('I', len(self.class_map))
+            for device in sorted(self.class_map):
+                writer.pack('ii', device, self.class_map[device])
+            self._encode_names(writer, self.class_name)
+            writer.pack('I', len(self.class_bucket))
+            for bucket_id in sorted(self.class_bucket):
+                classes = self.class_bucket[bucket_id]
+                writer.pack('iI', bucket_id, len(classes))
+                for class_id in sorted(classes):
+                    writer.pack('ii', class_id, classes[class_id])
+        if self.choose_args is not None:
+            writer.pack('I', len(self.choose_args))
+            for key, args in self.choose_args:
+                writer.pack('qI', key, len(args))
+                for index, weight_sets, ids in args:
+                    writer.pack('II', index, len(weight_sets))
+                    for weights in weight_sets:
+                        writer.pack('I', len(weights))
+                        writer.array('I', weights)
+                    writer.pack('I', len(ids))
+                    writer.array('i', ids)
+        return writer.getvalue()
+
+    @staticmethod
+    def _encode_names(writer, names):
+        writer.pack('I', len(names))
+        for key in sorted(names):
+            writer.pack('i', key)
+            writer.string(names[key])
+
+    def bucket(self, id):
+        """Return the bucket with id, or None."""
+        index = -1 - id
+        if 0 <= index < len(self.buckets):
+            return self.buckets[index]
+        return None
+
+    def shadow_buckets(self):
+        """Return the ids of the per device class shadow buckets.
+
+        :returns: dict of shadow bucket id to (bucket id, class name)
+        """
+        shadows = {}
+        for bucket_id, classes in (self.class_bucket or {}).items():
+            for class_id, shadow_id in classes.items():
+                shadows[shadow_id] = (bucket_id,
+                                      self.class_name.get(class_id))
+        return shadows
+
+    def decompile(self):
+        """Return the CRUSH map as the text 'crushtool -d' writes.
+
+        :returns: str
+        """
+        lines = ['# begin crush map']
+        for name, default in LEGACY_TUNABLES.items():
+            value = self.tunables.get(name, default)
+            if value != default:
+                lines.append('tunable {} {}'.format(name, value))
+
+        lines.extend(['', '# devices'])
+        classes = self.class_map or {}
+        for device in range(self.max_devices):
+            if device not in self.name_map:
+                continue
+            line = 'device {} {}'.format(device, self.name_map[device])
+            if device in classes:
+                line = '{} class {}'.format(
+                    line, self.class_name[classes[device]])
+            lines.append(line)
+
+        lines.extend(['', '# types'])
+        for type_id in sorted(self.type_map):
+            lines.append('type {} {}'.format(type_id, self.type_map[type_id]))
+
+        lines.extend(['', '# buckets'])
+        shadows = self.shadow_buckets()
+        done = set()
+        for index in range(len(self.buckets)):
+            self._decompile_bucket(-1 - index, shadows, done, lines)
+
+        lines.extend(['', '# rules'])
+        for index, rule in enumerate(self.rules):
+            if rule is not None:
+                self._decompile_rule(index, rule, shadows, lines)
+
+        if self.choose_args:
+            lines.extend(['', '# choose_args'])
+            for key, args in self.choose_args:
+                self._decompile_choose_args(key, args, lines)
+
+        lines.extend(['', '# end crush map', ''])
+        return '\n'.join(lines)
+
+    def _decompile_bucket(self, bucket_id, shadows, done, lines):
+        bucket = self.bucket(bucket_id)
+        if bucket is None or bucket_id in done or bucket_id in shadows:
+            return
+        done.add(bucket_id)
+        # Items are written before the buckets which contain them
+        for item in bucket.items:
+            if item < 0:
+                self._decompile_bucket(item, shadows, done, lines)
+        lines.append('{} {} {{'.format(self.type_map.get(bucket.type),
+                                       self.name_map.get(bucket_id)))
+        lines.append('\tid {}\t\t# do not change unnecessarily'.format(
+            bucket_id))
+        classes = (self.class_bucket or {}).get(bucket_id, {})
+        for class_id in sorted(classes):
+            lines.append('\tid {} class {}\t\t# do not change '
+                         'unnecessarily'.format(classes[class_id],
+                                                self.class_name[class_id]))
+        lines.append('\t# weight {}'.format(from_fixed(bucket.weight)))
+        lines.append('\talg {}'.format(BUCKET_ALGS[bucket.alg]))
+        hash_name = HASHES.get(bucket.hash)
+        if hash_name:
+            lines.append('\thash {}\t# {}'.format(bucket.hash, hash_name))
+        else:
+            lines.append('\thash {}'.format(bucket.hash))
+        for index, item in enumerate(bucket.items):
+            lines.append('\titem {} weight {}'.format(
+                self.name_map.get(item), from_fixed(bucket.weight_of(index))))
+        lines.append('}')
+
+    def _decompile_rule(self, index, rule, shadows, lines):
+        lines.append('rule {} {{'.format(
+            self.rule_name_map.get(index, 'rule{}'.format(index))))
+        # Luminous, which introduced device classes, made the ruleset the
+        # rule id.
+        if self.class_map is not None:
+            lines.append('\tid {}'.format(index))
+        else:
+            lines.append('\truleset {}'.format(rule.ruleset))
+        lines.append('\ttype {}'.format(
+            RULE_TYPES.get(rule.type, rule.type)))
+        lines.append('\tmin_size {}'.format(rule.min_size))
+        lines.append('\tmax_size {}'.format(rule.max_size))
+        for op, arg1, arg2 in rule.steps:
+            lines.append('\tstep {}'.format(
+                self._decompile_step(op, arg1, arg2, shadows)))
+        lines.append('}')
+
+    def _decompile_step(self, op, arg1, arg2, shadows):
+        if op == STEP_TAKE:
+            if arg1 in shadows:
+                bucket_id, class_name = shadows[arg1]
+                return 'take {} class {}'.format(self.name_map[bucket_id],
+                                                 class_name)
+            return 'take {}'.format(self.name_map.get(arg1, arg1))
+        if op in CHOOSE_STEPS:
+            verb, mode = CHOOSE_STEPS[op]
+            return '{} {} {} type {}'.format(verb, mode, arg1,
+                                             self.type_map.get(arg2, arg2))
+        if op == STEP_EMIT:
+            return 'emit'
+        if op in SET_STEPS:
+            return '{} {}'.format(SET_STEPS[op], arg1)
+        return 'noop'
+
+    def _decompile_choose_args(self, key, args, lines):
+        lines.append('choose_args {} {{'.format(key))
+        for index, weight_sets, ids in args:
+            lines.append('  {')
+            lines.append('    bucket_id {}'.format(-1 - index))
+            if weight_sets:
+                lines.append('    weight_set [')
+                for weights in weight_sets:
+                    lines.append('      [ {} ]'.format(' '.join(
+                        from_fixed(weight) for weight in weights)))
+                lines.append('    ]')
+            if ids:
+                lines.append('    ids [ {} ]'.format(
+                    ' '.join(str(item) for item in ids)))
+            lines.append('  }')
+        lines.append('}')
+
+    def _id_of(self, name, names):
+        for key, value in names.items():
+            if value == name:
+                return key
+        raise KeyError(name)
+
+    def add_bucket(self, name, type_name, id, alg='straw', hash=0,
+                   items=None):
+        """Add a bucket to the map.
+
+        Only empty buckets, and straw2 buckets, may be added: the other
+        algorithms derive per-item values which are left to crushtool.
+
+        :param name: str. The bucket name
+        :param type_name: str. The bucket type, Example: 'root'
+        :param id: int. The bucket id, which must be unused
+        :param alg: str. The bucket algorithm name
+        :param hash: int. The hash function
+        :param items: list of (name, weight) tuples, weights as floats
+        :raises: KeyError if a type or item name is unknown,
+                 NotImplementedError for items in other than straw2 buckets
+        """
+        algs = dict((value, key) for key, value in BUCKET_ALGS.items())
+        items = items or []
+        if items and algs[alg] != BUCKET_STRAW2:
+            raise NotImplementedError(
+                "Adding {} buckets with items requires crushtool".format(alg))
+        if self.bucket(id) is not None:
+            raise ValueError("Bucket id {} is in use".format(id))
+        bucket = BinaryBucket(id, self._id_of(type_name, self.type_map),
+                              algs[alg], hash)
+        for item_name, weight in items:
+            bucket.items.append(self._id_of(item_name, self.name_map))
+            bucket.item_weights.append(to_fixed(weight))
+        bucket.weight = sum(bucket.item_weights)
+        index = -1 - id
+        while len(self.buckets) <= index:
+            self.buckets.append(None)
+        self.buckets[index] = bucket
+        self.name_map[id] = name
+        return bucket
+
+    def add_rule(self, name, ruleset, type_name, min_size, max_size, steps):
+        """Add a rule to the map, in the first free rule slot.
+
+        :param name: str. The rule name
+        :param ruleset: int. The ruleset of the rule, or None to use the
+                        index of the rule as luminous requires
+        :param type_name: str. One of the names in RULE_TYPES
+        :param min_size: int. The smallest pool size the rule applies to
+        :param max_size: int. The largest pool size the rule applies to
+        :param steps: list of str. The steps as crushtool writes them,
+                      Example: ['take default', 'emit']
+        :returns: int. The index of the new rule
+        :raises: KeyError if a name in the steps is unknown,
+                 ValueError if a step can not be parsed
+        """
+        rule = BinaryRule(ruleset, self._id_of(type_name, RULE_TYPES),
+                          int(min_size), int(max_size),
+                          [self._compile_step(step) for step in steps])
+        if None in self.rules:
+            index = self.rules.index(None)
+            self.rules[index] = rule
+        else:
+            index = len(self.rules)
+            self.rules.append(rule)
+        if ruleset is None:
+            rule.ruleset = index
+        self.rule_name_map[index] = name
+        return index
+
+    def _compile_step(self, step):
+        words = step.split()
+        if words[0] == 'take' and len(words) == 2:
+            return (STEP_TAKE, self._id_of(words[1], self.name_map), 0)
+        if words[0] == 'emit':
+            return (STEP_EMIT, 0, 0)
+        if len(words) == 5 and words[3] == 'type':
+            for op, choose in CHOOSE_STEPS.items():
+                if choose == (words[0], words[1]):
+                    return (op, int(words[2]),
+                            self._id_of(words[4], self.type_map))
+        if len(words) == 2:
+            for op, name in SET_STEPS.items():
+                if name == words[0]:
+                    return (op, int(words[1]), 0)
+        raise ValueError("Unable to compile CRUSH rule step: {}".format(
+            step))
@@ -12,13 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import re
+import collections
 
-from subprocess import check_output, CalledProcessError
+from subprocess import CalledProcessError, Popen, PIPE
+from tempfile import NamedTemporaryFile
 
 from charmhelpers.core.hookenv import (
     log,
     ERROR,
+    WARNING,
+)
+
+from ceph.crush_codec import BinaryCrushmap
+from ceph.executor import (
+    CephCommand,
+    get_executor,
 )
 
 CRUSH_BUCKET = """root {name} {{
@@ -38,91 +46,725 @@ rule {name} {{
     step emit
 }}"""
 
-# This regular expression looks for a string like:
-# root NAME {
-# id NUMBER
-# so that we can extract NAME and ID from the crushmap
-CRUSHMAP_BUCKETS_RE = re.compile(r"root\s+(.+)\s+\{\s*id\s+(-?\d+)")
+# The keyword crushtool uses for the id of a rule, before and since luminous
+RULE_ID_KEYWORDS = ('ruleset', 'id')
+
+
+# How many times a queued transaction is retried when the CRUSH map is
+# changed by someone else while it is being committed
+CRUSHMAP_COMMIT_RETRIES = 3
+
+
+class CrushmapChanged(Exception):
+    """The CRUSH map in the cluster changed while it was being edited."""
+    pass
+
+
+def _strip_comment(line):
+    return line.split('#', 1)[0].strip()
+
+
+def format_weight(weight):
+    return "{:.5f}".format(float(weight))
+
+
+class CRUSHTunable(object):
+    """A 'tunable NAME VALUE' line of a CRUSH map."""
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def render(self):
+        return "tunable {} {}".format(self.name, self.value)
+
+
+class CRUSHDevice(object):
+    """A 'device ID NAME [class CLASS]' line of a CRUSH map."""
+
+    def __init__(self, id, name, device_class=None):
+        self.id = int(id)
+        self.name = name
+        self.device_class = device_class
+
+    def render(self):
+        line = "device {} {}".format(self.id, self.name)
+        if self.device_class:
+            line = "{} class {}".format(line, self.device_class)
+        return line
+
+
+class CRUSHType(object):
+    """A 'type ID NAME' line of a CRUSH map."""
+
+    def __init__(self, id, name):
+        self.id = int(id)
+        self.name = name
+
+    def render(self):
+        return "type {} {}".format(self.id, self.name)
+
+
+class CRUSHItem(object):
+    """An item of a bucket: a device or a bucket, with its weight.
+
+    The weight is kept as the text crushtool wrote, so that an unchanged
+    item is written back exactly as it was read.
+    """
+
+    def __init__(self, name, weight, pos=None):
+        self.name = name
+        self.weight = weight
+        self.pos = pos
+
+    def render(self):
+        line = "item {} weight {}".format(self.name, self.weight)
+        if self.pos is not None:
+            line = "{} pos {}".format(line, self.pos)
+        return line
+
+
+class CRUSHNode(object):
+    """A bucket of a CRUSH map, with the items it contains.
+
+    :param type_name: str. The bucket type, Example: 'host'
+    :param name: str. The bucket name
+    :param id: int. The bucket id, which is negative
+    :param alg: str. The bucket algorithm
+    :param hash: int. The hash function
+    :param items: list of CRUSHItem
+    :param class_ids: list of (class, id) tuples for the shadow buckets
+                      crushtool keeps for each device class
+    """
+
+    def __init__(self, type_name, name, id, alg='straw', hash=0, items=None,
+                 class_ids=None):
+        self.type_name = type_name
+        self.name = name
+        self.id = int(id)
+        self.alg = alg
+        self.hash = int(hash)
+        self.items = items or []
+        self.class_ids = class_ids or []
+
+    def ids(self):
+        """Return the bucket id and the ids of its shadow buckets."""
+        return [self.id] + [class_id for _, class_id in self.class_ids]
+
+    def weight(self):
+        return sum(float(item.weight) for item in self.items)
+
+    def render(self):
+        lines = ["{} {} {{".format(self.type_name, self.name),
+                 "    id {}    # do not change unnecessarily".format(self.id)]
+        for device_class, class_id in self.class_ids:
+            lines.append("    id {} class {}    # do not change "
+                         "unnecessarily".format(class_id, device_class))
+        lines.append("    # weight {:.3f}".format(self.weight()))
+        lines.append("    alg {}".format(self.alg))
+        if self.hash == 0:
+            lines.append("    hash 0  # rjenkins1")
+        else:
+            lines.append("    hash {}".format(self.hash))
+        for item in self.items:
+            lines.append("    {}".format(item.render()))
+        lines.append("}")
+        return '\n'.join(lines)
+
+
+class CRUSHRule(object):
+    """A rule of a CRUSH map.
+
+    :param name: str. The rule name
+    :param id: int. The rule id (the ruleset before luminous)
+    :param settings: list of (key, value) tuples, Example:
+                     [('type', 'replicated'), ('min_size', '1')]
+    :param steps: list of str, Example: ['take default', 'emit']
+    :param id_keyword: str. 'ruleset' or 'id', as crushtool wrote it
+    """
+
+    def __init__(self, name, id, settings=None, steps=None,
+                 id_keyword='ruleset'):
+        self.name = name
+        self.id = int(id)
+        self.settings = settings or []
+        self.steps = steps or []
+        self.id_keyword = id_keyword
+
+    def render(self):
+        lines = ["rule {} {{".format(self.name),
+                 "    {} {}".format(self.id_keyword, self.id)]
+        for key, value in self.settings:
+            lines.append("    {} {}".format(key, value))
+        for step in self.steps:
+            lines.append("    step {}".format(step))
+        lines.append("}")
+        return '\n'.join(lines)
+
+
+class CRUSHBlock(object):
+    """A section of a CRUSH map which is kept as text, like choose_args."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def render(self):
+        return self.text
+
+
+class CRUSHTree(object):
+    """A decompiled CRUSH map parsed into devices, types, buckets and rules.
+
+    Everything is indexed by name and by id. Each part of the map remembers
+    where it was in the text it was parsed from, and render() writes back
+    the original text for the parts which were not changed, so that only
+    the changed sections are rewritten.
+    """
+
+    def __init__(self, text=''):
+        self.text = text
+        self.tunables = collections.OrderedDict()
+        self.devices = collections.OrderedDict()
+        self.devices_by_id = {}
+        self.types = collections.OrderedDict()
+        self.types_by_id = {}
+        self.buckets = collections.OrderedDict()
+        self.buckets_by_id = {}
+        self.rules = collections.OrderedDict()
+        self.rules_by_id = {}
+        self.parents = {}
+        self._spans = {}
+        self._order = []
+        self._dirty = set()
+        self._new = []
+        self._min_id = 0
+
+    @classmethod
+    def parse(cls, text):
+        """Parse the text written by 'crushtool -d'.
 
-# This regular expression looks for ID strings in the crushmap like:
-# id NUMBER
-# so that we can extract the IDs from a crushmap
-CRUSHMAP_ID_RE = re.compile(r"id\s+(-?\d+)")
+        :param text: str. The decompiled CRUSH map
+        :returns: CRUSHTree
+        :raises: ValueError if the text is not a CRUSH map
+        """
+        tree = cls(text)
+        offset = 0
+        lines = text.split('\n')
+        index = 0
+        while index < len(lines):
+            start = offset
+            line = lines[index]
+            words = _strip_comment(line).split()
+            offset += len(line) + 1
+            index += 1
+            if not words:
+                continue
+            if words[-1] == '{':
+                depth = 1
+                body = []
+                while depth and index < len(lines):
+                    line = lines[index]
+                    offset += len(line) + 1
+                    index += 1
+                    depth += line.count('{') - line.count('}')
+                    if depth:
+                        body.append(line)
+                if depth:
+                    raise ValueError("Unterminated block '{}' in CRUSH "
+                                     "map".format(' '.join(words)))
+                end = offset - 1
+                part = tree._parse_block(words, body, text[start:end])
+            else:
+                end = start + len(line)
+                part = tree._parse_line(words)
+            tree._add(part, start, end)
+        return tree
+
+    def _parse_line(self, words):
+        if words[0] == 'tunable' and len(words) == 3:
+            return CRUSHTunable(words[1], words[2])
+        if words[0] == 'device' and len(words) in (3, 5):
+            return CRUSHDevice(words[1], words[2],
+                               words[4] if len(words) == 5 else None)
+        if words[0] == 'type' and len(words) == 3:
+            return CRUSHType(words[1], words[2])
+        raise ValueError("Unable to parse CRUSH map line: {}".format(
+            ' '.join(words)))
+
+    def _parse_block(self, words, body, text):
+        if words[0] == 'rule' and len(words) == 3:
+            return self._parse_rule(words[1], body)
+        if words[0] in self.types and len(words) == 3:
+            return self._parse_bucket(words[0], words[1], body)
+        return CRUSHBlock(text)
+
+    def _parse_bucket(self, type_name, name, body):
+        bucket = CRUSHNode(type_name, name, 0)
+        for line in body:
+            words = _strip_comment(line).split()
+            if not words:
+                continue
+            if words[0] == 'id' and len(words) == 2:
+                bucket.id = int(words[1])
+            elif words[0] == 'id' and len(words) == 4:
+                bucket.class_ids.append((words[3], int(words[1])))
+            elif words[0] == 'alg':
+                bucket.alg = words[1]
+            elif words[0] == 'hash':
+                bucket.hash = int(words[1])
+            elif words[0] == 'item' and words[2] == 'weight':
+                bucket.items.append(CRUSHItem(
+                    words[1], words[3], words[5] if len(words) > 5 else None))
+            else:
+                raise ValueError("Unable to parse line of bucket {}: "
+                                 "{}".format(name, line.strip()))
+        return bucket
+
+    def _parse_rule(self, name, body):
+        rule = CRUSHRule(name, 0)
+        for line in body:
+            words = _strip_comment(line).split()
+            if not words:
+                continue
+            if words[0] in RULE_ID_KEYWORDS:
+                rule.id = int(words[1])
+                rule.id_keyword = words[0]
+            elif words[0] == 'step':
+                rule.steps.append(' '.join(words[1:]))
+            else:
+                rule.settings.append((words[0], ' '.join(words[1:])))
+        return rule
+
+    def _add(self, part, start=None, end=None):
+        """Index a part of the map; parts without a span are new."""
+        if isinstance(part, CRUSHTunable):
+            self.tunables[part.name] = part
+        elif isinstance(part, CRUSHDevice):
+            self.devices[part.name] = part
+            self.devices_by_id[part.id] = part
+        elif isinstance(part, CRUSHType):
+            self.types[part.name] = part
+            self.types_by_id[part.id] = part
+        elif isinstance(part, CRUSHNode):
+            self.buckets[part.name] = part
+            for bucket_id in part.ids():
+                self.buckets_by_id[bucket_id] = part
+                self._min_id = min(self._min_id, bucket_id)
+            for item in part.items:
+                self.parents[item.name] = part.name
+        elif isinstance(part, CRUSHRule):
+            self.rules[part.name] = part
+            self.rules_by_id[part.id] = part
+        if start is None:
+            self._new.append(part)
+        else:
+            self._spans[id(part)] = (start, end)
+            self._order.append(part)
+
+    def next_bucket_id(self):
+        """Return the id to give a new bucket."""
+        return self._min_id - 1
+
+    def bucket_ids(self):
+        """Return the ids of all buckets, including shadow buckets."""
+        return list(self.buckets_by_id)
+
+    def roots(self):
+        """Return the buckets which are not an item of another bucket."""
+        return [bucket for bucket in self.buckets.values()
+                if bucket.name not in self.parents]
+
+    def is_new(self, part):
+        return id(part) not in self._spans
+
+    def item_weight(self, name):
+        """Return the weight of a device or bucket in its parent bucket.
+
+        :returns: float or None if the item is not in a bucket
+        """
+        parent = self.parents.get(name)
+        if parent is None:
+            return None
+        return float(self._item(self.buckets[parent], name).weight)
+
+    def _item(self, bucket, name):
+        for item in bucket.items:
+            if item.name == name:
+                return item
+        raise KeyError(name)
+
+    def _propagate(self, bucket_name):
+        """Update the weight of a bucket in each of its ancestors."""
+        while bucket_name in self.parents:
+            parent = self.buckets[self.parents[bucket_name]]
+            self._item(parent, bucket_name).weight = format_weight(
+                self.buckets[bucket_name].weight())
+            self.changed(parent)
+            bucket_name = parent.name
+
+    def set_item_weight(self, name, weight):
+        """Set the weight of an item in its bucket and in its ancestors.
+
+        :raises: KeyError if the item is not in a bucket
+        """
+        bucket = self.buckets[self.parents[name]]
+        self._item(bucket, name).weight = format_weight(weight)
+        self.changed(bucket)
+        self._propagate(bucket.name)
+
+    def move_item(self, name, bucket_name, weight):
+        """Move a device or bucket into a bucket.
+
+        The weights of the buckets it leaves and joins, and of their
+        ancestors, are updated.
+
+        :param name: str. The device or bucket to move
+        :param bucket_name: str. The bucket to move it into
+        :param weight: float. The weight of the item in its new bucket
+        :raises: KeyError if the item or bucket do not exist,
+                 ValueError if a bucket would be moved into itself
+        """
+        if name not in self.devices and name not in self.buckets:
+            raise KeyError(name)
+        target = self.buckets[bucket_name]
+        if self.parents.get(name) == bucket_name:
+            self.set_item_weight(name, weight)
+            return
+        ancestor = bucket_name
+        while ancestor is not None:
+            if ancestor == name:
+                raise ValueError("Unable to move bucket {} into its own "
+                                 "descendant {}".format(name, bucket_name))
+            ancestor = self.parents.get(ancestor)
+        old = self.parents.get(name)
+        if old is not None:
+            bucket = self.buckets[old]
+            bucket.items.remove(self._item(bucket, name))
+            self.changed(bucket)
+            self._propagate(old)
+        target.items.append(CRUSHItem(name, format_weight(weight)))
+        self.parents[name] = bucket_name
+        self.changed(target)
+        self._propagate(bucket_name)
+
+    def add(self, part):
+        """Add a new part to the map, to be written after the existing map.
+
+        :param part: CRUSHNode or CRUSHRule
+        """
+        self._add(part)
+
+    def changed(self, part):
+        """Mark a part of the map as changed so that it is rewritten."""
+        if not self.is_new(part):
+            self._dirty.add(id(part))
+
+    def modified(self):
+        """Return True if any part of the parsed map was changed."""
+        return bool(self._dirty)
+
+    def new_parts(self):
+        """Return the parts added to the map, in the order they were added."""
+        return list(self._new)
+
+    def _anchor(self, part):
+        """Return where a new part has to be written, or None to append it.
+
+        crushtool resolves names as it reads them, so new devices are
+        written after the existing devices and a new bucket is written
+        before the first existing bucket which (through other new buckets)
+        contains it.
+
+        :returns: (offset, text) to insert or None
+        """
+        if isinstance(part, CRUSHDevice):
+            devices = [existing for existing in self._order
+                       if isinstance(existing, CRUSHDevice)]
+            if devices:
+                end = self._spans[id(devices[-1])][1]
+                return end, '\n' + part.render()
+        elif isinstance(part, CRUSHNode):
+            name = part.name
+            while name in self.parents:
+                parent = self.buckets[self.parents[name]]
+                if not self.is_new(parent):
+                    start = self._spans[id(parent)][0]
+                    return start, part.render() + '\n'
+                name = parent.name
+        return None
+
+    def render(self):
+        """Return the CRUSH map as text.
+
+        Parts which did not change are copied from the parsed text.
+
+        :returns: str
+        """
+        edits = []
+        appended = []
+        for part in self._order:
+            if id(part) in self._dirty:
+                start, end = self._spans[id(part)]
+                edits.append((start, end, part.render()))
+        for part in self._new:
+            anchor = self._anchor(part)
+            if anchor is None:
+                appended.append(part.render())
+            else:
+                offset, text = anchor
+                edits.append((offset, offset, text))
+        # Inserts at the start of a changed part sort before it
+        edits.sort(key=lambda edit: (edit[0], edit[1]))
+        pieces = []
+        position = 0
+        for start, end, text in edits:
+            pieces.append(self.text[position:start])
+            pieces.append(text)
+            position = end
+        pieces.append(self.text[position:])
+        for text in appended:
+            pieces.append('\n\n')
+            pieces.append(text)
+        return ''.join(pieces)
 
 
 class Crushmap(object):
-    """An object oriented approach to Ceph crushmap management."""
+    """An object oriented approach to Ceph crushmap management.
+
+    Changes can be made one at a time, with ensure_bucket_is_present, or
+    queued in a transaction and saved together:
+
+        crushmap.begin()
+        crushmap.queue_add_bucket('fast')
+        crushmap.queue_move_item('osd.1', 'fast', 1.0)
+        crushmap.commit()
+
+    A transaction is saved with a single setcrushmap. If the CRUSH map in
+    the cluster changed since it was loaded, it is loaded again and the
+    queued changes are applied to it before retrying.
+    """
 
     def __init__(self):
-        self._crushmap = self.load_crushmap()
-        roots = re.findall(CRUSHMAP_BUCKETS_RE, self._crushmap)
-        buckets = []
-        ids = list(map(
-            lambda x: int(x),
-            re.findall(CRUSHMAP_ID_RE, self._crushmap)))
-        ids = sorted(ids)
-        if roots != []:
-            for root in roots:
-                buckets.append(CRUSHBucket(root[0], root[1], True))
-
-        self._buckets = buckets
-        if ids != []:
-            self._ids = ids
-        else:
-            self._ids = [0]
+        self._loaded = None
+        self._compiled = None
+        self._queue = None
+        self._tree = CRUSHTree.parse(self.load_crushmap())
+
+    @property
+    def _ids(self):
+        return sorted(self._tree.bucket_ids()) or [0]
 
     def load_crushmap(self):
+        """Fetch the CRUSH map from the cluster and return it decompiled.
+
+        The map is decompiled by crushtool, as that text is what crushtool
+        compiles again when the map is modified. The compiled map is kept
+        so that additions to it can be encoded in Python, but only when
+        decoding and encoding it gives back the exact bytes the cluster
+        returned.
+        """
         try:
-            crush = str(check_output(['ceph', 'osd', 'getcrushmap'])
-                        .decode('UTF-8'))
-            return str(check_output(['crushtool', '-d', '-'],
-                                    stdin=crush.stdout)
-                       .decode('UTF-8'))
+            compiled = get_executor().check_output_raw(
+                CephCommand('osd getcrushmap'))
+            self._loaded = compiled
+            self._compiled = compiled if self._round_trips(compiled) else None
+            return self._crushtool(['-d', '/dev/stdin'],
+                                   compiled).decode('UTF-8')
         except CalledProcessError as e:
             log("Error occured while loading and decompiling CRUSH map:"
                 "{}".format(e), ERROR)
-            raise "Failed to read CRUSH map"
+            raise
+
+    @staticmethod
+    def _round_trips(compiled):
+        """Whether the Python codec reproduces a compiled map exactly."""
+        try:
+            if BinaryCrushmap.decode(compiled).encode() == compiled:
+                return True
+            log("CRUSH map does not round-trip through the Python codec, "
+                "changes will be compiled with crushtool", level=WARNING)
+        except (ValueError, NotImplementedError) as e:
+            log("Unable to decode CRUSH map, changes will be compiled with "
+                "crushtool: {}".format(e), level=WARNING)
+        return False
+
+    @staticmethod
+    def _crushtool(args, data):
+        """Run crushtool with data on stdin and return its output."""
+        cmd = ['crushtool'] + args
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE)
+        output, _ = process.communicate(data)
+        if process.returncode:
+            raise CalledProcessError(process.returncode, cmd, output=output)
+        return output
 
     def ensure_bucket_is_present(self, bucket_name):
-        if bucket_name not in [bucket.name for bucket in self.buckets()]:
+        if self.bucket(bucket_name) is None:
             self.add_bucket(bucket_name)
             self.save()
 
+    def bucket(self, name):
+        """Return the named bucket, or None if there is no such bucket.
+
+        :returns: CRUSHNode
+        """
+        return self._tree.buckets.get(name)
+
     def buckets(self):
-        """Return a list of buckets that are in the Crushmap."""
-        return self._buckets
+        """Return a list of root buckets that are in the Crushmap."""
+        return [CRUSHBucket(bucket.name, bucket.id,
+                            not self._tree.is_new(bucket))
+                for bucket in self._tree.roots()]
 
     def add_bucket(self, bucket_name):
-        """Add a named bucket to Ceph"""
-        new_id = min(self._ids) - 1
-        self._ids.append(new_id)
-        self._buckets.append(CRUSHBucket(bucket_name, new_id))
+        """Add a named root bucket, and a rule placing data in it"""
+        new_id = self._tree.next_bucket_id()
+        self._tree.add(CRUSHNode('root', bucket_name, new_id))
+        self._tree.add(CRUSHRule(
+            bucket_name, 0,
+            settings=[('type', 'replicated'),
+                      ('min_size', '1'),
+                      ('max_size', '10')],
+            steps=['take {}'.format(bucket_name),
+                   'chooseleaf firstn 0 type host',
+                   'emit']))
+
+    def item_weight(self, name):
+        """Return the CRUSH weight of a device or bucket, or None."""
+        return self._tree.item_weight(name)
+
+    def begin(self):
+        """Start queueing changes, to be saved together by commit()."""
+        self._queue = []
 
-    def save(self):
-        """Persist Crushmap to Ceph"""
+    def _queue_op(self, *op):
+        """Apply a change to the loaded map and remember it for a retry."""
+        if self._queue is None:
+            raise ValueError("No CRUSH map transaction was begun")
+        self._apply(*op)
+        self._queue.append(op)
+
+    # The queue_* changes are applied to the loaded map straight away, so
+    # that invalid changes are rejected when they are queued.
+
+    def queue_add_bucket(self, bucket_name):
+        """Queue adding a root bucket, if it is not present by then."""
+        self._queue_op('add-bucket', bucket_name)
+
+    def queue_move_item(self, name, bucket_name, weight):
+        """Queue moving a device or bucket into a bucket with a weight."""
+        self._queue_op('move-item', name, bucket_name, weight)
+
+    def queue_reweight(self, name, weight):
+        """Queue setting the weight of a device or bucket."""
+        self._queue_op('reweight', name, weight)
+
+    def abort(self):
+        """Discard the queued changes."""
+        self._queue = None
+
+    def _apply(self, op, *args):
+        if op == 'add-bucket':
+            if self.bucket(args[0]) is None:
+                self.add_bucket(args[0])
+        elif op == 'move-item':
+            self._tree.move_item(*args)
+        elif op == 'reweight':
+            self._tree.set_item_weight(*args)
+
+    def commit(self, retries=CRUSHMAP_COMMIT_RETRIES):
+        """Save the queued changes with one setcrushmap.
+
+        :returns: str. The output of setcrushmap, or None if there were no
+                  changes to save
+        :raises: KeyError or ValueError if a queued change no longer
+                 applies to a reloaded map, CrushmapChanged if the CRUSH map
+                 kept changing, CalledProcessError if it can not be saved
+        """
+        queue = self._queue or []
+        self._queue = None
+        attempt = 0
+        while True:
+            if not self._tree.modified() and not self._tree.new_parts():
+                return None
+            try:
+                return self.save(check_unchanged=True)
+            except CrushmapChanged:
+                attempt += 1
+                if attempt >= retries:
+                    raise
+                log("CRUSH map changed while it was being edited, "
+                    "applying {} changes to it again".format(len(queue)),
+                    level=WARNING)
+                self._loaded = None
+                self._compiled = None
+                self._tree = CRUSHTree.parse(self.load_crushmap())
+                for op in queue:
+                    self._apply(*op)
+
+    def save(self, check_unchanged=False):
+        """Persist Crushmap to Ceph
+
+        :param check_unchanged: bool. Raise CrushmapChanged instead of
+                                saving if the CRUSH map in the cluster is not
+                                the one which was loaded.
+        """
         try:
-            crushmap = self.build_crushmap()
-            compiled = str(check_output(['crushtool', '-c', '/dev/stdin', '-o',
-                                         '/dev/stdout'], stdin=crushmap)
-                           .decode('UTF-8'))
-            ceph_output = str(check_output(['ceph', 'osd', 'setcrushmap', '-i',
-                                            '/dev/stdin'], stdin=compiled)
-                              .decode('UTF-8'))
-            return ceph_output
+            if check_unchanged and self._loaded is not None:
+                current = get_executor().check_output_raw(
+                    CephCommand('osd getcrushmap'))
+                if current != self._loaded:
+                    raise CrushmapChanged()
+            with NamedTemporaryFile() as compiled:
+                compiled.write(self.compile_crushmap())
+                compiled.flush()
+                return get_executor().check_output(
+                    CephCommand('osd setcrushmap', infile=compiled.name))
         except CalledProcessError as e:
             log("save error: {}".format(e))
-            raise "Failed to save CRUSH map."
+            raise
+
+    def compile_crushmap(self):
+        """Return the compiled CRUSH map, including the changes made to it.
+
+        When buckets and rules were only added, they are encoded into the
+        map read from the cluster. Other changes are compiled by crushtool.
+
+        :returns: bytes
+        """
+        if self._compiled is not None and not self._tree.modified():
+            try:
+                return self._encode_additions()
+            except (KeyError, ValueError, NotImplementedError) as e:
+                log("Unable to encode CRUSH map changes, compiling with "
+                    "crushtool: {}".format(e), level=WARNING)
+        return self._crushtool(['-c', '/dev/stdin', '-o', '/dev/stdout'],
+                               self.build_crushmap().encode('UTF-8'))
+
+    def _encode_additions(self):
+        crushmap = BinaryCrushmap.decode(self._compiled)
+        for part in self._tree.new_parts():
+            if isinstance(part, CRUSHNode):
+                crushmap.add_bucket(
+                    part.name, part.type_name, part.id, part.alg, part.hash,
+                    [(item.name, item.weight) for item in part.items])
+            elif isinstance(part, CRUSHRule):
+                settings = dict(part.settings)
+                # Since luminous the ruleset of a rule is its index
+                ruleset = part.id if crushmap.class_map is None else None
+                crushmap.add_rule(part.name, ruleset,
+                                  settings.get('type', 'replicated'),
+                                  settings.get('min_size', 1),
+                                  settings.get('max_size', 10),
+                                  part.steps)
+            else:
+                raise NotImplementedError(
+                    "Unable to encode {}".format(part.render()))
+        return crushmap.encode()
 
     def build_crushmap(self):
-        """Modifies the current CRUSH map to include the new buckets"""
-        tmp_crushmap = self._crushmap
-        for bucket in self._buckets:
-            if not bucket.default:
-                tmp_crushmap = "{}\n\n{}".format(
-                    tmp_crushmap,
-                    Crushmap.bucket_string(bucket.name, bucket.id))
-
-        return tmp_crushmap
+        """Render the CRUSH map, including the changes made to it"""
+        return self._tree.render()
 
     @staticmethod
     def bucket_string(name, id):
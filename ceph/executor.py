@@ -0,0 +1,489 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import base64
+import json
+import os
+import subprocess
+import threading
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    WARNING,
+)
+
+try:
+    import rados
+except ImportError:
+    rados = None
+
+CEPH_CONF = '/etc/ceph/ceph.conf'
+# The interpreter running the persistent ceph shell; the ceph CLI uses it
+# too, so it has the rados bindings even where the charm's python does not
+SHELL_PYTHON = '/usr/bin/python3'
+SHELL_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'mon_shell.py')
+
+
+class CephCommand(object):
+    """A single ceph cluster command.
+
+    The command is described once and can be rendered either as the argv of
+    the ceph (or rados) CLI or as a JSON mon_command, so that any executor
+    is able to run it.
+
+    :param prefix: str. The command words, Example: 'osd tree'
+    :param args: list of (name, value) tuples. Named command arguments in the
+                 order the CLI expects them as positional arguments. List
+                 values are expanded into several CLI arguments.
+    :param mon_args: dict. Overrides for args when rendered as a mon_command,
+                     for arguments that need a different type in JSON.
+    :param service: str. The cephx id to run the command as (--id)
+    :param name: str. The full cephx name to run the command as (--name)
+    :param keyring: str. Path to the keyring to authenticate with
+    :param user: str. The local user to run the CLI as, through sudo
+    :param fmt: str. The output format to request, Example: 'json'
+    :param binary: str. The CLI binary the command belongs to
+    :param infile: str. A file whose content is the input of the command
+                   (-i), Example: a compiled CRUSH map for setcrushmap
+    """
+
+    def __init__(self, prefix, args=None, mon_args=None, service=None,
+                 name=None, keyring=None, user=None, fmt=None,
+                 binary='ceph', infile=None):
+        self.prefix = prefix
+        self.args = args or []
+        self.mon_args = mon_args or {}
+        self.service = service
+        self.name = name
+        self.keyring = keyring
+        self.user = user
+        self.fmt = fmt
+        self.binary = binary
+        self.infile = infile
+
+    def argv(self):
+        """Render the command as a CLI invocation.
+
+        :returns: list. The argv to pass to subprocess
+        """
+        cmd = []
+        if self.user:
+            cmd.extend(['sudo', '-u', self.user])
+        cmd.append(self.binary)
+        if self.service:
+            cmd.extend(['--id', self.service])
+        if self.name:
+            cmd.extend(['--name', self.name])
+        if self.keyring:
+            cmd.extend(['--keyring', self.keyring])
+        cmd.extend(self.prefix.split())
+        for _, value in self.args:
+            if isinstance(value, list):
+                cmd.extend(value)
+            else:
+                cmd.append(value)
+        if self.infile:
+            cmd.extend(['-i', self.infile])
+        if self.fmt:
+            cmd.append('--format={}'.format(self.fmt))
+        return cmd
+
+    def mon_command(self):
+        """Render the command as a monitor command.
+
+        :returns: dict. The command to JSON encode for mon_command
+        """
+        cmd = {'prefix': self.prefix}
+        cmd.update(self.args)
+        cmd.update(self.mon_args)
+        if self.fmt:
+            cmd['format'] = self.fmt
+        return cmd
+
+    def inbuf(self):
+        """Return the input of the command for mon_command.
+
+        :returns: bytes. The content of infile, or nothing
+        """
+        if not self.infile:
+            return b''
+        with open(self.infile, 'rb') as f:
+            return f.read()
+
+    def __repr__(self):
+        return "CephCommand {{{}}}".format(' '.join(
+            str(part) for part in self.argv()))
+
+
+class CommandExecutor(object):
+    """Runs CephCommands against the cluster.
+
+    Executors raise CalledProcessError for failed commands regardless of how
+    the command was run, so callers keep a single error handling path.
+    """
+
+    def check_output(self, command, stderr=None):
+        """Run a command and return its output.
+
+        :param command: CephCommand. The command to run
+        :param stderr: Pass subprocess.STDOUT to include the status message
+                       of the command in the returned output.
+        :returns: str. The output of the command
+        :raises: CalledProcessError if the command fails
+        """
+        raise NotImplementedError
+
+    def check_output_raw(self, command):
+        """Run a command and return its output undecoded.
+
+        :param command: CephCommand. The command to run, with binary output
+                        such as 'osd getcrushmap'
+        :returns: bytes. The output of the command
+        :raises: CalledProcessError if the command fails
+        """
+        raise NotImplementedError
+
+    def check_call(self, command):
+        """Run a command, discarding its output.
+
+        :param command: CephCommand. The command to run
+        :raises: CalledProcessError if the command fails
+        """
+        self.check_output(command)
+
+    def close(self):
+        """Release any resources held by the executor."""
+        pass
+
+
+class SubprocessExecutor(CommandExecutor):
+    """Runs each command by forking the CLI."""
+
+    def check_output(self, command, stderr=None):
+        kwargs = {}
+        if stderr is not None:
+            kwargs['stderr'] = stderr
+        return str(subprocess
+                   .check_output(command.argv(), **kwargs)
+                   .decode('UTF-8'))
+
+    def check_output_raw(self, command):
+        return subprocess.check_output(command.argv())
+
+    def check_call(self, command):
+        subprocess.check_call(command.argv())
+
+
+def _mon_output(command, ret, outbuf, outs, stderr):
+    """Return the output of a mon_command as the CLI would print it.
+
+    :raises: CalledProcessError if ret is an error
+    """
+    if ret != 0:
+        # Mirror the CLI, which exits with the positive errno
+        raise subprocess.CalledProcessError(-ret, command.argv(),
+                                            output=outs)
+    output = outbuf.decode('UTF-8')
+    if stderr == subprocess.STDOUT and outs:
+        output = output + outs
+    return output
+
+
+def _identity(conffile, command):
+    """Return the rados.Rados keyword arguments for the identity of command.
+    """
+    kwargs = {'conffile': conffile}
+    if command.keyring:
+        kwargs['conf'] = {'keyring': command.keyring}
+    if command.name:
+        kwargs['name'] = command.name
+    else:
+        kwargs['rados_id'] = command.service or 'admin'
+    return kwargs
+
+
+class RadosExecutor(CommandExecutor):
+    """Runs commands over long-lived librados connections.
+
+    A connection is opened for each cephx identity the first time it is
+    used and is shared by every later command, so a hook only pays for the
+    monitor handshake once. Commands that have no librados equivalent,
+    commands to be run as another local user, which librados can not do
+    within this process, and identities that fail to connect are handed to
+    the fallback executor.
+
+    :param conffile: str. The ceph configuration file to connect with
+    :param fallback: CommandExecutor. Defaults to a SubprocessExecutor
+    :param timeout: int. Seconds to wait on connect and on each command
+    """
+
+    def __init__(self, conffile=CEPH_CONF, fallback=None, timeout=30):
+        self.conffile = conffile
+        self.fallback = fallback or SubprocessExecutor()
+        self.timeout = timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, command):
+        """Return the connection for the identity of command.
+
+        :returns: rados.Rados or None if the command can not be run over
+                  librados
+        """
+        if command.user or (command.binary == 'rados' and
+                            command.prefix != 'lspools'):
+            return None
+        key = (command.service, command.name, command.keyring)
+        with self._lock:
+            if key in self._connections:
+                return self._connections[key]
+            try:
+                connection = rados.Rados(**_identity(self.conffile, command))
+                connection.connect(timeout=self.timeout)
+                log("Connected to the cluster as {}".format(
+                    command.name or command.service or 'admin'), level=DEBUG)
+            except rados.Error as e:
+                log("Unable to connect to the cluster as {}, falling back "
+                    "to the CLI. Error: {}".format(
+                        command.name or command.service or 'admin', e),
+                    level=WARNING)
+                connection = None
+            self._connections[key] = connection
+            return connection
+
+    def _run(self, connection, command):
+        if command.binary == 'rados':
+            return 0, ''.join('{}\n'.format(pool) for pool in
+                              connection.list_pools()).encode('UTF-8'), ''
+        return connection.mon_command(json.dumps(command.mon_command()),
+                                      command.inbuf(), timeout=self.timeout)
+
+    def check_output(self, command, stderr=None):
+        connection = self._connection(command)
+        if connection is None:
+            return self.fallback.check_output(command, stderr=stderr)
+        ret, outbuf, outs = self._run(connection, command)
+        return _mon_output(command, ret, outbuf, outs, stderr)
+
+    def check_output_raw(self, command):
+        connection = self._connection(command)
+        if connection is None:
+            return self.fallback.check_output_raw(command)
+        ret, outbuf, outs = self._run(connection, command)
+        _mon_output(command, ret, b'', outs, None)
+        return outbuf
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections.values():
+                if connection is not None:
+                    connection.shutdown()
+            self._connections = {}
+        self.fallback.close()
+
+
+class CephShellExecutor(CommandExecutor):
+    """Runs commands through persistent ceph shell processes.
+
+    This is for when the rados bindings can not be imported by the charm's
+    own interpreter. A shell (ceph/mon_shell.py) is started under the
+    system python, which the ceph CLI uses as well, once for each local
+    user commands are run as, and keeps a librados connection open for
+    each cephx identity, so a hook pays for starting an interpreter and
+    for each monitor handshake once rather than for every command. The
+    commands sent to one shell run one at a time. Commands that have no
+    librados equivalent, and users or identities whose shell fails, are
+    handed to the fallback executor.
+
+    :param conffile: str. The ceph configuration file to connect with
+    :param fallback: CommandExecutor. Defaults to a SubprocessExecutor
+    :param timeout: int. Seconds to wait on connect and on each command
+    :param python: str. The interpreter to run the shell with
+    """
+
+    def __init__(self, conffile=CEPH_CONF, fallback=None, timeout=30,
+                 python=SHELL_PYTHON):
+        self.conffile = conffile
+        self.fallback = fallback or SubprocessExecutor()
+        self.timeout = timeout
+        self.python = python
+        self._shells = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def _shell(self, user):
+        """Return the shell of a local user, starting it if needed.
+
+        :returns: subprocess.Popen or None if the shell failed
+        """
+        if user not in self._shells:
+            cmd = [self.python, SHELL_SCRIPT]
+            if user:
+                cmd = ['sudo', '-u', user] + cmd
+            try:
+                self._shells[user] = subprocess.Popen(
+                    cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            except OSError as e:
+                log("Unable to start a ceph shell, falling back to the "
+                    "CLI. Error: {}".format(e), level=WARNING)
+                self._shells[user] = None
+        return self._shells[user]
+
+    @staticmethod
+    def _stop(shell):
+        try:
+            shell.stdin.close()
+        except (IOError, OSError):
+            pass
+        if shell.poll() is None:
+            shell.kill()
+        shell.wait()
+
+    def _run(self, command):
+        """Run command in the shell of its user.
+
+        :returns: tuple (ret, outbuf, outs), or None if the command has to
+                  be handed to the fallback
+        """
+        if command.binary == 'rados' and command.prefix != 'lspools':
+            return None
+        key = (command.user, command.service, command.name, command.keyring)
+        request = {'identity': _identity(self.conffile, command),
+                   'command': json.dumps(command.mon_command()),
+                   'inbuf': base64.b64encode(command.inbuf()).decode('ascii'),
+                   'timeout': self.timeout,
+                   'lspools': command.binary == 'rados'}
+        with self._lock:
+            if key in self._failed:
+                return None
+            shell = self._shell(command.user)
+            if shell is None:
+                return None
+            try:
+                shell.stdin.write(
+                    (json.dumps(request) + '\n').encode('UTF-8'))
+                shell.stdin.flush()
+                response = json.loads(shell.stdout.readline().decode('UTF-8'))
+            except (IOError, OSError, ValueError) as e:
+                log("The ceph shell stopped, falling back to the CLI. "
+                    "Error: {}".format(e), level=WARNING)
+                self._stop(shell)
+                self._shells[command.user] = None
+                return None
+            if 'error' in response:
+                log("Unable to connect to the cluster as {}, falling back "
+                    "to the CLI. Error: {}".format(
+                        command.name or command.service or 'admin',
+                        response['error']), level=WARNING)
+                self._failed.add(key)
+                return None
+        return (response['ret'], base64.b64decode(response['outbuf']),
+                response['outs'])
+
+    def check_output(self, command, stderr=None):
+        result = self._run(command)
+        if result is None:
+            return self.fallback.check_output(command, stderr=stderr)
+        ret, outbuf, outs = result
+        return _mon_output(command, ret, outbuf, outs, stderr)
+
+    def check_output_raw(self, command):
+        result = self._run(command)
+        if result is None:
+            return self.fallback.check_output_raw(command)
+        ret, outbuf, outs = result
+        _mon_output(command, ret, b'', outs, None)
+        return outbuf
+
+    def close(self):
+        with self._lock:
+            for shell in self._shells.values():
+                if shell is not None:
+                    self._stop(shell)
+            self._shells = {}
+        self.fallback.close()
+
+
+class FakeExecutor(CommandExecutor):
+    """An executor for tests which records commands and replays responses.
+
+    :param responses: dict. Maps a command prefix to the output to return,
+                      or to an exception instance to raise.
+    """
+
+    def __init__(self, responses=None):
+        self.responses = dict(responses or {})
+        self.commands = []
+
+    def check_output(self, command, stderr=None):
+        self.commands.append(command)
+        response = self.responses.get(command.prefix, '')
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def check_output_raw(self, command):
+        response = self.check_output(command)
+        if isinstance(response, bytes):
+            return response
+        return response.encode('UTF-8')
+
+    def prefixes(self):
+        """Return the prefixes of the commands run so far, in order."""
+        return [command.prefix for command in self.commands]
+
+
+_executor = None
+
+
+def get_executor():
+    """Return the executor used to run ceph commands.
+
+    librados connections are used when the python bindings are installed,
+    otherwise persistent ceph shells. Commands to be run as another local
+    user go to a ceph shell for that user. The executor is closed when the
+    process exits.
+
+    :returns: CommandExecutor
+    """
+    global _executor
+    if _executor is None:
+        if rados is not None:
+            _executor = RadosExecutor(fallback=CephShellExecutor())
+        else:
+            _executor = CephShellExecutor()
+    return _executor
+
+
+def set_executor(executor):
+    """Replace the executor used to run ceph commands.
+
+    :param executor: CommandExecutor or None to restore the default
+    :returns: CommandExecutor. The previous executor, which is not closed
+    """
+    global _executor
+    previous = _executor
+    _executor = executor
+    return previous
+
+
+def _close_executor():
+    if _executor is not None:
+        _executor.close()
+
+
+atexit.register(_close_executor)
@@ -0,0 +1,104 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent ceph shell for CephShellExecutor.
+
+The shell reads one JSON request per line from stdin and writes one JSON
+response per line to stdout, keeping a librados connection open for each
+cephx identity it is asked to use. It is run on its own by the system
+python, which the ceph CLI uses as well, so it only depends on the
+standard library and the rados bindings.
+
+A request has the 'identity' to connect as (the keyword arguments of
+rados.Rados), the mon 'command' as a JSON string, the base64 encoded
+'inbuf', a 'timeout' in seconds and 'lspools' to list the pools instead.
+A response has the 'ret', the base64 encoded 'outbuf' and the 'outs' of
+the command, or an 'error' if the identity could not connect.
+"""
+
+import base64
+import errno
+import json
+import sys
+
+
+def handle(rados, connections, request):
+    """Run one request, connecting as its identity if not yet connected.
+
+    :param rados: The rados module
+    :param connections: dict of identity to rados.Rados, updated in place
+    :param request: dict. The decoded request
+    :returns: dict. The response
+    """
+    key = json.dumps(request['identity'], sort_keys=True)
+    connection = connections.get(key)
+    if connection is None:
+        try:
+            connection = rados.Rados(**dict(
+                (str(name), value)
+                for name, value in request['identity'].items()))
+            connection.connect(timeout=request['timeout'])
+        except rados.Error as e:
+            return {'error': str(e)}
+        connections[key] = connection
+    try:
+        if request.get('lspools'):
+            ret, outs = 0, ''
+            outbuf = ''.join('{}\n'.format(pool)
+                             for pool in connection.list_pools())
+            outbuf = outbuf.encode('UTF-8')
+        else:
+            ret, outbuf, outs = connection.mon_command(
+                request['command'], base64.b64decode(request['inbuf']),
+                timeout=request['timeout'])
+    except rados.Error as e:
+        code = getattr(e, 'errno', None) or errno.EIO
+        ret, outbuf, outs = -code, b'', str(e)
+    return {'ret': ret, 'outbuf': base64.b64encode(outbuf).decode('ascii'),
+            'outs': outs}
+
+
+def serve(rados, stdin, stdout):
+    """Answer requests from stdin on stdout until stdin is closed.
+
+    :param rados: The rados module
+    :param stdin: binary file to read requests from
+    :param stdout: binary file to write responses to
+    """
+    connections = {}
+    try:
+        for line in iter(stdin.readline, b''):
+            response = handle(rados, connections, json.loads(
+                line.decode('UTF-8')))
+            stdout.write((json.dumps(response) + '\n').encode('UTF-8'))
+            stdout.flush()
+    finally:
+        for connection in connections.values():
+            connection.shutdown()
+
+
+def main():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        import rados
+    except ImportError as e:
+        stdout.write((json.dumps({'error': str(e)}) + '\n').encode('UTF-8'))
+        stdout.flush()
+        sys.exit(1)
+    serve(rados, stdin, stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,18 +15,30 @@
 import collections
 import ctypes
 import errno
+import grp
 import json
+import math
 import os
+import pwd
 import pyudev
 import random
 import re
 import socket
+import stat
 import subprocess
 import sys
+import threading
 import time
 import shutil
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 has no os.scandir, fall back to os.listdir and os.lstat
+    scandir = None
 
 from charmhelpers.core import hookenv
 from charmhelpers.core import templating
@@ -74,9 +86,17 @@ from charmhelpers.contrib.openstack.utils import (
     get_os_codename_install_source,
 )
 
+from ceph.executor import (
+    CephCommand,
+    get_executor,
+)
+
 CEPH_BASE_DIR = os.path.join(os.sep, 'var', 'lib', 'ceph')
 OSD_BASE_DIR = os.path.join(CEPH_BASE_DIR, 'osd')
 HDPARM_FILE = os.path.join(os.sep, 'etc', 'hdparm.conf')
+UDEV_TUNING_RULES = os.path.join(os.sep, 'etc', 'udev', 'rules.d',
+                                 '60-ceph-osd-tuning.rules')
+SYS_CLASS_BLOCK = os.path.join(os.sep, 'sys', 'class', 'block')
 
 LEADER = 'leader'
 PEON = 'peon'
@@ -90,7 +110,9 @@ LinkSpeed = {
     "BASE_100": 100,
     "BASE_1000": 1000,
     "GBASE_10": 10000,
+    "GBASE_25": 25000,
     "GBASE_40": 40000,
+    "GBASE_50": 50000,
     "GBASE_100": 100000,
     "UNKNOWN": None
 }
@@ -123,7 +145,80 @@ NETWORK_ADAPTER_SYSCTLS = {
         'net.ipv4.tcp_wmem': '4096 65536 4194304',
         'net.ipv4.tcp_low_latency': 1,
         'net.ipv4.tcp_adv_win_scale': 1
-    }
+    },
+    # 25Gb
+    LinkSpeed["GBASE_25"]: {
+        'net.core.netdev_max_backlog': 250000,
+        'net.core.rmem_max': 67108864,
+        'net.core.wmem_max': 67108864,
+        'net.core.rmem_default': 524287,
+        'net.core.wmem_default': 524287,
+        'net.core.optmem_max': 524287,
+        'net.ipv4.tcp_rmem': '4096 87380 33554432',
+        'net.ipv4.tcp_wmem': '4096 65536 33554432',
+    },
+    # 50Gb
+    LinkSpeed["GBASE_50"]: {
+        'net.core.netdev_max_backlog': 250000,
+        'net.core.rmem_max': 134217728,
+        'net.core.wmem_max': 134217728,
+        'net.core.rmem_default': 524287,
+        'net.core.wmem_default': 524287,
+        'net.core.optmem_max': 524287,
+        'net.ipv4.tcp_rmem': '4096 87380 67108864',
+        'net.ipv4.tcp_wmem': '4096 65536 67108864',
+    },
+    # 100Gb
+    LinkSpeed["GBASE_100"]: {
+        'net.core.netdev_max_backlog': 300000,
+        'net.core.rmem_max': 268435456,
+        'net.core.wmem_max': 268435456,
+        'net.core.rmem_default': 1048576,
+        'net.core.wmem_default': 1048576,
+        'net.core.optmem_max': 1048576,
+        'net.ipv4.tcp_rmem': '4096 87380 134217728',
+        'net.ipv4.tcp_wmem': '4096 65536 134217728',
+    },
+}
+
+SYS_CLASS_NET = os.path.join(os.sep, 'sys', 'class', 'net')
+SYS_DEVICES_SYSTEM = os.path.join(os.sep, 'sys', 'devices', 'system')
+PROC_DIR = os.path.join(os.sep, 'proc')
+SYSCTL_DIR = os.path.join(PROC_DIR, 'sys')
+SYSCTL_CONF_DIR = os.path.join(os.sep, 'etc', 'sysctl.d')
+UDEV_NIC_RULES = os.path.join(os.sep, 'etc', 'udev', 'rules.d',
+                              '60-ceph-osd-nic-tuning.rules')
+
+# NIC tuning by link speed class.  'rings' of 'max' grows the rings to the
+# hardware maximum; 'coalesce' and 'offloads' are ethtool -C and -K
+# settings; 'rps' spreads receive processing over the local CPUs when the
+# NIC has fewer receive queues than them; 'xps' and 'irq_affinity' give
+# each transmit queue and interrupt a local CPU of its own.
+_NIC_DEFAULT_PROFILE = {
+    'rings': 'max',
+    'coalesce': collections.OrderedDict([('adaptive-rx', 'on'),
+                                         ('adaptive-tx', 'on')]),
+    'offloads': collections.OrderedDict([('gro', 'on'), ('lro', 'off'),
+                                         ('tso', 'on')]),
+    'rps': True,
+    'xps': True,
+    'irq_affinity': True,
+}
+NIC_TUNING_PROFILES = {
+    LinkSpeed["BASE_1000"]: dict(_NIC_DEFAULT_PROFILE, coalesce={
+        'adaptive-rx': 'on'}),
+    LinkSpeed["GBASE_10"]: _NIC_DEFAULT_PROFILE,
+    LinkSpeed["GBASE_25"]: _NIC_DEFAULT_PROFILE,
+    LinkSpeed["GBASE_40"]: _NIC_DEFAULT_PROFILE,
+    LinkSpeed["GBASE_50"]: _NIC_DEFAULT_PROFILE,
+    LinkSpeed["GBASE_100"]: _NIC_DEFAULT_PROFILE,
+}
+
+# The ethtool -k names of the offloads in NIC_TUNING_PROFILES
+NIC_OFFLOAD_FEATURES = {
+    'gro': 'generic-receive-offload',
+    'lro': 'large-receive-offload',
+    'tso': 'tcp-segmentation-offload',
 }
 
 
@@ -163,8 +258,395 @@ class Partition(object):
         return not self.__eq__(other)
 
 
-def unmounted_disks():
-    """List of unmounted block devices on the current host."""
+def _lsblk_value(value):
+    """Normalises an lsblk JSON value; older lsblk reports only strings."""
+    if value in ('', None):
+        return None
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+def _human_size(nbytes):
+    """Formats a size in bytes the way partx does, Example: 1.5G"""
+    size = float(nbytes)
+    for unit in 'BKMGTPE':
+        if size < 1024 or unit == 'E':
+            break
+        size /= 1024
+    return '{:.1f}'.format(size).replace('.0', '') + unit
+
+
+def _lsblk_json(devices=None):
+    """Runs lsblk for devices, or all devices, and returns its entries."""
+    out = subprocess.check_output(
+        ['lsblk', '--json', '--output-all', '--bytes', '--paths'] +
+        list(devices or []))
+    return json.loads(out.decode('UTF-8')).get('blockdevices', [])
+
+
+def _udev_block_devices():
+    """Lists (device node, udev properties, parent device node) for every
+    device of the block subsystem."""
+    devices = []
+    context = pyudev.Context()
+    for device in context.list_devices(subsystem='block'):
+        properties = dict(getattr(device, 'properties', device))
+        parent = device.parent
+        devices.append((device.device_node, properties,
+                        parent.device_node if parent else None))
+    return devices
+
+
+def _proc_mounts():
+    """Returns a dict of mounted device, symlinks resolved, to its mount
+    point."""
+    mounts = {}
+    with open('/proc/mounts', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 1 and fields[0].startswith('/dev/'):
+                mounts.setdefault(os.path.realpath(fields[0]), fields[1])
+    return mounts
+
+
+def _without_mountpoints(entry):
+    """Returns a copy of an lsblk entry without its mount points."""
+    copy = dict((key, value) for key, value in entry.items()
+                if key not in ('mountpoint', 'mountpoints', 'children'))
+    if entry.get('children'):
+        copy['children'] = [_without_mountpoints(child)
+                            for child in entry['children']]
+    return copy
+
+
+def _block_holders(node):
+    """Lists the devices stacked on node, such as dm-crypt, from sysfs."""
+    name = os.path.basename(node)
+    try:
+        return sorted(os.listdir(
+            os.path.join(SYS_CLASS_BLOCK, name, 'holders')))
+    except OSError:
+        return []
+
+
+def write_json_atomically(path, data, what):
+    """Writes data as JSON to path through a temporary file and a rename,
+    creating the directory if needed, so readers never see a partial file.
+
+    State files are only an optimisation, so a failure is logged rather
+    than raised.
+
+    :param path: str. The file to write
+    :param data: The data to write
+    :param what: str. What the file holds, for the log
+    :returns: bool. True if the file was written
+    """
+    tmp = path + '.tmp'
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as err:
+        log('Unable to write {} {}: {}'.format(what, path, err), WARNING)
+        return False
+    return True
+
+
+# Where BlockInventory.cached keeps the device inventory between hooks
+DEVICE_INVENTORY_CACHE = '/var/cache/ceph-devices/inventory.json'
+
+
+class BlockInventory(object):
+    """A picture of the host's block devices taken in one pass.
+
+    The picture comes from a single ``lsblk --json`` call and a single
+    udev enumeration and answers the same questions as unmounted_disks,
+    is_osd_disk, get_partition_list, get_partitions, get_block_uuid and
+    is_device_mounted, without running a command per device or per
+    partition.  It is not updated as devices change, so scan again after
+    partitioning.
+
+    Each device is a dict with its 'type' ('disk', 'part', ...), 'size'
+    in bytes, 'rotational', 'uuid', 'parttype', 'partuuid', 'partlabel',
+    partition 'number', 'start' and 'sectors', 'mountpoints', 'children'
+    and 'partitions' (the device paths of partitions of a disk).
+
+    BlockInventory.cached() keeps the inventory between hooks and only
+    asks lsblk about disks whose udev properties changed.
+    """
+
+    def __init__(self, lsblk_devices, udev_devices, mounts=None):
+        """
+        :param lsblk_devices: list. The 'blockdevices' of ``lsblk --json
+                              --output-all --bytes --paths``
+        :param udev_devices: list of (device node, udev properties, parent
+                             device node) for the block subsystem
+        :param mounts: dict. Device to mount point from /proc/mounts (see
+                       _proc_mounts), added to what lsblk reported
+        """
+        self.devices = collections.OrderedDict()
+        self.udev = collections.OrderedDict()
+        self.changed = []
+        for node, properties, parent in udev_devices:
+            self.udev[node] = properties
+            device = self._device(node)
+            device['type'] = {'disk': 'disk', 'partition': 'part'}.get(
+                properties.get('DEVTYPE'), device['type'])
+            device['uuid'] = properties.get('ID_FS_UUID')
+            device['parttype'] = properties.get('ID_PART_ENTRY_TYPE')
+            device['partuuid'] = properties.get('ID_PART_ENTRY_UUID')
+            device['partlabel'] = properties.get('ID_PART_ENTRY_NAME')
+            device['number'] = properties.get('ID_PART_ENTRY_NUMBER')
+            device['start'] = properties.get('ID_PART_ENTRY_OFFSET')
+            device['sectors'] = properties.get('ID_PART_ENTRY_SIZE')
+            if device['sectors'] and device['sectors'].isdigit():
+                device['size'] = int(device['sectors']) * 512
+            if parent and device['type'] == 'part':
+                self._device(parent)['partitions'].append(node)
+                self._device(parent)['children'].append(node)
+        for entry in lsblk_devices:
+            self._add_lsblk(entry)
+        for node, device in self.devices.items():
+            mountpoint = (mounts or {}).get(os.path.realpath(node))
+            if mountpoint and mountpoint not in device['mountpoints']:
+                device['mountpoints'].append(mountpoint)
+
+    def _device(self, node):
+        if node not in self.devices:
+            self.devices[node] = {
+                'type': None, 'size': None, 'rotational': None,
+                'uuid': None, 'parttype': None, 'partuuid': None,
+                'partlabel': None, 'number': None, 'start': None,
+                'sectors': None, 'mountpoints': [], 'children': [],
+                'partitions': []}
+        return self.devices[node]
+
+    def _add_lsblk(self, entry):
+        node = entry.get('path') or entry['name']
+        device = self._device(node)
+        for key, column in (('type', 'type'), ('uuid', 'uuid'),
+                            ('parttype', 'parttype'),
+                            ('partuuid', 'partuuid'),
+                            ('partlabel', 'partlabel'),
+                            ('number', 'partn'), ('start', 'start'),
+                            ('rotational', 'rota')):
+            value = _lsblk_value(entry.get(column))
+            if value is not None:
+                device[key] = value
+        size = _lsblk_value(entry.get('size'))
+        if size and size.isdigit():
+            device['size'] = int(size)
+            if device['type'] == 'part':
+                device['sectors'] = str(device['size'] // 512)
+        mountpoints = entry.get('mountpoints') or [entry.get('mountpoint')]
+        for mountpoint in mountpoints:
+            if mountpoint and mountpoint not in device['mountpoints']:
+                device['mountpoints'].append(mountpoint)
+        for child in entry.get('children', []):
+            child_node = self._add_lsblk(child)
+            if child_node not in device['children']:
+                device['children'].append(child_node)
+            if (self.devices[child_node]['type'] == 'part' and
+                    child_node not in device['partitions']):
+                device['partitions'].append(child_node)
+        return node
+
+    @classmethod
+    def scan(cls):
+        """Takes an inventory of the host's block devices.
+
+        lsblk versions without JSON output leave the inventory to udev,
+        with mount state read from /proc/mounts.
+
+        :returns: BlockInventory
+        """
+        try:
+            lsblk_devices = _lsblk_json()
+            mounts = None
+        except (subprocess.CalledProcessError, OSError, ValueError) as err:
+            log('Unable to list block devices with lsblk: {}'.format(err),
+                level=WARNING)
+            lsblk_devices = []
+            mounts = _proc_mounts()
+        return cls(lsblk_devices, _udev_block_devices(), mounts)
+
+    @classmethod
+    def cached(cls, cache_file=DEVICE_INVENTORY_CACHE):
+        """Takes an inventory, reusing what cache_file knows.
+
+        Devices are grouped by disk: a disk with its partitions.  A group
+        is unchanged while the udev properties of all its devices are
+        unchanged; these carry the SEQNUM of the last event (where udev
+        records it), USEC_INITIALIZED and the partition table UUID, and
+        partitions appearing or going away change the group too, as do
+        devices stacked on it (the sysfs holders) and a change of the
+        sysfs size of any of its devices, such as a resized LUN.  lsblk
+        is only run for the disks of changed groups, and not at all when
+        nothing changed.  Mount state is not tracked by udev, so it is
+        always read afresh from /proc/mounts.
+
+        :param cache_file: str. Where the inventory is kept between hooks
+        :returns: BlockInventory. Its 'changed' attribute lists the disks
+                  which were looked at again
+        """
+        udev_devices = _udev_block_devices()
+        groups = collections.OrderedDict()
+        for node, properties, parent in udev_devices:
+            if properties.get('DEVTYPE') != 'partition' or not parent:
+                parent = node
+            group = groups.setdefault(parent, {'udev': {}, 'holders': {},
+                                               'sizes': {}})
+            group['udev'][node] = properties
+            group['holders'][node] = _block_holders(node)
+            group['sizes'][node] = _read_block_attr(node, 'size')
+
+        cache = {}
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache.get('version') != 1:
+                cache = {}
+        except (IOError, OSError, ValueError):
+            pass
+        cached_groups = cache.get('groups', {})
+
+        changed = [disk for disk, group in groups.items()
+                   if disk not in cached_groups or
+                   cached_groups[disk]['udev'] != group['udev'] or
+                   cached_groups[disk]['holders'] != group['holders'] or
+                   cached_groups[disk].get('sizes') != group['sizes']]
+        fresh = {}
+        if changed:
+            try:
+                for entry in _lsblk_json(changed):
+                    path = entry.get('path') or entry['name']
+                    fresh[os.path.realpath(path)] = entry
+            except (subprocess.CalledProcessError, OSError,
+                    ValueError) as err:
+                log('Unable to list block devices with lsblk: {}'.format(
+                    err), level=WARNING)
+                return cls.scan()
+
+        kept = collections.OrderedDict()
+        for disk, group in groups.items():
+            if disk in changed:
+                # Devices lsblk does not list, such as unused loop devices,
+                # are kept without an entry so they are not asked again
+                entry = fresh.get(os.path.realpath(disk))
+                group['lsblk'] = entry and _without_mountpoints(entry)
+                kept[disk] = group
+            else:
+                kept[disk] = cached_groups[disk]
+        write_json_atomically(cache_file, {'version': 1, 'groups': kept},
+                              'device inventory')
+
+        log('Device inventory: {} of {} disks changed'.format(
+            len(changed), len(groups)), level=DEBUG)
+        inventory = cls([group['lsblk'] for group in kept.values()
+                         if group['lsblk']],
+                        udev_devices, _proc_mounts())
+        inventory.changed = changed
+        return inventory
+
+    def device(self, dev):
+        """Returns the dict for dev, resolving symlinks, or None."""
+        return (self.devices.get(dev) or
+                self.devices.get(os.path.realpath(dev)))
+
+    def unmounted_disks(self):
+        """List of unmounted block devices on the current host."""
+        disks = []
+        for node, device in self.devices.items():
+            if device['type'] != 'disk':
+                continue
+            if any(block_type in node
+                   for block_type in [u'dm', u'loop', u'ram', u'nbd']):
+                continue
+            disks.append(node)
+        log("Found disks: {}".format(disks))
+        return [disk for disk in disks if not self.is_device_mounted(disk)]
+
+    def is_device_mounted(self, dev):
+        """Whether dev or anything on it is mounted."""
+        device = self.device(dev)
+        if not device:
+            return False
+        if device['mountpoints']:
+            return True
+        return any(self.is_device_mounted(child)
+                   for child in device['children'])
+
+    def _partition_columns(self, dev):
+        """The partx columns (NR START END SECTORS SIZE NAME UUID) of the
+        partitions of dev."""
+        device = self.device(dev)
+        if not device:
+            return []
+        columns = []
+        for node in device['partitions']:
+            part = self.devices[node]
+            number = part['number']
+            if not number:
+                number = re.search(r'(\d+)$', node).group(1)
+            start = part['start'] or '0'
+            sectors = part['sectors'] or '0'
+            columns.append((number, start,
+                            str(int(start) + int(sectors) - 1), sectors,
+                            _human_size(part['size'] or 0),
+                            (part['partlabel'] or '').replace(' ', '\\x20'),
+                            part['partuuid'] or ''))
+        return columns
+
+    def get_partition_list(self, dev):
+        """Lists the partitions of dev as Partition objects."""
+        return [Partition(number=number, start=start, end=end,
+                          sectors=sectors, size=size, name=name, uuid=uuid)
+                for number, start, end, sectors, size, name, uuid
+                in self._partition_columns(dev)]
+
+    def get_partitions(self, dev):
+        """Lists the partitions of dev in the form partx prints them."""
+        return [' '.join(columns) for columns in self._partition_columns(dev)]
+
+    def is_osd_disk(self, dev):
+        """Whether dev has a ceph data, journal or in-creation partition."""
+        device = self.device(dev)
+        if not device:
+            return False
+        ceph_types = set(ptype.upper() for ptype in CEPH_PARTITIONS)
+        return any((self.devices[node]['parttype'] or '').upper()
+                   in ceph_types for node in device['partitions'])
+
+    def get_block_uuid(self, dev):
+        """The filesystem UUID of dev or None."""
+        device = self.device(dev)
+        return device['uuid'] if device else None
+
+    def is_rotational(self, dev):
+        """Whether dev is rotational, or None if unknown."""
+        device = self.device(dev)
+        if not device or device['rotational'] is None:
+            return None
+        return device['rotational'] == '1'
+
+    def get_size(self, dev):
+        """The size of dev in bytes or None if unknown."""
+        device = self.device(dev)
+        return device['size'] if device else None
+
+
+def unmounted_disks(inventory=None):
+    """List of unmounted block devices on the current host.
+
+    :param inventory: BlockInventory. Answer from this inventory rather
+                      than asking udev and lsblk
+    """
+    if inventory is not None:
+        return inventory.unmounted_disks()
     disks = []
     context = pyudev.Context()
     for device in context.list_devices(DEVTYPE='disk'):
@@ -183,35 +665,86 @@ def unmounted_disks():
 def save_sysctls(sysctl_dict, save_location):
     """Persist the sysctls to the hard drive.
 
+    The file is only written when its contents change.
+
     :param sysctl_dict: dict
     :param save_location: path to save the settings to
+    :returns: bool. True if the file was written
     :raises: IOError if anything goes wrong with writing.
     """
+    content = ''.join("{}={}\n".format(key, sysctl_dict[key])
+                      for key in sorted(sysctl_dict))
+    try:
+        with open(save_location, "r") as fd:
+            if fd.read() == content:
+                return False
+    except IOError:
+        pass
     try:
         # Persist the settings for reboots
         with open(save_location, "w") as fd:
-            for key, value in sysctl_dict.items():
-                fd.write("{}={}\n".format(key, value))
-
+            fd.write(content)
     except IOError as e:
         log("Unable to persist sysctl settings to {}. Error {}".format(
             save_location, e), level=ERROR)
         raise
+    return True
+
+
+def _sysctl_value(value):
+    # /proc/sys separates the fields of values like tcp_rmem with tabs
+    return ' '.join(str(value).split())
+
+
+def get_sysctl(key):
+    """Reads the current value of a sysctl from /proc/sys.
+
+    :param key: str. The sysctl, such as net.core.rmem_max
+    :returns: str with its fields separated by single spaces, or None if
+              the kernel does not have it
+    """
+    value = _read_sys(os.path.join(SYSCTL_DIR, *key.split('.')))
+    if value is None:
+        return None
+    return _sysctl_value(value)
+
+
+def apply_sysctls(sysctl_dict):
+    """Sets the sysctls whose current value differs from sysctl_dict.
+
+    Unlike sysctl -p, sysctls which already have their value are not
+    written again.
+
+    :param sysctl_dict: dict of sysctl to value
+    :returns: list of (sysctl, old value, new value) which were changed
+    """
+    changes = []
+    for key in sorted(sysctl_dict):
+        value = _sysctl_value(sysctl_dict[key])
+        current = get_sysctl(key)
+        if current is None:
+            log("Sysctl {} is not supported by this kernel".format(key),
+                level=DEBUG)
+        elif current != value:
+            if _write_sys(os.path.join(SYSCTL_DIR, *key.split('.')), value):
+                changes.append((key, current, value))
+    return changes
 
 
 def tune_nic(network_interface):
-    """This will set optimal sysctls for the particular network adapter.
+    """This will set optimal sysctls for the particular network adapter
+    and tune its queues and interrupts (see tune_nic_queues).
 
     :param network_interface: string The network adapter name.
+    :returns: list of (setting, old value, new value) which were changed
     """
     speed = get_link_speed(network_interface)
+    changes = tune_nic_queues(network_interface, speed)
     if speed in NETWORK_ADAPTER_SYSCTLS:
         status_set('maintenance', 'Tuning device {}'.format(
             network_interface))
         sysctl_file = os.path.join(
-            os.sep,
-            'etc',
-            'sysctl.d',
+            SYSCTL_CONF_DIR,
             '51-ceph-osd-charm-{}.conf'.format(network_interface))
         try:
             log("Saving sysctl_file: {} values: {}".format(
@@ -224,17 +757,14 @@ def tune_nic(network_interface):
                 "failed. {}".format(network_interface, e),
                 level=ERROR)
 
-        try:
-            # Apply the settings
-            log("Applying sysctl settings", level=DEBUG)
-            subprocess.check_output(["sysctl", "-p", sysctl_file])
-        except subprocess.CalledProcessError as err:
-            log('sysctl -p {} failed with error {}'.format(sysctl_file,
-                                                           err.output),
-                level=ERROR)
+        # Apply the settings
+        for key, old, new in apply_sysctls(NETWORK_ADAPTER_SYSCTLS[speed]):
+            log("Changed sysctl {} from {} to {}".format(key, old, new))
+            changes.append((key, old, new))
     else:
         log("No settings found for network adapter: {}".format(
             network_interface), level=DEBUG)
+    return changes
 
 
 def get_link_speed(network_interface):
@@ -243,8 +773,7 @@ def get_link_speed(network_interface):
     :param network_interface: string The network adapter interface.
     :returns: LinkSpeed
     """
-    speed_path = os.path.join(os.sep, 'sys', 'class', 'net',
-                              network_interface, 'speed')
+    speed_path = os.path.join(SYS_CLASS_NET, network_interface, 'speed')
     # I'm not sure where else we'd check if this doesn't exist
     if not os.path.exists(speed_path):
         return LinkSpeed["UNKNOWN"]
@@ -261,15 +790,386 @@ def get_link_speed(network_interface):
             for name, speed in LinkSpeed.items():
                 if speed == int(nic_speed[0].strip()):
                     return speed
-            # Default to UNKNOWN if we can't find a match
-            return LinkSpeed["UNKNOWN"]
-    except IOError as e:
+            # Otherwise use the fastest class the link reaches, such as
+            # 20G for a bond of two 10G links
+            return get_speed_class(int(nic_speed[0].strip()))
+    except (IOError, ValueError) as e:
+        # Links which are down report an invalid speed
         log("Unable to open {path} because of error: {error}".format(
             path=speed_path,
             error=e), level='error')
         return LinkSpeed["UNKNOWN"]
 
 
+def get_speed_class(speed):
+    """Returns the fastest speed class a link speed reaches.
+
+    :param speed: int. The link speed in Mb/s
+    :returns: LinkSpeed. UNKNOWN for speeds slower than any class
+    """
+    classes = [cls for cls in NIC_TUNING_PROFILES if cls <= (speed or 0)]
+    if not classes:
+        return LinkSpeed["UNKNOWN"]
+    return max(classes)
+
+
+def _read_sys(path):
+    """Returns the stripped contents of a sysfs or procfs file, or None."""
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _write_sys(path, value):
+    """Writes a sysfs or procfs file.
+
+    :returns: bool. True if it was written
+    """
+    try:
+        with open(path, 'w') as f:
+            f.write(str(value))
+        return True
+    except IOError as e:
+        log('Failed to write {} to {}. Error: {}'.format(value, path, e),
+            level=ERROR)
+        return False
+
+
+def parse_cpu_list(cpu_list):
+    """Parses a kernel CPU list such as 0-3,8-11 into a sorted list."""
+    cpus = set()
+    for part in (cpu_list or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def cpu_mask(cpus):
+    """Formats CPUs as a kernel CPU mask, Example: 00000000,0000000f"""
+    value = 0
+    for cpu in cpus:
+        value |= 1 << cpu
+    digits = '{:x}'.format(value)
+    digits = digits.zfill(-(-len(digits) // 8) * 8)
+    return ','.join(digits[i:i + 8] for i in range(0, len(digits), 8))
+
+
+def _mask_value(mask):
+    return int((mask or '0').replace(',', '') or '0', 16)
+
+
+def get_osd_cpus():
+    """Returns the CPUs the running ceph-osd daemons may use."""
+    cpus = set()
+    try:
+        pids = [pid for pid in os.listdir(PROC_DIR) if pid.isdigit()]
+    except OSError:
+        return []
+    for pid in pids:
+        if _read_sys(os.path.join(PROC_DIR, pid, 'comm')) != 'ceph-osd':
+            continue
+        status = _read_sys(os.path.join(PROC_DIR, pid, 'status')) or ''
+        for line in status.splitlines():
+            if line.startswith('Cpus_allowed_list:'):
+                cpus.update(parse_cpu_list(line.split(':', 1)[1]))
+    return sorted(cpus)
+
+
+def get_nic_cpus(network_interface):
+    """Returns the CPUs to handle a NIC's queues and interrupts.
+
+    These are the CPUs of the NIC's NUMA node which the ceph-osd daemons
+    run on, or all the node's CPUs if the daemons run elsewhere or are
+    not running, or every online CPU if the NIC has no NUMA node.
+
+    :param network_interface: string The network adapter name.
+    :returns: list of int
+    """
+    online = parse_cpu_list(_read_sys(
+        os.path.join(SYS_DEVICES_SYSTEM, 'cpu', 'online')))
+    node = _read_sys(os.path.join(SYS_CLASS_NET, network_interface,
+                                  'device', 'numa_node'))
+    local = online
+    if node and node.lstrip('-').isdigit() and int(node) >= 0:
+        local = parse_cpu_list(_read_sys(os.path.join(
+            SYS_DEVICES_SYSTEM, 'node', 'node{}'.format(node),
+            'cpulist'))) or online
+    osd_local = [cpu for cpu in get_osd_cpus() if cpu in local]
+    return osd_local or local
+
+
+def _ethtool(args):
+    return subprocess.check_output(['ethtool'] + args).decode('UTF-8')
+
+
+def get_nic_rings(network_interface):
+    """Returns the ring sizes of a NIC from ethtool -g.
+
+    :returns: dict with the 'max' and 'current' dicts of 'rx' and 'tx'
+              ring sizes
+    """
+    rings = {'max': {}, 'current': {}}
+    section = None
+    for line in _ethtool(['-g', network_interface]).splitlines():
+        if line.startswith('Pre-set maximums'):
+            section = 'max'
+        elif line.startswith('Current hardware settings'):
+            section = 'current'
+        elif section and ':' in line:
+            key, value = [part.strip() for part in line.split(':', 1)]
+            if key in ('RX', 'TX') and value.isdigit():
+                rings[section][key.lower()] = int(value)
+    return rings
+
+
+def get_nic_coalesce(network_interface):
+    """Returns the interrupt coalescing settings of a NIC from ethtool -c.
+
+    :returns: dict of ethtool -C setting name to value
+    """
+    settings = {}
+    for line in _ethtool(['-c', network_interface]).splitlines():
+        adaptive = re.match(r'Adaptive RX:\s*(\S+)\s+TX:\s*(\S+)', line)
+        if adaptive:
+            settings['adaptive-rx'] = adaptive.group(1)
+            settings['adaptive-tx'] = adaptive.group(2)
+        elif ':' in line:
+            key, value = [part.strip() for part in line.split(':', 1)]
+            if key and value:
+                settings[key] = value
+    return settings
+
+
+def get_nic_features(network_interface):
+    """Returns the offload features of a NIC from ethtool -k.
+
+    :returns: dict of feature name to a tuple of its state ('on' or 'off')
+              and whether it is fixed
+    """
+    features = {}
+    for line in _ethtool(['-k', network_interface]).splitlines():
+        if ':' not in line or line.startswith('Features for'):
+            continue
+        name, value = [part.strip() for part in line.split(':', 1)]
+        if value:
+            features[name] = (value.split()[0], '[fixed]' in value)
+    return features
+
+
+def get_nic_irqs(network_interface):
+    """Returns the MSI interrupts of a NIC, in order."""
+    try:
+        irqs = os.listdir(os.path.join(SYS_CLASS_NET, network_interface,
+                                       'device', 'msi_irqs'))
+    except OSError:
+        return []
+    return sorted(int(irq) for irq in irqs if irq.isdigit())
+
+
+def _nic_queues(network_interface, prefix):
+    try:
+        queues = os.listdir(os.path.join(SYS_CLASS_NET, network_interface,
+                                         'queues'))
+    except OSError:
+        return []
+    return sorted((queue for queue in queues if queue.startswith(prefix)),
+                  key=lambda queue: int(queue.split('-', 1)[1]))
+
+
+def plan_nic_tuning(network_interface, speed=None):
+    """Works out how a NIC should be tuned from its speed class profile.
+
+    :param network_interface: string The network adapter name.
+    :param speed: LinkSpeed. Defaults to the link's speed
+    :returns: dict with 'rings' ({'rx': n, 'tx': n}), 'coalesce' and
+              'offloads' (ethtool setting to value), 'queues' (sysfs queue
+              attribute such as rx-0/rps_cpus to a CPU mask) and 'irqs'
+              (interrupt number to a CPU list), holding the whole wanted
+              state, or None if there is no profile for the speed.
+              Coalescing settings the NIC reports as n/a are left out
+    """
+    if speed is None:
+        speed = get_link_speed(network_interface)
+    profile = NIC_TUNING_PROFILES.get(get_speed_class(speed))
+    if not profile:
+        return None
+    plan = {'rings': {}, 'coalesce': {}, 'offloads': {}, 'queues': {},
+            'irqs': {}}
+    if profile['rings'] == 'max':
+        try:
+            plan['rings'] = get_nic_rings(network_interface)['max']
+        except (subprocess.CalledProcessError, OSError) as err:
+            log('Unable to query the rings of {} with ethtool: {}'.format(
+                network_interface, err), level=WARNING)
+    try:
+        coalesce = get_nic_coalesce(network_interface)
+        plan['coalesce'] = dict((key, value) for key, value in
+                                profile['coalesce'].items()
+                                if coalesce.get(key, 'n/a') != 'n/a')
+    except (subprocess.CalledProcessError, OSError) as err:
+        log('Unable to query the coalescing of {} with ethtool: {}'.format(
+            network_interface, err), level=WARNING)
+    try:
+        features = get_nic_features(network_interface)
+        for name, value in profile['offloads'].items():
+            feature = features.get(NIC_OFFLOAD_FEATURES[name])
+            if feature and not feature[1]:
+                plan['offloads'][name] = value
+    except (subprocess.CalledProcessError, OSError) as err:
+        log('Unable to query the offloads of {} with ethtool: {}'.format(
+            network_interface, err), level=WARNING)
+
+    cpus = get_nic_cpus(network_interface)
+    if not cpus:
+        return plan
+    rx_queues = _nic_queues(network_interface, 'rx-')
+    if profile['rps']:
+        mask = cpu_mask(cpus) if len(rx_queues) < len(cpus) else cpu_mask([])
+        for queue in rx_queues:
+            plan['queues']['{}/rps_cpus'.format(queue)] = mask
+    if profile['xps']:
+        for i, queue in enumerate(_nic_queues(network_interface, 'tx-')):
+            plan['queues']['{}/xps_cpus'.format(queue)] = cpu_mask(
+                [cpus[i % len(cpus)]])
+    if profile['irq_affinity']:
+        for i, irq in enumerate(get_nic_irqs(network_interface)):
+            plan['irqs'][irq] = str(cpus[i % len(cpus)])
+    return plan
+
+
+def apply_nic_tuning(network_interface, plan):
+    """Brings a NIC to the state planned by plan_nic_tuning.
+
+    Only settings which differ from the current state are changed, so
+    applying the same plan again changes nothing.  The rings, coalescing
+    and offloads are set with separate ethtool calls; those ethtool
+    refuses are removed from plan so that they are not persisted.
+
+    :param network_interface: string The network adapter name.
+    :param plan: dict from plan_nic_tuning, updated in place
+    :returns: list of (setting, old value, new value) which were changed
+    """
+    changes = []
+    try:
+        current = get_nic_rings(network_interface)['current']
+        args = []
+        rings = []
+        for ring, size in sorted(plan['rings'].items()):
+            if current.get(ring) != size:
+                args.extend([ring, str(size)])
+                rings.append(('ring ' + ring, current.get(ring), size))
+        if args:
+            _ethtool(['-G', network_interface] + args)
+        changes.extend(rings)
+    except (subprocess.CalledProcessError, OSError) as err:
+        log('Unable to set the rings of {} with ethtool: {}'.format(
+            network_interface, err), level=ERROR)
+        plan['rings'] = {}
+
+    try:
+        current = get_nic_coalesce(network_interface)
+        args = []
+        coalesce = []
+        for key, value in sorted(plan['coalesce'].items()):
+            if current.get(key) != value:
+                args.extend([key, value])
+                coalesce.append((key, current.get(key), value))
+        if args:
+            _ethtool(['-C', network_interface] + args)
+        changes.extend(coalesce)
+    except (subprocess.CalledProcessError, OSError) as err:
+        log('Unable to set the coalescing of {} with ethtool: {}'.format(
+            network_interface, err), level=ERROR)
+        plan['coalesce'] = {}
+
+    try:
+        current = get_nic_features(network_interface)
+        args = []
+        offloads = []
+        for name, value in sorted(plan['offloads'].items()):
+            state = current.get(NIC_OFFLOAD_FEATURES[name], (None,))[0]
+            if state != value:
+                args.extend([name, value])
+                offloads.append((name, state, value))
+        if args:
+            _ethtool(['-K', network_interface] + args)
+        changes.extend(offloads)
+    except (subprocess.CalledProcessError, OSError) as err:
+        log('Unable to set the offloads of {} with ethtool: {}'.format(
+            network_interface, err), level=ERROR)
+        plan['offloads'] = {}
+
+    for attr, mask in sorted(plan['queues'].items()):
+        path = os.path.join(SYS_CLASS_NET, network_interface, 'queues', attr)
+        current = _read_sys(path)
+        if current is not None and _mask_value(current) != _mask_value(mask):
+            if _write_sys(path, mask):
+                changes.append((attr, current, mask))
+
+    for irq, cpus in sorted(plan['irqs'].items()):
+        path = os.path.join(PROC_DIR, 'irq', str(irq), 'smp_affinity_list')
+        current = _read_sys(path)
+        if (current is not None and
+                parse_cpu_list(current) != parse_cpu_list(cpus)):
+            if _write_sys(path, cpus):
+                changes.append(('irq {}'.format(irq), current, cpus))
+    return changes
+
+
+def _udev_nic_rule(network_interface, plan):
+    """Returns the udev rule which restores plan when the NIC appears."""
+    rule = ['ACTION=="add"', 'SUBSYSTEM=="net"',
+            'KERNEL=="{}"'.format(network_interface)]
+    for option, settings in (('-G', plan['rings']),
+                             ('-C', plan['coalesce']),
+                             ('-K', plan['offloads'])):
+        if settings:
+            rule.append('RUN+="/sbin/ethtool {} {} {}"'.format(
+                option, network_interface, ' '.join(
+                    '{} {}'.format(key, value)
+                    for key, value in sorted(settings.items()))))
+    for attr, mask in sorted(plan['queues'].items()):
+        rule.append('ATTR{{queues/{}}}="{}"'.format(attr, mask))
+    return ', '.join(rule)
+
+
+def tune_nic_queues(network_interface, speed=None):
+    """Tunes the rings, coalescing, offloads, RPS/XPS and interrupts of a
+    NIC for its speed class.
+
+    The rings, coalescing, offloads and queue masks are persisted as a
+    udev rule, leaving out ethtool settings the NIC refused.  Interrupt
+    numbers can change from boot to boot, so the interrupt affinity is
+    not persisted and is set again whenever this runs; irqbalance, where
+    running, may move the interrupts again.
+
+    :param network_interface: string The network adapter name.
+    :param speed: LinkSpeed. Defaults to the link's speed
+    :returns: list of (setting, old value, new value) which were changed
+    """
+    plan = plan_nic_tuning(network_interface, speed)
+    if plan is None:
+        log("No queue tuning for network adapter: {}".format(
+            network_interface), level=DEBUG)
+        return []
+    changes = apply_nic_tuning(network_interface, plan)
+    for setting, old, new in changes:
+        log('Changed {} of {} from {} to {}'.format(
+            setting, network_interface, old, new))
+    _merge_udev_rules(UDEV_NIC_RULES, r'KERNEL=="([^"]+)"',
+                      {network_interface: _udev_nic_rule(network_interface,
+                                                         plan)})
+    return changes
+
+
 def persist_settings(settings_dict):
     # Write all settings to /etc/hdparm.conf
     """ This will persist the hard drive settings to the /etc/hdparm.conf file
@@ -295,186 +1195,687 @@ def persist_settings(settings_dict):
             path=HDPARM_FILE, error=e), level=ERROR)
 
 
-def set_max_sectors_kb(dev_name, max_sectors_size):
-    """This function sets the max_sectors_kb size of a given block device.
+def get_block_uuid(block_dev, inventory=None):
+    """This queries blkid to get the uuid for a block device.
 
-    :param dev_name: Name of the block device to query
-    :param max_sectors_size: int of the max_sectors_size to save
+    :param block_dev: Name of the block device to query.
+    :param inventory: BlockInventory. Answer from this inventory rather
+                      than running blkid
+    :returns: The UUID of the device or None on Error.
     """
-    max_sectors_kb_path = os.path.join('sys', 'block', dev_name, 'queue',
-                                       'max_sectors_kb')
+    if inventory is not None:
+        return inventory.get_block_uuid(block_dev)
     try:
-        with open(max_sectors_kb_path, 'w') as f:
-            f.write(max_sectors_size)
-    except IOError as e:
-        log('Failed to write max_sectors_kb to {}. Error: {}'.format(
-            max_sectors_kb_path, e), level=ERROR)
+        block_info = str(subprocess
+                         .check_output(['blkid', '-o', 'export', block_dev])
+                         .decode('UTF-8'))
+        for tag in block_info.split('\n'):
+            parts = tag.split('=')
+            if parts[0] == 'UUID':
+                return parts[1]
+        return None
+    except subprocess.CalledProcessError as err:
+        log('get_block_uuid failed with error: {}'.format(err.output),
+            level=ERROR)
+        return None
+
+
+# Block device tuning per device class.  Schedulers are in order of
+# preference; 'max_sectors_kb' raises the request size towards the hardware
+# limit, capped by the max-sectors-kb option, and 'nr_requests' is only ever
+# raised.  None leaves a setting as the kernel or firmware has it.
+BLOCK_TUNING_PROFILES = {
+    'hdd': {
+        'scheduler': ['mq-deadline', 'deadline'],
+        'read_ahead_sect': 2048,
+        'nr_requests': 256,
+        'max_sectors_kb': True,
+        'rq_affinity': 1,
+        'write_cache': 'on',
+    },
+    'ssd': {
+        'scheduler': ['mq-deadline', 'deadline', 'none', 'noop'],
+        'read_ahead_sect': 256,
+        'nr_requests': 256,
+        'max_sectors_kb': True,
+        'rq_affinity': 1,
+        'write_cache': None,
+    },
+    'nvme': {
+        'scheduler': ['none', 'noop'],
+        'read_ahead_sect': 256,
+        'nr_requests': None,
+        'max_sectors_kb': False,
+        'rq_affinity': 2,
+        'write_cache': None,
+    },
+}
+
+# The tuning settings which are persisted through udev rules; the rest go
+# to hdparm.conf
+UDEV_TUNING_ATTRS = collections.OrderedDict([
+    ('scheduler', 'queue/scheduler'),
+    ('nr_requests', 'queue/nr_requests'),
+    ('max_sectors_kb', 'queue/max_sectors_kb'),
+    ('rq_affinity', 'queue/rq_affinity'),
+])
 
 
-def get_max_sectors_kb(dev_name):
-    """This function gets the max_sectors_kb size of a given block device.
+def get_device_transport(dev):
+    """Returns how a block device is attached.
 
-    :param dev_name: Name of the block device to query
-    :returns: int which is either the max_sectors_kb or 0 on error.
+    :param dev: str. The device, Example: /dev/sdb
+    :returns: str. 'nvme', 'sas' or 'sata', or None for anything else
     """
-    max_sectors_kb_path = os.path.join('sys', 'block', dev_name, 'queue',
-                                       'max_sectors_kb')
+    name = os.path.basename(os.path.realpath(dev))
+    if name.startswith('nvme'):
+        return 'nvme'
+    if _read_block_attr(dev, 'device/sas_address') is not None:
+        return 'sas'
+    if '/ata' in os.path.realpath(os.path.join(SYS_CLASS_BLOCK, name)):
+        return 'sata'
+    return None
 
-    # Read in what Linux has set by default
-    if os.path.exists(max_sectors_kb_path):
-        try:
-            with open(max_sectors_kb_path, 'r') as f:
-                max_sectors_kb = f.read().strip()
-                return int(max_sectors_kb)
-        except IOError as e:
-            log('Failed to read max_sectors_kb to {}. Error: {}'.format(
-                max_sectors_kb_path, e), level=ERROR)
-            # Bail.
-            return 0
-    return 0
 
+def _read_block_int(dev, attr):
+    value = _read_block_attr(dev, attr)
+    if value is None or not value.isdigit():
+        return None
+    return int(value)
+
+
+def get_block_tuning(block_dev):
+    """Works out the tuning of a block device from its class profile.
+
+    The profile from BLOCK_TUNING_PROFILES is fitted to the device: the
+    first scheduler it offers is used, max_sectors_kb and nr_requests are
+    only raised and never beyond the hardware limit, and the write cache
+    is only set on SATA devices, where hdparm can persist it.  Where the
+    device's model was benchmarked (see benchmark_device) its best
+    scheduler, max_sectors_kb and read ahead are used instead.
 
-def get_max_hw_sectors_kb(dev_name):
-    """This function gets the max_hw_sectors_kb for a given block device.
+    :param block_dev: A block device name: Example: /dev/sda
+    :returns: dict of setting to value, holding only what should change
+              from the defaults
+    """
+    device_class = get_device_class(block_dev)
+    transport = get_device_transport(block_dev)
+    profile = BLOCK_TUNING_PROFILES[device_class]
+    settings = {}
+
+    available = (_read_block_attr(block_dev, 'queue/scheduler') or '').split()
+    available = [sched.strip('[]') for sched in available]
+    for scheduler in profile['scheduler']:
+        if scheduler in available:
+            settings['scheduler'] = scheduler
+            break
+
+    if profile['read_ahead_sect']:
+        settings['read_ahead_sect'] = profile['read_ahead_sect']
+
+    nr_requests = _read_block_int(block_dev, 'queue/nr_requests')
+    if (profile['nr_requests'] and nr_requests is not None and
+            nr_requests < profile['nr_requests']):
+        settings['nr_requests'] = profile['nr_requests']
+
+    max_sectors_kb = _read_block_int(block_dev, 'queue/max_sectors_kb')
+    max_hw_sectors_kb = _read_block_int(block_dev, 'queue/max_hw_sectors_kb')
+    if profile['max_sectors_kb'] and max_sectors_kb and max_hw_sectors_kb:
+        wanted = min(hookenv.config('max-sectors-kb') or max_hw_sectors_kb,
+                     max_hw_sectors_kb)
+        if wanted > max_sectors_kb:
+            settings['max_sectors_kb'] = wanted
+
+    if profile['rq_affinity'] is not None:
+        settings['rq_affinity'] = profile['rq_affinity']
+
+    benchmarked = get_benchmarked_tuning(block_dev) or {}
+    if benchmarked.get('scheduler') in available:
+        settings['scheduler'] = benchmarked['scheduler']
+    if benchmarked.get('read_ahead_kb'):
+        settings['read_ahead_sect'] = int(benchmarked['read_ahead_kb']) * 2
+    if (benchmarked.get('max_sectors_kb') and max_hw_sectors_kb and
+            int(benchmarked['max_sectors_kb']) <= max_hw_sectors_kb):
+        settings['max_sectors_kb'] = int(benchmarked['max_sectors_kb'])
+
+    if profile['write_cache'] and transport == 'sata':
+        settings['write_cache'] = profile['write_cache']
+
+    log('Tuning profile for {} ({} {}): {}'.format(
+        block_dev, device_class, transport, settings), level=DEBUG)
+    return settings
+
+
+def apply_block_tuning(block_dev, settings):
+    """Applies settings from get_block_tuning to a block device.
 
-    :param dev_name: Name of the block device to query
-    :returns: int which is either the max_hw_sectors_kb or 0 on error.
+    :param block_dev: A block device name: Example: /dev/sda
+    :param settings: dict of setting to value
     """
-    max_hw_sectors_kb_path = os.path.join('sys', 'block', dev_name, 'queue',
-                                          'max_hw_sectors_kb')
-    # Read in what the hardware supports
-    if os.path.exists(max_hw_sectors_kb_path):
+    for setting, attr in UDEV_TUNING_ATTRS.items():
+        if setting in settings:
+            log('Setting {} for device {} to {}'.format(
+                setting, block_dev, settings[setting]))
+            _write_block_attr(block_dev, attr, settings[setting])
+    if 'read_ahead_sect' in settings:
+        log('Setting read ahead to {} for device {}'.format(
+            settings['read_ahead_sect'], block_dev))
+        _write_block_attr(block_dev, 'queue/read_ahead_kb',
+                          settings['read_ahead_sect'] // 2)
+    if 'write_cache' in settings:
+        flag = '-W1' if settings['write_cache'] == 'on' else '-W0'
         try:
-            with open(max_hw_sectors_kb_path, 'r') as f:
-                max_hw_sectors_kb = f.read().strip()
-                return int(max_hw_sectors_kb)
-        except IOError as e:
-            log('Failed to read max_hw_sectors_kb to {}. Error: {}'.format(
-                max_hw_sectors_kb_path, e), level=ERROR)
-            return 0
-    return 0
+            subprocess.check_output(['hdparm', flag, block_dev])
+        except subprocess.CalledProcessError as e:
+            log('hdparm failed with error: {}'.format(e.output),
+                level=ERROR)
+
 
+def _udev_tuning_rule(uuid, settings):
+    """Returns the udev rule which applies settings to the device with
+    the filesystem uuid."""
+    rule = ['ACTION=="add|change"', 'SUBSYSTEM=="block"',
+            'ENV{{ID_FS_UUID}}=="{}"'.format(uuid)]
+    for setting, attr in UDEV_TUNING_ATTRS.items():
+        if setting in settings:
+            rule.append('ATTR{{{}}}="{}"'.format(attr, settings[setting]))
+    return ', '.join(rule)
 
-def set_hdd_read_ahead(dev_name, read_ahead_sectors=256):
-    """This function sets the hard drive read ahead.
 
-    :param dev_name: Name of the block device to set read ahead on.
-    :param read_ahead_sectors: int How many sectors to read ahead.
+def _merge_udev_rules(path, key_pattern, new_rules):
+    """Updates some of the rules in a udev rules file.
+
+    :param path: str. The rules file
+    :param key_pattern: str. A regular expression whose first group is the
+                        key of a rule, such as the device it matches
+    :param new_rules: dict of key to the new rule, or None to drop it;
+                      rules with other keys are kept
+    :returns: bool. True if the file was written, which is only done when
+              its contents change
     """
+    rules = collections.OrderedDict()
     try:
-        # Set the read ahead sectors to 256
-        log('Setting read ahead to {} for device {}'.format(
-            read_ahead_sectors,
-            dev_name))
-        subprocess.check_output(['hdparm',
-                                 '-a{}'.format(read_ahead_sectors),
-                                 dev_name])
-    except subprocess.CalledProcessError as e:
-        log('hdparm failed with error: {}'.format(e.output),
-            level=ERROR)
+        with open(path, 'r') as f:
+            current = f.read()
+    except IOError:
+        current = ''
+    for line in current.splitlines():
+        match = re.search(key_pattern, line)
+        if match:
+            rules[match.group(1)] = line
+    for key, rule in new_rules.items():
+        if rule:
+            rules[key] = rule
+        else:
+            rules.pop(key, None)
+    content = ''
+    if rules:
+        content = '# Written by the ceph charms, changes will be lost\n'
+        content += ''.join('{}\n'.format(rule) for rule in rules.values())
+    if content == current:
+        return False
+    try:
+        with open(path, 'w') as f:
+            f.write(content)
+    except IOError as err:
+        log("Unable to open {path} because of error: {error}".format(
+            path=path, error=err), level=ERROR)
+        return False
+    return True
 
 
-def get_block_uuid(block_dev):
-    """This queries blkid to get the uuid for a block device.
+def persist_udev_tuning(device_settings):
+    """Persists the sysfs tuning of devices as udev rules.
 
-    :param block_dev: Name of the block device to query.
-    :returns: The UUID of the device or None on Error.
+    Rules for devices not in device_settings are kept, so devices can be
+    tuned one at a time.  The file is only written when it changes.
+
+    :param device_settings: dict of filesystem uuid to the settings from
+                            get_block_tuning
     """
+    rules = {}
+    for uuid, settings in device_settings.items():
+        rules[uuid] = None
+        if any(setting in settings for setting in UDEV_TUNING_ATTRS):
+            rules[uuid] = _udev_tuning_rule(uuid, settings)
+    _merge_udev_rules(UDEV_TUNING_RULES, r'ENV\{ID_FS_UUID\}=="([^"]+)"',
+                      rules)
+
+
+# The most devices tuned at once
+TUNING_WORKERS = 8
+
+# The hdparm.conf settings of every tuned device, by filesystem uuid
+DRIVE_SETTINGS_STATE = '/var/cache/ceph-tuning/drive_settings.json'
+DISK_BY_UUID = '/dev/disk/by-uuid'
+
+
+def get_block_uuids(block_devs):
+    """This queries blkid once to get the uuids of many block devices.
+
+    :param block_devs: list of block device names, Example: ['/dev/sda']
+    :returns: dict of block device to its UUID, without devices which
+              have none
+    """
+    if not block_devs:
+        return {}
     try:
-        block_info = str(subprocess
-                         .check_output(['blkid', '-o', 'export', block_dev])
-                         .decode('UTF-8'))
-        for tag in block_info.split('\n'):
-            parts = tag.split('=')
-            if parts[0] == 'UUID':
-                return parts[1]
-        return None
+        out = subprocess.check_output(['blkid', '-o', 'export'] +
+                                      list(block_devs))
     except subprocess.CalledProcessError as err:
-        log('get_block_uuid failed with error: {}'.format(err.output),
-            level=ERROR)
-        return None
+        # blkid exits 2 if any device has no tags but still reports
+        # the others
+        out = err.output or b''
+    by_path = dict((os.path.realpath(dev), dev) for dev in block_devs)
+    uuids = {}
+    for section in out.decode('UTF-8').split('\n\n'):
+        tags = dict(line.split('=', 1) for line in section.splitlines()
+                    if '=' in line)
+        dev = tags.get('DEVNAME')
+        if dev and tags.get('UUID'):
+            uuids[by_path.get(os.path.realpath(dev), dev)] = tags['UUID']
+    return uuids
+
+
+def _load_drive_settings():
+    try:
+        with open(DRIVE_SETTINGS_STATE, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
 
 
-def check_max_sectors(save_settings_dict,
-                      block_dev,
-                      uuid):
-    """Tune the max_hw_sectors if needed.
+def _save_drive_settings(drive_settings):
+    write_json_atomically(DRIVE_SETTINGS_STATE, drive_settings,
+                          'drive settings')
 
-    make sure that /sys/.../max_sectors_kb matches max_hw_sectors_kb or at
-    least 1MB for spinning disks
-    If the box has a RAID card with cache this could go much bigger.
 
-    :param save_settings_dict: The dict used to persist settings
-    :param block_dev: A block device name: Example: /dev/sda
-    :param uuid: The uuid of the block device
+def tune_devices(block_devs, max_workers=TUNING_WORKERS):
+    """Tunes many block devices with the profiles for their class.
+
+    Each device is tuned as tune_dev describes.  The uuids of all the
+    devices come from one blkid call and devices are tuned several at a
+    time.  hdparm.conf is rendered once with the settings of every device
+    tuned so far, kept in DRIVE_SETTINGS_STATE, and only when they
+    changed; the udev rules are likewise written once.  Devices which no
+    longer exist, such as wiped or replaced disks, are dropped from
+    hdparm.conf.
+
+    :param block_devs: list of block device names, Example: ['/dev/sda']
+    :param max_workers: int. The most devices tuned at once
+    :returns: dict of block device to the settings applied to it
     """
-    dev_name = None
-    path_parts = os.path.split(block_dev)
-    if len(path_parts) == 2:
-        dev_name = path_parts[1]
-    else:
-        log('Unable to determine the block device name from path: {}'.format(
-            block_dev))
-        # Play it safe and bail
-        return
-    max_sectors_kb = get_max_sectors_kb(dev_name=dev_name)
-    max_hw_sectors_kb = get_max_hw_sectors_kb(dev_name=dev_name)
-
-    if max_sectors_kb < max_hw_sectors_kb:
-        # OK we have a situation where the hardware supports more than Linux is
-        # currently requesting
-        config_max_sectors_kb = hookenv.config('max-sectors-kb')
-        if config_max_sectors_kb < max_hw_sectors_kb:
-            # Set the max_sectors_kb to the config.yaml value if it is less
-            # than the max_hw_sectors_kb
-            log('Setting max_sectors_kb for device {} to {}'.format(
-                dev_name, config_max_sectors_kb))
-            save_settings_dict[
-                "drive_settings"][uuid][
-                "read_ahead_sect"] = config_max_sectors_kb
-            set_max_sectors_kb(dev_name=dev_name,
-                               max_sectors_size=config_max_sectors_kb)
-        else:
-            # Set to the max_hw_sectors_kb
-            log('Setting max_sectors_kb for device {} to {}'.format(
-                dev_name, max_hw_sectors_kb))
-            save_settings_dict[
-                "drive_settings"][uuid]['read_ahead_sect'] = max_hw_sectors_kb
-            set_max_sectors_kb(dev_name=dev_name,
-                               max_sectors_size=max_hw_sectors_kb)
-    else:
-        log('max_sectors_kb match max_hw_sectors_kb. No change needed for '
-            'device: {}'.format(block_dev))
+    uuids = get_block_uuids(block_devs)
+    for block_dev in block_devs:
+        if block_dev not in uuids:
+            log('block device {} uuid is None. Unable to save to '
+                'hdparm.conf'.format(block_dev), level=DEBUG)
+    devices = [block_dev for block_dev in block_devs if block_dev in uuids]
+    if not devices:
+        return {}
+
+    log('Tuning devices {}'.format(', '.join(devices)))
+    status_set('maintenance', 'Tuning device{} {}'.format(
+        's' if len(devices) > 1 else '', ', '.join(devices)))
+
+    def tune(block_dev):
+        settings = get_block_tuning(block_dev)
+        apply_block_tuning(block_dev, settings)
+        return block_dev, settings
+
+    pool = ThreadPool(processes=min(max_workers, len(devices)))
+    try:
+        tuned = dict(pool.map(tune, devices))
+    finally:
+        pool.close()
+        pool.join()
+
+    previous = _load_drive_settings()
+    drive_settings = dict(
+        (uuid, settings) for uuid, settings in previous.items()
+        if os.path.exists(os.path.join(DISK_BY_UUID, uuid)))
+    for block_dev, settings in tuned.items():
+        drive_settings[uuids[block_dev]] = dict(
+            (key, settings[key]) for key in ('read_ahead_sect', 'write_cache')
+            if key in settings)
+    if drive_settings != previous or not os.path.exists(HDPARM_FILE):
+        persist_settings(settings_dict={"drive_settings": drive_settings})
+        _save_drive_settings(drive_settings)
+    persist_udev_tuning(dict((uuids[block_dev], settings)
+                             for block_dev, settings in tuned.items()))
+    status_set('maintenance', 'Finished tuning device{} {}'.format(
+        's' if len(devices) > 1 else '', ', '.join(devices)))
+    return tuned
 
 
 def tune_dev(block_dev):
-    """Try to make some intelligent decisions with HDD tuning. Future work will
-    include optimizing SSDs.
+    """Tunes a block device with the profile for its class.
 
-    This function will change the read ahead sectors and the max write
-    sectors for each block device.
+    The device is classed as hdd, ssd or nvme and tuned with the matching
+    entry of BLOCK_TUNING_PROFILES (see get_block_tuning): IO scheduler,
+    read ahead, nr_requests, max_sectors_kb, rq_affinity and write cache.
+    Read ahead and write cache are persisted in hdparm.conf, the queue
+    settings in udev rules.  See tune_devices for tuning many devices.
 
     :param block_dev: A block device name: Example: /dev/sda
     """
-    uuid = get_block_uuid(block_dev)
-    if uuid is None:
-        log('block device {} uuid is None. Unable to save to '
-            'hdparm.conf'.format(block_dev), level=DEBUG)
-        return
-    save_settings_dict = {}
-    log('Tuning device {}'.format(block_dev))
-    status_set('maintenance', 'Tuning device {}'.format(block_dev))
-    set_hdd_read_ahead(block_dev)
-    save_settings_dict["drive_settings"] = {}
-    save_settings_dict["drive_settings"][uuid] = {}
-    save_settings_dict["drive_settings"][uuid]['read_ahead_sect'] = 256
+    tune_devices([block_dev])
+
+
+# Micro-benchmark of block device settings: how long each probe runs, how
+# much of the target it spans and where results are kept, by device model
+BENCHMARK_PROBE_SECONDS = 2
+BENCHMARK_SPAN = 256 * 1024 * 1024
+BENCHMARK_CACHE = '/var/cache/ceph-tuning/benchmarks.json'
+BENCHMARK_CANDIDATES = collections.OrderedDict([
+    ('scheduler', ['none', 'noop', 'mq-deadline', 'deadline', 'kyber',
+                   'bfq', 'cfq']),
+    ('max_sectors_kb', [128, 256, 512, 1024, 2048, 4096]),
+    ('read_ahead_kb', [128, 512, 1024, 2048, 4096]),
+])
+# The probes each setting is judged by, and the measure they are scored on
+BENCHMARK_PROBES = {
+    'scheduler': [('randread', 'iops'), ('randwrite', 'iops')],
+    'max_sectors_kb': [('read', 'bandwidth'), ('write', 'bandwidth')],
+    'read_ahead_kb': [('bufread', 'bandwidth')],
+}
+BENCHMARK_BLOCK_SIZES = {'read': 1048576, 'write': 1048576,
+                         'randread': 4096, 'randwrite': 4096,
+                         'bufread': 131072}
+_ALIGNMENT = 4096
+_POSIX_FADV_DONTNEED = 4
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    for name in ('pread', 'pwrite'):
+        function = getattr(libc, name)
+        function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_longlong]
+        function.restype = ctypes.c_ssize_t
+    return libc
+
+
+def _percentile(values, fraction):
+    """Returns the value below which fraction of values fall."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_io_probe(target, pattern, block_size, span=BENCHMARK_SPAN,
+                 seconds=BENCHMARK_PROBE_SECONDS, direct=True):
+    """Runs a short IO probe against a file or block device.
+
+    :param target: str. The file or (loop) device to read and write
+    :param pattern: str. 'read' or 'write' for sequential direct IO,
+                    'randread' or 'randwrite' for random direct IO, or
+                    'bufread' for sequential reads through the page cache,
+                    which is what read ahead affects.  As a second pass
+                    over span would be served from the page cache,
+                    'bufread' stops at the end of span rather than
+                    wrapping
+    :param block_size: int. Bytes per IO, a multiple of 4096
+    :param span: int. How many bytes from the start of target to use, at
+                 most the size of target
+    :param seconds: float. How long to run
+    :param direct: bool. Whether to bypass the page cache; file systems
+                   such as tmpfs do not allow it
+    :returns: dict with 'bandwidth' in bytes per second, 'iops' and the
+              'p50', 'p95' and 'p99' latencies in seconds
+    :raises OSError: if an IO fails or transfers less than block_size
+    :raises ValueError: if target is smaller than block_size
+    """
+    libc = _libc()
+    writing = pattern in ('write', 'randwrite')
+    flags = os.O_RDWR if writing else os.O_RDONLY
+    if direct and pattern != 'bufread':
+        flags |= getattr(os, 'O_DIRECT', 0)
+    raw = ctypes.create_string_buffer(block_size + _ALIGNMENT)
+    address = ctypes.addressof(raw)
+    buf = address + (-address % _ALIGNMENT)
+    if writing:
+        ctypes.memmove(buf, os.urandom(block_size), block_size)
+    rng = random.Random(0)
+    latencies = []
+    transferred = 0
+    fd = os.open(target, flags)
+    try:
+        # Reads past the end of target return nothing, and would be
+        # counted as the fastest IO of all
+        blocks = min(span, os.lseek(fd, 0, os.SEEK_END)) // block_size
+        if blocks < 1:
+            raise ValueError('{} is too small to probe with {} byte '
+                             'IOs'.format(target, block_size))
+        if pattern == 'bufread':
+            libc.posix_fadvise(fd, ctypes.c_longlong(0),
+                               ctypes.c_longlong(0), _POSIX_FADV_DONTNEED)
+        io = libc.pwrite if writing else libc.pread
+        start = time.time()
+        deadline = start + seconds
+        now = start
+        while now < deadline:
+            if pattern.startswith('rand'):
+                offset = rng.randrange(blocks) * block_size
+            elif pattern == 'bufread' and len(latencies) >= blocks:
+                break
+            else:
+                offset = (len(latencies) % blocks) * block_size
+            done = io(fd, buf, block_size, offset)
+            after = time.time()
+            if done < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), target)
+            if done < block_size:
+                raise OSError(errno.EIO, 'Short IO of {} bytes at offset '
+                              '{}'.format(done, offset), target)
+            transferred += done
+            latencies.append(after - now)
+            now = after
+        if writing:
+            os.fsync(fd)
+        elapsed = max(time.time() - start, 1e-9)
+    finally:
+        os.close(fd)
+    return {'bandwidth': transferred / elapsed,
+            'iops': len(latencies) / elapsed,
+            'p50': _percentile(latencies, 0.50),
+            'p95': _percentile(latencies, 0.95),
+            'p99': _percentile(latencies, 0.99)}
+
+
+def prepare_benchmark_target(path, size=BENCHMARK_SPAN):
+    """Creates a file of size bytes to benchmark through.
+
+    The file is written out rather than left sparse so that reads reach
+    the device.
+
+    :param path: str. The file, on a file system of the device to test
+    :param size: int. Its size in bytes
+    """
+    chunk = b'\0' * 1048576
+    with open(path, 'wb') as f:
+        for _ in range(size // len(chunk)):
+            f.write(chunk)
+        os.fsync(f.fileno())
+
+
+def attach_loop_device(path):
+    """Attaches a file to a free loop device with direct IO.
+
+    :param path: str. The backing file
+    :returns: str. The loop device, Example: /dev/loop3
+    :raises CalledProcessError: if losetup fails
+    """
+    return subprocess.check_output(
+        ['losetup', '--find', '--show', '--direct-io=on', path]
+    ).decode('UTF-8').strip()
+
+
+def detach_loop_device(loop_dev):
+    subprocess.check_call(['losetup', '--detach', loop_dev])
+
 
-    check_max_sectors(block_dev=block_dev,
-                      save_settings_dict=save_settings_dict,
-                      uuid=uuid)
+def get_device_model(block_dev):
+    """Returns the model and firmware revision of a block device.
 
-    persist_settings(settings_dict=save_settings_dict)
-    status_set('maintenance', 'Finished tuning device {}'.format(block_dev))
+    :param block_dev: A block device name: Example: /dev/sda
+    :returns: tuple of str (model, firmware); either is None if unknown
+    """
+    model = _read_block_attr(block_dev, 'device/model')
+    firmware = (_read_block_attr(block_dev, 'device/firmware_rev') or
+                _read_block_attr(block_dev, 'device/rev'))
+    return model, firmware
+
+
+def _benchmark_key(block_dev):
+    model, firmware = get_device_model(block_dev)
+    if not model:
+        return None
+    return re.sub(r'[^A-Za-z0-9._-]+', '-', '{}_{}'.format(
+        model, firmware or 'unknown')).strip('-')
+
+
+def _load_benchmarks():
+    try:
+        with open(BENCHMARK_CACHE, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_benchmark(key, result):
+    benchmarks = _load_benchmarks()
+    benchmarks[key] = result
+    write_json_atomically(BENCHMARK_CACHE, benchmarks, 'benchmark results')
+
+
+def get_benchmarked_tuning(block_dev, service=None):
+    """Returns the best settings found for the model of a block device.
+
+    :param block_dev: A block device name: Example: /dev/sda
+    :param service: str. The cephx user to look for results of other
+                    hosts with, or None to only look on this host
+    :returns: dict of 'scheduler', 'max_sectors_kb' and 'read_ahead_kb',
+              or None if this model was not benchmarked
+    """
+    key = _benchmark_key(block_dev)
+    if not key:
+        return None
+    result = _load_benchmarks().get(key)
+    if result is None and service:
+        try:
+            stored = monitor_key_get(service, 'benchmark_{}'.format(key))
+        except subprocess.CalledProcessError:
+            stored = None
+        if stored:
+            result = json.loads(stored)
+            _save_benchmark(key, result)
+    return result and result['settings']
+
+
+def benchmark_device(block_dev, target, service=None, force=False,
+                     candidates=None, seconds=BENCHMARK_PROBE_SECONDS,
+                     span=BENCHMARK_SPAN, direct=True, probe=run_io_probe):
+    """Finds the best scheduler, max_sectors_kb and read ahead for a device.
+
+    The settings are tried one at a time, each candidate with the best
+    of the settings before it, and judged by the probes in
+    BENCHMARK_PROBES run against target.  target is a file on the device,
+    or a loop device over one, so nothing on the device is overwritten.
+    Candidates the device does not offer or exceeding its hardware limit
+    are left out, and the device's settings are put back afterwards.
+    Read ahead is only tried when target is a file: reads of a loop
+    device use the loop device's own read ahead, not block_dev's.  The
+    result is kept by device model and firmware, on this host and with
+    service also in the monitor's config-key store, so identical disks
+    are only benchmarked once.
+
+    :param block_dev: A block device name: Example: /dev/sda
+    :param target: str. The file or loop device to run probes against
+    :param service: str. The cephx user to share results with, or None
+    :param force: bool. Whether to benchmark even if results exist
+    :param candidates: dict of setting to candidate values, defaults to
+                       BENCHMARK_CANDIDATES
+    :param seconds: float. How long each probe runs
+    :param span: int. How many bytes of target the probes use
+    :param direct: bool. Whether the probes bypass the page cache
+    :param probe: The function running a probe, as run_io_probe
+    :returns: dict with the best 'settings' and each trial in 'results'
+    """
+    key = _benchmark_key(block_dev)
+    if key and not force:
+        settings = get_benchmarked_tuning(block_dev, service)
+        if settings:
+            log('Using benchmark results for {} ({})'.format(block_dev, key))
+            return {'settings': settings, 'results': []}
+
+    attrs = {'scheduler': 'queue/scheduler',
+             'max_sectors_kb': 'queue/max_sectors_kb',
+             'read_ahead_kb': 'queue/read_ahead_kb'}
+    original = {}
+    for setting, attr in attrs.items():
+        value = _read_block_attr(block_dev, attr)
+        if value and setting == 'scheduler':
+            value = re.search(r'\[(\S+)\]', value)
+            value = value.group(1) if value else None
+        if value:
+            original[setting] = value
+    available = [sched.strip('[]') for sched in
+                 (_read_block_attr(block_dev, 'queue/scheduler') or '')
+                 .split()]
+    max_hw_sectors_kb = _read_block_int(block_dev, 'queue/max_hw_sectors_kb')
+
+    status_set('maintenance', 'Benchmarking device {}'.format(block_dev))
+    best = {}
+    results = []
+    try:
+        for setting, values in (candidates or BENCHMARK_CANDIDATES).items():
+            if setting == 'scheduler':
+                values = [value for value in values if value in available]
+            elif setting == 'max_sectors_kb' and max_hw_sectors_kb:
+                values = [value for value in values
+                          if value <= max_hw_sectors_kb]
+            elif setting == 'read_ahead_kb' and is_block_device(target):
+                log('Not benchmarking read ahead of {} through block '
+                    'device {}'.format(block_dev, target), level=DEBUG)
+                continue
+            best_score = None
+            for value in values:
+                _write_block_attr(block_dev, attrs[setting], value)
+                trial = {'setting': setting, 'value': value, 'probes': {}}
+                score = 0.0
+                for pattern, measure in BENCHMARK_PROBES[setting]:
+                    outcome = probe(target, pattern,
+                                    BENCHMARK_BLOCK_SIZES[pattern],
+                                    span=span, seconds=seconds,
+                                    direct=direct)
+                    trial['probes'][pattern] = outcome
+                    score += outcome[measure]
+                trial['score'] = score
+                results.append(trial)
+                log('Benchmark {} {}={}: {}'.format(
+                    block_dev, setting, value, score), level=DEBUG)
+                if best_score is None or score > best_score:
+                    best_score = score
+                    best[setting] = value
+            if setting in best:
+                _write_block_attr(block_dev, attrs[setting], best[setting])
+    finally:
+        for setting, value in original.items():
+            _write_block_attr(block_dev, attrs[setting], value)
+
+    result = {'settings': best, 'results': results, 'device': block_dev,
+              'timestamp': time.time()}
+    if key:
+        _save_benchmark(key, result)
+        if service:
+            monitor_key_set(service, 'benchmark_{}'.format(key),
+                            json.dumps({'settings': best,
+                                        'timestamp': result['timestamp']}))
+    log('Best settings for {}: {}'.format(block_dev, best))
+    return result
 
 
 def ceph_user():
@@ -526,6 +1927,160 @@ class CrushLocation(object):
         return self.name < other.name
 
 
+class OsdTreeSnapshot(object):
+    """An indexed copy of 'ceph osd tree' for one osdmap epoch.
+
+    The tree is fetched at most once per osdmap epoch; refresh() only
+    re-reads it when 'ceph osd stat' reports a different epoch.  The
+    first load skips that probe, so one-off lookups cost a single
+    command; the epoch is then learnt, with one more read of the tree,
+    the next time the snapshot is refreshed.  Nodes are indexed by id,
+    by name, by parent and by host so that lookups do not scan the node
+    list.
+    """
+
+    def __init__(self, service=None):
+        self.service = service
+        self.epoch = None
+        self.nodes = []
+        self.by_id = {}
+        self.by_name = {}
+        self.by_parent = {}
+        self.by_host = {}
+        self.parents = {}
+        self._loaded = False
+
+    def _osdmap_epoch(self):
+        """Return the current osdmap epoch or None if it cannot be read."""
+        try:
+            stat = json.loads(get_executor().check_output(
+                CephCommand('osd stat', service=self.service, fmt='json')))
+        except (subprocess.CalledProcessError, ValueError) as e:
+            log("Unable to read the osdmap epoch: {}".format(e),
+                level=DEBUG)
+            return None
+        if not isinstance(stat, dict):
+            return None
+        # Releases before mimic nest the summary one level deeper
+        stat = stat.get('osdmap', stat)
+        return stat.get('epoch')
+
+    def refresh(self, force=False):
+        """Re-read the tree if the osdmap epoch has changed.
+
+        :param force: bool. Re-read the tree even if the epoch is unchanged
+        :returns: bool. True if the tree was re-read
+        :raises: ValueError if the tree fails to parse.
+        :raises: CalledProcessError if our ceph command fails.
+        """
+        epoch = None
+        if self._loaded:
+            epoch = self._osdmap_epoch()
+            if not force and epoch is not None and epoch == self.epoch:
+                return False
+        try:
+            tree = get_executor().check_output(
+                CephCommand('osd tree', service=self.service, fmt='json'))
+            try:
+                json_tree = json.loads(tree)
+            except ValueError as v:
+                log("Unable to parse ceph tree json: {}. Error: {}".format(
+                    tree, v))
+                raise
+        except subprocess.CalledProcessError as e:
+            log("ceph osd tree command failed with message: {}".format(
+                e))
+            raise
+        self._index(json_tree.get('nodes') or [])
+        self.epoch = epoch
+        self._loaded = True
+        return True
+
+    def _index(self, nodes):
+        self.nodes = nodes
+        self.by_id = {}
+        self.by_name = {}
+        self.by_parent = {}
+        self.by_host = {}
+        self.parents = {}
+        for node in nodes:
+            self.by_id[node['id']] = node
+            self.by_name[node.get('name')] = node
+        for node in nodes:
+            children = [self.by_id[child] for child in node.get('children', [])
+                        if child in self.by_id]
+            self.by_parent[node['id']] = children
+            for child in children:
+                self.parents[child['id']] = node
+            if node.get('type') == 'host':
+                self.by_host[node.get('name')] = [
+                    child for child in children if child.get('type') == 'osd']
+
+    def node(self, name):
+        """Return the node called name, or None."""
+        return self.by_name.get(name)
+
+    def parent(self, name):
+        """Return the node containing the node called name, or None."""
+        node = self.by_name.get(name)
+        if node is None:
+            return None
+        return self.parents.get(node['id'])
+
+    def children(self, name):
+        """Return the nodes directly below the node called name."""
+        node = self.by_name.get(name)
+        if node is None:
+            return []
+        return self.by_parent.get(node['id'], [])
+
+    def host_osds(self, host):
+        """Return the osd nodes below the host bucket called host."""
+        return self.by_host.get(host, [])
+
+    def osd_weight(self, osd_id):
+        """Return the crush weight of the osd called osd_id, or None."""
+        node = self.by_name.get(osd_id)
+        if node is None or node.get('type') != 'osd':
+            return None
+        return node['crush_weight']
+
+    def crush_locations(self):
+        """Return the buckets below the first node of the tree, in order.
+
+        :returns: list of CrushLocation or None if the tree is empty
+        """
+        if not self.nodes:
+            return None
+        return [CrushLocation(name=child.get('name'),
+                              identifier=child['id'],
+                              host=child.get('host'),
+                              rack=child.get('rack'),
+                              row=child.get('row'),
+                              datacenter=child.get('datacenter'),
+                              chassis=child.get('chassis'),
+                              root=child.get('root'))
+                for child in self.by_parent[self.nodes[0]['id']]]
+
+
+_osd_tree_snapshots = {}
+
+
+def get_osd_tree_snapshot(service=None):
+    """Return the shared, current OsdTreeSnapshot for service.
+
+    :param service: String service id to run under
+    :returns: OsdTreeSnapshot
+    :raises: ValueError if the tree fails to parse.
+    :raises: CalledProcessError if our ceph command fails.
+    """
+    snapshot = _osd_tree_snapshots.get(service)
+    if snapshot is None:
+        snapshot = _osd_tree_snapshots[service] = OsdTreeSnapshot(service)
+    snapshot.refresh()
+    return snapshot
+
+
 def get_osd_weight(osd_id):
     """Returns the weight of the specified OSD.
 
@@ -533,26 +2088,7 @@ def get_osd_weight(osd_id):
     :raises: ValueError if the monmap fails to parse.
     :raises: CalledProcessError if our ceph command fails.
     """
-    try:
-        tree = str(subprocess
-                   .check_output(['ceph', 'osd', 'tree', '--format=json'])
-                   .decode('UTF-8'))
-        try:
-            json_tree = json.loads(tree)
-            # Make sure children are present in the json
-            if not json_tree['nodes']:
-                return None
-            for device in json_tree['nodes']:
-                if device['type'] == 'osd' and device['name'] == osd_id:
-                    return device['crush_weight']
-        except ValueError as v:
-            log("Unable to parse ceph tree json: {}. Error: {}".format(
-                tree, v))
-            raise
-    except subprocess.CalledProcessError as e:
-        log("ceph osd tree command failed with message: {}".format(
-            e))
-        raise
+    return get_osd_tree_snapshot().osd_weight(osd_id)
 
 
 def get_osd_tree(service):
@@ -562,41 +2098,7 @@ def get_osd_tree(service):
     :raises: ValueError if the monmap fails to parse.
              Also raises CalledProcessError if our ceph command fails
     """
-    try:
-        tree = str(subprocess
-                   .check_output(['ceph', '--id', service,
-                                  'osd', 'tree', '--format=json'])
-                   .decode('UTF-8'))
-        try:
-            json_tree = json.loads(tree)
-            crush_list = []
-            # Make sure children are present in the json
-            if not json_tree['nodes']:
-                return None
-            child_ids = json_tree['nodes'][0]['children']
-            for child in json_tree['nodes']:
-                if child['id'] in child_ids:
-                    crush_list.append(
-                        CrushLocation(
-                            name=child.get('name'),
-                            identifier=child['id'],
-                            host=child.get('host'),
-                            rack=child.get('rack'),
-                            row=child.get('row'),
-                            datacenter=child.get('datacenter'),
-                            chassis=child.get('chassis'),
-                            root=child.get('root')
-                        )
-                    )
-            return crush_list
-        except ValueError as v:
-            log("Unable to parse ceph tree json: {}. Error: {}".format(
-                tree, v))
-            raise
-    except subprocess.CalledProcessError as e:
-        log("ceph osd tree command failed with message: {}".format(
-            e))
-        raise
+    return get_osd_tree_snapshot(service).crush_locations()
 
 
 def _get_child_dirs(path):
@@ -881,12 +2383,10 @@ def replace_osd(dead_osd_number,
         # Drop this osd out of the cluster. This will begin a
         # rebalance operation
         status_set('maintenance', 'Removing osd {}'.format(dead_osd_number))
-        subprocess.check_output([
-            'ceph',
-            '--id',
-            'osd-upgrade',
-            'osd', 'out',
-            'osd.{}'.format(dead_osd_number)])
+        osd_name = 'osd.{}'.format(dead_osd_number)
+        executor = get_executor()
+        executor.check_output(CephCommand(
+            'osd out', args=[('ids', [osd_name])], service='osd-upgrade'))
 
         # Kill the osd process if it's not already dead
         if systemd():
@@ -901,25 +2401,14 @@ def replace_osd(dead_osd_number,
                 mount_point, os.strerror(ret)))
         # Clean up the old mount point
         shutil.rmtree(mount_point)
-        subprocess.check_output([
-            'ceph',
-            '--id',
-            'osd-upgrade',
-            'osd', 'crush', 'remove',
-            'osd.{}'.format(dead_osd_number)])
+        executor.check_output(CephCommand(
+            'osd crush remove', args=[('name', osd_name)],
+            service='osd-upgrade'))
         # Revoke the OSDs access keys
-        subprocess.check_output([
-            'ceph',
-            '--id',
-            'osd-upgrade',
-            'auth', 'del',
-            'osd.{}'.format(dead_osd_number)])
-        subprocess.check_output([
-            'ceph',
-            '--id',
-            'osd-upgrade',
-            'osd', 'rm',
-            'osd.{}'.format(dead_osd_number)])
+        executor.check_output(CephCommand(
+            'auth del', args=[('entity', osd_name)], service='osd-upgrade'))
+        executor.check_output(CephCommand(
+            'osd rm', args=[('ids', [osd_name])], service='osd-upgrade'))
         status_set('maintenance', 'Setting up replacement osd {}'.format(
             new_osd_device))
         osdize(new_osd_device,
@@ -931,13 +2420,17 @@ def replace_osd(dead_osd_number,
         log('replace_osd failed with error: ' + e.output)
 
 
-def get_partition_list(dev):
+def get_partition_list(dev, inventory=None):
     """Lists the partitions of a block device.
 
     :param dev: Path to a block device. ex: /dev/sda
+    :param inventory: BlockInventory. Answer from this inventory rather
+                      than running partx
     :returns: Returns a list of Partition objects.
     :raises: CalledProcessException if lsblk fails
     """
+    if inventory is not None:
+        return inventory.get_partition_list(dev)
     partitions_list = []
     try:
         partitions = get_partitions(dev)
@@ -970,7 +2463,9 @@ def get_partition_list(dev):
         raise
 
 
-def is_osd_disk(dev):
+def is_osd_disk(dev, inventory=None):
+    if inventory is not None:
+        return inventory.is_osd_disk(dev)
     partitions = get_partition_list(dev)
     for partition in partitions:
         try:
@@ -1178,6 +2673,11 @@ mds_caps = collections.OrderedDict([
 osd_upgrade_caps = collections.OrderedDict([
     ('mon', ['allow command "config-key"',
              'allow command "osd tree"',
+             'allow command "osd stat"',
+             'allow command "osd crush rule dump"',
+             'allow command "osd pool ls"',
+             'allow command "pg stat"',
+             'allow command "osd dump"',
              'allow command "config-key list"',
              'allow command "config-key put"',
              'allow command "config-key get"',
@@ -1190,28 +2690,24 @@ osd_upgrade_caps = collections.OrderedDict([
 ])
 
 
+def _mon_keyring_command(prefix, args):
+    """Build a command authenticated with this unit's mon. keyring."""
+    return CephCommand(prefix, args=args, user=ceph_user(), name='mon.',
+                       keyring='/var/lib/ceph/mon/ceph-{}/keyring'.format(
+                           socket.gethostname()))
+
+
 def create_named_keyring(entity, name, caps=None):
     caps = caps or _default_caps
-    cmd = [
-        "sudo",
-        "-u",
-        ceph_user(),
-        'ceph',
-        '--name', 'mon.',
-        '--keyring',
-        '/var/lib/ceph/mon/ceph-{}/keyring'.format(
-            socket.gethostname()
-        ),
-        'auth', 'get-or-create', '{entity}.{name}'.format(entity=entity,
-                                                          name=name),
-    ]
+    cmd_caps = []
     for subsystem, subcaps in caps.items():
-        cmd.extend([subsystem, '; '.join(subcaps)])
+        cmd_caps.extend([subsystem, '; '.join(subcaps)])
+    cmd = _mon_keyring_command(
+        'auth get-or-create',
+        [('entity', '{entity}.{name}'.format(entity=entity, name=name)),
+         ('caps', cmd_caps)])
     log("Calling check_output: {}".format(cmd), level=DEBUG)
-    return (parse_key(str(subprocess
-                          .check_output(cmd)
-                          .decode('UTF-8'))
-                      .strip()))  # IGNORE:E1103
+    return parse_key(get_executor().check_output(cmd).strip())
 
 
 def get_upgrade_key():
@@ -1228,37 +2724,14 @@ def get_named_key(name, caps=None, pool_list=None):
     """
     try:
         # Does the key already exist?
-        output = str(subprocess.check_output(
-            [
-                'sudo',
-                '-u', ceph_user(),
-                'ceph',
-                '--name', 'mon.',
-                '--keyring',
-                '/var/lib/ceph/mon/ceph-{}/keyring'.format(
-                    socket.gethostname()
-                ),
-                'auth',
-                'get',
-                'client.{}'.format(name),
-            ]).decode('UTF-8')).strip()
+        output = get_executor().check_output(_mon_keyring_command(
+            'auth get', [('entity', 'client.{}'.format(name))])).strip()
         return parse_key(output)
     except subprocess.CalledProcessError:
         # Couldn't get the key, time to create it!
         log("Creating new key for {}".format(name), level=DEBUG)
     caps = caps or _default_caps
-    cmd = [
-        "sudo",
-        "-u",
-        ceph_user(),
-        'ceph',
-        '--name', 'mon.',
-        '--keyring',
-        '/var/lib/ceph/mon/ceph-{}/keyring'.format(
-            socket.gethostname()
-        ),
-        'auth', 'get-or-create', 'client.{}'.format(name),
-    ]
+    cmd_caps = []
     # Add capabilities
     for subsystem, subcaps in caps.items():
         if subsystem == 'osd':
@@ -1267,13 +2740,13 @@ def get_named_key(name, caps=None, pool_list=None):
                 # "pool=rgw pool=rbd pool=something"
                 pools = " ".join(['pool={0}'.format(i) for i in pool_list])
                 subcaps[0] = subcaps[0] + " " + pools
-        cmd.extend([subsystem, '; '.join(subcaps)])
+        cmd_caps.extend([subsystem, '; '.join(subcaps)])
+    cmd = _mon_keyring_command('auth get-or-create',
+                               [('entity', 'client.{}'.format(name)),
+                                ('caps', cmd_caps)])
 
     log("Calling check_output: {}".format(cmd), level=DEBUG)
-    return parse_key(str(subprocess
-                         .check_output(cmd)
-                         .decode('UTF-8'))
-                     .strip())  # IGNORE:E1103
+    return parse_key(get_executor().check_output(cmd).strip())
 
 
 def upgrade_key_caps(key, caps):
@@ -1281,12 +2754,12 @@ def upgrade_key_caps(key, caps):
     if not is_leader():
         # Not the MON leader OR not clustered
         return
-    cmd = [
-        "sudo", "-u", ceph_user(), 'ceph', 'auth', 'caps', key
-    ]
+    cmd_caps = []
     for subsystem, subcaps in caps.items():
-        cmd.extend([subsystem, '; '.join(subcaps)])
-    subprocess.check_call(cmd)
+        cmd_caps.extend([subsystem, '; '.join(subcaps)])
+    get_executor().check_call(CephCommand(
+        'auth caps', args=[('entity', key), ('caps', cmd_caps)],
+        user=ceph_user()))
 
 
 @cached
@@ -1338,6 +2811,7 @@ def add_keyring_to_ceph(keyring, secret, hostname, path, done, init_marker):
                            '-i', hostname,
                            '--keyring', keyring])
     chownr(path, ceph_user(), ceph_user())
+    _clear_ownership_markers(path)
     with open(done, 'w'):
         pass
     with open(init_marker, 'w'):
@@ -1385,7 +2859,9 @@ def maybe_zap_journal(journal_dev):
     log("Zapped journal device {}".format(journal_dev))
 
 
-def get_partitions(dev):
+def get_partitions(dev, inventory=None):
+    if inventory is not None:
+        return inventory.get_partitions(dev)
     cmd = ['partx', '--raw', '--noheadings', dev]
     try:
         out = str(subprocess.check_output(cmd).decode('UTF-8')).splitlines()
@@ -1399,16 +2875,144 @@ def get_partitions(dev):
 def find_least_used_utility_device(utility_devices):
     """
     Find a utility device which has the smallest number of partitions
-    among other devices in the supplied list.
+    among other devices in the supplied list, weighted by their capacity
+    and throughput class (see UtilityDevicePlanner).
+
+    The partitions are counted afresh on every call and nothing is
+    reserved, so calling this does not change later answers.
 
     :utility_devices: A list of devices to be used for filestore journal
     or bluestore wal or db.
     :return: string device name
     """
+    return UtilityDevicePlanner(utility_devices).least_loaded()
+
+
+# Relative throughput of the classes of utility devices
+UTILITY_CLASS_WEIGHTS = {'nvme': 4, 'ssd': 2, 'hdd': 1}
+
+
+def _read_block_attr(dev, attr):
+    """Returns a sysfs attribute of a block device or None if unreadable.
+
+    :param dev: str. The device, Example: /dev/sdb
+    :param attr: str. The attribute, Example: queue/rotational
+    """
+    name = os.path.basename(os.path.realpath(dev))
+    try:
+        with open(os.path.join(SYS_CLASS_BLOCK, name, attr), 'r') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _write_block_attr(dev, attr, value):
+    """Writes a sysfs attribute of a block device.
+
+    :param dev: str. The device, Example: /dev/sdb
+    :param attr: str. The attribute, Example: queue/nr_requests
+    :param value: The value to write
+    :returns: bool. True if the attribute was written
+    """
+    name = os.path.basename(os.path.realpath(dev))
+    path = os.path.join(SYS_CLASS_BLOCK, name, attr)
+    try:
+        with open(path, 'w') as f:
+            f.write(str(value))
+        return True
+    except IOError as e:
+        log('Failed to write {} to {}. Error: {}'.format(value, path, e),
+            level=ERROR)
+        return False
+
+
+def get_device_class(dev, inventory=None):
+    """Returns the throughput class of a block device.
+
+    :param dev: str. The device, Example: /dev/sdb
+    :param inventory: BlockInventory. Answer from this inventory rather
+                      than sysfs
+    :returns: str. 'nvme', 'ssd' or 'hdd'; devices which cannot be
+              inspected are treated as 'hdd'
+    """
+    if os.path.basename(os.path.realpath(dev)).startswith('nvme'):
+        return 'nvme'
+    if inventory is not None:
+        rotational = inventory.is_rotational(dev)
+    else:
+        rotational = _read_block_attr(dev, 'queue/rotational') != '0'
+    return 'hdd' if rotational in (True, None) else 'ssd'
+
+
+def get_device_size(dev, inventory=None):
+    """Returns the size of a block device in bytes or None if unknown."""
+    if inventory is not None:
+        return inventory.get_size(dev)
+    sectors = _read_block_attr(dev, 'size')
+    if not sectors or not sectors.isdigit():
+        return None
+    return int(sectors) * 512
+
+
+class UtilityDevicePlanner(object):
+    """Plans which utility device each OSD's journal, WAL or DB uses.
+
+    The partitions of each utility device are counted once.  Every
+    assignment then goes to the device with the lowest load, where load
+    is the partition count (including those already planned) divided by a
+    weight.  The weight is the device's throughput class weight from
+    UTILITY_CLASS_WEIGHTS scaled by its size relative to the largest
+    device, so bigger and faster devices take proportionally more slots.
+    Assignments are kept, so planning a device twice gives the same
+    answer.
+    """
 
-    usages = map(lambda a: (len(get_partitions(a)), a), utility_devices)
-    least = min(usages, key=lambda t: t[0])
-    return least[1]
+    def __init__(self, utility_devices, inventory=None):
+        """
+        :param utility_devices: A list of devices to be used for filestore
+                                journal or bluestore wal or db.
+        :param inventory: BlockInventory. Read partitions, sizes and
+                          classes from this inventory
+        """
+        self.slots = {}
+        self.weights = {}
+        self.plan = {}
+        self._lock = threading.Lock()
+        sizes = dict((device, get_device_size(device, inventory))
+                     for device in utility_devices)
+        largest = max([size for size in sizes.values() if size] or [1])
+        for device in utility_devices:
+            self.slots[device] = len(get_partitions(device, inventory))
+            capacity = float(sizes[device] or largest) / largest
+            self.weights[device] = capacity * UTILITY_CLASS_WEIGHTS[
+                get_device_class(device, inventory)]
+
+    def load(self, device, extra=0):
+        """Returns the load of device with extra more partitions."""
+        return (self.slots[device] + extra) / self.weights[device]
+
+    def least_loaded(self):
+        """Returns the utility device one more partition should go to,
+        without reserving it."""
+        return min(sorted(self.slots),
+                   key=lambda d: (self.load(d, 1), self.slots[d]))
+
+    def assign(self, dev, role=None):
+        """Reserves a utility device for one more partition.
+
+        :param dev: str. The data device the partition is for.  A data
+                    device which was planned before for the same role
+                    keeps its utility device.
+        :param role: str. 'journal', 'wal' or 'db'
+        :returns: str. The utility device
+        """
+        with self._lock:
+            if (dev, role) in self.plan:
+                return self.plan[(dev, role)]
+            device = self.least_loaded()
+            self.slots[device] += 1
+            self.plan[(dev, role)] = device
+            return device
 
 
 def get_devices(name):
@@ -1425,38 +3029,153 @@ def get_devices(name):
     devices.extend((storage_get('location', s) for s in storage_ids))
     devices = filter(os.path.exists, devices)
 
-    return set(devices)
+    return set(devices)
+
+
+def osdize(dev, osd_format, osd_journal, reformat_osd=False,
+           ignore_errors=False, encrypt=False, bluestore=False):
+    if dev.startswith('/dev'):
+        osdize_dev(dev, osd_format, osd_journal,
+                   reformat_osd, ignore_errors, encrypt,
+                   bluestore)
+    else:
+        osdize_dir(dev, encrypt, bluestore)
+
+
+# The most devices prepared at once, in total and per storage controller
+OSDIZE_MAX_WORKERS = 16
+OSDIZE_PER_CONTROLLER = 4
+
+_PCI_ADDRESS = re.compile(r'[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-9a-f]')
+
+
+def get_device_controller(dev):
+    """Returns the storage controller a block device is attached to.
+
+    :param dev: str. The device, Example: /dev/sdb
+    :returns: str. The PCI address of the controller or None if the device
+              is not behind a PCI device
+    """
+    name = os.path.basename(os.path.realpath(dev))
+    sys_path = os.path.realpath(os.path.join(SYS_CLASS_BLOCK, name))
+    addresses = _PCI_ADDRESS.findall(sys_path)
+    if not addresses:
+        return None
+    return addresses[-1]
+
+
+def plan_utility_devices(devices, utility_devices, role=None,
+                         inventory=None, planners=None):
+    """Assigns one of utility_devices to each of devices.
+
+    The assignments come from a planner for utility_devices (see
+    UtilityDevicePlanner) so that the devices are spread evenly.
+
+    :param devices: list of str. The devices to plan for
+    :param utility_devices: A list of devices to be used for filestore
+                            journal or bluestore wal or db.
+    :param role: str. 'journal', 'wal' or 'db'
+    :param inventory: BlockInventory. Used when a new planner is needed
+    :param planners: dict. Planners shared by calls planning together,
+                     keyed by their devices, so that a set of devices given
+                     for both WAL and DB is balanced as a whole; a new
+                     planner counting the partitions afresh is used when
+                     None
+    :returns: dict of device to utility device
+    """
+    if not utility_devices:
+        return {}
+    if planners is None:
+        planners = {}
+    key = tuple(sorted(set(utility_devices)))
+    if key not in planners:
+        planners[key] = UtilityDevicePlanner(key, inventory)
+    return dict((dev, planners[key].assign(dev, role)) for dev in devices)
+
+
+def plan_osd_placement(devices, osd_journal=None, bluestore=False,
+                       inventory=None):
+    """Plans the journal, WAL and DB devices of each device up front.
+
+    :param devices: list of str. The devices to plan for
+    :param osd_journal: list of str. The filestore journal devices
+    :param bluestore: bool. Whether to plan bluestore WAL and DB devices
+    :param inventory: BlockInventory. Used when a new planner is needed
+    :returns: dict of device to a dict with the 'journal', 'wal' and 'db'
+              devices planned for it, where there are any
+    """
+    plan = dict((dev, {}) for dev in devices)
+    planners = {}
+    roles = []
+    if bluestore:
+        roles.append(('wal', get_devices('bluestore-wal')))
+        roles.append(('db', get_devices('bluestore-db')))
+    if osd_journal:
+        roles.append(('journal', osd_journal))
+    for role, utility_devices in roles:
+        for dev, device in plan_utility_devices(devices, utility_devices,
+                                                role, inventory,
+                                                planners).items():
+            plan[dev][role] = device
+    return plan
+
+
+def _osdize_dev_skip_reason(dev, reformat_osd=False, inventory=None):
+    """Returns why dev should not be prepared as an OSD, or None."""
+    if not os.path.exists(dev):
+        return 'Path {} does not exist - bailing'.format(dev)
 
+    if not is_block_device(dev):
+        return 'Path {} is not a block device - bailing'.format(dev)
 
-def osdize(dev, osd_format, osd_journal, reformat_osd=False,
-           ignore_errors=False, encrypt=False, bluestore=False):
-    if dev.startswith('/dev'):
-        osdize_dev(dev, osd_format, osd_journal,
-                   reformat_osd, ignore_errors, encrypt,
-                   bluestore)
+    if is_osd_disk(dev, inventory) and not reformat_osd:
+        return ('Looks like {} is already an'
+                ' OSD data or journal, skipping.'.format(dev))
+
+    if inventory is not None:
+        mounted = inventory.is_device_mounted(dev)
     else:
-        osdize_dir(dev, encrypt, bluestore)
+        mounted = is_device_mounted(dev)
+    if mounted:
+        return 'Looks like {} is in use, skipping.'.format(dev)
+    return None
 
 
 def osdize_dev(dev, osd_format, osd_journal, reformat_osd=False,
                ignore_errors=False, encrypt=False, bluestore=False):
-    if not os.path.exists(dev):
-        log('Path {} does not exist - bailing'.format(dev))
-        return
+    """Ask ceph-disk to prepare a block device to become an osd.
 
-    if not is_block_device(dev):
-        log('Path {} is not a block device - bailing'.format(dev))
-        return
+    :returns: bool. True if the device was prepared
+    """
+    reason = _osdize_dev_skip_reason(dev, reformat_osd)
+    if reason:
+        log(reason)
+        return False
 
-    if is_osd_disk(dev) and not reformat_osd:
-        log('Looks like {} is already an'
-            ' OSD data or journal, skipping.'.format(dev))
-        return
+    placement = plan_osd_placement(
+        [dev], osd_journal,
+        bluestore and cmp_pkgrevno('ceph', '10.2.0') >= 0)[dev]
+    try:
+        _prepare_osd_dev(dev, osd_format, placement, reformat_osd, encrypt,
+                         bluestore)
+    except subprocess.CalledProcessError:
+        if ignore_errors:
+            log('Unable to initialize device: {}'.format(dev), WARNING)
+            return False
+        else:
+            log('Unable to initialize device: {}'.format(dev), ERROR)
+            raise
+    return True
 
-    if is_device_mounted(dev):
-        log('Looks like {} is in use, skipping.'.format(dev))
-        return
 
+def _prepare_osd_dev(dev, osd_format, placement, reformat_osd=False,
+                     encrypt=False, bluestore=False):
+    """Runs ceph-disk prepare for dev.
+
+    :param placement: dict. The 'journal', 'wal' and 'db' devices for dev
+                      from plan_osd_placement
+    :raises CalledProcessError: if ceph-disk fails
+    """
     status_set('maintenance', 'Initializing device {}'.format(dev))
     cmd = ['ceph-disk', 'prepare']
     # Later versions of ceph support more options
@@ -1474,24 +3193,19 @@ def osdize_dev(dev, osd_format, osd_journal, reformat_osd=False,
         # NOTE(jamespage): enable experimental bluestore support
         if cmp_pkgrevno('ceph', '10.2.0') >= 0 and bluestore:
             cmd.append('--bluestore')
-            wal = get_devices('bluestore-wal')
-            if wal:
+            if placement.get('wal'):
                 cmd.append('--block.wal')
-                least_used_wal = find_least_used_utility_device(wal)
-                cmd.append(least_used_wal)
-            db = get_devices('bluestore-db')
-            if db:
+                cmd.append(placement['wal'])
+            if placement.get('db'):
                 cmd.append('--block.db')
-                least_used_db = find_least_used_utility_device(db)
-                cmd.append(least_used_db)
+                cmd.append(placement['db'])
         elif cmp_pkgrevno('ceph', '12.1.0') >= 0 and not bluestore:
             cmd.append('--filestore')
 
         cmd.append(dev)
 
-        if osd_journal:
-            least_used = find_least_used_utility_device(osd_journal)
-            cmd.append(least_used)
+        if placement.get('journal'):
+            cmd.append(placement['journal'])
     else:
         # Just provide the device - no other options
         # for older versions of ceph
@@ -1499,15 +3213,120 @@ def osdize_dev(dev, osd_format, osd_journal, reformat_osd=False,
         if reformat_osd:
             zap_disk(dev)
 
+    log("osdize cmd: {}".format(cmd))
+    subprocess.check_call(cmd)
+
+
+def _interleave_by_controller(devices, controllers):
+    """Orders devices so that consecutive devices use other controllers."""
+    queues = collections.OrderedDict()
+    for dev in devices:
+        queues.setdefault(controllers[dev], []).append(dev)
+    ordered = []
+    while queues:
+        for controller in list(queues):
+            ordered.append(queues[controller].pop(0))
+            if not queues[controller]:
+                del queues[controller]
+    return ordered
+
+
+def osdize_many(devices, osd_format, osd_journal, reformat_osd=False,
+                encrypt=False, bluestore=False,
+                max_workers=OSDIZE_MAX_WORKERS,
+                per_controller=OSDIZE_PER_CONTROLLER):
+    """Prepares many devices or directories as OSDs, several at a time.
+
+    The devices which can be used are found first, from one
+    BlockInventory scan, and their journal, WAL and DB devices are
+    planned together (see plan_osd_placement), then up
+    to max_workers devices are prepared at once with no more than
+    per_controller of them on the same storage controller.  Devices
+    sharing a journal, WAL or DB device are prepared one after another so
+    that their partitions are not created at the same time.  Directories
+    are prepared one at a time.
+
+    :param devices: list of str. Block devices or directories
+    :param osd_format: str. The filesystem for filestore OSDs
+    :param osd_journal: list of str. The filestore journal devices
+    :param reformat_osd: bool. Whether to zap devices which are OSDs
+    :param encrypt: bool. Whether to encrypt the OSDs
+    :param bluestore: bool. Whether to use bluestore
+    :param max_workers: int. The most devices prepared at once
+    :param per_controller: int. The most devices prepared at once on one
+                           controller
+    :returns: OrderedDict of device to a result dict.  'status' is one of
+              'prepared', 'skipped' (with a 'reason') or 'failed' (with an
+              'error'); prepared and failed devices also have their
+              'placement' and the 'elapsed' seconds.
+    """
+    results = collections.OrderedDict((dev, None) for dev in devices)
+    inventory = None
+    if any(dev.startswith('/dev') for dev in devices):
+        inventory = BlockInventory.cached()
+    disks = []
+    for dev in devices:
+        if dev.startswith('/dev'):
+            reason = _osdize_dev_skip_reason(dev, reformat_osd, inventory)
+            if reason:
+                log(reason)
+                results[dev] = {'status': 'skipped', 'reason': reason}
+            else:
+                disks.append(dev)
+            continue
+        try:
+            if osdize_dir(dev, encrypt, bluestore):
+                results[dev] = {'status': 'prepared'}
+            else:
+                results[dev] = {'status': 'skipped',
+                                'reason': 'Unable to use {}'.format(dev)}
+        except subprocess.CalledProcessError as err:
+            results[dev] = {'status': 'failed', 'error': str(err)}
+    if not disks:
+        return results
+
+    plan = plan_osd_placement(
+        disks, osd_journal,
+        bluestore and cmp_pkgrevno('ceph', '10.2.0') >= 0, inventory)
+    controllers = dict((dev, get_device_controller(dev)) for dev in disks)
+    slots = dict((controller, threading.Semaphore(per_controller))
+                 for controller in set(controllers.values()))
+    utility_locks = dict((device, threading.Lock())
+                         for placement in plan.values()
+                         for device in placement.values())
+
+    def prepare(dev):
+        start = time.time()
+        locks = [utility_locks[device]
+                 for device in sorted(set(plan[dev].values()))]
+        with slots[controllers[dev]]:
+            for lock in locks:
+                lock.acquire()
+            try:
+                _prepare_osd_dev(dev, osd_format, plan[dev], reformat_osd,
+                                 encrypt, bluestore)
+                result = {'status': 'prepared'}
+            except subprocess.CalledProcessError as err:
+                log('Unable to initialize device: {}'.format(dev), ERROR)
+                result = {'status': 'failed', 'error': str(err)}
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+        result['placement'] = plan[dev]
+        result['elapsed'] = time.time() - start
+        return dev, result
+
+    log('Preparing {} devices, at most {} at once and {} per '
+        'controller'.format(len(disks), max_workers, per_controller))
+    pool = ThreadPool(processes=min(max_workers, len(disks)))
     try:
-        log("osdize cmd: {}".format(cmd))
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError:
-        if ignore_errors:
-            log('Unable to initialize device: {}'.format(dev), WARNING)
-        else:
-            log('Unable to initialize device: {}'.format(dev), ERROR)
-            raise
+        for dev, result in pool.imap_unordered(
+                prepare, _interleave_by_controller(disks, controllers)):
+            results[dev] = result
+    finally:
+        pool.close()
+        pool.join()
+    return results
 
 
 def osdize_dir(path, encrypt=False, bluestore=False):
@@ -1515,19 +3334,20 @@ def osdize_dir(path, encrypt=False, bluestore=False):
 
     :param path: str. The directory to osdize
     :param encrypt: bool. Should the OSD directory be encrypted at rest
-    :returns: None
+    :returns: bool. True if the directory was prepared
     """
     if os.path.exists(os.path.join(path, 'upstart')):
         log('Path {} is already configured as an OSD - bailing'.format(path))
-        return
+        return False
 
     if cmp_pkgrevno('ceph', "0.56.6") < 0:
         log('Unable to use directories for OSDs with ceph < 0.56.6',
             level=ERROR)
-        return
+        return False
 
     mkdir(path, owner=ceph_user(), group=ceph_user(), perms=0o755)
     chownr('/var/lib/ceph', ceph_user(), ceph_user())
+    _clear_ownership_markers('/var/lib/ceph')
     cmd = [
         'sudo', '-u', ceph_user(),
         'ceph-disk',
@@ -1546,6 +3366,7 @@ def osdize_dir(path, encrypt=False, bluestore=False):
         cmd.append('--filestore')
     log("osdize dir cmd: {}".format(cmd))
     subprocess.check_call(cmd)
+    return True
 
 
 def filesystem_mounted(fs):
@@ -1572,9 +3393,8 @@ def get_cephfs(service):
         # This command wasn't introduced until 0.86 ceph
         return []
     try:
-        output = str(subprocess
-                     .check_output(["ceph", '--id', service, "fs", "ls"])
-                     .decode('UTF-8'))
+        output = get_executor().check_output(
+            CephCommand('fs ls', service=service))
         if not output:
             return []
         """
@@ -1593,35 +3413,146 @@ def get_cephfs(service):
         return []
 
 
+# Backoff, in seconds, used while waiting on other units during a
+# rolling upgrade
+UPGRADE_POLL_INITIAL = 1
+UPGRADE_POLL_MAX = 16
+# How long a unit may take to upgrade before it is considered dead
+UPGRADE_NODE_TIMEOUT = 10 * 60
+# The fraction of PGs which may be unclean when the next OSD host starts.
+# PGs which were already unclean before a host was upgraded, such as those
+# of a known-degraded pool or stuck undersized, are allowed on top of this,
+# so they do not hold every host for UPGRADE_NODE_TIMEOUT.  Callers of
+# roll_osd_cluster can pass max_unclean_pgs to be stricter or looser.
+UPGRADE_MAX_UNCLEAN_PGS = 0.01
+# A failure domain bucket upgrades all its hosts at once when the previous
+# bucket recovered within this many seconds, fewer when it took longer
+UPGRADE_RECOVERY_TARGET = 2 * 60
+
+
+def wait_for(condition, deadline=None, initial=UPGRADE_POLL_INITIAL,
+             maximum=UPGRADE_POLL_MAX):
+    """Wait until condition() is true, backing off exponentially.
+
+    The delay starts at initial seconds and doubles up to maximum.  Each
+    sleep is jittered between half and all of the current delay so that
+    units waiting on the same key do not poll in lock step, and is cut
+    short so that the deadline is not overshot.
+
+    :param condition: callable taking no arguments and returning a bool
+    :param deadline: float. time.time() at which to give up or None to
+                     wait forever
+    :param initial: float. The first delay in seconds
+    :param maximum: float. The longest delay in seconds
+    :returns: bool. True if condition() became true, False on timeout
+    """
+    delay = initial
+    while not condition():
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            return False
+        wait_time = random.uniform(delay / 2.0, delay)
+        if deadline is not None:
+            wait_time = min(wait_time, deadline - now)
+        log('waiting for {:.1f} seconds'.format(wait_time), level=DEBUG)
+        time.sleep(wait_time)
+        delay = min(delay * 2, maximum)
+    return True
+
+
+def _log_upgrade_timing(service, my_name, waited, worked):
+    """Log how long this unit spent waiting on others versus upgrading."""
+    log('{} {} spent {:.1f} seconds waiting on other units and {:.1f} '
+        'seconds upgrading'.format(service, my_name, waited, worked))
+
+
+def wait_for_pg_recovery(service=None, max_unclean=UPGRADE_MAX_UNCLEAN_PGS,
+                         deadline=None):
+    """Wait until no more than max_unclean of the PGs are not active+clean.
+
+    :param service: String service id to run under
+    :param max_unclean: float. The fraction of PGs allowed to be unclean
+    :param deadline: float. time.time() at which to give up or None to
+                     wait forever
+    :returns: bool. True if the PGs recovered, False on timeout
+    :raises: CalledProcessError if our ceph command fails.
+    """
+    def recovered():
+        unclean = get_unclean_pg_fraction(service=service)
+        if unclean > max_unclean:
+            log('{:.1%} of PGs are not active+clean, waiting for recovery '
+                '(allowed {:.1%})'.format(unclean, max_unclean))
+            return False
+        return True
+
+    return wait_for(recovered, deadline=deadline)
+
+
+def get_upgrade_recovery_time(upgrade_key, service, nodes, version):
+    """Return the longest PG recovery recorded by lock_and_roll for nodes.
+
+    :param upgrade_key: str. The cephx key to use
+    :param service: str. The cephx id to use
+    :param nodes: list of str. The names of the upgraded nodes
+    :param version: str. The version upgraded to
+    :returns: float seconds or None if no node recorded a recovery time
+    """
+    times = []
+    for node in nodes:
+        recovery = monitor_key_get(upgrade_key, "{}_{}_{}_recovery".format(
+            service, node, version))
+        if recovery is not None:
+            times.append(float(recovery))
+    if not times:
+        return None
+    return max(times)
+
+
+def get_upgrade_concurrency(group_size, recovery_time):
+    """Return how many hosts of a failure domain bucket may upgrade at once.
+
+    The whole bucket rolls together when the previous bucket recovered
+    within UPGRADE_RECOVERY_TARGET seconds (or nothing has been upgraded
+    yet); slower recoveries shrink the number proportionally, down to one
+    host at a time.
+
+    :param group_size: int. The number of hosts in the bucket
+    :param recovery_time: float seconds the previous bucket took to
+                          recover or None
+    :returns: int
+    """
+    if recovery_time is None or recovery_time <= UPGRADE_RECOVERY_TARGET:
+        return group_size
+    return max(1, int(group_size * UPGRADE_RECOVERY_TARGET / recovery_time))
+
+
 def wait_for_all_monitors_to_upgrade(new_version, upgrade_key):
     """Fairly self explanatory name. This function will wait
     for all monitors in the cluster to upgrade or it will
-    return after a timeout period has expired.
+    raise after a timeout period has expired.
 
     :param new_version: str of the version to watch
     :param upgrade_key: the cephx key name to use
+    :raises: Exception if the monitors are not upgraded within
+             UPGRADE_NODE_TIMEOUT seconds.
+    :raises: CalledProcessError if our ceph command fails.
     """
-    done = False
-    start_time = time.time()
+    deadline = time.time() + UPGRADE_NODE_TIMEOUT
     monitor_list = []
 
     mon_map = get_mon_map('admin')
     if mon_map['monmap']['mons']:
         for mon in mon_map['monmap']['mons']:
             monitor_list.append(mon['name'])
-    while not done:
-        try:
-            done = all(monitor_key_exists(upgrade_key, "{}_{}_{}_done".format(
-                "mon", mon, new_version
-            )) for mon in monitor_list)
-            current_time = time.time()
-            if current_time > (start_time + 10 * 60):
-                raise Exception
-            else:
-                # Wait 30 seconds and test again if all monitors are upgraded
-                time.sleep(30)
-        except subprocess.CalledProcessError:
-            raise
+
+    def all_done():
+        return all(monitor_key_exists(upgrade_key, "{}_{}_{}_done".format(
+            "mon", mon, new_version
+        )) for mon in monitor_list)
+
+    if not wait_for(all_done, deadline=deadline):
+        raise Exception("Timed out waiting for all monitors to upgrade "
+                        "to {}".format(new_version))
 
 
 # Edge cases:
@@ -1630,8 +3561,8 @@ def roll_monitor_cluster(new_version, upgrade_key):
     """This is tricky to get right so here's what we're going to do.
 
     There's 2 possible cases: Either I'm first in line or not.
-    If I'm not first in line I'll wait a random time between 5-30 seconds
-    and test to see if the previous monitor is upgraded yet.
+    If I'm not first in line I'll wait for the previous monitor's done
+    key, polling with a jittered exponential backoff (see wait_for).
 
     :param new_version: str of the version to upgrade to
     :param upgrade_key: the cephx key name to use when upgrading
@@ -1654,14 +3585,8 @@ def roll_monitor_cluster(new_version, upgrade_key):
     try:
         position = mon_sorted_list.index(my_name)
         log("upgrade position: {}".format(position))
-        if position == 0:
-            # I'm first!  Roll
-            # First set a key to inform others I'm about to roll
-            lock_and_roll(upgrade_key=upgrade_key,
-                          service='mon',
-                          my_name=my_name,
-                          version=new_version)
-        else:
+        started = time.time()
+        if position > 0:
             # Check if the previous node has finished
             status_set('waiting',
                        'Waiting on {} to finish upgrading'.format(
@@ -1670,17 +3595,23 @@ def roll_monitor_cluster(new_version, upgrade_key):
                                   service='mon',
                                   previous_node=mon_sorted_list[position - 1],
                                   version=new_version)
-            lock_and_roll(upgrade_key=upgrade_key,
-                          service='mon',
-                          my_name=my_name,
-                          version=new_version)
+        # Set a key to inform others I'm about to roll, then roll
+        rolling = time.time()
+        lock_and_roll(upgrade_key=upgrade_key,
+                      service='mon',
+                      my_name=my_name,
+                      version=new_version)
+        finished = time.time()
+        waited = rolling - started
         # NOTE(jamespage):
         # Wait until all monitors have upgraded before bootstrapping
         # the ceph-mgr daemons due to use of new mgr keyring profiles
         if new_version == 'luminous':
             wait_for_all_monitors_to_upgrade(new_version=new_version,
                                              upgrade_key=upgrade_key)
+            waited += time.time() - finished
             bootstrap_manager()
+        _log_upgrade_timing('mon', my_name, waited, finished - rolling)
     except ValueError:
         log("Failed to find {} in list {}.".format(
             my_name, mon_sorted_list))
@@ -1727,6 +3658,8 @@ def upgrade_monitor(new_version):
                    owner=owner,
                    group=owner,
                    follow_links=True)
+            _clear_ownership_markers(os.path.join(os.sep, "var", "lib",
+                                                  "ceph"))
 
         # Ensure that mon directory is user writable
         hostname = socket.gethostname()
@@ -1745,13 +3678,22 @@ def upgrade_monitor(new_version):
         sys.exit(1)
 
 
-def lock_and_roll(upgrade_key, service, my_name, version):
+def lock_and_roll(upgrade_key, service, my_name, version,
+                  max_unclean_pgs=UPGRADE_MAX_UNCLEAN_PGS):
     """Create a lock on the ceph monitor cluster and upgrade.
 
+    After upgrading an OSD host the done key is only set once no more than
+    max_unclean_pgs of the PGs, or the fraction which was already unclean
+    before the upgrade if that is higher, are unclean, or
+    UPGRADE_NODE_TIMEOUT seconds have passed.  The time the PGs took to
+    recover is recorded for get_upgrade_recovery_time.
+
     :param upgrade_key: str. The cephx key to use
     :param service: str. The cephx id to use
     :param my_name: str. The current hostname
     :param version: str. The version we are upgrading to
+    :param max_unclean_pgs: float. The fraction of PGs which may be
+                            unclean when the next host starts
     """
     start_timestamp = time.time()
 
@@ -1764,6 +3706,14 @@ def lock_and_roll(upgrade_key, service, my_name, version):
         service, my_name, version), start_timestamp)
     log("Rolling")
 
+    already_unclean = 0.0
+    if service == 'osd':
+        try:
+            already_unclean = get_unclean_pg_fraction(service=upgrade_key)
+        except (subprocess.CalledProcessError, ValueError) as err:
+            log("Unable to read the placement group state: {}".format(err),
+                level=DEBUG)
+
     # This should be quick
     if service == 'osd':
         upgrade_osd(version)
@@ -1774,17 +3724,61 @@ def lock_and_roll(upgrade_key, service, my_name, version):
             level=ERROR)
     log("Done")
 
-    stop_timestamp = time.time()
-    # Set a key to inform others I am finished
-    log('monitor_key_set {}_{}_{}_done {}'.format(service,
-                                                  my_name,
-                                                  version,
-                                                  stop_timestamp))
-    status_set('maintenance', 'Finishing upgrade')
-    monitor_key_set(upgrade_key, "{}_{}_{}_done".format(service,
-                                                        my_name,
-                                                        version),
-                    stop_timestamp)
+    try:
+        if service == 'osd':
+            if already_unclean > max_unclean_pgs:
+                log("{:.1%} of PGs were unclean before the upgrade, only "
+                    "waiting for those".format(already_unclean),
+                    level=WARNING)
+            _wait_for_upgrade_recovery(upgrade_key, service, my_name,
+                                       version,
+                                       max(max_unclean_pgs, already_unclean))
+    finally:
+        # The host is upgraded whatever happened while waiting for the
+        # PGs; without the done key every later host would wait out
+        # UPGRADE_NODE_TIMEOUT before treating this one as dead.
+        stop_timestamp = time.time()
+        # Set a key to inform others I am finished
+        log('monitor_key_set {}_{}_{}_done {}'.format(service,
+                                                      my_name,
+                                                      version,
+                                                      stop_timestamp))
+        status_set('maintenance', 'Finishing upgrade')
+        monitor_key_set(upgrade_key, "{}_{}_{}_done".format(service,
+                                                            my_name,
+                                                            version),
+                        stop_timestamp)
+
+
+def _wait_for_upgrade_recovery(upgrade_key, service, my_name, version,
+                               max_unclean_pgs):
+    """Wait for the PGs to recover after upgrading an OSD host and record
+    how long they took for get_upgrade_recovery_time.
+
+    A failure to read the PG state is logged rather than raised, since
+    the host has already been upgraded by then.
+    """
+    recovery_start = time.time()
+    # Other units treat a unit whose start key is too old as dead,
+    # so restart that clock for the recovery wait.
+    monitor_key_set(upgrade_key, "{}_{}_{}_recovering".format(
+        service, my_name, version), recovery_start)
+    status_set('maintenance', 'Waiting for placement groups to recover')
+    try:
+        if not wait_for_pg_recovery(
+                service=upgrade_key, max_unclean=max_unclean_pgs,
+                deadline=recovery_start + UPGRADE_NODE_TIMEOUT):
+            log("Placement groups did not recover within {} seconds, "
+                "moving on".format(UPGRADE_NODE_TIMEOUT), level=WARNING)
+    except (subprocess.CalledProcessError, ValueError) as err:
+        log("Unable to check placement group recovery, moving on: "
+            "{}".format(err), level=WARNING)
+    finally:
+        recovery = time.time() - recovery_start
+        log("Waited {:.1f} seconds for placement groups to recover".format(
+            recovery))
+        monitor_key_set(upgrade_key, "{}_{}_{}_recovery".format(
+            service, my_name, version), recovery)
 
 
 def wait_on_previous_node(upgrade_key, service, previous_node, version):
@@ -1799,11 +3793,11 @@ def wait_on_previous_node(upgrade_key, service, previous_node, version):
     """
     log("Previous node is: {}".format(previous_node))
 
-    previous_node_finished = monitor_key_exists(
-        upgrade_key,
-        "{}_{}_{}_done".format(service, previous_node, version))
-
-    while previous_node_finished is False:
+    def previous_node_finished():
+        if monitor_key_exists(
+                upgrade_key,
+                "{}_{}_{}_done".format(service, previous_node, version)):
+            return True
         log("{} is not finished. Waiting".format(previous_node))
         # Has this node been trying to upgrade for longer than
         # 10 minutes?
@@ -1816,8 +3810,14 @@ def wait_on_previous_node(upgrade_key, service, previous_node, version):
         previous_node_start_time = monitor_key_get(
             upgrade_key,
             "{}_{}_{}_start".format(service, previous_node, version))
+        # A node waiting for PGs to recover after upgrading is alive
+        previous_node_recovering = monitor_key_get(
+            upgrade_key,
+            "{}_{}_{}_recovering".format(service, previous_node, version))
+        if previous_node_recovering is not None:
+            previous_node_start_time = previous_node_recovering
         if (previous_node_start_time is not None and
-                ((current_timestamp - (10 * 60)) >
+                ((current_timestamp - UPGRADE_NODE_TIMEOUT) >
                  float(previous_node_start_time))):
             # NOTE(jamespage):
             # Previous node is probably dead as we've been waiting
@@ -1825,19 +3825,15 @@ def wait_on_previous_node(upgrade_key, service, previous_node, version):
             log("Waited 10 mins on node {}. current time: {} > "
                 "previous node start time: {} Moving on".format(
                     previous_node,
-                    (current_timestamp - (10 * 60)),
+                    (current_timestamp - UPGRADE_NODE_TIMEOUT),
                     previous_node_start_time))
-            return
+            return True
         # NOTE(jamespage)
         # Previous node has not started, or started less than
-        # 10 minutes ago - sleep a random amount of time and
-        # then check again.
-        wait_time = random.randrange(5, 30)
-        log('waiting for {} seconds'.format(wait_time))
-        time.sleep(wait_time)
-        previous_node_finished = monitor_key_exists(
-            upgrade_key,
-            "{}_{}_{}_done".format(service, previous_node, version))
+        # 10 minutes ago - back off and then check again.
+        return False
+
+    wait_for(previous_node_finished)
 
 
 def get_upgrade_position(osd_sorted_list, match_name):
@@ -1853,63 +3849,181 @@ def get_upgrade_position(osd_sorted_list, match_name):
     return None
 
 
-# Edge cases:
-# 1. Previous node dies on upgrade, can we retry?
-# 2. This assumes that the osd failure domain is not set to osd.
-#    It rolls an entire server at a time.
-def roll_osd_cluster(new_version, upgrade_key):
-    """This is tricky to get right so here's what we're going to do.
+# The default CRUSH types, from the most to the least specific
+CRUSH_TYPE_ORDER = ['osd', 'host', 'chassis', 'rack', 'row', 'pdu', 'pod',
+                    'room', 'datacenter', 'region', 'root']
+
+
+def _crush_type_rank(type_name):
+    """Return how wide a CRUSH type is; unknown types count as host."""
+    if type_name in CRUSH_TYPE_ORDER:
+        return CRUSH_TYPE_ORDER.index(type_name)
+    return CRUSH_TYPE_ORDER.index('host')
 
-    There's 2 possible cases: Either I'm first in line or not.
-    If I'm not first in line I'll wait a random time between 5-30 seconds
-    and test to see if the previous osd is upgraded yet.
 
-    TODO: If you're not in the same failure domain it's safe to upgrade
-     1. Examine all pools and adopt the most strict failure domain policy
+def get_upgrade_failure_domain(service):
+    """Return the strictest failure domain used by any pool.
+
+    The CRUSH rule of every pool is examined and the narrowest bucket type
+    chosen by any of their choose/chooseleaf steps is returned.
         Example: Pool 1: Failure domain = rack
         Pool 2: Failure domain = host
         Pool 3: Failure domain = row
 
         outcome: Failure domain = host
 
+    :param service: String service id to run under
+    :returns: str. The CRUSH type name, 'host' if there are no pools
+    :raises: ValueError if the output fails to parse.
+    :raises: CalledProcessError if our ceph command fails.
+    """
+    executor = get_executor()
+    pools = json.loads(executor.check_output(CephCommand(
+        'osd pool ls', args=[('detail', 'detail')], service=service,
+        fmt='json')))
+    rules = json.loads(executor.check_output(CephCommand(
+        'osd crush rule dump', service=service, fmt='json')))
+    by_id = {}
+    by_ruleset = {}
+    for rule in rules:
+        by_id[rule.get('rule_id')] = rule
+        by_ruleset[rule.get('ruleset')] = rule
+    domains = set()
+    for pool in pools:
+        if 'crush_rule' in pool:
+            rule = by_id.get(pool['crush_rule'])
+        else:
+            # Releases before luminous refer to the rule by ruleset
+            rule = by_ruleset.get(pool.get('crush_ruleset'))
+        if rule is None:
+            continue
+        for step in rule.get('steps', []):
+            if step.get('op', '').startswith('choose') and 'type' in step:
+                domains.add(step['type'])
+    if not domains:
+        return 'host'
+    return min(domains, key=_crush_type_rank)
+
+
+def get_upgrade_groups(service, failure_domain):
+    """Group the OSD hosts by the failure domain bucket they belong to.
+
+    Hosts in the same group share a failure domain bucket, so they can be
+    upgraded together without making any placement group lose more than
+    one replica.  When the failure domain is host or narrower every host
+    is its own group.
+
+    :param service: String service id to run under
+    :param failure_domain: str. The CRUSH type of the failure domain
+    :returns: list of (bucket name, sorted list of host names), sorted by
+              bucket name.
+    :raises: ValueError if the tree fails to parse.
+    :raises: CalledProcessError if our ceph command fails.
+    """
+    snapshot = get_osd_tree_snapshot(service)
+    per_host = _crush_type_rank(failure_domain) <= _crush_type_rank('host')
+    groups = {}
+    for node in snapshot.nodes:
+        if node.get('type') != 'host':
+            continue
+        bucket = node
+        while not per_host and bucket is not None:
+            if bucket.get('type') == failure_domain:
+                break
+            bucket = snapshot.parents.get(bucket['id'])
+        if per_host or bucket is None:
+            bucket = node
+        groups.setdefault(bucket['name'], set()).add(node['name'])
+    return [(name, sorted(groups[name])) for name in sorted(groups)]
+
+
+def roll_osd_cluster(new_version, upgrade_key,
+                     max_unclean_pgs=UPGRADE_MAX_UNCLEAN_PGS):
+    """Upgrade the OSD hosts one failure domain bucket at a time.
+
+    The strictest failure domain used by the pools is looked up and the
+    hosts are grouped by the bucket of that type they sit in.  Groups are
+    upgraded in order of their bucket name: the hosts of any group but the
+    first wait for every host of the previous group to set its done key,
+    which lock_and_roll only sets once the PGs have recovered.
+
+    How many hosts of a group roll at once depends on how long the
+    previous group took to recover (see get_upgrade_concurrency); a host
+    beyond that window waits for the host that many places before it.
+
     :param new_version: str of the version to upgrade to
     :param upgrade_key: the cephx key name to use when upgrading
+    :param max_unclean_pgs: float. The fraction of PGs which may be
+                            unclean when the next host starts
     """
     log('roll_osd_cluster called with {}'.format(new_version))
     my_name = socket.gethostname()
-    osd_tree = get_osd_tree(service=upgrade_key)
-    # A sorted list of osd unit names
-    osd_sorted_list = sorted(osd_tree)
-    log("osd_sorted_list: {}".format(osd_sorted_list))
-
+    # Keys created before the failure domain lookups were added cannot run
+    # them, as get-or-create leaves the caps of an existing key alone; fall
+    # back to upgrading one host at a time in name order.
     try:
-        position = get_upgrade_position(osd_sorted_list, my_name)
-        log("upgrade position: {}".format(position))
-        if position == 0:
-            # I'm first!  Roll
-            # First set a key to inform others I'm about to roll
-            lock_and_roll(upgrade_key=upgrade_key,
-                          service='osd',
-                          my_name=my_name,
-                          version=new_version)
-        else:
-            # Check if the previous node has finished
-            status_set('waiting',
-                       'Waiting on {} to finish upgrading'.format(
-                           osd_sorted_list[position - 1].name))
-            wait_on_previous_node(
-                upgrade_key=upgrade_key,
-                service='osd',
-                previous_node=osd_sorted_list[position - 1].name,
-                version=new_version)
-            lock_and_roll(upgrade_key=upgrade_key,
-                          service='osd',
-                          my_name=my_name,
-                          version=new_version)
-    except ValueError:
-        log("Failed to find name {} in list {}".format(
-            my_name, osd_sorted_list))
+        failure_domain = get_upgrade_failure_domain(service=upgrade_key)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        log("Unable to find the failure domain, upgrading one host at a "
+            "time: {}".format(e), level=WARNING)
+        failure_domain = 'host'
+    try:
+        groups = get_upgrade_groups(upgrade_key, failure_domain)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        log("Unable to group the hosts by {}, upgrading one host at a "
+            "time: {}".format(failure_domain, e), level=WARNING)
+        failure_domain = 'host'
+        groups = [(location.name, [location.name]) for location in
+                  sorted(get_osd_tree(service=upgrade_key) or [])]
+    log("failure domain: {} upgrade groups: {}".format(failure_domain,
+                                                       groups))
+
+    position = None
+    for index, (_, hosts) in enumerate(groups):
+        if my_name in hosts:
+            position = index
+            break
+    if position is None:
+        log("Failed to find name {} in groups {}".format(my_name, groups))
         status_set('blocked', 'failed to upgrade osd')
+        return
+    log("upgrade position: {}".format(position))
+
+    started = time.time()
+    recovery_time = None
+    if position > 0:
+        previous_bucket, previous_hosts = groups[position - 1]
+        status_set('waiting',
+                   'Waiting on {} {} to finish upgrading'.format(
+                       failure_domain, previous_bucket))
+        for previous_node in previous_hosts:
+            wait_on_previous_node(upgrade_key=upgrade_key,
+                                  service='osd',
+                                  previous_node=previous_node,
+                                  version=new_version)
+        recovery_time = get_upgrade_recovery_time(
+            upgrade_key, 'osd', previous_hosts, new_version)
+
+    hosts = groups[position][1]
+    concurrency = get_upgrade_concurrency(len(hosts), recovery_time)
+    index = hosts.index(my_name)
+    log("upgrading {} of {} hosts at once".format(concurrency, len(hosts)))
+    if index >= concurrency:
+        status_set('waiting',
+                   'Waiting on {} to finish upgrading'.format(
+                       hosts[index - concurrency]))
+        wait_on_previous_node(upgrade_key=upgrade_key,
+                              service='osd',
+                              previous_node=hosts[index - concurrency],
+                              version=new_version)
+    rolling = time.time()
+    lock_and_roll(upgrade_key=upgrade_key,
+                  service='osd',
+                  my_name=my_name,
+                  version=new_version,
+                  max_unclean_pgs=max_unclean_pgs)
+    _log_upgrade_timing('osd', my_name, rolling - started,
+                        time.time() - rolling)
 
 
 def upgrade_osd(new_version):
@@ -1962,24 +4076,138 @@ def upgrade_osd(new_version):
 
         # Fast service restart wasn't an option because each of the OSD
         # directories need the ownership updated for all the files on
-        # the OSD. Walk through the OSDs one-by-one upgrading the OSD.
+        # the OSD. Upgrade the OSDs, several at a time when it is safe.
+        osds = []
         for osd_dir in _get_child_dirs(OSD_BASE_DIR):
             try:
-                osd_num = _get_osd_num_from_dirname(osd_dir)
-                _upgrade_single_osd(osd_num, osd_dir)
+                osds.append((_get_osd_num_from_dirname(osd_dir), osd_dir))
             except ValueError as ex:
                 # Directory could not be parsed - junk directory?
                 log('Could not parse osd directory %s: %s' % (osd_dir, ex),
                     WARNING)
                 continue
+        _upgrade_osds(osds)
 
-    except (subprocess.CalledProcessError, IOError) as err:
+    except (subprocess.CalledProcessError, IOError, OSError) as err:
         log("Stopping ceph and upgrading packages failed "
             "with message: {}".format(err))
         status_set("blocked", "Upgrade to {} failed".format(new_version))
         sys.exit(1)
 
 
+# The most OSDs whose ownership is migrated at the same time
+OSD_MIGRATION_WORKERS = 4
+
+
+def get_osd_flags(service):
+    """Returns the cluster wide OSD flags.
+
+    :param service: String service id to run under
+    :returns: set of flag names. Example: set(['noout', 'sortbitwise'])
+    :raises: CalledProcessError if our ceph command fails,
+             ValueError if the osdmap fails to parse.
+    """
+    dump = json.loads(get_executor().check_output(
+        CephCommand('osd dump', service=service, fmt='json')))
+    return set(flag for flag in dump.get('flags', '').split(',') if flag)
+
+
+def _osd_migration_concurrency(osd_count, max_workers,
+                               service='osd-upgrade'):
+    """Returns how many OSDs may be stopped for migration at once.
+
+    Several OSDs are only migrated together when noout is set, so that
+    the stopped OSDs are not marked out and rebalanced while their files
+    are re-owned, and when the placement groups are healthy.
+
+    :param osd_count: int. The number of OSDs to migrate
+    :param max_workers: int. The most OSDs to migrate at once
+    :param service: String service id to run under
+    :returns: int
+    """
+    workers = min(osd_count, max_workers)
+    if workers <= 1:
+        return 1
+    try:
+        if 'noout' not in get_osd_flags(service):
+            log('noout is not set, migrating one OSD at a time', WARNING)
+            return 1
+        unclean = get_unclean_pg_fraction(service=service)
+    except (subprocess.CalledProcessError, OSError, ValueError) as err:
+        log('Unable to check the cluster state, migrating one OSD at a '
+            'time: {}'.format(err), WARNING)
+        return 1
+    if unclean > UPGRADE_MAX_UNCLEAN_PGS:
+        log('{:.1%} of PGs are not active+clean, migrating one OSD at a '
+            'time'.format(unclean), WARNING)
+        return 1
+    return workers
+
+
+def _upgrade_osds(osds, max_workers=OSD_MIGRATION_WORKERS):
+    """Upgrades the OSDs with _upgrade_single_osd, several at a time.
+
+    Progress is reported through status_set as each OSD starts and
+    finishes.  After a failure no further OSDs are started; the OSDs
+    already being migrated are finished.
+
+    :param osds: list of (osd num, osd directory) tuples
+    :param max_workers: int. The most OSDs to migrate at once
+    :raises CalledProcessError: if an error occurs in a command issued as part
+                                of the upgrade process
+    :raises IOError: if an error occurs reading/writing to a file as part
+                     of the upgrade process
+    """
+    if not osds:
+        return
+    workers = _osd_migration_concurrency(len(osds), max_workers)
+    lock = threading.Lock()
+    running = []
+    finished = []
+    errors = []
+
+    def report():
+        message = 'Updating ownership of OSDs: {}/{} done'.format(
+            len(finished), len(osds))
+        if running:
+            message += ', migrating {}'.format(
+                ', '.join('osd.{}'.format(num) for num in running))
+        status_set('maintenance', message)
+
+    def migrate(osd):
+        osd_num, osd_dir = osd
+        with lock:
+            if errors:
+                return
+            running.append(osd_num)
+            report()
+        try:
+            _upgrade_single_osd(osd_num, osd_dir)
+        except (subprocess.CalledProcessError, IOError, OSError) as err:
+            log('Failed to upgrade osd.{}: {}'.format(osd_num, err), ERROR)
+            with lock:
+                errors.append(err)
+        finally:
+            with lock:
+                running.remove(osd_num)
+                finished.append(osd_num)
+                report()
+
+    log('Upgrading {} OSDs, {} at a time'.format(len(osds), workers))
+    if workers == 1:
+        for osd in osds:
+            migrate(osd)
+    else:
+        pool = ThreadPool(processes=workers)
+        try:
+            pool.map(migrate, osds, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    if errors:
+        raise errors[0]
+
+
 def _upgrade_single_osd(osd_num, osd_dir):
     """Upgrades the single OSD directory.
 
@@ -2088,13 +4316,233 @@ def enable_osd(osd_num):
         update_owner(ready_file)
 
 
+# Directory walkers used to change the ownership of a tree
+OWNERSHIP_WORKERS = 8
+# Entries whose ownership is changed before the counters are updated
+OWNERSHIP_BATCH_SIZE = 256
+# Where the progress of interrupted ownership changes and the results of
+# ownership audits are kept
+OWNERSHIP_STATE_DIR = '/var/cache/ceph-ownership'
+# Seconds between checkpoints
+OWNERSHIP_CHECKPOINT_INTERVAL = 10
+# Seconds an ownership audit result is trusted for; it is dropped sooner
+# when the root of the audited tree changes or its ownership is fixed
+OWNERSHIP_AUDIT_TTL = 24 * 60 * 60
+
+
+class OwnershipFixer(object):
+    """Changes the ownership of a directory tree, several directories at a
+    time.
+
+    Every directory is scanned by a worker of a thread pool and only the
+    entries which are not already owned by uid:gid are changed, with
+    os.lchown so that symlinks are not followed.  Subtrees which have been
+    completely walked are written to a checkpoint file so that a walk which
+    was interrupted resumes without rescanning them; the checkpoint is
+    removed once the whole tree is done.
+    """
+
+    def __init__(self, path, uid, gid, workers=OWNERSHIP_WORKERS,
+                 batch_size=OWNERSHIP_BATCH_SIZE, checkpoint=None):
+        """
+        :param path: str. The root of the tree
+        :param uid: int. The user id which should own the tree
+        :param gid: int. The group id which should own the tree
+        :param workers: int. The number of directories scanned at once
+        :param batch_size: int. Entries changed between counter updates
+        :param checkpoint: str. The checkpoint file or None to not keep one
+        """
+        self.path = path
+        self.uid = uid
+        self.gid = gid
+        self.workers = workers
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.scanned = 0
+        self.changed = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._outstanding = 0
+        self._errors = []
+        self._skip = set()
+        self._done = set()
+        self._done_children = {}
+        self._pending = {}
+        self._saved = 0
+
+    def _load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        try:
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as err:
+            log('Ignoring unreadable ownership checkpoint {}: {}'.format(
+                self.checkpoint, err), WARNING)
+            return
+        if (state.get('path'), state.get('uid'), state.get('gid')) != \
+                (self.path, self.uid, self.gid):
+            return
+        self._skip = set(state.get('done', []))
+        log('Resuming ownership change of {}, skipping {} finished '
+            'directories'.format(self.path, len(self._skip)), DEBUG)
+
+    def _save_checkpoint(self):
+        """Write the finished subtrees; called with the lock held."""
+        self._saved = time.time()
+        if not self.checkpoint:
+            return
+        state = {'path': self.path, 'uid': self.uid, 'gid': self.gid,
+                 'done': sorted(self._skip | self._done)}
+        write_json_atomically(self.checkpoint, state,
+                              'ownership checkpoint')
+
+    def _entries(self, directory):
+        """Yield (name, is_dir, lstat) for the entries of directory."""
+        if scandir is not None:
+            for entry in scandir(directory):
+                yield (entry.name, entry.is_dir(follow_symlinks=False),
+                       entry.stat(follow_symlinks=False))
+        else:
+            for name in os.listdir(directory):
+                st = os.lstat(os.path.join(directory, name))
+                yield name, stat.S_ISDIR(st.st_mode), st
+
+    def _chown(self, paths):
+        for path in paths:
+            try:
+                os.lchown(path, self.uid, self.gid)
+            except OSError as err:
+                # The daemons are stopped but a file may still vanish
+                if err.errno != errno.ENOENT:
+                    raise
+        with self._lock:
+            self.changed += len(paths)
+
+    def _scan(self, rel):
+        directory = os.path.join(self.path, rel)
+        subdirs = []
+        batch = []
+        scanned = 0
+        for name, is_dir, st in self._entries(directory):
+            scanned += 1
+            child = os.path.join(rel, name)
+            if st.st_uid != self.uid or st.st_gid != self.gid:
+                batch.append(os.path.join(self.path, child))
+                if len(batch) >= self.batch_size:
+                    self._chown(batch)
+                    batch = []
+            if is_dir and child not in self._skip:
+                subdirs.append(child)
+        self._chown(batch)
+        return scanned, subdirs
+
+    def _stopped(self):
+        """Whether to stop scanning; called with the lock held."""
+        return bool(self._errors)
+
+    def _submit(self, pool, rel):
+        with self._lock:
+            self._outstanding += 1
+        pool.apply_async(self._walk, (pool, rel))
+
+    def _walk(self, pool, rel):
+        subdirs = []
+        try:
+            with self._lock:
+                failed = self._stopped()
+            if not failed:
+                scanned, subdirs = self._scan(rel)
+                with self._lock:
+                    self.scanned += scanned
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                with self._lock:
+                    self._errors.append(err)
+                subdirs = []
+        except Exception as err:
+            with self._lock:
+                self._errors.append(err)
+            subdirs = []
+        with self._lock:
+            # The directory is finished when it and all its subdirectories
+            # are; the extra count is this scan.
+            self._pending[rel] = len(subdirs) + 1
+        for child in subdirs:
+            self._submit(pool, child)
+        with self._lock:
+            if not self._errors:
+                self._finish(rel)
+            self._outstanding -= 1
+            if not self._outstanding:
+                self._idle.notify_all()
+
+    def _finish(self, rel):
+        """Count down rel and its parents; called with the lock held."""
+        while True:
+            self._pending[rel] -= 1
+            if self._pending[rel]:
+                return
+            del self._pending[rel]
+            if not rel:
+                return
+            # Only the outermost finished subtrees are kept
+            for child in self._done_children.pop(rel, []):
+                self._done.discard(child)
+            self._done.add(rel)
+            parent = os.path.dirname(rel)
+            self._done_children.setdefault(parent, []).append(rel)
+            if time.time() - self._saved >= OWNERSHIP_CHECKPOINT_INTERVAL:
+                self._save_checkpoint()
+            rel = parent
+
+    def run(self):
+        """Change the ownership of the tree.
+
+        :returns: int. The number of entries whose ownership was changed
+        :raises OSError: if the ownership of an entry cannot be changed or
+                         a directory cannot be read.
+        """
+        start = time.time()
+        self._load_checkpoint()
+        self._saved = start
+        st = os.lstat(self.path)
+        if st.st_uid != self.uid or st.st_gid != self.gid:
+            self._chown([self.path])
+        pool = ThreadPool(processes=self.workers)
+        try:
+            self._submit(pool, '')
+            with self._lock:
+                while self._outstanding:
+                    self._idle.wait(1)
+        finally:
+            pool.close()
+            pool.join()
+        self.elapsed = time.time() - start
+        if self._errors:
+            with self._lock:
+                self._save_checkpoint()
+            raise self._errors[0]
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+        return self.changed
+
+
+def _ownership_checkpoint(path):
+    """Returns the checkpoint file used when changing the owner of path."""
+    return os.path.join(OWNERSHIP_STATE_DIR,
+                        path.strip('/').replace('/', '_') + '.json')
+
+
 def update_owner(path, recurse_dirs=True):
     """Changes the ownership of the specified path.
 
-    Changes the ownership of the specified path to the new ceph daemon user
-    using the system's native chown functionality. This may take awhile,
-    so this method will issue a set_status for any changes of ownership which
-    recurses into directory structures.
+    Changes the ownership of the specified path to the new ceph daemon user.
+    A directory tree is walked with an OwnershipFixer, which only changes
+    the entries not owned by the ceph user and resumes an interrupted walk.
+    This may take awhile, so this method will issue a set_status for any
+    changes of ownership which recurses into directory structures.
 
     :param path: the path to recursively change ownership for
     :param recurse_dirs: boolean indicating whether to recursively change the
@@ -2102,23 +4550,243 @@ def update_owner(path, recurse_dirs=True):
                          simply change the ownership of the path.
     :raises CalledProcessError: if an error occurs issuing the chown system
                                 command
+    :raises OSError: if an error occurs changing the ownership of the tree
     """
     user = ceph_user()
     user_group = '{ceph_user}:{ceph_user}'.format(ceph_user=user)
-    cmd = ['chown', user_group, path]
-    if os.path.isdir(path) and recurse_dirs:
-        status_set('maintenance', ('Updating ownership of %s to %s' %
-                                   (path, user)))
-        cmd.insert(1, '-R')
-
     log('Changing ownership of {path} to {user}'.format(
         path=path, user=user_group), DEBUG)
-    start = datetime.now()
-    subprocess.check_call(cmd)
-    elapsed_time = (datetime.now() - start)
 
-    log('Took {secs} seconds to change the ownership of path: {path}'.format(
-        secs=elapsed_time.total_seconds(), path=path), DEBUG)
+    if not (os.path.isdir(path) and recurse_dirs):
+        start = datetime.now()
+        subprocess.check_call(['chown', user_group, path])
+        elapsed_time = (datetime.now() - start)
+        log('Took {secs} seconds to change the ownership of path: '
+            '{path}'.format(secs=elapsed_time.total_seconds(), path=path),
+            DEBUG)
+        return
+
+    status_set('maintenance', ('Updating ownership of %s to %s' %
+                               (path, user)))
+    fixer = OwnershipFixer(path, pwd.getpwnam(user).pw_uid,
+                           grp.getgrnam(user).gr_gid,
+                           checkpoint=_ownership_checkpoint(path))
+    fixer.run()
+    log('Changed the ownership of {} of {} entries under {} in {:.1f} '
+        'seconds ({:.0f} entries/s)'.format(
+            fixer.changed, fixer.scanned, path, fixer.elapsed,
+            fixer.scanned / max(fixer.elapsed, 0.001)))
+    _write_ownership_marker(path, fixer.uid, fixer.gid, AUDIT_FULL, False)
+
+
+class OwnershipAuditor(OwnershipFixer):
+    """Walks a directory tree like OwnershipFixer without changing it.
+
+    The walk stops as soon as an entry not owned by uid:gid is found.
+    """
+
+    def __init__(self, path, uid, gid, workers=OWNERSHIP_WORKERS):
+        super(OwnershipAuditor, self).__init__(path, uid, gid,
+                                               workers=workers)
+        self.mismatched = []
+
+    def _chown(self, paths):
+        if paths:
+            with self._lock:
+                self.mismatched.extend(paths)
+
+    def _stopped(self):
+        return bool(self._errors or self.mismatched)
+
+    def run(self):
+        """Audit the tree.
+
+        :returns: bool. True if any entry is not owned by uid:gid
+        :raises OSError: if a directory cannot be read.
+        """
+        super(OwnershipAuditor, self).run()
+        return bool(self.mismatched)
+
+
+# Ownership audit modes: the top level directories only, a random sample
+# of the entries or every entry
+AUDIT_TOP = 'top'
+AUDIT_SAMPLED = 'sampled'
+AUDIT_FULL = 'full'
+# A sampled audit checks the entries met on random descents from the root
+# of the tree (see _ownership_samples).  Each descent picks a child of
+# every directory on its way with equal probability.  When the mis-owned
+# entries make up at least AUDIT_MIN_FRACTION of the children of the
+# directories a descent passes through, as when whole subtrees were left
+# unchanged, they are found with a probability of at least
+# AUDIT_CONFIDENCE.  A few mis-owned entries in one large directory deep in
+# the tree are found less often: the descents do not weigh each entry of
+# the tree equally, and in return only read the directories they pass
+# through.
+AUDIT_CONFIDENCE = 0.99
+AUDIT_MIN_FRACTION = 0.01
+
+
+def _ownership_samples(confidence=AUDIT_CONFIDENCE,
+                       fraction=AUDIT_MIN_FRACTION):
+    """Returns how many entries to sample to find a mis-owned fraction.
+
+    Each sampled entry misses the mis-owned ones with probability
+    (1 - fraction), so n samples miss them all with (1 - fraction) ** n.
+
+    :param confidence: float. The probability of finding them
+    :param fraction: float. The smallest fraction of mis-owned entries
+    :returns: int
+    """
+    return int(math.ceil(math.log(1 - confidence) / math.log(1 - fraction)))
+
+
+def _sample_ownership(path, uid, gid, samples):
+    """Checks the owner of the entries on random descents under path.
+
+    Each descent starts at path and moves to a randomly chosen child of
+    each directory, checking the owner of every entry on its way, until it
+    reaches a file or an empty directory.  Each directory is listed at
+    most once.
+
+    :param path: str. The root of the tree
+    :param uid: int. The expected user id
+    :param gid: int. The expected group id
+    :param samples: int. The number of descents
+    :returns: str. The first mis-owned entry found or None
+    :raises OSError: if a directory cannot be read.
+    """
+    listings = {}
+    for _ in range(samples):
+        directory = path
+        while True:
+            names = listings.get(directory)
+            if names is None:
+                try:
+                    names = os.listdir(directory)
+                except OSError as err:
+                    if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        raise
+                    names = []
+                listings[directory] = names
+            if not names:
+                break
+            child = os.path.join(directory, random.choice(names))
+            try:
+                st = os.lstat(child)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                break
+            if st.st_uid != uid or st.st_gid != gid:
+                return child
+            if not stat.S_ISDIR(st.st_mode):
+                break
+            directory = child
+    return None
+
+
+def _ownership_marker(path):
+    """Returns the file caching the ownership audit of path."""
+    return os.path.join(OWNERSHIP_STATE_DIR,
+                        path.strip('/').replace('/', '_') + '.audit.json')
+
+
+def _root_ctime(path):
+    try:
+        return os.lstat(path).st_ctime
+    except OSError:
+        return None
+
+
+def _read_ownership_marker(path, uid, gid, mode):
+    """Returns the cached audit result for path or None.
+
+    A full audit also answers a sampled one, and a tree found to need an
+    update needs it whatever the mode.  Results older than
+    OWNERSHIP_AUDIT_TTL, or taken before the root of the tree last changed,
+    are not used.
+    """
+    try:
+        with open(_ownership_marker(path)) as f:
+            marker = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if (marker.get('path'), marker.get('uid'), marker.get('gid')) != \
+            (path, uid, gid):
+        return None
+    if time.time() - marker.get('timestamp', 0) > OWNERSHIP_AUDIT_TTL:
+        return None
+    if marker.get('root_ctime') != _root_ctime(path):
+        return None
+    if marker.get('needs_update') or marker.get('mode') in (mode, AUDIT_FULL):
+        return bool(marker.get('needs_update'))
+    return None
+
+
+def _write_ownership_marker(path, uid, gid, mode, needs_update):
+    """Caches the ownership audit result for path."""
+    write_json_atomically(_ownership_marker(path), {
+        'path': path, 'uid': uid, 'gid': gid, 'mode': mode,
+        'needs_update': needs_update, 'root_ctime': _root_ctime(path),
+        'timestamp': time.time()}, 'ownership marker')
+
+
+def _clear_ownership_markers(path):
+    """Drops the cached audit results for path and the trees below it.
+
+    Called wherever the ownership of a tree is changed other than by
+    update_owner, which records its own result.
+    """
+    try:
+        names = os.listdir(OWNERSHIP_STATE_DIR)
+    except OSError:
+        return
+    prefix = path.rstrip('/') + '/'
+    for name in names:
+        if not name.endswith('.audit.json'):
+            continue
+        marker = os.path.join(OWNERSHIP_STATE_DIR, name)
+        try:
+            with open(marker) as f:
+                audited = json.load(f).get('path') or ''
+            if audited == path or audited.startswith(prefix):
+                os.unlink(marker)
+        except (IOError, OSError, ValueError) as err:
+            log('Unable to clear ownership marker {}: {}'.format(
+                marker, err), WARNING)
+
+
+def audit_ownership(path, uid, gid, mode=AUDIT_SAMPLED, use_cache=True):
+    """Determines whether a directory tree has entries with another owner.
+
+    :param path: str. The root of the tree
+    :param uid: int. The expected user id
+    :param gid: int. The expected group id
+    :param mode: str. AUDIT_SAMPLED to check a random sample of the entries
+                 or AUDIT_FULL to check every entry
+    :param use_cache: bool. Whether to use and store the result in the
+                      marker file for path
+    :returns: bool. True if the ownership of the tree needs an update
+    :raises OSError: if a directory cannot be read.
+    """
+    if use_cache:
+        cached = _read_ownership_marker(path, uid, gid, mode)
+        if cached is not None:
+            return cached
+    start = time.time()
+    if mode == AUDIT_FULL:
+        needs_update = OwnershipAuditor(path, uid, gid).run()
+    else:
+        found = _sample_ownership(path, uid, gid, _ownership_samples())
+        if found:
+            log('{} needs its ownership updated'.format(found), DEBUG)
+        needs_update = found is not None
+    log('{} audit of the ownership of {} took {:.1f} seconds'.format(
+        mode, path, time.time() - start), DEBUG)
+    if use_cache:
+        _write_ownership_marker(path, uid, gid, mode, needs_update)
+    return needs_update
 
 
 def list_pools(service):
@@ -2130,9 +4798,8 @@ def list_pools(service):
     """
     try:
         pool_list = []
-        pools = str(subprocess
-                    .check_output(['rados', '--id', service, 'lspools'])
-                    .decode('UTF-8'))
+        pools = get_executor().check_output(
+            CephCommand('lspools', service=service, binary='rados'))
         for pool in pools.splitlines():
             pool_list.append(pool)
         return pool_list
@@ -2141,7 +4808,7 @@ def list_pools(service):
         raise
 
 
-def dirs_need_ownership_update(service):
+def dirs_need_ownership_update(service, mode=AUDIT_SAMPLED):
     """Determines if directories still need change of ownership.
 
     Examines the set of directories under the /var/lib/ceph/{service} directory
@@ -2149,7 +4816,13 @@ def dirs_need_ownership_update(service):
     necessary due to the upgrade from Hammer to Jewel where the daemon user
     changes from root: to ceph:.
 
+    The trees below correctly owned directories are audited too, by
+    default with AUDIT_SAMPLED (see audit_ownership), or not at all with
+    AUDIT_TOP; the results are cached per directory so repeated calls only
+    read the marker files.
+
     :param service: the name of the service folder to check (e.g. osd, mon)
+    :param mode: str. AUDIT_TOP, AUDIT_SAMPLED or AUDIT_FULL
     :returns: boolean. True if the directories need a change of ownership,
              False otherwise.
     :raises IOError: if an error occurs reading the file stats from one of
@@ -2162,7 +4835,10 @@ def dirs_need_ownership_update(service):
         curr_owner, curr_group = owner(child)
 
         if (curr_owner == expected_owner) and (curr_group == expected_group):
-            continue
+            if mode == AUDIT_TOP or not audit_ownership(
+                    child, pwd.getpwnam(expected_owner).pw_uid,
+                    grp.getgrnam(expected_group).gr_gid, mode=mode):
+                continue
 
         log('Directory "%s" needs its ownership updated' % child, DEBUG)
         return True
@@ -2208,15 +4884,15 @@ def resolve_ceph_version(source):
     return UCA_CODENAME_MAP.get(os_release)
 
 
-def get_ceph_pg_stat():
+def get_ceph_pg_stat(service=None):
     """Returns the result of ceph pg stat.
 
+    :param service: String service id to run under
     :returns: dict
     """
     try:
-        tree = str(subprocess
-                   .check_output(['ceph', 'pg', 'stat', '--format=json'])
-                   .decode('UTF-8'))
+        tree = get_executor().check_output(
+            CephCommand('pg stat', service=service, fmt='json'))
         try:
             json_tree = json.loads(tree)
             if not json_tree['num_pg_by_state']:
@@ -2231,6 +4907,31 @@ def get_ceph_pg_stat():
         raise
 
 
+def get_unclean_pg_fraction(service=None):
+    """Returns the fraction of placement groups which are not active+clean.
+
+    Placement groups which are also scrubbing count as clean.
+
+    :param service: String service id to run under
+    :returns: float between 0.0 and 1.0, 0.0 when there are no PGs
+    :raises: CalledProcessError if our ceph command fails.
+    """
+    pg_stat = get_ceph_pg_stat(service=service)
+    if not pg_stat:
+        return 0.0
+    total = 0
+    clean = 0
+    for state in pg_stat['num_pg_by_state']:
+        total += state['num']
+        parts = state['name'].split('+')
+        if 'active' in parts and 'clean' in parts:
+            clean += state['num']
+    total = pg_stat.get('num_pgs', total)
+    if not total:
+        return 0.0
+    return float(total - clean) / total
+
+
 def get_ceph_health():
     """Returns the health of the cluster from a 'ceph status'
 
@@ -2239,9 +4940,8 @@ def get_ceph_health():
              status, use get_ceph_health()['overall_status'].
     """
     try:
-        tree = str(subprocess
-                   .check_output(['ceph', 'status', '--format=json'])
-                   .decode('UTF-8'))
+        tree = get_executor().check_output(
+            CephCommand('status', fmt='json'))
         try:
             json_tree = json.loads(tree)
             # Make sure children are present in the json
@@ -2258,6 +4958,31 @@ def get_ceph_health():
         raise
 
 
+def get_cluster_epochs(service='admin'):
+    """Returns the epochs of the cluster maps from a 'ceph status'
+
+    A change in any epoch means the cluster state has changed since the
+    epochs were last read.
+
+    :param service: String service id to run under
+    :returns: dict of map name to epoch. Example: {'osdmap': 42, 'fsmap': 3}
+    :raises: CalledProcessError if our ceph command fails,
+             ValueError if the status fails to parse.
+    """
+    status = json.loads(get_executor().check_output(
+        CephCommand('status', service=service, fmt='json')))
+    epochs = {}
+    osdmap = status.get('osdmap', {})
+    # Releases before mimic nest the osdmap summary one level deeper
+    osdmap = osdmap.get('osdmap', osdmap)
+    if 'epoch' in osdmap:
+        epochs['osdmap'] = osdmap['epoch']
+    for name in ['monmap', 'fsmap']:
+        if 'epoch' in status.get(name, {}):
+            epochs[name] = status[name]['epoch']
+    return epochs
+
+
 def reweight_osd(osd_num, new_weight):
     """Changes the crush weight of an OSD to the value specified.
 
@@ -2267,12 +4992,12 @@ def reweight_osd(osd_num, new_weight):
     :raises CalledProcessError: if an error occurs invoking the systemd cmd
     """
     try:
-        cmd_result = str(subprocess
-                         .check_output(['ceph', 'osd', 'crush',
-                                        'reweight', "osd.{}".format(osd_num),
-                                        new_weight],
-                                       stderr=subprocess.STDOUT)
-                         .decode('UTF-8'))
+        cmd_result = get_executor().check_output(
+            CephCommand('osd crush reweight',
+                        args=[('name', "osd.{}".format(osd_num)),
+                              ('weight', new_weight)],
+                        mon_args={'weight': float(new_weight)}),
+            stderr=subprocess.STDOUT)
         expected_result = "reweighted item id {ID} name \'osd.{ID}\'".format(
                           ID=osd_num) + " to {}".format(new_weight)
         log(cmd_result)
@@ -2305,12 +5030,15 @@ def bootstrap_manager():
         log('bootstrap_manager: mgr already initialized.')
     else:
         mkdir(path, owner=ceph_user(), group=ceph_user())
-        subprocess.check_call(['ceph', 'auth', 'get-or-create',
-                               'mgr.{}'.format(hostname), 'mon',
-                               'allow profile mgr', 'osd', 'allow *',
-                               'mds', 'allow *', '--out-file',
-                               keyring])
+        output = get_executor().check_output(CephCommand(
+            'auth get-or-create',
+            args=[('entity', 'mgr.{}'.format(hostname)),
+                  ('caps', ['mon', 'allow profile mgr', 'osd', 'allow *',
+                            'mds', 'allow *'])]))
+        with open(keyring, 'w') as f:
+            f.write(output)
         chownr(path, ceph_user(), ceph_user())
+        _clear_ownership_markers(path)
 
         unit = 'ceph-mgr@{}'.format(hostname)
         subprocess.check_call(['systemctl', 'enable', unit])
@@ -2329,9 +5057,10 @@ def osd_noout(enable):
         False: 'unset',
     }
     try:
-        subprocess.check_call(['ceph', '--id', 'admin',
-                               'osd', operation[enable],
-                               'noout'])
+        get_executor().check_call(
+            CephCommand('osd {}'.format(operation[enable]),
+                        args=[('key', 'noout')],
+                        service='admin'))
         log('running ceph osd {} noout'.format(operation[enable]))
         return True
     except subprocess.CalledProcessError as e:
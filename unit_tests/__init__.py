@@ -15,3 +15,9 @@
 import sys
 
 sys.path.append('ceph')
+
+import ceph.executor  # noqa: E402
+
+# The tests mock the CLI rather than running commands over librados or
+# through a persistent ceph shell
+ceph.executor.set_executor(ceph.executor.SubprocessExecutor())
@@ -13,18 +13,56 @@
 # limitations under the License.
 
 import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 from mock import patch
+from subprocess import CalledProcessError
 
 import ceph.broker
+import ceph.executor
 
 from mock import call
 
 
+CRUSHMAP = """# devices
+device 0 osd.0
+device 1 osd.1
+device 2 osd.2
+
+# types
+type 0 osd
+type 1 host
+type 10 root
+
+# buckets
+host node1 {
+    id -2
+    alg straw
+    hash 0
+    item osd.0 weight 1.000
+    item osd.1 weight 1.000
+    item osd.2 weight 1.000
+}
+root default {
+    id -1
+    alg straw
+    hash 0
+    item node1 weight 3.000
+}
+"""
+
+
 class CephBrokerTestCase(unittest.TestCase):
     def setUp(self):
         super(CephBrokerTestCase, self).setUp()
+        # Without cluster epochs the response cache is not used
+        patcher = patch.object(ceph.broker, 'get_cluster_epochs')
+        patcher.start().return_value = {}
+        self.addCleanup(patcher.stop)
 
     @patch.object(ceph.broker, 'check_call')
     def test_update_service_permission(self, _check_call):
@@ -258,13 +296,13 @@ class CephBrokerTestCase(unittest.TestCase):
 
     @patch.object(ceph.broker, 'get_osds')
     @patch.object(ceph.broker, 'ReplicatedPool')
-    @patch.object(ceph.broker, 'pool_exists')
+    @patch.object(ceph.broker, 'list_pools')
     @patch.object(ceph.broker, 'log')
     def test_process_requests_create_pool_w_pg_num(self, mock_log,
-                                                   mock_pool_exists,
+                                                   mock_list_pools,
                                                    mock_replicated_pool,
                                                    mock_get_osds):
-        mock_pool_exists.return_value = False
+        mock_list_pools.return_value = []
         mock_get_osds.return_value = [0, 1, 2]
         reqs = json.dumps({'api-version': 1,
                            'ops': [{
@@ -273,19 +311,20 @@ class CephBrokerTestCase(unittest.TestCase):
                                'replicas': 3,
                                'pg_num': 100}]})
         rc = ceph.broker.process_requests(reqs)
-        mock_pool_exists.assert_called_with(service='admin', name='foo')
+        mock_list_pools.assert_called_once_with(service='admin')
+        mock_get_osds.assert_called_once_with('admin')
         mock_replicated_pool.assert_called_with(service='admin', name='foo',
                                                 replicas=3, pg_num=100)
         self.assertEqual(json.loads(rc), {'exit-code': 0})
 
     @patch.object(ceph.broker, 'ReplicatedPool')
-    @patch.object(ceph.broker, 'pool_exists')
+    @patch.object(ceph.broker, 'list_pools')
     @patch.object(ceph.broker, 'log')
     @patch.object(ceph.broker, 'add_pool_to_group')
     def test_process_requests_create_pool_w_group(self, add_pool_to_group,
-                                                  mock_log, mock_pool_exists,
+                                                  mock_log, mock_list_pools,
                                                   mock_replicated_pool):
-        mock_pool_exists.return_value = False
+        mock_list_pools.return_value = []
         reqs = json.dumps({'api-version': 1,
                            'ops': [{
                                'op': 'create-pool',
@@ -296,35 +335,34 @@ class CephBrokerTestCase(unittest.TestCase):
         add_pool_to_group.assert_called_with(group='image',
                                              pool='foo',
                                              namespace=None)
-        mock_pool_exists.assert_called_with(service='admin', name='foo')
+        mock_list_pools.assert_called_once_with(service='admin')
         mock_replicated_pool.assert_called_with(service='admin', name='foo',
                                                 replicas=3)
         self.assertEqual(json.loads(rc), {'exit-code': 0})
 
     @patch.object(ceph.broker, 'ReplicatedPool')
-    @patch.object(ceph.broker, 'pool_exists')
+    @patch.object(ceph.broker, 'list_pools')
     @patch.object(ceph.broker, 'log')
     def test_process_requests_create_pool_exists(self, mock_log,
-                                                 mock_pool_exists,
+                                                 mock_list_pools,
                                                  mock_replicated_pool):
-        mock_pool_exists.return_value = True
+        mock_list_pools.return_value = ['foo']
         reqs = json.dumps({'api-version': 1,
                            'ops': [{'op': 'create-pool',
                                     'name': 'foo',
                                     'replicas': 3}]})
         rc = ceph.broker.process_requests(reqs)
-        mock_pool_exists.assert_called_with(service='admin',
-                                            name='foo')
-        self.assertFalse(mock_replicated_pool.create.called)
+        mock_list_pools.assert_called_once_with(service='admin')
+        self.assertFalse(mock_replicated_pool.return_value.create.called)
         self.assertEqual(json.loads(rc), {'exit-code': 0})
 
     @patch.object(ceph.broker, 'ReplicatedPool')
-    @patch.object(ceph.broker, 'pool_exists')
+    @patch.object(ceph.broker, 'list_pools')
     @patch.object(ceph.broker, 'log')
     def test_process_requests_create_pool_rid(self, mock_log,
-                                              mock_pool_exists,
+                                              mock_list_pools,
                                               mock_replicated_pool):
-        mock_pool_exists.return_value = False
+        mock_list_pools.return_value = []
         reqs = json.dumps({'api-version': 1,
                            'request-id': '1ef5aede',
                            'ops': [{
@@ -332,7 +370,7 @@ class CephBrokerTestCase(unittest.TestCase):
                                'name': 'foo',
                                'replicas': 3}]})
         rc = ceph.broker.process_requests(reqs)
-        mock_pool_exists.assert_called_with(service='admin', name='foo')
+        mock_list_pools.assert_called_once_with(service='admin')
         mock_replicated_pool.assert_called_with(service='admin',
                                                 name='foo',
                                                 replicas=3)
@@ -341,15 +379,15 @@ class CephBrokerTestCase(unittest.TestCase):
 
     @patch.object(ceph.broker, 'get_cephfs')
     @patch.object(ceph.broker, 'check_output')
-    @patch.object(ceph.broker, 'pool_exists')
+    @patch.object(ceph.broker, 'list_pools')
     @patch.object(ceph.broker, 'log')
     def test_process_requests_create_cephfs(self,
                                             mock_log,
-                                            mock_pool_exists,
+                                            mock_list_pools,
                                             check_output,
                                             get_cephfs):
         get_cephfs.return_value = []
-        mock_pool_exists.return_value = True
+        mock_list_pools.return_value = ['data', 'metadata']
         reqs = json.dumps({'api-version': 1,
                            'request-id': '1ef5aede',
                            'ops': [{
@@ -359,11 +397,7 @@ class CephBrokerTestCase(unittest.TestCase):
                                'metadata_pool': 'metadata',
                            }]})
         rc = ceph.broker.process_requests(reqs)
-        mock_pool_exists.assert_has_calls(
-            [
-                call(service='admin', name='data'),
-                call(service='admin', name='metadata'),
-            ])
+        mock_list_pools.assert_called_once_with(service='admin')
         check_output.assert_called_with(["ceph",
                                          '--id', 'admin',
                                          "fs", "new", 'foo',
@@ -373,34 +407,69 @@ class CephBrokerTestCase(unittest.TestCase):
         self.assertEqual(json.loads(rc)['exit-code'], 0)
         self.assertEqual(json.loads(rc)['request-id'], '1ef5aede')
 
-    @patch.object(ceph.broker, 'check_output')
     @patch.object(ceph.broker, 'get_osd_weight')
     @patch.object(ceph.broker, 'log')
+    @patch('ceph.crush_utils.Crushmap.save')
     @patch('ceph.crush_utils.Crushmap.load_crushmap')
-    @patch('ceph.crush_utils.Crushmap.ensure_bucket_is_present')
     def test_process_requests_move_osd(self,
-                                       mock_ensure_bucket_is_present,
                                        mock_load_crushmap,
+                                       mock_save,
                                        mock_log,
-                                       mock_get_osd_weight,
-                                       mock_check_output):
-        mock_load_crushmap.return_value = ""
-        mock_ensure_bucket_is_present.return_value = None
-        mock_get_osd_weight.return_value = 1
+                                       mock_get_osd_weight):
+        mock_load_crushmap.return_value = CRUSHMAP
         reqs = json.dumps({'api-version': 1,
                            'request-id': '1ef5aede',
                            'ops': [{
                                'op': 'move-osd-to-bucket',
-                               'osd': 'osd.0',
+                               'osd': osd,
                                'bucket': 'test'
-                           }]})
+                           } for osd in ['osd.0', 1, 'osd.2']]})
         rc = ceph.broker.process_requests(reqs)
         self.assertEqual(json.loads(rc)['exit-code'], 0)
         self.assertEqual(json.loads(rc)['request-id'], '1ef5aede')
-        mock_check_output.assert_called_with(["ceph",
-                                              '--id', 'admin',
-                                              "osd", "crush", "set",
-                                              "osd.0", "1", "root=test"])
+        self.assertEqual(mock_load_crushmap.call_count, 1)
+        mock_save.assert_called_once_with(check_unchanged=True)
+        self.assertFalse(mock_get_osd_weight.called)
+
+    @patch.object(ceph.broker, 'get_osd_weight')
+    @patch.object(ceph.broker, 'log')
+    @patch('ceph.crush_utils.Crushmap.save')
+    @patch('ceph.crush_utils.Crushmap.load_crushmap')
+    def test_process_requests_move_osd_save_fails(self,
+                                                  mock_load_crushmap,
+                                                  mock_save,
+                                                  mock_log,
+                                                  mock_get_osd_weight):
+        mock_load_crushmap.return_value = CRUSHMAP
+        mock_save.side_effect = CalledProcessError(1, 'ceph')
+        reqs = json.dumps({'api-version': 1,
+                           'ops': [{'op': 'move-osd-to-bucket',
+                                    'osd': 'osd.0',
+                                    'bucket': 'test'}]})
+        rc = json.loads(ceph.broker.process_requests(reqs))
+        self.assertEqual(rc['exit-code'], 1)
+        self.assertIn('Failed to update the CRUSH map', rc['stderr'])
+
+    @patch.object(ceph.broker, 'log')
+    @patch('ceph.crush_utils.Crushmap.load_crushmap')
+    def test_process_requests_move_unknown_osd(self, mock_load_crushmap,
+                                               mock_log):
+        mock_load_crushmap.return_value = CRUSHMAP
+        reqs = json.dumps({'api-version': 1,
+                           'ops': [{'op': 'move-osd-to-bucket',
+                                    'osd': 'osd.0',
+                                    'bucket': 'test'},
+                                   {'op': 'move-osd-to-bucket',
+                                    'osd': 'osd.9',
+                                    'bucket': 'test'}]})
+        with patch.object(ceph.broker, 'get_osd_weight') as weight, \
+                patch('ceph.crush_utils.Crushmap.save') as save:
+            weight.return_value = 1.0
+            rc = json.loads(ceph.broker.process_requests(reqs))
+        self.assertEqual(rc['exit-code'], 1)
+        self.assertIn('osd.9', rc['stderr'])
+        # The move which was valid is still saved
+        save.assert_called_once_with(check_unchanged=True)
 
     @patch.object(ceph.broker, 'log')
     def test_process_requests_invalid_api_rid(self, mock_log):
@@ -485,7 +554,8 @@ class CephBrokerTestCase(unittest.TestCase):
                 u'name': u'cinder',
                 u'op': u'add-permissions-to-key'},
             service='admin')
-        mock_handle_add_perms_to_key.assert_has_calls([call1, call2])
+        mock_handle_add_perms_to_key.assert_has_calls([call1, call2],
+                                                      any_order=True)
         self.assertEqual(
             json.loads(rc),
             {'exit-code': 0, u'request-id': u'0155c14b'})
@@ -634,3 +704,434 @@ class CephBrokerTestCase(unittest.TestCase):
                 'osd',
                 ('allow rwx pool=glance, '
                  'allow class-read object_prefix rbd_children')])
+
+    @patch.object(ceph.broker, 'check_call')
+    @patch.object(ceph.broker, 'monitor_key_set')
+    @patch.object(ceph.broker, 'monitor_key_get')
+    @patch.object(ceph.broker, 'ReplicatedPool')
+    @patch.object(ceph.broker, 'list_pools')
+    @patch.object(ceph.broker, 'log')
+    def test_process_requests_batches_state(self, mock_log, mock_list_pools,
+                                            mock_replicated_pool,
+                                            mock_monitor_key_get,
+                                            mock_monitor_key_set,
+                                            mock_check_call):
+        mock_list_pools.return_value = ['glance']
+        fake = ceph.executor.FakeExecutor({'config-key dump': json.dumps({
+            'cephx.groups.images': ('{"pools": ["glance"], '
+                                    '"services": ["nova"]}'),
+            'cephx.services.nova': '{"group_names": {"rwx": ["images"]}}',
+            'mgr/x': 'y'})})
+        previous = ceph.executor.set_executor(fake)
+        self.addCleanup(ceph.executor.set_executor, previous)
+        reqs = json.dumps({'api-version': 1,
+                           'ops': [{'op': 'create-pool',
+                                    'name': name,
+                                    'replicas': 3,
+                                    'group': 'images'}
+                                   for name in ['p1', 'p2', 'p3']]})
+        rc = ceph.broker.process_requests(reqs)
+        self.assertEqual(json.loads(rc), {'exit-code': 0})
+        mock_list_pools.assert_called_once_with(service='admin')
+        self.assertEqual(mock_replicated_pool.return_value.create.call_count,
+                         3)
+        self.assertEqual(fake.prefixes(), ['config-key dump', 'auth list'])
+        self.assertFalse(mock_monitor_key_get.called)
+        mock_monitor_key_set.assert_called_once_with(
+            service='admin',
+            key='cephx.groups.images',
+            value=json.dumps({"pools": ["glance", "p1", "p2", "p3"],
+                              "services": ["nova"]}, sort_keys=True))
+        mock_check_call.assert_called_once_with([
+            'ceph', 'auth', 'caps', 'client.nova', 'mon', 'allow r', 'osd',
+            'allow rwx pool=glance, allow rwx pool=p1, allow rwx pool=p2, '
+            'allow rwx pool=p3'])
+
+    @patch.object(ceph.broker, 'monitor_key_set')
+    @patch.object(ceph.broker, 'monitor_key_get')
+    @patch.object(ceph.broker, 'ReplicatedPool')
+    @patch.object(ceph.broker, 'list_pools')
+    @patch.object(ceph.broker, 'log')
+    def test_process_requests_flushes_before_error(self, mock_log,
+                                                   mock_list_pools,
+                                                   mock_replicated_pool,
+                                                   mock_monitor_key_get,
+                                                   mock_monitor_key_set):
+        mock_list_pools.return_value = []
+        mock_monitor_key_get.return_value = None
+        reqs = json.dumps({'api-version': 1,
+                           'ops': [{'op': 'create-pool',
+                                    'name': 'foo',
+                                    'replicas': 3,
+                                    'group': 'images'},
+                                   {'op': 'invalid_op'}]})
+        rc = ceph.broker.process_requests(reqs)
+        self.assertEqual(json.loads(rc),
+                         {'exit-code': 1,
+                          'stderr': "Unknown operation 'invalid_op'"})
+        mock_monitor_key_set.assert_called_once_with(
+            service='admin',
+            key='cephx.groups.images',
+            value=json.dumps({"pools": ["foo"], "services": []},
+                             sort_keys=True))
+        self.assertIsNone(ceph.broker.BrokerState.current())
+
+    @patch.object(ceph.broker, 'rename_pool')
+    @patch.object(ceph.broker, 'list_pools')
+    @patch.object(ceph.broker, 'log')
+    def test_process_requests_tracks_renamed_pool(self, mock_log,
+                                                  mock_list_pools,
+                                                  mock_rename_pool):
+        mock_list_pools.return_value = ['old', 'hot']
+        with patch.object(ceph.broker, 'Pool') as mock_pool:
+            reqs = json.dumps({'api-version': 1,
+                               'ops': [{'op': 'rename-pool',
+                                        'name': 'old',
+                                        'new-name': 'new'},
+                                       {'op': 'create-cache-tier',
+                                        'cold-pool': 'new',
+                                        'hot-pool': 'hot'}]})
+            rc = ceph.broker.process_requests(reqs)
+        self.assertEqual(json.loads(rc), {'exit-code': 0})
+        mock_list_pools.assert_called_once_with(service='admin')
+        mock_pool.return_value.add_cache_tier.assert_called_once_with(
+            cache_pool='hot', mode='writeback')
+
+    def test_op_dependencies(self):
+        reqs = [
+            {'op': 'create-pool', 'name': 'cold', 'replicas': 3},
+            {'op': 'create-pool', 'name': 'hot', 'replicas': 3,
+             'group': 'images'},
+            {'op': 'create-cache-tier', 'cold-pool': 'cold',
+             'hot-pool': 'hot'},
+            {'op': 'set-pool-value', 'name': 'other', 'key': 'size',
+             'value': 3},
+            {'op': 'add-permissions-to-key', 'name': 'glance',
+             'group': 'images'},
+            {'op': 'rgw-create-user', 'rgw-uid': 'u1'},
+            {'op': 'rgw-create-user', 'rgw-uid': 'u2'},
+            {'op': 'create-cephfs', 'mds_name': 'fs', 'data_pool': 'cold',
+             'metadata_pool': 'other'},
+        ]
+        self.assertEqual(ceph.broker.op_dependencies(reqs),
+                         [set(), set(), {0, 1}, set(), {1}, set(), set(),
+                          {0, 2, 3}])
+
+    @patch.object(ceph.broker, 'log')
+    def test_run_ops_concurrently(self, mock_log):
+        barrier = threading.Event()
+        started = []
+
+        def dispatch(req, service):
+            started.append(req['name'])
+            if req['name'] == 'a':
+                # Only returns once the independent op has started too
+                self.assertTrue(barrier.wait(5))
+            else:
+                barrier.set()
+
+        reqs = [{'op': 'set-pool-value', 'name': 'a'},
+                {'op': 'set-pool-value', 'name': 'b'},
+                {'op': 'set-pool-value', 'name': 'a'}]
+        state = ceph.broker.BrokerState(service='admin')
+        with patch.object(ceph.broker, 'dispatch_op', side_effect=dispatch):
+            results = ceph.broker.run_ops(reqs, 'admin', state)
+        self.assertEqual(results, {0: None, 1: None, 2: None})
+        self.assertEqual(started[-1], 'a')
+
+    @patch.object(ceph.broker, 'log')
+    def test_run_ops_stops_after_error(self, mock_log):
+        error = {'exit-code': 1, 'stderr': 'failed'}
+
+        def dispatch(req, service):
+            if req['name'] == 'a':
+                return error
+
+        reqs = [{'op': 'set-pool-value', 'name': 'a'},
+                {'op': 'set-pool-value', 'name': 'a'}]
+        state = ceph.broker.BrokerState(service='admin')
+        with patch.object(ceph.broker, 'dispatch_op',
+                          side_effect=dispatch) as mock_dispatch:
+            results = ceph.broker.run_ops(reqs, 'admin', state,
+                                          max_workers=2)
+        self.assertEqual(results, {0: error})
+        self.assertEqual(mock_dispatch.call_count, 1)
+
+    @patch.object(ceph.broker, 'log')
+    def test_run_ops_runs_earlier_ops_after_error(self, mock_log):
+        error = {'exit-code': 1, 'stderr': 'failed'}
+        failed = threading.Event()
+
+        def dispatch(req, service):
+            if req['name'] == 'b':
+                failed.set()
+                return error
+            self.assertTrue(failed.wait(5))
+
+        # The second op waits on the first, so it is only ready once the
+        # independent third op has already failed
+        reqs = [{'op': 'set-pool-value', 'name': 'a'},
+                {'op': 'set-pool-value', 'name': 'a'},
+                {'op': 'set-pool-value', 'name': 'b'},
+                {'op': 'set-pool-value', 'name': 'a'}]
+        state = ceph.broker.BrokerState(service='admin')
+        with patch.object(ceph.broker, 'dispatch_op', side_effect=dispatch):
+            results = ceph.broker.run_ops(reqs, 'admin', state,
+                                          max_workers=2)
+        self.assertEqual(results, {0: None, 1: None, 2: error})
+
+    @patch.object(ceph.broker, 'log')
+    def test_run_ops_raises(self, mock_log):
+        def dispatch(req, service):
+            self.assertIs(ceph.broker.BrokerState.current(), state)
+            if req['name'] == 'b':
+                raise ValueError('boom')
+
+        reqs = [{'op': 'set-pool-value', 'name': 'a'},
+                {'op': 'set-pool-value', 'name': 'b'}]
+        state = ceph.broker.BrokerState(service='admin')
+        with patch.object(ceph.broker, 'dispatch_op', side_effect=dispatch):
+            with self.assertRaises(ValueError):
+                ceph.broker.run_ops(reqs, 'admin', state)
+
+    @patch.object(ceph.broker, 'run_ops')
+    @patch.object(ceph.broker, 'log')
+    def test_process_requests_first_error(self, mock_log, mock_run_ops):
+        mock_run_ops.return_value = {
+            0: None,
+            1: {'exit-code': 1, 'stderr': 'first'},
+            2: {'exit-code': 1, 'stderr': 'second'}}
+        reqs = json.dumps({'api-version': 1,
+                           'ops': [{'op': 'set-pool-value', 'name': 'a'},
+                                   {'op': 'set-pool-value', 'name': 'b'},
+                                   {'op': 'set-pool-value', 'name': 'c'}]})
+        rc = ceph.broker.process_requests(reqs)
+        self.assertEqual(json.loads(rc), {'exit-code': 1, 'stderr': 'first'})
+
+
+class BrokerStateCapsTestCase(unittest.TestCase):
+    def setUp(self):
+        super(BrokerStateCapsTestCase, self).setUp()
+        self.fake = ceph.executor.FakeExecutor()
+        previous = ceph.executor.set_executor(self.fake)
+        self.addCleanup(ceph.executor.set_executor, previous)
+        groups = {'pools': ['glance'],
+                  'services': ['tenant{}'.format(i) for i in range(5)]}
+        keys = {'cephx.groups.images': json.dumps(groups)}
+        for service in groups['services']:
+            keys['cephx.services.{}'.format(service)] = json.dumps(
+                {'group_names': {'rwx': ['images']}})
+        self.fake.responses['config-key dump'] = json.dumps(keys)
+        self.fake.responses['auth list'] = json.dumps({'auth_dump': [
+            {'entity': 'client.{}'.format(service),
+             'caps': {'mon': 'allow r', 'osd': 'allow rwx pool=glance'}}
+            for service in groups['services']]})
+
+    def caps_calls(self, mock_check_call):
+        return sorted(c[0][0][3] for c in mock_check_call.call_args_list)
+
+    @patch.object(ceph.broker, 'check_call')
+    def test_unchanged_caps_not_applied(self, mock_check_call):
+        with ceph.broker.BrokerState('admin'):
+            ceph.broker.add_pool_to_group('glance', 'images')
+        self.assertFalse(mock_check_call.called)
+        self.assertEqual(self.fake.prefixes(),
+                         ['config-key dump', 'auth list'])
+
+    @patch.object(ceph.broker, 'monitor_key_set')
+    @patch.object(ceph.broker, 'check_call')
+    def test_only_changed_caps_applied(self, mock_check_call,
+                                       mock_monitor_key_set):
+        auth = json.loads(self.fake.responses['auth list'])
+        auth['auth_dump'][0]['caps']['osd'] = ('allow rwx pool=glance, '
+                                               'allow rwx pool=cinder')
+        self.fake.responses['auth list'] = json.dumps(auth)
+        state = ceph.broker.BrokerState('admin')
+        with state:
+            ceph.broker.add_pool_to_group('cinder', 'images')
+        self.assertEqual(self.caps_calls(mock_check_call),
+                         ['client.tenant1', 'client.tenant2',
+                          'client.tenant3', 'client.tenant4'])
+        self.assertEqual(
+            state.applied_caps()['client.tenant1']['osd'],
+            'allow rwx pool=glance, allow rwx pool=cinder')
+
+    @patch.object(ceph.broker, 'log')
+    @patch.object(ceph.broker, 'monitor_key_set')
+    @patch.object(ceph.broker, 'check_call')
+    def test_failed_caps_not_recorded(self, mock_check_call,
+                                      mock_monitor_key_set, _log):
+        mock_check_call.side_effect = CalledProcessError(1, 'ceph')
+        state = ceph.broker.BrokerState('admin')
+        with state:
+            ceph.broker.add_pool_to_group('cinder', 'images')
+        self.assertEqual(len(mock_check_call.call_args_list), 5)
+        self.assertEqual(state.applied_caps()['client.tenant0']['osd'],
+                         'allow rwx pool=glance')
+
+
+class CephxGroupStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        super(CephxGroupStoreTestCase, self).setUp()
+        self.fake = ceph.executor.FakeExecutor()
+        previous = ceph.executor.set_executor(self.fake)
+        self.addCleanup(ceph.executor.set_executor, previous)
+        self.store = ceph.broker.CephxGroupStore('admin')
+
+    @patch.object(ceph.broker, 'monitor_key_get')
+    def test_loaded_once(self, _monitor_key_get):
+        self.fake.responses['config-key dump'] = json.dumps({
+            'cephx.groups.images': '{"pools": ["glance"]}',
+            'cephx.services.nova': '{"group_names": {}}',
+            'mgr/dashboard/server_port': '7000'})
+        self.assertEqual(self.store.get('cephx.groups.images'),
+                         '{"pools": ["glance"]}')
+        self.assertEqual(self.store.get('cephx.services.nova'),
+                         '{"group_names": {}}')
+        self.assertIsNone(self.store.get('cephx.groups.volumes'))
+        self.assertEqual(self.fake.prefixes(), ['config-key dump'])
+        self.assertFalse(_monitor_key_get.called)
+
+    @patch.object(ceph.broker, 'log')
+    @patch.object(ceph.broker, 'monitor_key_get')
+    def test_dump_failure_reads_keys(self, _monitor_key_get, _log):
+        self.fake.responses['config-key dump'] = CalledProcessError(
+            1, 'ceph')
+        _monitor_key_get.return_value = '{"pools": []}'
+        self.store.get('cephx.groups.images')
+        self.store.get('cephx.groups.images')
+        _monitor_key_get.assert_called_once_with(
+            service='admin', key='cephx.groups.images')
+
+    @patch.object(ceph.broker, 'monitor_key_set')
+    def test_flush_only_changed(self, _monitor_key_set):
+        self.fake.responses['config-key dump'] = json.dumps({
+            'cephx.groups.images': '{"pools": ["glance"]}'})
+        self.store.set('cephx.groups.images', '{"pools": ["glance"]}')
+        self.store.set('cephx.groups.volumes', '{"pools": []}')
+        self.store.set('cephx.groups.volumes', '{"pools": ["cinder"]}')
+        self.assertEqual(self.store.dirty(), ['cephx.groups.volumes'])
+        self.store.flush()
+        _monitor_key_set.assert_called_once_with(
+            service='admin', key='cephx.groups.volumes',
+            value='{"pools": ["cinder"]}')
+        self.assertEqual(self.store.dirty(), [])
+
+    @patch.object(ceph.broker, 'monitor_key_set')
+    def test_flush_failure_keeps_dirty(self, _monitor_key_set):
+        self.fake.responses['config-key dump'] = '{}'
+        self.store.set('cephx.groups.a', '{}')
+        self.store.set('cephx.groups.b', '{}')
+        _monitor_key_set.side_effect = [None, CalledProcessError(1, 'ceph')]
+        with self.assertRaises(CalledProcessError):
+            self.store.flush()
+        self.assertEqual(self.store.dirty(), ['cephx.groups.b'])
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ResponseCacheTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'cache.json')
+        self.epochs = {'osdmap': 10, 'monmap': 1, 'fsmap': 1}
+
+    def test_key_independent_of_dict_order(self):
+        key = ceph.broker.ResponseCache.key
+        self.assertEqual(key('abc', [{'op': 'create-pool', 'name': 'foo'}]),
+                         key('abc', [{'name': 'foo', 'op': 'create-pool'}]))
+        self.assertNotEqual(key('abc', [{'op': 'create-pool', 'name': 'a'}]),
+                            key('abc', [{'op': 'create-pool', 'name': 'b'}]))
+
+    def test_persisted(self):
+        cache = ceph.broker.ResponseCache(path=self.path)
+        cache.put('a', self.epochs, {'exit-code': 0})
+        cache.save()
+        cache = ceph.broker.ResponseCache(path=self.path)
+        cache.load()
+        self.assertEqual(cache.get('a', self.epochs), {'exit-code': 0})
+
+    def test_save_creates_directory(self):
+        path = os.path.join(self.tmpdir, 'state', 'cache.json')
+        cache = ceph.broker.ResponseCache(path=path)
+        cache.put('a', self.epochs, {'exit-code': 0})
+        cache.save()
+        cache = ceph.broker.ResponseCache(path=path)
+        cache.load()
+        self.assertEqual(cache.get('a', self.epochs), {'exit-code': 0})
+
+    @patch.object(ceph.broker, 'log')
+    def test_load_corrupt(self, _log):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        cache = ceph.broker.ResponseCache(path=self.path)
+        cache.load()
+        self.assertEqual(len(cache), 0)
+
+    def test_epoch_change_invalidates(self):
+        cache = ceph.broker.ResponseCache(path=self.path)
+        cache.put('a', self.epochs, {'exit-code': 0})
+        self.assertIsNone(cache.get('a', dict(self.epochs, osdmap=11)))
+        self.assertIsNone(cache.get('a', self.epochs))
+
+    @patch.object(ceph.broker.time, 'time')
+    def test_expired(self, _time):
+        _time.return_value = 1000
+        cache = ceph.broker.ResponseCache(path=self.path, ttl=60)
+        cache.put('a', self.epochs, {'exit-code': 0})
+        _time.return_value = 1059
+        self.assertEqual(cache.get('a', self.epochs), {'exit-code': 0})
+        _time.return_value = 1061
+        self.assertIsNone(cache.get('a', self.epochs))
+
+    def test_lru_eviction(self):
+        cache = ceph.broker.ResponseCache(path=self.path, size=2)
+        cache.put('a', self.epochs, {'exit-code': 0})
+        cache.put('b', self.epochs, {'exit-code': 0})
+        cache.get('a', self.epochs)
+        cache.put('c', self.epochs, {'exit-code': 0})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b', self.epochs))
+        self.assertIsNotNone(cache.get('a', self.epochs))
+        self.assertIsNotNone(cache.get('c', self.epochs))
+
+    @patch.object(ceph.broker, 'process_requests_v1')
+    @patch.object(ceph.broker, 'get_cluster_epochs')
+    @patch.object(ceph.broker, 'log')
+    def test_process_requests_replays(self, _log, _get_cluster_epochs,
+                                      _process_requests_v1):
+        patcher = patch.object(ceph.broker, 'BROKER_CACHE_FILE', self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _get_cluster_epochs.return_value = self.epochs
+        _process_requests_v1.return_value = {'exit-code': 0}
+        reqs = json.dumps({'api-version': 1, 'request-id': '1ef5aede',
+                           'ops': [{'op': 'create-pool', 'name': 'foo',
+                                    'replicas': 3}]})
+        self.assertEqual(json.loads(ceph.broker.process_requests(reqs)),
+                         {'exit-code': 0, 'request-id': '1ef5aede'})
+        self.assertEqual(json.loads(ceph.broker.process_requests(reqs)),
+                         {'exit-code': 0, 'request-id': '1ef5aede'})
+        self.assertEqual(_process_requests_v1.call_count, 1)
+
+        _get_cluster_epochs.return_value = dict(self.epochs, osdmap=11)
+        ceph.broker.process_requests(reqs)
+        self.assertEqual(_process_requests_v1.call_count, 2)
+
+    @patch.object(ceph.broker, 'process_requests_v1')
+    @patch.object(ceph.broker, 'get_cluster_epochs')
+    @patch.object(ceph.broker, 'log')
+    def test_process_requests_errors_not_cached(self, _log,
+                                                _get_cluster_epochs,
+                                                _process_requests_v1):
+        patcher = patch.object(ceph.broker, 'BROKER_CACHE_FILE', self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _get_cluster_epochs.return_value = self.epochs
+        _process_requests_v1.return_value = {'exit-code': 1, 'stderr': 'no'}
+        reqs = json.dumps({'api-version': 1, 'request-id': '1ef5aede',
+                           'ops': [{'op': 'delete-pool', 'name': 'foo'}]})
+        ceph.broker.process_requests(reqs)
+        ceph.broker.process_requests(reqs)
+        self.assertEqual(_process_requests_v1.call_count, 2)
+        self.assertFalse(os.path.exists(self.path))
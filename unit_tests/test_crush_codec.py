@@ -0,0 +1,343 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import unittest
+
+from mock import patch
+
+import ceph.crush_codec as crush_codec
+import ceph.crush_utils as crush_utils
+import ceph.executor as executor
+
+
+# The fixtures are laid out field by field as CrushWrapper::encode writes
+# them, independently of the encoder under test. They are not the output
+# of a real crushtool, which is why Crushmap still decompiles with
+# crushtool and only encodes maps the codec reproduces exactly.
+
+def u8(*values):
+    return struct.pack('<{}B'.format(len(values)), *values)
+
+
+def u32(*values):
+    return struct.pack('<{}I'.format(len(values)), *values)
+
+
+def s32(*values):
+    return struct.pack('<{}i'.format(len(values)), *values)
+
+
+def names(mapping):
+    data = u32(len(mapping))
+    for key in sorted(mapping):
+        value = mapping[key].encode('UTF-8')
+        data += s32(key) + u32(len(value)) + value
+    return data
+
+
+def bucket(id, type, alg, weight, items, weights):
+    return (u32(alg) +
+            struct.pack('<iHBBII', id, type, alg, 0, weight, len(items)) +
+            s32(*items) + weights)
+
+
+def rule(ruleset, type, min_size, max_size, steps):
+    data = u32(1, len(steps)) + u8(ruleset, type, min_size, max_size)
+    for step in steps:
+        data += struct.pack('<Iii', *step)
+    return data
+
+
+TYPES = {0: 'osd', 1: 'host', 2: 'chassis', 3: 'rack', 4: 'row', 5: 'pdu',
+         6: 'pod', 7: 'room', 8: 'datacenter', 9: 'region', 10: 'root'}
+
+# 0.003 in 16.16 fixed point
+W = 197
+
+JEWEL_HEAD = (
+    u32(0x10000) + s32(4) + u32(1) + s32(3) +
+    # straw buckets: item weight and straw for each item
+    bucket(-1, 10, 4, 3 * W, [-2, -3, -4], u32(W, 0x10000) * 3) +
+    bucket(-2, 1, 4, W, [0], u32(W, 0x10000)) +
+    bucket(-3, 1, 4, W, [1], u32(W, 0x10000)) +
+    bucket(-4, 1, 4, W, [2], u32(W, 0x10000)) +
+    rule(0, 1, 1, 10, [(1, -1, 0), (6, 0, 1), (4, 0, 0)]) +
+    names(TYPES) +
+    names({-4: 'ip-172-31-30-0', -3: 'ip-172-31-54-117',
+           -2: 'ip-172-31-33-152', -1: 'default',
+           0: 'osd.0', 1: 'osd.1', 2: 'osd.2'}) +
+    names({0: 'replicated_ruleset'}))
+
+JEWEL = (JEWEL_HEAD +
+         u32(0, 0, 50) + u32(1) + u8(1) + u8(1) + u32(54) + u8(0))
+
+JEWEL_TEXT = """# begin crush map
+tunable choose_local_tries 0
+tunable choose_local_fallback_tries 0
+tunable choose_total_tries 50
+tunable chooseleaf_descend_once 1
+tunable chooseleaf_vary_r 1
+tunable straw_calc_version 1
+tunable allowed_bucket_algs 54
+
+# devices
+device 0 osd.0
+device 1 osd.1
+device 2 osd.2
+
+# types
+type 0 osd
+type 1 host
+type 2 chassis
+type 3 rack
+type 4 row
+type 5 pdu
+type 6 pod
+type 7 room
+type 8 datacenter
+type 9 region
+type 10 root
+
+# buckets
+host ip-172-31-33-152 {
+\tid -2\t\t# do not change unnecessarily
+\t# weight 0.003
+\talg straw
+\thash 0\t# rjenkins1
+\titem osd.0 weight 0.003
+}
+host ip-172-31-54-117 {
+\tid -3\t\t# do not change unnecessarily
+\t# weight 0.003
+\talg straw
+\thash 0\t# rjenkins1
+\titem osd.1 weight 0.003
+}
+host ip-172-31-30-0 {
+\tid -4\t\t# do not change unnecessarily
+\t# weight 0.003
+\talg straw
+\thash 0\t# rjenkins1
+\titem osd.2 weight 0.003
+}
+root default {
+\tid -1\t\t# do not change unnecessarily
+\t# weight 0.009
+\talg straw
+\thash 0\t# rjenkins1
+\titem ip-172-31-33-152 weight 0.003
+\titem ip-172-31-54-117 weight 0.003
+\titem ip-172-31-30-0 weight 0.003
+}
+
+# rules
+rule replicated_ruleset {
+\truleset 0
+\ttype replicated
+\tmin_size 1
+\tmax_size 10
+\tstep take default
+\tstep chooseleaf firstn 0 type host
+\tstep emit
+}
+
+# end crush map
+"""
+
+# A luminous map: straw2 buckets, device classes with their shadow buckets
+# (-2 is default~ssd, -4 is node1~ssd), a rule taking a class and a
+# choose_args weight set.
+LUMINOUS = (
+    u32(0x10000) + s32(4) + u32(2) + s32(2) +
+    bucket(-1, 10, 5, 2 * W, [-3], u32(2 * W)) +
+    bucket(-2, 10, 5, W, [-4], u32(W)) +
+    bucket(-3, 1, 5, 2 * W, [0, 1], u32(W, W)) +
+    bucket(-4, 1, 5, W, [0], u32(W)) +
+    rule(0, 1, 1, 10, [(1, -1, 0), (6, 0, 1), (4, 0, 0)]) +
+    rule(1, 1, 1, 10, [(8, 100, 0), (1, -2, 0), (6, 0, 1), (4, 0, 0)]) +
+    names({0: 'osd', 1: 'host', 10: 'root'}) +
+    names({-4: 'node1~ssd', -3: 'node1', -2: 'default~ssd', -1: 'default',
+           0: 'osd.0', 1: 'osd.1'}) +
+    names({0: 'replicated_rule', 1: 'fast'}) +
+    u32(0, 0, 50) + u32(1) + u8(1) + u8(1) + u32(54) + u8(1) +
+    # class_map, class_name, class_bucket
+    u32(2) + s32(0, 0) + s32(1, 1) +
+    names({0: 'ssd', 1: 'hdd'}) +
+    u32(2) + s32(-3) + u32(1) + s32(0, -4) + s32(-1) + u32(1) + s32(0, -2) +
+    # choose_args: one map, with a weight set for bucket -3
+    u32(1) + struct.pack('<q', 1) + u32(1) + u32(2) + u32(1) + u32(2) +
+    u32(W, 2 * W) + u32(0))
+
+# Uniform, list and tree buckets, from an old map without tunables
+OTHER_ALGS = (
+    u32(0x10000) + s32(5) + u32(0) + s32(2) +
+    bucket(-1, 1, 1, 2 * W, [0, 1], u32(W)) +
+    bucket(-2, 1, 2, 2 * W, [0, 1], u32(W, W, W, 2 * W)) +
+    # a tree of 2 items has 4 nodes: the items are at the odd nodes and
+    # their parent at node 2
+    bucket(-3, 1, 3, 2 * W, [0, 1], u8(4) + u32(0, W, 2 * W, W)) +
+    u32(0) +
+    bucket(-5, 2, 5, 6 * W, [-1, -2, -3], u32(2 * W, 2 * W, 2 * W)) +
+    names({0: 'osd', 1: 'host', 2: 'root'}) +
+    names({-5: 'default', -3: 'tree', -2: 'list', -1: 'uniform',
+           0: 'osd.0', 1: 'osd.1'}) +
+    names({}))
+
+
+class BinaryCrushmapTests(unittest.TestCase):
+    def test_round_trip(self):
+        for fixture in [JEWEL, JEWEL_HEAD, LUMINOUS, OTHER_ALGS]:
+            crushmap = crush_codec.BinaryCrushmap.decode(fixture)
+            self.assertEqual(crushmap.encode(), fixture)
+
+    def test_decompile(self):
+        crushmap = crush_codec.BinaryCrushmap.decode(JEWEL)
+        self.assertEqual(crushmap.decompile(), JEWEL_TEXT)
+
+    def test_decompile_luminous(self):
+        crushmap = crush_codec.BinaryCrushmap.decode(LUMINOUS)
+        tree = crush_utils.CRUSHTree.parse(crushmap.decompile())
+        self.assertEqual(list(tree.buckets), ['node1', 'default'])
+        self.assertEqual(tree.buckets['node1'].class_ids, [('ssd', -4)])
+        self.assertEqual(tree.buckets['node1'].alg, 'straw2')
+        self.assertEqual(tree.devices['osd.1'].device_class, 'hdd')
+        self.assertEqual(tree.rules['fast'].id_keyword, 'id')
+        self.assertEqual(tree.rules_by_id[1].steps,
+                         ['set_choose_tries 100', 'take default class ssd',
+                          'chooseleaf firstn 0 type host', 'emit'])
+        self.assertEqual(tree.tunables['chooseleaf_stable'].value, '1')
+        self.assertIn("choose_args 1 {\n  {\n    bucket_id -3\n"
+                      "    weight_set [\n      [ 0.003 0.006 ]\n    ]\n"
+                      "  }\n}", tree.render())
+
+    def test_decompile_other_algs(self):
+        crushmap = crush_codec.BinaryCrushmap.decode(OTHER_ALGS)
+        tree = crush_utils.CRUSHTree.parse(crushmap.decompile())
+        for name in ['uniform', 'list', 'tree']:
+            self.assertEqual(
+                [(item.name, item.weight)
+                 for item in tree.buckets[name].items],
+                [('osd.0', '0.003'), ('osd.1', '0.003')])
+        self.assertEqual(tree.tunables, {})
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            crush_codec.BinaryCrushmap.decode(u32(0x1234))
+        with self.assertRaises(ValueError):
+            crush_codec.BinaryCrushmap.decode(JEWEL[:-20])
+        with self.assertRaises(ValueError):
+            crush_codec.BinaryCrushmap.decode(LUMINOUS + u8(0))
+
+    def test_add_bucket_and_rule(self):
+        crushmap = crush_codec.BinaryCrushmap.decode(JEWEL)
+        crushmap.add_bucket('fast', 'root', -5)
+        index = crushmap.add_rule('fast', 1, 'replicated', 1, 10,
+                                  ['take fast',
+                                   'chooseleaf firstn 0 type host', 'emit'])
+        self.assertEqual(index, 1)
+        crushmap = crush_codec.BinaryCrushmap.decode(crushmap.encode())
+        self.assertEqual(crushmap.name_map[-5], 'fast')
+        self.assertEqual(crushmap.bucket(-5).type, 10)
+        self.assertEqual(crushmap.bucket(-5).items, [])
+        self.assertEqual(crushmap.rule_name_map[1], 'fast')
+        self.assertEqual(crushmap.rules[1].ruleset, 1)
+        self.assertEqual(crushmap.rules[1].steps,
+                         [(1, -5, 0), (6, 0, 1), (4, 0, 0)])
+
+    def test_add_rule_luminous_ruleset(self):
+        crushmap = crush_codec.BinaryCrushmap.decode(LUMINOUS)
+        index = crushmap.add_rule('slow', None, 'replicated', 1, 10,
+                                  ['take default', 'emit'])
+        self.assertEqual(crushmap.rules[index].ruleset, 2)
+
+    def test_add_straw_bucket_with_items(self):
+        crushmap = crush_codec.BinaryCrushmap.decode(JEWEL)
+        with self.assertRaises(NotImplementedError):
+            crushmap.add_bucket('rack1', 'rack', -5, 'straw',
+                                items=[('ip-172-31-30-0', 0.003)])
+        bucket = crushmap.add_bucket('rack1', 'rack', -5, 'straw2',
+                                     items=[('ip-172-31-30-0', 0.003)])
+        self.assertEqual(bucket.items, [-4])
+        self.assertEqual(bucket.weight, W)
+
+
+class SavingExecutor(executor.FakeExecutor):
+    """Keeps the input of each command, such as a saved CRUSH map."""
+
+    def __init__(self, responses=None):
+        super(SavingExecutor, self).__init__(responses)
+        self.saved = []
+
+    def check_output(self, command, stderr=None):
+        if command.infile:
+            self.saved.append(command.inbuf())
+        return super(SavingExecutor, self).check_output(command, stderr)
+
+
+class CrushmapBinaryTests(unittest.TestCase):
+    def setUp(self):
+        super(CrushmapBinaryTests, self).setUp()
+        self.executor = SavingExecutor({'osd getcrushmap': JEWEL})
+        previous = executor.set_executor(self.executor)
+        self.addCleanup(executor.set_executor, previous)
+
+    def crushtool(self, popen, output):
+        popen.return_value.communicate.return_value = (output, None)
+        popen.return_value.returncode = 0
+
+    @patch.object(crush_utils, 'Popen')
+    def test_add_bucket_without_compiling(self, popen):
+        self.crushtool(popen, JEWEL_TEXT.encode('UTF-8'))
+        crushmap = crush_utils.Crushmap()
+        self.assertEqual(crushmap.buckets(),
+                         [crush_utils.CRUSHBucket('default', -1, True)])
+        crushmap.ensure_bucket_is_present('test')
+        crushmap.ensure_bucket_is_present('default')
+        popen.assert_called_once_with(['crushtool', '-d', '/dev/stdin'],
+                                      stdin=crush_utils.PIPE,
+                                      stdout=crush_utils.PIPE)
+        popen.return_value.communicate.assert_called_once_with(JEWEL)
+        self.assertEqual(self.executor.prefixes(),
+                         ['osd getcrushmap', 'osd setcrushmap'])
+        self.assertEqual(len(self.executor.saved), 1)
+        saved = crush_codec.BinaryCrushmap.decode(self.executor.saved[0])
+        self.assertEqual(saved.name_map[-5], 'test')
+        self.assertEqual(saved.rule_name_map[1], 'test')
+        self.assertEqual(saved.rules[1].steps[0], (1, -5, 0))
+
+    @patch.object(crush_utils, 'log')
+    @patch.object(crush_utils, 'Popen')
+    def test_undecodable_map_uses_crushtool(self, popen, _log):
+        self.executor.responses['osd getcrushmap'] = b'not a crushmap'
+        self.crushtool(popen, JEWEL_TEXT.encode('UTF-8'))
+        crushmap = crush_utils.Crushmap()
+        popen.return_value.communicate.assert_called_once_with(
+            b'not a crushmap')
+        self.assertIsNotNone(crushmap.bucket('ip-172-31-30-0'))
+        self.assertIsNone(crushmap._compiled)
+
+    @patch.object(crush_utils, 'log')
+    @patch.object(crush_codec.BinaryCrushmap, 'encode')
+    @patch.object(crush_utils, 'Popen')
+    def test_map_not_round_tripping_uses_crushtool(self, popen, encode,
+                                                   _log):
+        encode.return_value = b'different'
+        self.crushtool(popen, JEWEL_TEXT.encode('UTF-8'))
+        crushmap = crush_utils.Crushmap()
+        self.assertIsNone(crushmap._compiled)
+        self.crushtool(popen, b'compiled by crushtool')
+        crushmap.ensure_bucket_is_present('test')
+        self.assertEqual(popen.call_args[0][0][:2], ['crushtool', '-c'])
+        self.assertEqual(self.executor.saved, [b'compiled by crushtool'])
@@ -15,6 +15,7 @@
 import unittest
 
 import ceph.crush_utils
+import ceph.executor
 
 from mock import patch
 
@@ -301,3 +302,244 @@ class CephCrushmapTests(unittest.TestCase):
         result = ceph.crush_utils.Crushmap.bucket_string("fast", -21)
         expected = CRUSHMAP4
         self.assertEqual(expected, result)
+
+
+CRUSHMAP_LUMINOUS = """# begin crush map
+tunable choose_total_tries 50
+tunable straw_calc_version 1
+
+# devices
+device 0 osd.0 class ssd
+device 1 osd.1 class hdd
+
+# types
+type 0 osd
+type 1 host
+type 11 root
+
+# buckets
+host node1 {
+\tid -3\t\t# do not change unnecessarily
+\tid -4 class ssd\t\t# do not change unnecessarily
+\tid -5 class hdd\t\t# do not change unnecessarily
+\t# weight 0.020
+\talg straw2
+\thash 0\t# rjenkins1
+\titem osd.0 weight 0.010
+\titem osd.1 weight 0.010
+}
+root default {
+\tid -1\t\t# do not change unnecessarily
+\tid -2 class ssd\t\t# do not change unnecessarily
+\t# weight 0.020
+\talg straw2
+\thash 0\t# rjenkins1
+\titem node1 weight 0.020
+}
+
+# rules
+rule replicated_rule {
+\tid 0
+\ttype replicated
+\tmin_size 1
+\tmax_size 10
+\tstep take default
+\tstep chooseleaf firstn 0 type host
+\tstep emit
+}
+
+# choose_args
+choose_args 1 {
+  {
+    bucket_id -1
+    weight_set [
+      [ 0.020 ]
+    ]
+  }
+}
+
+# end crush map
+"""
+
+
+class CRUSHTreeTests(unittest.TestCase):
+    def setUp(self):
+        super(CRUSHTreeTests, self).setUp()
+        self.tree = ceph.crush_utils.CRUSHTree.parse(CRUSHMAP_LUMINOUS)
+
+    def test_indexes(self):
+        self.assertEqual(self.tree.tunables['choose_total_tries'].value, '50')
+        self.assertEqual(self.tree.devices['osd.0'].device_class, 'ssd')
+        self.assertEqual(self.tree.devices_by_id[1].name, 'osd.1')
+        self.assertEqual(self.tree.types_by_id[11].name, 'root')
+        self.assertEqual(self.tree.buckets_by_id[-4].name, 'node1')
+        self.assertEqual(self.tree.buckets['node1'].alg, 'straw2')
+        self.assertEqual(self.tree.parents['osd.1'], 'node1')
+        self.assertEqual(self.tree.parents['node1'], 'default')
+        self.assertEqual([bucket.name for bucket in self.tree.roots()],
+                         ['default'])
+        self.assertEqual(self.tree.next_bucket_id(), -6)
+        rule = self.tree.rules_by_id[0]
+        self.assertEqual(rule.name, 'replicated_rule')
+        self.assertEqual(rule.id_keyword, 'id')
+        self.assertEqual(rule.steps[1], 'chooseleaf firstn 0 type host')
+
+    def test_unchanged_render(self):
+        self.assertEqual(self.tree.render(), CRUSHMAP_LUMINOUS)
+
+    def test_only_changed_sections_rendered(self):
+        bucket = self.tree.buckets['node1']
+        bucket.items[1].weight = '0.500'
+        self.tree.changed(bucket)
+        expected = CRUSHMAP_LUMINOUS.replace(
+            CRUSHMAP_LUMINOUS[CRUSHMAP_LUMINOUS.index('host node1'):
+                              CRUSHMAP_LUMINOUS.index('root default') - 1],
+            """host node1 {
+    id -3    # do not change unnecessarily
+    id -4 class ssd    # do not change unnecessarily
+    id -5 class hdd    # do not change unnecessarily
+    # weight 0.510
+    alg straw2
+    hash 0  # rjenkins1
+    item osd.0 weight 0.010
+    item osd.1 weight 0.500
+}""")
+        self.assertEqual(self.tree.render(), expected)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ceph.crush_utils.CRUSHTree.parse("nonsense here")
+        with self.assertRaises(ValueError):
+            ceph.crush_utils.CRUSHTree.parse("type 1 host\nhost a {\n")
+
+    @patch.object(ceph.crush_utils.Crushmap, 'load_crushmap')
+    def test_crushmap_bucket_lookup(self, load_crushmap):
+        load_crushmap.return_value = CRUSHMAP_LUMINOUS
+        crushmap = ceph.crush_utils.Crushmap()
+        self.assertEqual(crushmap.bucket('node1').id, -3)
+        self.assertIsNone(crushmap.bucket('missing'))
+        self.assertEqual(crushmap._ids, [-5, -4, -3, -2, -1])
+
+
+class CRUSHTreeEditTests(unittest.TestCase):
+    def setUp(self):
+        super(CRUSHTreeEditTests, self).setUp()
+        self.tree = ceph.crush_utils.CRUSHTree.parse(CRUSHMAP1)
+
+    def test_move_item_updates_weights(self):
+        self.tree.add(ceph.crush_utils.CRUSHNode('root', 'fast', -5))
+        self.tree.move_item('osd.1', 'fast', 0.5)
+        self.assertEqual(self.tree.parents['osd.1'], 'fast')
+        self.assertEqual(self.tree.buckets['ip-172-31-54-117'].items, [])
+        self.assertEqual(self.tree.item_weight('ip-172-31-54-117'), 0.0)
+        self.assertEqual(self.tree.item_weight('osd.1'), 0.5)
+        rendered = self.tree.render()
+        self.assertIn("    item ip-172-31-54-117 weight 0.00000\n", rendered)
+        self.assertTrue(rendered.endswith(
+            "root fast {\n"
+            "    id -5    # do not change unnecessarily\n"
+            "    # weight 0.500\n"
+            "    alg straw\n"
+            "    hash 0  # rjenkins1\n"
+            "    item osd.1 weight 0.50000\n"
+            "}"))
+        # Untouched buckets are written as they were read
+        self.assertIn(CRUSHMAP1[CRUSHMAP1.index('host ip-172-31-33-152'):
+                                CRUSHMAP1.index('host ip-172-31-54-117')],
+                      rendered)
+
+    def test_reweight(self):
+        self.tree.set_item_weight('osd.2', 1)
+        self.assertEqual(self.tree.item_weight('ip-172-31-30-0'), 1.0)
+        self.assertIn("    # weight 1.006\n", self.tree.render())
+
+    def test_new_bucket_written_before_its_parent(self):
+        self.tree.add(ceph.crush_utils.CRUSHNode('rack', 'rack1', -5))
+        self.tree.move_item('rack1', 'default', 0)
+        self.tree.move_item('ip-172-31-30-0', 'rack1', 0.003)
+        rendered = self.tree.render()
+        self.assertLess(rendered.index('rack rack1 {'),
+                        rendered.index('root default {'))
+        self.assertIn('    item rack1 weight 0.00300\n', rendered)
+        self.assertEqual(self.tree.item_weight('rack1'), 0.003)
+
+    def test_move_errors(self):
+        with self.assertRaises(KeyError):
+            self.tree.move_item('osd.9', 'default', 1)
+        with self.assertRaises(KeyError):
+            self.tree.move_item('osd.0', 'missing', 1)
+        with self.assertRaises(ValueError):
+            self.tree.move_item('default', 'ip-172-31-30-0', 1)
+
+
+class CrushmapTransactionTests(unittest.TestCase):
+    @patch.object(ceph.crush_utils.Crushmap, 'save')
+    @patch.object(ceph.crush_utils.Crushmap, 'load_crushmap')
+    def test_commit_saves_once(self, load_crushmap, save):
+        load_crushmap.return_value = CRUSHMAP1
+        crushmap = ceph.crush_utils.Crushmap()
+        crushmap.begin()
+        crushmap.queue_add_bucket('fast')
+        for osd in ['osd.0', 'osd.1', 'osd.2']:
+            crushmap.queue_move_item(osd, 'fast', 0.003)
+        crushmap.queue_reweight('osd.2', 0.01)
+        crushmap.commit()
+        save.assert_called_once_with(check_unchanged=True)
+        self.assertEqual(crushmap.item_weight('osd.2'), 0.01)
+        self.assertEqual(crushmap.item_weight('ip-172-31-30-0'), 0.0)
+
+    @patch.object(ceph.crush_utils.Crushmap, 'save')
+    @patch.object(ceph.crush_utils.Crushmap, 'load_crushmap')
+    def test_nothing_to_commit(self, load_crushmap, save):
+        load_crushmap.return_value = CRUSHMAP1
+        crushmap = ceph.crush_utils.Crushmap()
+        crushmap.begin()
+        crushmap.queue_add_bucket('default')
+        self.assertIsNone(crushmap.commit())
+        self.assertFalse(save.called)
+
+    @patch.object(ceph.crush_utils.Crushmap, 'load_crushmap')
+    def test_queue_requires_begin(self, load_crushmap):
+        load_crushmap.return_value = CRUSHMAP1
+        crushmap = ceph.crush_utils.Crushmap()
+        with self.assertRaises(ValueError):
+            crushmap.queue_add_bucket('fast')
+
+    @patch.object(ceph.crush_utils, 'log')
+    @patch.object(ceph.crush_utils.Crushmap, 'save')
+    @patch.object(ceph.crush_utils.Crushmap, 'load_crushmap')
+    def test_commit_reapplies_on_change(self, load_crushmap, save, _log):
+        load_crushmap.return_value = CRUSHMAP1
+        save.side_effect = [ceph.crush_utils.CrushmapChanged(), 'ok']
+        crushmap = ceph.crush_utils.Crushmap()
+        crushmap.begin()
+        crushmap.queue_add_bucket('fast')
+        crushmap.queue_move_item('osd.0', 'fast', 0.003)
+        self.assertEqual(crushmap.commit(), 'ok')
+        self.assertEqual(load_crushmap.call_count, 2)
+        self.assertEqual(crushmap._tree.parents['osd.0'], 'fast')
+
+    @patch.object(ceph.crush_utils, 'log')
+    @patch.object(ceph.crush_utils.Crushmap, 'save')
+    @patch.object(ceph.crush_utils.Crushmap, 'load_crushmap')
+    def test_commit_gives_up(self, load_crushmap, save, _log):
+        load_crushmap.return_value = CRUSHMAP1
+        save.side_effect = ceph.crush_utils.CrushmapChanged()
+        crushmap = ceph.crush_utils.Crushmap()
+        crushmap.begin()
+        crushmap.queue_add_bucket('fast')
+        with self.assertRaises(ceph.crush_utils.CrushmapChanged):
+            crushmap.commit(retries=2)
+        self.assertEqual(save.call_count, 2)
+
+    @patch.object(ceph.crush_utils.Crushmap, 'load_crushmap')
+    def test_save_checks_unchanged(self, load_crushmap):
+        fake = ceph.executor.FakeExecutor({'osd getcrushmap': b'after'})
+        previous = ceph.executor.set_executor(fake)
+        self.addCleanup(ceph.executor.set_executor, previous)
+        load_crushmap.return_value = CRUSHMAP1
+        crushmap = ceph.crush_utils.Crushmap()
+        crushmap._loaded = b'before'
+        with self.assertRaises(ceph.crush_utils.CrushmapChanged):
+            crushmap.save(check_unchanged=True)
+        self.assertEqual(fake.prefixes(), ['osd getcrushmap'])
@@ -12,9 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
-from mock import patch
+from mock import ANY, call, patch
+from subprocess import CalledProcessError
 
 import ceph.utils
 
@@ -43,3 +48,331 @@ class DiskTuningTestCase(unittest.TestCase):
         renderer = _templating.render
         ceph.utils.persist_settings({})
         assert not renderer.called, 'renderer should not have been called'
+
+
+def make_block_device(sys_dir, name, path, attrs):
+    """Creates a fake sysfs entry for a block device under sys_dir."""
+    device_dir = os.path.join(sys_dir, 'devices', path, name)
+    os.makedirs(os.path.join(device_dir, 'queue'))
+    os.makedirs(os.path.join(device_dir, 'device'))
+    for attr, value in attrs.items():
+        with open(os.path.join(device_dir, attr), 'w') as f:
+            f.write('{}\n'.format(value))
+    os.symlink(device_dir, os.path.join(sys_dir, 'class', 'block', name))
+
+
+class BlockDeviceTestCase(unittest.TestCase):
+    """Runs against a fake sysfs tree with sdb, sdc and nvme0n1."""
+
+    def setUp(self):
+        super(BlockDeviceTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sys_block = os.path.join(self.tmpdir, 'sys', 'class', 'block')
+        os.makedirs(self.sys_block)
+        self.rules = os.path.join(self.tmpdir, '60-ceph-osd-tuning.rules')
+        self.state = os.path.join(self.tmpdir, 'tuning', 'drive.json')
+        self.by_uuid = os.path.join(self.tmpdir, 'by-uuid')
+        os.makedirs(self.by_uuid)
+        for uuid in ('uuid-b', 'uuid-c'):
+            open(os.path.join(self.by_uuid, uuid), 'w').close()
+        for name, value in (('SYS_CLASS_BLOCK', self.sys_block),
+                            ('DISK_BY_UUID', self.by_uuid),
+                            ('UDEV_TUNING_RULES', self.rules),
+                            ('DRIVE_SETTINGS_STATE', self.state),
+                            ('BENCHMARK_CACHE', self.state + '.bench'),
+                            ('HDPARM_FILE', self.state + '.hdparm')):
+            patcher = patch.object(ceph.utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(ceph.utils, 'hookenv')
+        self.hookenv = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hookenv.config.return_value = 1024
+        sys_dir = os.path.join(self.tmpdir, 'sys')
+        make_block_device(sys_dir, 'sdb', 'pci0000:00/ata1/host0', {
+            'queue/rotational': 1,
+            'queue/scheduler': 'noop deadline [cfq]',
+            'queue/nr_requests': 128,
+            'queue/max_sectors_kb': 512,
+            'queue/max_hw_sectors_kb': 32767,
+            'queue/rq_affinity': 1,
+            'queue/read_ahead_kb': 128,
+            'device/model': 'ST4000NM0035',
+            'device/rev': 'TN02'})
+        make_block_device(sys_dir, 'sdc', 'pci0000:00/host1', {
+            'queue/rotational': 0,
+            'queue/scheduler': '[mq-deadline] none',
+            'queue/nr_requests': 256,
+            'queue/max_sectors_kb': 1280,
+            'queue/max_hw_sectors_kb': 1280,
+            'device/sas_address': '0x5000c500a1b2c3d4'})
+        make_block_device(sys_dir, 'nvme0n1', 'pci0000:00/nvme0', {
+            'queue/rotational': 0,
+            'queue/scheduler': '[none] mq-deadline',
+            'queue/nr_requests': 1023,
+            'queue/max_sectors_kb': 128,
+            'queue/max_hw_sectors_kb': 128})
+
+    def read_attr(self, name, attr):
+        with open(os.path.join(self.sys_block, name, attr)) as f:
+            return f.read().strip()
+
+    def blkid(self, cmd):
+        if cmd[0] != 'blkid':
+            return b''
+        out = []
+        for dev in cmd[3:]:
+            if dev != '/dev/nvme0n1':
+                out.append('DEVNAME={}\nUUID=uuid-{}\nTYPE=xfs\n'.format(
+                    dev, dev[-1]))
+        return '\n'.join(out).encode('UTF-8')
+
+
+class BlockTuningTestCase(BlockDeviceTestCase):
+    def test_transport(self):
+        self.assertEqual(ceph.utils.get_device_transport('/dev/sdb'), 'sata')
+        self.assertEqual(ceph.utils.get_device_transport('/dev/sdc'), 'sas')
+        self.assertEqual(ceph.utils.get_device_transport('/dev/nvme0n1'),
+                         'nvme')
+
+    @patch.object(ceph.utils, 'log')
+    def test_hdd_profile(self, _log):
+        self.assertEqual(ceph.utils.get_block_tuning('/dev/sdb'), {
+            'scheduler': 'deadline', 'read_ahead_sect': 2048,
+            'nr_requests': 256, 'max_sectors_kb': 1024, 'rq_affinity': 1,
+            'write_cache': 'on'})
+
+    @patch.object(ceph.utils, 'log')
+    def test_ssd_profile_respects_limits(self, _log):
+        self.assertEqual(ceph.utils.get_block_tuning('/dev/sdc'), {
+            'scheduler': 'mq-deadline', 'read_ahead_sect': 256,
+            'rq_affinity': 1})
+
+    @patch.object(ceph.utils, 'log')
+    def test_nvme_profile(self, _log):
+        self.assertEqual(ceph.utils.get_block_tuning('/dev/nvme0n1'), {
+            'scheduler': 'none', 'read_ahead_sect': 256, 'rq_affinity': 2})
+
+    @patch.object(ceph.utils.subprocess, 'check_output')
+    def test_get_block_uuids(self, _check_output):
+        _check_output.side_effect = CalledProcessError(
+            2, 'blkid', output=self.blkid(
+                ['blkid', '-o', 'export', '/dev/sdb', '/dev/nvme0n1',
+                 '/dev/sdc']))
+        self.assertEqual(
+            ceph.utils.get_block_uuids(['/dev/sdb', '/dev/nvme0n1',
+                                        '/dev/sdc']),
+            {'/dev/sdb': 'uuid-b', '/dev/sdc': 'uuid-c'})
+        _check_output.assert_called_once_with(
+            ['blkid', '-o', 'export', '/dev/sdb', '/dev/nvme0n1', '/dev/sdc'])
+
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'persist_settings')
+    @patch.object(ceph.utils.subprocess, 'check_output')
+    @patch.object(ceph.utils, 'log')
+    def test_tune_dev(self, _log, _check_output, _persist, _status_set):
+        _check_output.side_effect = self.blkid
+        ceph.utils.tune_dev('/dev/sdb')
+        self.assertEqual(self.read_attr('sdb', 'queue/scheduler'), 'deadline')
+        self.assertEqual(self.read_attr('sdb', 'queue/nr_requests'), '256')
+        self.assertEqual(self.read_attr('sdb', 'queue/max_sectors_kb'),
+                         '1024')
+        self.assertEqual(self.read_attr('sdb', 'queue/read_ahead_kb'),
+                         '1024')
+        self.assertEqual(_check_output.call_args_list,
+                         [call(['blkid', '-o', 'export', '/dev/sdb']),
+                          call(['hdparm', '-W1', '/dev/sdb'])])
+        _persist.assert_called_once_with(settings_dict={
+            'drive_settings': {'uuid-b': {'read_ahead_sect': 2048,
+                                          'write_cache': 'on'}}})
+        with open(self.rules) as f:
+            rules = f.read().splitlines()
+        self.assertEqual(rules[1], (
+            'ACTION=="add|change", SUBSYSTEM=="block", '
+            'ENV{ID_FS_UUID}=="uuid-b", ATTR{queue/scheduler}="deadline", '
+            'ATTR{queue/nr_requests}="256", '
+            'ATTR{queue/max_sectors_kb}="1024", '
+            'ATTR{queue/rq_affinity}="1"'))
+
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'persist_settings')
+    @patch.object(ceph.utils.subprocess, 'check_output')
+    @patch.object(ceph.utils, 'log')
+    def test_tune_devices_merges_settings(self, _log, _check_output,
+                                          _persist, _status_set):
+        _check_output.side_effect = self.blkid
+        tuned = ceph.utils.tune_devices(['/dev/sdb', '/dev/nvme0n1'])
+        self.assertEqual(list(tuned), ['/dev/sdb'])
+        ceph.utils.tune_devices(['/dev/sdc'])
+        self.assertEqual(_persist.call_args_list[-1], call(settings_dict={
+            'drive_settings': {
+                'uuid-b': {'read_ahead_sect': 2048, 'write_cache': 'on'},
+                'uuid-c': {'read_ahead_sect': 256}}}))
+        self.assertEqual(self.read_attr('sdc', 'queue/read_ahead_kb'), '128')
+        with open(self.state + '.hdparm', 'w') as f:
+            f.write('rendered')
+        ceph.utils.tune_devices(['/dev/sdb', '/dev/sdc'])
+        self.assertEqual(_persist.call_count, 2)
+        with open(self.rules) as f:
+            self.assertEqual(len(f.read().splitlines()), 3)
+
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'persist_settings')
+    @patch.object(ceph.utils.subprocess, 'check_output')
+    @patch.object(ceph.utils, 'log')
+    def test_tune_devices_prunes_missing_disks(self, _log, _check_output,
+                                               _persist, _status_set):
+        _check_output.side_effect = self.blkid
+        ceph.utils.tune_devices(['/dev/sdb'])
+        os.remove(os.path.join(self.by_uuid, 'uuid-b'))
+        ceph.utils.tune_devices(['/dev/sdc'])
+        self.assertEqual(_persist.call_args_list[-1], call(settings_dict={
+            'drive_settings': {'uuid-c': {'read_ahead_sect': 256}}}))
+        with open(self.state) as f:
+            self.assertEqual(list(json.load(f)), ['uuid-c'])
+
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'persist_settings')
+    @patch.object(ceph.utils.subprocess, 'check_output')
+    @patch.object(ceph.utils, 'log')
+    def test_tune_devices_without_uuids(self, _log, _check_output, _persist,
+                                        _status_set):
+        _check_output.side_effect = CalledProcessError(2, 'blkid', output=b'')
+        self.assertEqual(ceph.utils.tune_devices(['/dev/nvme0n1']), {})
+        self.assertFalse(_persist.called)
+
+    @patch.object(ceph.utils, 'log')
+    def test_persist_udev_tuning_merges(self, _log):
+        ceph.utils.persist_udev_tuning({'uuid-b': {'rq_affinity': 1}})
+        ceph.utils.persist_udev_tuning({'uuid-c': {'rq_affinity': 2}})
+        mtime = os.stat(self.rules).st_mtime
+        with open(self.rules) as f:
+            rules = f.read().splitlines()
+        self.assertEqual(len(rules), 3)
+        self.assertIn('uuid-b', rules[1])
+        self.assertIn('uuid-c', rules[2])
+        with patch.object(ceph.utils, 'open', create=True) as _open:
+            _open.side_effect = open
+            ceph.utils.persist_udev_tuning({'uuid-c': {'rq_affinity': 2}})
+            self.assertEqual([c[0][1:] for c in _open.call_args_list],
+                             [('r',)])
+        self.assertEqual(os.stat(self.rules).st_mtime, mtime)
+
+
+class BenchmarkTestCase(BlockDeviceTestCase):
+    def fake_probe(self, target, pattern, block_size, span, seconds,
+                   direct):
+        self.probes.append(pattern)
+        scheduler = self.read_attr('sdb', 'queue/scheduler')
+        max_sectors_kb = int(self.read_attr('sdb', 'queue/max_sectors_kb'))
+        read_ahead_kb = int(self.read_attr('sdb', 'queue/read_ahead_kb'))
+        return {'iops': 100 if scheduler == 'deadline' else 50,
+                'bandwidth': (read_ahead_kb if pattern == 'bufread' else
+                              max_sectors_kb if max_sectors_kb <= 1024
+                              else 10),
+                'p50': 0.001, 'p95': 0.002, 'p99': 0.003}
+
+    def setUp(self):
+        super(BenchmarkTestCase, self).setUp()
+        self.probes = []
+        for name in ('log', 'status_set', 'monitor_key_get',
+                     'monitor_key_set'):
+            patcher = patch.object(ceph.utils, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.monitor_key_get.return_value = None
+
+    def test_run_io_probe(self):
+        target = os.path.join(self.tmpdir, 'target')
+        ceph.utils.prepare_benchmark_target(target, 4 * 1048576)
+        self.assertEqual(os.path.getsize(target), 4 * 1048576)
+        for pattern in ('read', 'randwrite', 'bufread'):
+            result = ceph.utils.run_io_probe(target, pattern, 4096,
+                                             span=1048576, seconds=0.05,
+                                             direct=False)
+            self.assertTrue(result['bandwidth'] > 0)
+            self.assertAlmostEqual(result['bandwidth'], result['iops'] * 4096)
+            self.assertTrue(result['p50'] <= result['p99'])
+
+    @patch.object(ceph.utils, '_libc')
+    def test_bufread_does_not_wrap(self, _libc):
+        target = os.path.join(self.tmpdir, 'target')
+        ceph.utils.prepare_benchmark_target(target, 1048576)
+        _libc.return_value.pread.return_value = 4096
+        ceph.utils.run_io_probe(target, 'bufread', 4096, span=1048576,
+                                seconds=60)
+        self.assertEqual(_libc.return_value.pread.call_count, 256)
+        offsets = [c[0][3] for c in _libc.return_value.pread.call_args_list]
+        self.assertEqual(len(set(offsets)), 256)
+
+    @patch.object(ceph.utils, '_libc')
+    def test_probe_limited_to_target(self, _libc):
+        target = os.path.join(self.tmpdir, 'target')
+        ceph.utils.prepare_benchmark_target(target, 1048576)
+        pread = _libc.return_value.pread
+        pread.return_value = 4096
+        result = ceph.utils.run_io_probe(target, 'randread', 4096,
+                                         seconds=0.05)
+        self.assertLess(max(c[0][3] for c in pread.call_args_list),
+                        1048576)
+        self.assertAlmostEqual(result['bandwidth'], result['iops'] * 4096)
+        pread.return_value = 0
+        with self.assertRaises(OSError):
+            ceph.utils.run_io_probe(target, 'read', 4096, seconds=0.05)
+        with self.assertRaises(ValueError):
+            ceph.utils.run_io_probe(target, 'read', 2 * 1048576,
+                                    seconds=0.05)
+
+    @patch.object(ceph.utils, 'is_block_device')
+    def test_benchmark_loop_device(self, _is_block_device):
+        _is_block_device.return_value = True
+        result = ceph.utils.benchmark_device(
+            '/dev/sdb', '/dev/loop3', probe=self.fake_probe)
+        _is_block_device.assert_called_with('/dev/loop3')
+        self.assertNotIn('read_ahead_kb', result['settings'])
+        self.assertNotIn('bufread', self.probes)
+        self.assertEqual(result['settings']['scheduler'], 'deadline')
+
+    def test_benchmark_device(self):
+        result = ceph.utils.benchmark_device(
+            '/dev/sdb', '/srv/bench', service='osd-upgrade',
+            probe=self.fake_probe)
+        self.assertEqual(result['settings'], {'scheduler': 'deadline',
+                                              'max_sectors_kb': 1024,
+                                              'read_ahead_kb': 4096})
+        self.assertEqual([(r['setting'], r['value'])
+                          for r in result['results']][:3],
+                         [('scheduler', 'noop'), ('scheduler', 'deadline'),
+                          ('scheduler', 'cfq')])
+        self.assertEqual(self.read_attr('sdb', 'queue/scheduler'), 'cfq')
+        self.assertEqual(self.read_attr('sdb', 'queue/max_sectors_kb'),
+                         '512')
+        self.monitor_key_set.assert_called_once_with(
+            'osd-upgrade', 'benchmark_ST4000NM0035_TN02', ANY)
+
+        self.probes = []
+        again = ceph.utils.benchmark_device('/dev/sdb', '/srv/bench',
+                                            probe=self.fake_probe)
+        self.assertEqual(again['settings'], result['settings'])
+        self.assertEqual(self.probes, [])
+
+    def test_results_shared_by_model(self):
+        self.monitor_key_get.return_value = (
+            '{"settings": {"scheduler": "noop", "read_ahead_kb": 512}}')
+        self.assertEqual(
+            ceph.utils.get_benchmarked_tuning('/dev/sdb', 'osd-upgrade'),
+            {'scheduler': 'noop', 'read_ahead_kb': 512})
+        self.monitor_key_get.assert_called_once_with(
+            'osd-upgrade', 'benchmark_ST4000NM0035_TN02')
+        tuning = ceph.utils.get_block_tuning('/dev/sdb')
+        self.assertEqual(tuning['scheduler'], 'noop')
+        self.assertEqual(tuning['read_ahead_sect'], 1024)
+
+    @patch.object(ceph.utils.subprocess, 'check_output')
+    def test_attach_loop_device(self, _check_output):
+        _check_output.return_value = b'/dev/loop3\n'
+        self.assertEqual(ceph.utils.attach_loop_device('/srv/bench'),
+                         '/dev/loop3')
+        _check_output.assert_called_once_with(
+            ['losetup', '--find', '--show', '--direct-io=on', '/srv/bench'])
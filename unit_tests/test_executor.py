@@ -0,0 +1,352 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+from subprocess import CalledProcessError, STDOUT
+
+import ceph.executor as executor
+import ceph.utils as utils
+
+
+class FakeRadosError(Exception):
+    pass
+
+
+class CephCommandTestCase(unittest.TestCase):
+    def test_argv(self):
+        cmd = executor.CephCommand('osd tree', service='admin', fmt='json')
+        self.assertEqual(cmd.argv(),
+                         ['ceph', '--id', 'admin', 'osd', 'tree',
+                          '--format=json'])
+
+    def test_argv_keyring_and_list_args(self):
+        cmd = executor.CephCommand(
+            'auth get-or-create',
+            args=[('entity', 'client.foo'),
+                  ('caps', ['mon', 'allow r', 'osd', 'allow rwx'])],
+            user='ceph', name='mon.', keyring='/path/keyring')
+        self.assertEqual(cmd.argv(),
+                         ['sudo', '-u', 'ceph', 'ceph', '--name', 'mon.',
+                          '--keyring', '/path/keyring',
+                          'auth', 'get-or-create', 'client.foo',
+                          'mon', 'allow r', 'osd', 'allow rwx'])
+
+    def test_argv_rados(self):
+        cmd = executor.CephCommand('lspools', service='admin',
+                                   binary='rados')
+        self.assertEqual(cmd.argv(), ['rados', '--id', 'admin', 'lspools'])
+
+    def test_mon_command(self):
+        cmd = executor.CephCommand('osd crush reweight',
+                                   args=[('name', 'osd.0'), ('weight', '1')],
+                                   mon_args={'weight': 1.0},
+                                   fmt='json')
+        self.assertEqual(cmd.mon_command(),
+                         {'prefix': 'osd crush reweight',
+                          'name': 'osd.0',
+                          'weight': 1.0,
+                          'format': 'json'})
+
+
+class RadosExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        super(RadosExecutorTestCase, self).setUp()
+        patcher = patch.object(executor, 'rados')
+        self.rados = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rados.Error = FakeRadosError
+        self.connection = self.rados.Rados.return_value
+        self.fallback = executor.FakeExecutor({'osd tree': 'from-cli'})
+        self.executor = executor.RadosExecutor(fallback=self.fallback)
+
+    @patch.object(executor, 'log')
+    def test_connection_reused(self, _log):
+        self.connection.mon_command.return_value = (0, b'{"nodes": []}', '')
+        cmd = executor.CephCommand('osd tree', service='admin', fmt='json')
+        self.assertEqual(self.executor.check_output(cmd), '{"nodes": []}')
+        self.assertEqual(self.executor.check_output(cmd), '{"nodes": []}')
+        self.rados.Rados.assert_called_once_with(
+            conffile=executor.CEPH_CONF, rados_id='admin')
+        self.assertEqual(self.connection.connect.call_count, 1)
+        self.connection.mon_command.assert_called_with(
+            json.dumps({'prefix': 'osd tree', 'format': 'json'}), b'',
+            timeout=30)
+        self.assertEqual(self.fallback.commands, [])
+
+    @patch.object(executor, 'log')
+    def test_mon_command_error(self, _log):
+        self.connection.mon_command.return_value = (-22, b'', 'invalid')
+        cmd = executor.CephCommand('osd set', args=[('key', 'bogus')])
+        with self.assertRaises(CalledProcessError) as ctx:
+            self.executor.check_output(cmd)
+        self.assertEqual(ctx.exception.returncode, 22)
+        self.assertEqual(ctx.exception.output, 'invalid')
+
+    @patch.object(executor, 'log')
+    def test_status_message_merged(self, _log):
+        self.connection.mon_command.return_value = (
+            0, b'', "reweighted item id 0 name 'osd.0' to 1")
+        cmd = executor.CephCommand('osd crush reweight',
+                                   args=[('name', 'osd.0'), ('weight', '1')])
+        self.assertEqual(self.executor.check_output(cmd), '')
+        self.assertEqual(self.executor.check_output(cmd, stderr=STDOUT),
+                         "reweighted item id 0 name 'osd.0' to 1")
+
+    @patch.object(executor, 'log')
+    def test_lspools(self, _log):
+        self.connection.list_pools.return_value = ['rbd', 'glance']
+        cmd = executor.CephCommand('lspools', service='admin',
+                                   binary='rados')
+        self.assertEqual(self.executor.check_output(cmd), 'rbd\nglance\n')
+
+    @patch.object(executor, 'log')
+    def test_connect_failure_falls_back(self, _log):
+        self.connection.connect.side_effect = FakeRadosError('denied')
+        cmd = executor.CephCommand('osd tree', service='osd-upgrade',
+                                   fmt='json')
+        self.assertEqual(self.executor.check_output(cmd), 'from-cli')
+        self.assertEqual(self.executor.check_output(cmd), 'from-cli')
+        self.assertEqual(self.connection.connect.call_count, 1)
+        self.assertEqual(self.fallback.prefixes(), ['osd tree', 'osd tree'])
+
+    @patch.object(executor, 'log')
+    def test_close(self, _log):
+        self.connection.mon_command.return_value = (0, b'', '')
+        self.executor.check_call(executor.CephCommand('status'))
+        self.executor.close()
+        self.connection.shutdown.assert_called_once_with()
+
+    def test_other_user_goes_to_fallback(self):
+        cmd = executor.CephCommand('osd tree', user='ceph')
+        self.assertEqual(self.executor.check_output(cmd), 'from-cli')
+        self.assertFalse(self.rados.Rados.called)
+        self.assertEqual(self.fallback.commands, [cmd])
+
+    @patch.object(executor, 'log')
+    def test_raw_output_and_infile(self, _log):
+        self.connection.mon_command.return_value = (0, b'\x00\xff', '')
+        cmd = executor.CephCommand('osd getcrushmap')
+        self.assertEqual(self.executor.check_output_raw(cmd), b'\x00\xff')
+        self.connection.mon_command.return_value = (0, b'', '')
+        with tempfile.NamedTemporaryFile() as crushmap:
+            crushmap.write(b'compiled')
+            crushmap.flush()
+            cmd = executor.CephCommand('osd setcrushmap',
+                                       infile=crushmap.name)
+            self.assertEqual(cmd.argv(), ['ceph', 'osd', 'setcrushmap',
+                                          '-i', crushmap.name])
+            self.executor.check_call(cmd)
+        self.connection.mon_command.assert_called_with(
+            json.dumps({'prefix': 'osd setcrushmap'}), b'compiled',
+            timeout=30)
+
+
+FAKE_RADOS = """
+import json
+
+
+class Error(Exception):
+    pass
+
+
+class Rados(object):
+    connects = 0
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def connect(self, timeout=None):
+        if self.kwargs.get('rados_id') == 'denied':
+            raise Error('denied')
+        Rados.connects += 1
+
+    def mon_command(self, cmd, inbuf, timeout=None):
+        prefix = json.loads(cmd)['prefix']
+        if prefix == 'osd getcrushmap':
+            return 0, b'\\x00\\xff', ''
+        if prefix == 'osd setcrushmap':
+            return 0, b'', 'set {} bytes'.format(len(inbuf))
+        if prefix == 'osd set':
+            return -22, b'', 'invalid'
+        return 0, json.dumps({'connects': Rados.connects,
+                              'identity': self.kwargs}).encode('UTF-8'), ''
+
+    def list_pools(self):
+        return ['rbd', 'glance']
+
+    def shutdown(self):
+        pass
+"""
+
+
+class CephShellExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        super(CephShellExecutorTestCase, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'rados.py'), 'w') as f:
+            f.write(FAKE_RADOS)
+        patcher = patch.dict(os.environ, {'PYTHONPATH': tmpdir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(executor, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fallback = executor.FakeExecutor({'osd tree': 'from-cli'})
+        self.executor = executor.CephShellExecutor(
+            fallback=self.fallback, python=sys.executable)
+        self.addCleanup(self.executor.close)
+
+    def test_connection_reused(self):
+        cmd = executor.CephCommand('osd tree', service='admin', fmt='json')
+        self.assertEqual(json.loads(self.executor.check_output(cmd)), {
+            'connects': 1,
+            'identity': {'conffile': executor.CEPH_CONF,
+                         'rados_id': 'admin'}})
+        output = json.loads(self.executor.check_output(cmd))
+        self.assertEqual(output['connects'], 1)
+        self.assertEqual(len(self.executor._shells), 1)
+        self.assertEqual(self.fallback.commands, [])
+
+    def test_outputs(self):
+        self.assertEqual(self.executor.check_output_raw(
+            executor.CephCommand('osd getcrushmap')), b'\x00\xff')
+        self.assertEqual(self.executor.check_output(
+            executor.CephCommand('lspools', binary='rados')),
+            'rbd\nglance\n')
+        with tempfile.NamedTemporaryFile() as crushmap:
+            crushmap.write(b'compiled')
+            crushmap.flush()
+            self.assertEqual(self.executor.check_output(
+                executor.CephCommand('osd setcrushmap', infile=crushmap.name),
+                stderr=STDOUT), 'set 8 bytes')
+        with self.assertRaises(CalledProcessError) as ctx:
+            self.executor.check_call(executor.CephCommand('osd set'))
+        self.assertEqual(ctx.exception.returncode, 22)
+        self.assertEqual(ctx.exception.output, 'invalid')
+
+    def test_connect_failure_falls_back(self):
+        cmd = executor.CephCommand('osd tree', service='denied')
+        self.assertEqual(self.executor.check_output(cmd), 'from-cli')
+        self.assertEqual(self.executor.check_output(cmd), 'from-cli')
+        self.assertEqual(self.fallback.prefixes(), ['osd tree', 'osd tree'])
+        self.assertNotEqual(self.executor.check_output(
+            executor.CephCommand('osd tree')), 'from-cli')
+
+    def test_stopped_shell_falls_back(self):
+        cmd = executor.CephCommand('osd tree')
+        self.executor.check_output(cmd)
+        shell = self.executor._shells[None]
+        shell.kill()
+        shell.wait()
+        self.assertEqual(self.executor.check_output(cmd), 'from-cli')
+        self.assertIsNone(self.executor._shells[None])
+
+    def test_without_rados(self):
+        os.environ['PYTHONPATH'] = ''
+        cmd = executor.CephCommand('osd tree')
+        self.assertEqual(self.executor.check_output(cmd), 'from-cli')
+
+    def test_close(self):
+        self.executor.check_output(executor.CephCommand('osd tree'))
+        shell = self.executor._shells[None]
+        self.executor.close()
+        self.assertIsNotNone(shell.poll())
+        self.assertEqual(self.executor._shells, {})
+
+    @patch.object(executor.subprocess, 'Popen')
+    def test_shell_per_user(self, popen):
+        popen.side_effect = OSError('no sudo')
+        self.executor.check_output(executor.CephCommand('osd tree',
+                                                        user='ceph'))
+        popen.assert_called_once_with(
+            ['sudo', '-u', 'ceph', sys.executable, executor.SHELL_SCRIPT],
+            stdin=executor.subprocess.PIPE, stdout=executor.subprocess.PIPE)
+
+
+class GetExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        super(GetExecutorTestCase, self).setUp()
+        previous = executor.set_executor(None)
+        self.addCleanup(executor.set_executor, previous)
+
+    @patch.object(executor, 'rados')
+    def test_rados_with_shell_fallback(self, _rados):
+        chosen = executor.get_executor()
+        self.assertIsInstance(chosen, executor.RadosExecutor)
+        self.assertIsInstance(chosen.fallback, executor.CephShellExecutor)
+        self.assertIs(executor.get_executor(), chosen)
+
+    @patch.object(executor, 'rados', None)
+    def test_shell_without_bindings(self):
+        self.assertIsInstance(executor.get_executor(),
+                              executor.CephShellExecutor)
+
+    def test_closed_at_exit(self):
+        fake = executor.FakeExecutor()
+        executor.set_executor(fake)
+        with patch.object(fake, 'close') as close:
+            executor._close_executor()
+        close.assert_called_once_with()
+
+
+class ExecutorHelpersTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ExecutorHelpersTestCase, self).setUp()
+        self.fake = executor.FakeExecutor()
+        previous = executor.set_executor(self.fake)
+        self.addCleanup(executor.set_executor, previous)
+
+    def test_list_pools(self):
+        self.fake.responses['lspools'] = 'rbd\nglance\n'
+        self.assertEqual(utils.list_pools('admin'), ['rbd', 'glance'])
+
+    def test_osd_noout(self):
+        utils.osd_noout(True)
+        utils.osd_noout(False)
+        self.assertEqual(self.fake.prefixes(), ['osd set', 'osd unset'])
+
+    @patch.object(utils, 'log')
+    def test_get_osd_weight_error(self, _log):
+        self.fake.responses['osd tree'] = CalledProcessError(1, 'ceph')
+        with self.assertRaises(CalledProcessError):
+            utils.get_osd_weight('osd.0')
+
+    def test_single_executor_for_many_helpers(self):
+        self.fake.responses['pg stat'] = '{"num_pg_by_state": [1]}'
+        self.fake.responses['status'] = '{"overall_status": "HEALTH_OK"}'
+        utils.get_ceph_pg_stat()
+        utils.get_ceph_health()
+        self.assertEqual(self.fake.prefixes(), ['pg stat', 'status'])
+
+    def test_get_cluster_epochs(self):
+        self.fake.responses['status'] = json.dumps({
+            'osdmap': {'osdmap': {'epoch': 42, 'num_osds': 3}},
+            'monmap': {'epoch': 2},
+            'fsmap': {'epoch': 5}})
+        self.assertEqual(utils.get_cluster_epochs(),
+                         {'osdmap': 42, 'monmap': 2, 'fsmap': 5})
+
+    def test_get_cluster_epochs_flat_osdmap(self):
+        self.fake.responses['status'] = json.dumps({
+            'osdmap': {'epoch': 7}, 'monmap': {'epoch': 1}})
+        self.assertEqual(utils.get_cluster_epochs(),
+                         {'osdmap': 7, 'monmap': 1})
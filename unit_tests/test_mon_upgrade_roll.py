@@ -322,3 +322,90 @@ class UpgradeRollingTestCase(unittest.TestCase):
             [call('ip-192-168-1-2 is not finished. Waiting')],
         )
         self.assertGreaterEqual(tval[0], previous_node_start_time + 600)
+
+
+class FakeClock(object):
+    """A time module whose sleep() advances time() instantly."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@patch.object(ceph.utils, 'log')
+class WaitForTestCase(unittest.TestCase):
+    def setUp(self):
+        super(WaitForTestCase, self).setUp()
+        self.clock = FakeClock()
+        patcher = patch.object(ceph.utils, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backoff_grows_with_jitter(self, _log):
+        results = [False] * 7 + [True]
+        self.assertTrue(ceph.utils.wait_for(lambda: results.pop(0),
+                                            initial=1, maximum=8))
+        self.assertEqual(len(self.clock.sleeps), 7)
+        for delay, slept in zip([1, 2, 4, 8, 8, 8, 8], self.clock.sleeps):
+            self.assertGreaterEqual(slept, delay / 2.0)
+            self.assertLessEqual(slept, delay)
+
+    def test_no_wait_when_ready(self, _log):
+        self.assertTrue(ceph.utils.wait_for(lambda: True))
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_deadline(self, _log):
+        self.assertFalse(ceph.utils.wait_for(lambda: False,
+                                             deadline=self.clock.now + 20,
+                                             initial=4, maximum=16))
+        self.assertEqual(self.clock.now, 1020.0)
+
+    @patch.object(ceph.utils, 'monitor_key_exists')
+    @patch.object(ceph.utils, 'get_mon_map')
+    def test_wait_for_all_monitors(self, get_mon_map, monitor_key_exists,
+                                   _log):
+        get_mon_map.return_value = {
+            'monmap': {'mons': [{'name': 'mon1'}, {'name': 'mon2'}]}}
+        monitor_key_exists.side_effect = [True, False, True, True]
+        ceph.utils.wait_for_all_monitors_to_upgrade(new_version='luminous',
+                                                    upgrade_key='admin')
+        self.assertEqual(len(self.clock.sleeps), 1)
+        monitor_key_exists.assert_called_with('admin',
+                                              'mon_mon2_luminous_done')
+
+    @patch.object(ceph.utils, 'monitor_key_exists')
+    @patch.object(ceph.utils, 'get_mon_map')
+    def test_wait_for_all_monitors_timeout(self, get_mon_map,
+                                           monitor_key_exists, _log):
+        get_mon_map.return_value = {'monmap': {'mons': [{'name': 'mon1'}]}}
+        monitor_key_exists.return_value = False
+        with self.assertRaises(Exception):
+            ceph.utils.wait_for_all_monitors_to_upgrade(
+                new_version='luminous', upgrade_key='admin')
+        self.assertEqual(self.clock.now, 1000.0 + 600)
+
+    @patch.object(ceph.utils, 'lock_and_roll')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'wait_on_previous_node')
+    @patch.object(ceph.utils, 'get_mon_map')
+    @patch.object(ceph.utils, 'socket')
+    def test_roll_reports_timing(self, socket, get_mon_map,
+                                 wait_on_previous_node, status_set,
+                                 lock_and_roll, log):
+        socket.gethostname.return_value = 'mon2'
+        get_mon_map.return_value = {
+            'monmap': {'mons': [{'name': 'mon1'}, {'name': 'mon2'}]}}
+        wait_on_previous_node.side_effect = \
+            lambda **kwargs: self.clock.sleep(12)
+        lock_and_roll.side_effect = lambda **kwargs: self.clock.sleep(30)
+        ceph.utils.roll_monitor_cluster(new_version='jewel',
+                                        upgrade_key='admin')
+        log.assert_called_with('mon mon2 spent 12.0 seconds waiting on '
+                               'other units and 30.0 seconds upgrading')
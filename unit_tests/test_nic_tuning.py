@@ -0,0 +1,297 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+from subprocess import CalledProcessError
+
+import ceph.utils
+
+
+class FakeEthtool(object):
+    """Answers ethtool commands from, and applies them to, a NIC state."""
+
+    def __init__(self):
+        self.rings = {'max': {'rx': 8192, 'tx': 8192},
+                      'current': {'rx': 1024, 'tx': 1024}}
+        self.coalesce = {'adaptive-rx': 'off', 'adaptive-tx': 'off',
+                         'rx-usecs': '50'}
+        self.features = {'generic-receive-offload': 'on',
+                         'large-receive-offload': 'on',
+                         'tcp-segmentation-offload': 'off'}
+        self.fixed = set()
+        self.refused = set()
+        self.commands = []
+
+    def __call__(self, cmd):
+        assert cmd[0] == 'ethtool'
+        option, iface, args = cmd[1], cmd[2], cmd[3:]
+        self.commands.append(cmd[1:])
+        if option in self.refused:
+            raise CalledProcessError(75, cmd)
+        pairs = dict(zip(args[::2], args[1::2]))
+        if option == '-g':
+            return (
+                'Ring parameters for {}:\n'
+                'Pre-set maximums:\n'
+                'RX:\t\t{max[rx]}\nRX Mini:\tn/a\nRX Jumbo:\t0\n'
+                'TX:\t\t{max[tx]}\n'
+                'Current hardware settings:\n'
+                'RX:\t\t{current[rx]}\nRX Mini:\tn/a\nRX Jumbo:\t0\n'
+                'TX:\t\t{current[tx]}\n'.format(iface, **self.rings)
+            ).encode('UTF-8')
+        if option == '-G':
+            self.rings['current'].update(
+                (key, int(value)) for key, value in pairs.items())
+        elif option == '-c':
+            return (
+                'Coalesce parameters for {}:\n'
+                'Adaptive RX: {adaptive-rx}  TX: {adaptive-tx}\n'
+                'stats-block-usecs: 0\n'
+                'rx-usecs: {rx-usecs}\n'.format(iface, **self.coalesce)
+            ).encode('UTF-8')
+        elif option == '-C':
+            self.coalesce.update(pairs)
+        elif option == '-k':
+            return ('Features for {}:\n'.format(iface) + ''.join(
+                '{}: {}{}\n'.format(name, state,
+                                    ' [fixed]' if name in self.fixed else '')
+                for name, state in sorted(self.features.items()))
+            ).encode('UTF-8')
+        elif option == '-K':
+            for name, value in pairs.items():
+                self.features[ceph.utils.NIC_OFFLOAD_FEATURES[name]] = value
+        return b''
+
+
+class NicTestCase(unittest.TestCase):
+    """Runs against a fake sysfs and procfs tree with a 25G eth0."""
+
+    def setUp(self):
+        super(NicTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sys_net = os.path.join(self.tmpdir, 'sys', 'class', 'net')
+        self.sys_system = os.path.join(self.tmpdir, 'sys', 'devices',
+                                       'system')
+        self.proc = os.path.join(self.tmpdir, 'proc')
+        self.rules = os.path.join(self.tmpdir, 'nic.rules')
+        for name, value in (('SYS_CLASS_NET', self.sys_net),
+                            ('SYS_DEVICES_SYSTEM', self.sys_system),
+                            ('PROC_DIR', self.proc),
+                            ('UDEV_NIC_RULES', self.rules)):
+            patcher = patch.object(ceph.utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.ethtool = FakeEthtool()
+        patcher = patch.object(ceph.utils.subprocess, 'check_output',
+                               side_effect=self.ethtool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(ceph.utils, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.write(self.sys_system, 'cpu/online', '0-7')
+        self.write(self.sys_system, 'node/node0/cpulist', '0-3')
+        self.write(self.sys_system, 'node/node1/cpulist', '4-7')
+        self.write(self.sys_net, 'eth0/speed', '25000')
+        self.write(self.sys_net, 'eth0/device/numa_node', '1')
+        for queue in range(2):
+            self.write(self.sys_net, 'eth0/queues/rx-{}/rps_cpus'.format(
+                queue), '00')
+            self.write(self.sys_net, 'eth0/queues/tx-{}/xps_cpus'.format(
+                queue), '00')
+        for irq in (70, 71, 72):
+            self.write(self.sys_net, 'eth0/device/msi_irqs/{}'.format(irq),
+                       'msix')
+            self.write(self.proc, 'irq/{}/smp_affinity_list'.format(irq),
+                       '0-7')
+        self.write(self.proc, '1/comm', 'systemd')
+        self.write(self.proc, '1234/comm', 'ceph-osd')
+        self.write(self.proc, '1234/status',
+                   'Name:\tceph-osd\nCpus_allowed_list:\t5-7\n')
+
+    def write(self, root, path, value):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('{}\n'.format(value))
+
+    def read(self, root, path):
+        with open(os.path.join(root, path)) as f:
+            return f.read().strip()
+
+
+class NicTuningTestCase(NicTestCase):
+    def test_link_speed_classes(self):
+        self.assertEqual(ceph.utils.get_link_speed('eth0'), 25000)
+        self.write(self.sys_net, 'eth0/speed', '20000')
+        self.assertEqual(ceph.utils.get_link_speed('eth0'), 10000)
+        self.write(self.sys_net, 'eth0/speed', '100000')
+        self.assertEqual(ceph.utils.get_link_speed('eth0'), 100000)
+        self.assertIsNone(ceph.utils.get_speed_class(100))
+        for speed in (10000, 25000, 40000, 50000, 100000):
+            self.assertIn(speed, ceph.utils.NETWORK_ADAPTER_SYSCTLS)
+
+    def test_cpu_helpers(self):
+        self.assertEqual(ceph.utils.parse_cpu_list('0-2,8,10-11'),
+                         [0, 1, 2, 8, 10, 11])
+        self.assertEqual(ceph.utils.cpu_mask([0, 1, 2, 3]), '0000000f')
+        self.assertEqual(ceph.utils.cpu_mask([32]), '00000001,00000000')
+
+    def test_nic_cpus_are_numa_local_osd_cpus(self):
+        self.assertEqual(ceph.utils.get_nic_cpus('eth0'), [5, 6, 7])
+        self.write(self.proc, '1234/comm', 'bash')
+        self.assertEqual(ceph.utils.get_nic_cpus('eth0'), [4, 5, 6, 7])
+        self.write(self.sys_net, 'eth0/device/numa_node', '-1')
+        self.assertEqual(ceph.utils.get_nic_cpus('eth0'), list(range(8)))
+
+    def test_plan(self):
+        self.ethtool.fixed.add('large-receive-offload')
+        plan = ceph.utils.plan_nic_tuning('eth0')
+        self.assertEqual(plan['rings'], {'rx': 8192, 'tx': 8192})
+        self.assertEqual(plan['coalesce'], {'adaptive-rx': 'on',
+                                            'adaptive-tx': 'on'})
+        self.assertEqual(plan['offloads'], {'gro': 'on', 'tso': 'on'})
+        self.assertEqual(plan['queues'], {
+            'rx-0/rps_cpus': '000000e0', 'rx-1/rps_cpus': '000000e0',
+            'tx-0/xps_cpus': '00000020', 'tx-1/xps_cpus': '00000040'})
+        self.assertEqual(plan['irqs'], {70: '5', 71: '6', 72: '7'})
+
+    def test_tune_nic_queues_is_idempotent(self):
+        changes = ceph.utils.tune_nic_queues('eth0')
+        self.assertIn(('ring rx', 1024, 8192), changes)
+        self.assertIn(('lro', 'on', 'off'), changes)
+        self.assertIn(('irq 71', '0-7', '6'), changes)
+        self.assertEqual(self.ethtool.rings['current'],
+                         {'rx': 8192, 'tx': 8192})
+        self.assertEqual(self.ethtool.features['tcp-segmentation-offload'],
+                         'on')
+        self.assertEqual(self.read(self.sys_net, 'eth0/queues/tx-1/xps_cpus'),
+                         '00000040')
+        self.assertEqual(self.read(self.proc, 'irq/72/smp_affinity_list'),
+                         '7')
+        with open(self.rules) as f:
+            rule = f.read().splitlines()[1]
+        self.assertTrue(rule.startswith(
+            'ACTION=="add", SUBSYSTEM=="net", KERNEL=="eth0", '
+            'RUN+="/sbin/ethtool -G eth0 rx 8192 tx 8192", '
+            'RUN+="/sbin/ethtool -C eth0 adaptive-rx on adaptive-tx on", '
+            'RUN+="/sbin/ethtool -K eth0 gro on lro off tso on", '
+            'ATTR{queues/rx-0/rps_cpus}="000000e0"'))
+        mtime = os.stat(self.rules).st_mtime
+
+        self.ethtool.commands = []
+        self.assertEqual(ceph.utils.tune_nic_queues('eth0'), [])
+        self.assertEqual([command[0] for command in self.ethtool.commands],
+                         ['-g', '-c', '-k', '-g', '-c', '-k'])
+        self.assertEqual(os.stat(self.rules).st_mtime, mtime)
+
+    def test_refused_options_not_persisted(self):
+        self.ethtool.coalesce['adaptive-tx'] = 'n/a'
+        plan = ceph.utils.plan_nic_tuning('eth0')
+        self.assertEqual(plan['coalesce'], {'adaptive-rx': 'on'})
+        self.ethtool.refused.add('-C')
+        changes = ceph.utils.tune_nic_queues('eth0')
+        self.assertIn(('ring rx', 1024, 8192), changes)
+        self.assertIn(('lro', 'on', 'off'), changes)
+        self.assertNotIn('adaptive-rx', [change[0] for change in changes])
+        self.assertEqual(self.ethtool.features['tcp-segmentation-offload'],
+                         'on')
+        with open(self.rules) as f:
+            rule = f.read().splitlines()[1]
+        self.assertIn('RUN+="/sbin/ethtool -G eth0 rx 8192 tx 8192", '
+                      'RUN+="/sbin/ethtool -K eth0 gro on lro off tso on"',
+                      rule)
+        self.assertNotIn('-C', rule)
+
+    def test_plan_without_ring_support(self):
+        self.ethtool.refused.add('-g')
+        plan = ceph.utils.plan_nic_tuning('eth0')
+        self.assertEqual(plan['rings'], {})
+        self.assertEqual(plan['coalesce'], {'adaptive-rx': 'on',
+                                            'adaptive-tx': 'on'})
+        self.assertEqual(plan['offloads'], {'gro': 'on', 'lro': 'off',
+                                            'tso': 'on'})
+
+    def test_unknown_speed_not_tuned(self):
+        self.write(self.sys_net, 'eth0/speed', '-1')
+        self.assertEqual(ceph.utils.tune_nic_queues('eth0'), [])
+        self.assertEqual(self.ethtool.commands, [])
+
+
+class SysctlTestCase(NicTestCase):
+    def setUp(self):
+        super(SysctlTestCase, self).setUp()
+        self.sysctl_conf = os.path.join(self.tmpdir, 'sysctl.d')
+        os.makedirs(self.sysctl_conf)
+        for name, value in (('SYSCTL_DIR', os.path.join(self.proc, 'sys')),
+                            ('SYSCTL_CONF_DIR', self.sysctl_conf)):
+            patcher = patch.object(ceph.utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(ceph.utils, 'status_set')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write(self.proc, 'sys/net/core/rmem_max', '212992')
+        self.write(self.proc, 'sys/net/ipv4/tcp_rmem', '4096\t87380\t6291456')
+
+    def test_get_sysctl(self):
+        self.assertEqual(ceph.utils.get_sysctl('net.core.rmem_max'),
+                         '212992')
+        self.assertEqual(ceph.utils.get_sysctl('net.ipv4.tcp_rmem'),
+                         '4096 87380 6291456')
+        self.assertIsNone(ceph.utils.get_sysctl('net.ipv4.tcp_low_latency'))
+
+    def test_apply_sysctls_only_writes_differences(self):
+        wanted = {'net.core.rmem_max': 67108864,
+                  'net.ipv4.tcp_rmem': '4096 87380 6291456',
+                  'net.ipv4.tcp_low_latency': 1}
+        self.assertEqual(ceph.utils.apply_sysctls(wanted), [
+            ('net.core.rmem_max', '212992', '67108864')])
+        self.assertEqual(self.read(self.proc, 'sys/net/core/rmem_max'),
+                         '67108864')
+        self.assertEqual(self.read(self.proc, 'sys/net/ipv4/tcp_rmem'),
+                         '4096\t87380\t6291456')
+        self.assertEqual(ceph.utils.apply_sysctls(wanted), [])
+
+    def test_save_sysctls_only_writes_changes(self):
+        path = os.path.join(self.sysctl_conf, 'test.conf')
+        settings = {'net.ipv4.tcp_rmem': '4096 87380 6291456',
+                    'net.core.rmem_max': 212992}
+        self.assertTrue(ceph.utils.save_sysctls(settings, path))
+        with open(path) as f:
+            self.assertEqual(f.read(),
+                             'net.core.rmem_max=212992\n'
+                             'net.ipv4.tcp_rmem=4096 87380 6291456\n')
+        self.assertFalse(ceph.utils.save_sysctls(settings, path))
+        settings['net.core.rmem_max'] = 1
+        self.assertTrue(ceph.utils.save_sysctls(settings, path))
+
+    def test_tune_nic(self):
+        changes = ceph.utils.tune_nic('eth0')
+        self.assertIn(('net.core.rmem_max', '212992', '67108864'), changes)
+        self.assertIn(('ring rx', 1024, 8192), changes)
+        conf = os.path.join(self.sysctl_conf, '51-ceph-osd-charm-eth0.conf')
+        with open(conf) as f:
+            self.assertIn('net.core.rmem_max=67108864\n', f.read())
+        mtime = os.stat(conf).st_mtime
+        self.assertEqual(ceph.utils.tune_nic('eth0'), [])
+        self.assertEqual(os.stat(conf).st_mtime, mtime)
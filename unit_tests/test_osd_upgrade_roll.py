@@ -12,13 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import json
 import os
+import shutil
 import sys
+import tempfile
 import time
 import unittest
 
 from mock import patch, call, mock_open
+from subprocess import CalledProcessError
 
+import ceph.executor
 import ceph.utils
 
 TO_PATCH = [
@@ -98,6 +104,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         # Make sure on an Upgrade to Hammer that chownr was NOT called.
         assert not chownr.called
 
+    @patch.object(ceph.utils, '_osd_migration_concurrency')
     @patch.object(ceph.utils, '_upgrade_single_osd')
     @patch.object(ceph.utils, 'update_owner')
     @patch('os.listdir')
@@ -116,7 +123,9 @@ class UpgradeRollingTestCase(unittest.TestCase):
                                local_osds, add_source, apt_update, status_set,
                                log, apt_install, dirs_need_ownership_update,
                                _get_child_dirs, listdir, update_owner,
-                               _upgrade_single_osd):
+                               _upgrade_single_osd,
+                               _osd_migration_concurrency):
+        _osd_migration_concurrency.return_value = 1
         config.side_effect = config_side_effect
         get_version.side_effect = [0.94, 10.1]
         systemd.return_value = False
@@ -264,80 +273,145 @@ class UpgradeRollingTestCase(unittest.TestCase):
         update_owner.assert_called_with('/var/lib/ceph/osd/ceph-6/ready')
 
     @patch.object(ceph.utils, 'socket')
-    @patch.object(ceph.utils, 'get_osd_tree')
+    @patch.object(ceph.utils, 'get_upgrade_groups')
+    @patch.object(ceph.utils, 'get_upgrade_failure_domain')
     @patch.object(ceph.utils, 'log')
     @patch.object(ceph.utils, 'lock_and_roll')
-    @patch.object(ceph.utils, 'get_upgrade_position')
+    @patch.object(ceph.utils, 'wait_on_previous_node')
     def test_roll_osd_cluster_first(self,
-                                    get_upgrade_position,
+                                    wait_on_previous_node,
                                     lock_and_roll,
                                     log,
-                                    get_osd_tree,
+                                    get_upgrade_failure_domain,
+                                    get_upgrade_groups,
                                     socket):
         socket.gethostname.return_value = "ip-192-168-1-2"
-        get_osd_tree.return_value = ""
-        get_upgrade_position.return_value = 0
+        get_upgrade_failure_domain.return_value = 'rack'
+        get_upgrade_groups.return_value = [
+            ('rack-a', ['ip-192-168-1-1', 'ip-192-168-1-2']),
+            ('rack-b', ['ip-192-168-1-3'])]
 
         ceph.utils.roll_osd_cluster(new_version='0.94.1',
                                     upgrade_key='osd-upgrade')
         log.assert_has_calls(
             [
                 call('roll_osd_cluster called with 0.94.1'),
-                call('osd_sorted_list: []'),
+                call("failure domain: rack upgrade groups: "
+                     "[('rack-a', ['ip-192-168-1-1', 'ip-192-168-1-2']), "
+                     "('rack-b', ['ip-192-168-1-3'])]"),
                 call('upgrade position: 0')
             ]
         )
+        get_upgrade_groups.assert_called_once_with('osd-upgrade', 'rack')
+        self.assertFalse(wait_on_previous_node.called)
         lock_and_roll.assert_called_with(my_name="ip-192-168-1-2",
                                          version="0.94.1",
                                          upgrade_key='osd-upgrade',
-                                         service='osd')
+                                         service='osd',
+                                         max_unclean_pgs=0.01)
 
-    @patch.object(ceph.utils, 'get_osd_tree')
+    @patch.object(ceph.utils, 'get_upgrade_recovery_time')
+    @patch.object(ceph.utils, 'get_upgrade_groups')
+    @patch.object(ceph.utils, 'get_upgrade_failure_domain')
     @patch.object(ceph.utils, 'socket')
     @patch.object(ceph.utils, 'status_set')
     @patch.object(ceph.utils, 'lock_and_roll')
-    @patch.object(ceph.utils, 'get_upgrade_position')
     @patch.object(ceph.utils, 'wait_on_previous_node')
     def test_roll_osd_cluster_second(self,
                                      wait_on_previous_node,
-                                     get_upgrade_position,
                                      lock_and_roll,
                                      status_set,
                                      socket,
-                                     get_osd_tree):
+                                     get_upgrade_failure_domain,
+                                     get_upgrade_groups,
+                                     get_upgrade_recovery_time):
         wait_on_previous_node.return_value = None
-        socket.gethostname.return_value = "ip-192-168-1-3"
-        get_osd_tree.return_value = [
-            ceph.utils.CrushLocation(
-                name="ip-192-168-1-2",
-                identifier='a',
-                host='host-a',
-                rack='rack-a',
-                row='row-a',
-                datacenter='dc-1',
-                chassis='chassis-a',
-                root='ceph'),
-            ceph.utils.CrushLocation(
-                name="ip-192-168-1-3",
-                identifier='a',
-                host='host-b',
-                rack='rack-a',
-                row='row-a',
-                datacenter='dc-1',
-                chassis='chassis-a',
-                root='ceph')
-        ]
-        get_upgrade_position.return_value = 1
+        get_upgrade_recovery_time.return_value = 30.0
+        socket.gethostname.return_value = "ip-192-168-1-4"
+        get_upgrade_failure_domain.return_value = 'rack'
+        get_upgrade_groups.return_value = [
+            ('rack-a', ['ip-192-168-1-2', 'ip-192-168-1-3']),
+            ('rack-b', ['ip-192-168-1-4', 'ip-192-168-1-5']),
+            ('rack-c', ['ip-192-168-1-6'])]
 
         ceph.utils.roll_osd_cluster(new_version='0.94.1',
                                     upgrade_key='osd-upgrade')
         status_set.assert_called_with(
             'waiting',
-            'Waiting on ip-192-168-1-2 to finish upgrading')
-        lock_and_roll.assert_called_with(my_name='ip-192-168-1-3',
+            'Waiting on rack rack-a to finish upgrading')
+        wait_on_previous_node.assert_has_calls([
+            call(upgrade_key='osd-upgrade', service='osd',
+                 previous_node=name, version='0.94.1')
+            for name in ['ip-192-168-1-2', 'ip-192-168-1-3']])
+        self.assertEqual(wait_on_previous_node.call_count, 2)
+        get_upgrade_recovery_time.assert_called_once_with(
+            'osd-upgrade', 'osd', ['ip-192-168-1-2', 'ip-192-168-1-3'],
+            '0.94.1')
+        lock_and_roll.assert_called_with(my_name='ip-192-168-1-4',
                                          service='osd',
                                          upgrade_key='osd-upgrade',
-                                         version='0.94.1')
+                                         version='0.94.1',
+                                         max_unclean_pgs=0.01)
+
+    @patch.object(ceph.utils, 'get_upgrade_recovery_time')
+    @patch.object(ceph.utils, 'get_upgrade_groups')
+    @patch.object(ceph.utils, 'get_upgrade_failure_domain')
+    @patch.object(ceph.utils, 'socket')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'lock_and_roll')
+    @patch.object(ceph.utils, 'wait_on_previous_node')
+    def test_roll_osd_cluster_slow_recovery(self,
+                                            wait_on_previous_node,
+                                            lock_and_roll,
+                                            status_set,
+                                            socket,
+                                            get_upgrade_failure_domain,
+                                            get_upgrade_groups,
+                                            get_upgrade_recovery_time):
+        socket.gethostname.return_value = "ip-192-168-1-6"
+        get_upgrade_failure_domain.return_value = 'rack'
+        get_upgrade_groups.return_value = [
+            ('rack-a', ['ip-192-168-1-2']),
+            ('rack-b', ['ip-192-168-1-4', 'ip-192-168-1-5',
+                        'ip-192-168-1-6', 'ip-192-168-1-7'])]
+        # Twice the target recovery time halves the hosts rolled at once
+        get_upgrade_recovery_time.return_value = 240.0
+
+        ceph.utils.roll_osd_cluster(new_version='0.94.1',
+                                    upgrade_key='osd-upgrade',
+                                    max_unclean_pgs=0.05)
+        wait_on_previous_node.assert_has_calls([
+            call(upgrade_key='osd-upgrade', service='osd',
+                 previous_node=name, version='0.94.1')
+            for name in ['ip-192-168-1-2', 'ip-192-168-1-4']])
+        status_set.assert_called_with(
+            'waiting', 'Waiting on ip-192-168-1-4 to finish upgrading')
+        lock_and_roll.assert_called_with(my_name='ip-192-168-1-6',
+                                         service='osd',
+                                         upgrade_key='osd-upgrade',
+                                         version='0.94.1',
+                                         max_unclean_pgs=0.05)
+
+    @patch.object(ceph.utils, 'get_upgrade_groups')
+    @patch.object(ceph.utils, 'get_upgrade_failure_domain')
+    @patch.object(ceph.utils, 'socket')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'lock_and_roll')
+    def test_roll_osd_cluster_unknown_host(self,
+                                           lock_and_roll,
+                                           status_set,
+                                           socket,
+                                           get_upgrade_failure_domain,
+                                           get_upgrade_groups):
+        socket.gethostname.return_value = "ip-192-168-1-9"
+        get_upgrade_failure_domain.return_value = 'host'
+        get_upgrade_groups.return_value = [
+            ('ip-192-168-1-2', ['ip-192-168-1-2'])]
+
+        ceph.utils.roll_osd_cluster(new_version='0.94.1',
+                                    upgrade_key='osd-upgrade')
+        status_set.assert_called_with('blocked', 'failed to upgrade osd')
+        self.assertFalse(lock_and_roll.called)
 
     @patch('os.path.exists')
     @patch('os.listdir')
@@ -395,17 +469,37 @@ class UpgradeRollingTestCase(unittest.TestCase):
         ceph.utils.update_owner('/var/lib/ceph', True)
         check_call.assert_called_with(['chown', 'ceph:ceph', '/var/lib/ceph'])
 
+    @patch.object(ceph.utils, '_write_ownership_marker')
+    @patch.object(ceph.utils, 'grp')
+    @patch.object(ceph.utils, 'pwd')
+    @patch.object(ceph.utils, 'OwnershipFixer')
     @patch.object(ceph.utils, 'ceph_user')
     @patch('os.path.isdir')
     @patch('subprocess.check_call')
     @patch.object(ceph.utils, 'status_set')
     def test_update_owner_recurse(self, status_set, check_call,
-                                  isdir, ceph_user):
+                                  isdir, ceph_user, OwnershipFixer, pwd, grp,
+                                  _write_ownership_marker):
         ceph_user.return_value = 'ceph'
         isdir.return_value = True
-        ceph.utils.update_owner('/var/lib/ceph', True)
-        check_call.assert_called_with(['chown', '-R', 'ceph:ceph',
-                                       '/var/lib/ceph'])
+        pwd.getpwnam.return_value.pw_uid = 64045
+        grp.getgrnam.return_value.gr_gid = 64046
+        fixer = OwnershipFixer.return_value
+        fixer.changed = 10
+        fixer.scanned = 20
+        fixer.elapsed = 2.0
+        ceph.utils.update_owner('/var/lib/ceph/osd/ceph-1', True)
+        self.assertFalse(check_call.called)
+        OwnershipFixer.assert_called_once_with(
+            '/var/lib/ceph/osd/ceph-1', 64045, 64046,
+            checkpoint='/var/cache/ceph-ownership/'
+                       'var_lib_ceph_osd_ceph-1.json')
+        fixer.run.assert_called_once_with()
+        status_set.assert_called_once_with(
+            'maintenance',
+            'Updating ownership of /var/lib/ceph/osd/ceph-1 to ceph')
+        _write_ownership_marker.assert_called_once_with(
+            '/var/lib/ceph/osd/ceph-1', fixer.uid, fixer.gid, 'full', False)
 
 """
     @patch.object(ceph.utils, 'log')
@@ -438,3 +532,578 @@ class UpgradeRollingTestCase(unittest.TestCase):
             [call('ip-192-168-1-2 is not finished. Waiting')],
         )
 """
+
+
+def _rule(rule_id, ruleset, *types):
+    steps = [{'op': 'take', 'item': -1, 'item_name': 'default'}]
+    steps += [{'op': 'chooseleaf_firstn', 'num': 0, 'type': t} for t in types]
+    steps.append({'op': 'emit'})
+    return {'rule_id': rule_id, 'ruleset': ruleset, 'steps': steps}
+
+
+RACK_TREE = json.dumps({'nodes': [
+    {'id': -1, 'name': 'default', 'type': 'root', 'children': [-3, -2]},
+    {'id': -2, 'name': 'rack-b', 'type': 'rack', 'children': [-4]},
+    {'id': -3, 'name': 'rack-a', 'type': 'rack', 'children': [-6, -5]},
+    {'id': -4, 'name': 'node3', 'type': 'host', 'children': [2]},
+    {'id': -5, 'name': 'node2', 'type': 'host', 'children': [1]},
+    {'id': -6, 'name': 'node1', 'type': 'host', 'children': [0]},
+    {'id': 0, 'name': 'osd.0', 'type': 'osd', 'crush_weight': 1.0},
+    {'id': 1, 'name': 'osd.1', 'type': 'osd', 'crush_weight': 1.0},
+    {'id': 2, 'name': 'osd.2', 'type': 'osd', 'crush_weight': 1.0}]})
+
+
+class UpgradeGroupsTestCase(unittest.TestCase):
+    def setUp(self):
+        super(UpgradeGroupsTestCase, self).setUp()
+        self.fake = ceph.executor.FakeExecutor({
+            'osd stat': '{"epoch": 3}',
+            'osd tree': RACK_TREE})
+        previous = ceph.executor.set_executor(self.fake)
+        self.addCleanup(ceph.executor.set_executor, previous)
+        patcher = patch.dict(ceph.utils._osd_tree_snapshots, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failure_domain_strictest_pool(self):
+        self.fake.responses['osd pool ls'] = json.dumps([
+            {'pool_name': 'rbd', 'crush_rule': 0},
+            {'pool_name': 'glance', 'crush_rule': 2}])
+        self.fake.responses['osd crush rule dump'] = json.dumps([
+            _rule(0, 0, 'rack'), _rule(1, 1, 'osd'), _rule(2, 2, 'row')])
+        self.assertEqual(
+            ceph.utils.get_upgrade_failure_domain('osd-upgrade'), 'rack')
+        self.assertEqual(self.fake.commands[0].args, [('detail', 'detail')])
+
+    def test_failure_domain_ruleset(self):
+        self.fake.responses['osd pool ls'] = json.dumps([
+            {'pool_name': 'rbd', 'crush_ruleset': 1}])
+        self.fake.responses['osd crush rule dump'] = json.dumps([
+            _rule(0, 0, 'rack'), _rule(1, 1, 'row', 'host')])
+        self.assertEqual(
+            ceph.utils.get_upgrade_failure_domain('osd-upgrade'), 'host')
+
+    def test_failure_domain_no_pools(self):
+        self.fake.responses['osd pool ls'] = '[]'
+        self.fake.responses['osd crush rule dump'] = json.dumps([
+            _rule(0, 0, 'rack')])
+        self.assertEqual(
+            ceph.utils.get_upgrade_failure_domain('osd-upgrade'), 'host')
+
+    def test_groups_by_rack(self):
+        self.assertEqual(ceph.utils.get_upgrade_groups('osd-upgrade', 'rack'),
+                         [('rack-a', ['node1', 'node2']),
+                          ('rack-b', ['node3'])])
+
+    def test_groups_by_host(self):
+        self.assertEqual(ceph.utils.get_upgrade_groups('osd-upgrade', 'osd'),
+                         [('node1', ['node1']),
+                          ('node2', ['node2']),
+                          ('node3', ['node3'])])
+
+    def test_groups_missing_domain(self):
+        self.assertEqual(
+            ceph.utils.get_upgrade_groups('osd-upgrade', 'datacenter'),
+            [('node1', ['node1']), ('node2', ['node2']),
+             ('node3', ['node3'])])
+
+    @patch.object(ceph.utils, 'get_upgrade_recovery_time')
+    @patch.object(ceph.utils, 'socket')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'log')
+    @patch.object(ceph.utils, 'lock_and_roll')
+    @patch.object(ceph.utils, 'wait_on_previous_node')
+    def test_roll_falls_back_to_hosts(self, wait_on_previous_node,
+                                      lock_and_roll, log, status_set, socket,
+                                      get_upgrade_recovery_time):
+        # An osd-upgrade key created before the failure domain lookups
+        # were added is refused them
+        self.fake.responses['osd pool ls'] = CalledProcessError(13, 'ceph')
+        self.fake.responses['osd crush rule dump'] = CalledProcessError(
+            13, 'ceph')
+        self.fake.responses['osd stat'] = CalledProcessError(13, 'ceph')
+        socket.gethostname.return_value = 'node2'
+        get_upgrade_recovery_time.return_value = None
+
+        ceph.utils.roll_osd_cluster(new_version='0.94.1',
+                                    upgrade_key='osd-upgrade')
+        wait_on_previous_node.assert_called_once_with(
+            upgrade_key='osd-upgrade', service='osd', previous_node='node1',
+            version='0.94.1')
+        self.assertEqual(lock_and_roll.call_args[1]['my_name'], 'node2')
+
+    @patch.object(ceph.utils, 'get_upgrade_groups')
+    @patch.object(ceph.utils, 'socket')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'log')
+    @patch.object(ceph.utils, 'lock_and_roll')
+    @patch.object(ceph.utils, 'wait_on_previous_node')
+    def test_roll_grouping_fails(self, wait_on_previous_node, lock_and_roll,
+                                 log, status_set, socket, get_upgrade_groups):
+        self.fake.responses['osd pool ls'] = '[]'
+        self.fake.responses['osd crush rule dump'] = '[]'
+        get_upgrade_groups.side_effect = ValueError('bad tree')
+        socket.gethostname.return_value = 'rack-a'
+
+        ceph.utils.roll_osd_cluster(new_version='0.94.1',
+                                    upgrade_key='osd-upgrade')
+        # The old order: the buckets below the root, sorted by name
+        self.assertFalse(wait_on_previous_node.called)
+        self.assertEqual(lock_and_roll.call_args[1]['my_name'], 'rack-a')
+
+
+class UpgradePacingTestCase(unittest.TestCase):
+    def setUp(self):
+        super(UpgradePacingTestCase, self).setUp()
+        self.fake = ceph.executor.FakeExecutor()
+        previous = ceph.executor.set_executor(self.fake)
+        self.addCleanup(ceph.executor.set_executor, previous)
+
+    def test_unclean_pg_fraction(self):
+        self.fake.responses['pg stat'] = json.dumps({
+            'num_pg_by_state': [
+                {'name': 'active+clean', 'num': 90},
+                {'name': 'active+clean+scrubbing', 'num': 5},
+                {'name': 'active+undersized+degraded', 'num': 5}],
+            'num_pgs': 100})
+        self.assertEqual(
+            ceph.utils.get_unclean_pg_fraction(service='osd-upgrade'), 0.05)
+        self.assertEqual(self.fake.commands[0].service, 'osd-upgrade')
+
+    def test_unclean_pg_fraction_no_pgs(self):
+        self.fake.responses['pg stat'] = '{"num_pg_by_state": []}'
+        self.assertEqual(ceph.utils.get_unclean_pg_fraction(), 0.0)
+
+    def test_concurrency(self):
+        self.assertEqual(ceph.utils.get_upgrade_concurrency(6, None), 6)
+        self.assertEqual(ceph.utils.get_upgrade_concurrency(6, 60.0), 6)
+        self.assertEqual(ceph.utils.get_upgrade_concurrency(6, 360.0), 2)
+        self.assertEqual(ceph.utils.get_upgrade_concurrency(6, 3600.0), 1)
+
+    @patch.object(ceph.utils, 'monitor_key_get')
+    def test_recovery_time(self, monitor_key_get):
+        monitor_key_get.side_effect = ['12.5', None, '40.0']
+        self.assertEqual(ceph.utils.get_upgrade_recovery_time(
+            'osd-upgrade', 'osd', ['a', 'b', 'c'], 'luminous'), 40.0)
+        monitor_key_get.assert_called_with('osd-upgrade',
+                                           'osd_c_luminous_recovery')
+
+    @patch.object(ceph.utils, 'monitor_key_get')
+    def test_recovery_time_unknown(self, monitor_key_get):
+        monitor_key_get.return_value = None
+        self.assertIsNone(ceph.utils.get_upgrade_recovery_time(
+            'osd-upgrade', 'osd', ['a'], 'luminous'))
+
+    @patch.object(ceph.utils, 'time')
+    @patch.object(ceph.utils, 'log')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'upgrade_osd')
+    @patch.object(ceph.utils, 'monitor_key_set')
+    def test_lock_and_roll_waits_for_recovery(self, monitor_key_set,
+                                              upgrade_osd, status_set, log,
+                                              mock_time):
+        clock = [100.0]
+
+        def recover(seconds):
+            # The PGs peer while we sleep
+            clock[0] += seconds
+            self.fake.responses['pg stat'] = json.dumps({
+                'num_pg_by_state': [{'name': 'active+clean', 'num': 100}]})
+
+        def upgrade(version):
+            self.fake.responses['pg stat'] = json.dumps({
+                'num_pg_by_state': [{'name': 'active+clean', 'num': 96},
+                                    {'name': 'peering', 'num': 4}]})
+
+        mock_time.time.side_effect = lambda: clock[0]
+        mock_time.sleep.side_effect = recover
+        upgrade_osd.side_effect = upgrade
+        self.fake.responses['pg stat'] = json.dumps({
+            'num_pg_by_state': [{'name': 'active+clean', 'num': 100}]})
+        ceph.utils.lock_and_roll(upgrade_key='osd-upgrade', service='osd',
+                                 my_name='node1', version='luminous',
+                                 max_unclean_pgs=0.01)
+        upgrade_osd.assert_called_once_with('luminous')
+        keys = [c[0][1] for c in monitor_key_set.call_args_list]
+        self.assertEqual(keys, ['osd_node1_luminous_start',
+                                'osd_node1_luminous_recovering',
+                                'osd_node1_luminous_recovery',
+                                'osd_node1_luminous_done'])
+        recovery = monitor_key_set.call_args_list[2][0][2]
+        self.assertGreater(recovery, 0)
+        self.assertEqual(mock_time.sleep.call_count, 1)
+        self.assertEqual(self.fake.prefixes(),
+                         ['pg stat', 'pg stat', 'pg stat'])
+
+    @patch.object(ceph.utils, 'time')
+    @patch.object(ceph.utils, 'log')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'upgrade_osd')
+    @patch.object(ceph.utils, 'monitor_key_set')
+    def test_lock_and_roll_already_unclean(self, monitor_key_set,
+                                           upgrade_osd, status_set, log,
+                                           mock_time):
+        # A pool which was degraded before the upgrade does not hold the
+        # host for the whole timeout
+        mock_time.time.return_value = 100.0
+        self.fake.responses['pg stat'] = json.dumps({
+            'num_pg_by_state': [{'name': 'active+clean', 'num': 90},
+                                {'name': 'active+undersized+degraded',
+                                 'num': 10}]})
+        ceph.utils.lock_and_roll(upgrade_key='osd-upgrade', service='osd',
+                                 my_name='node1', version='luminous')
+        self.assertFalse(mock_time.sleep.called)
+        self.assertEqual(self.fake.prefixes(), ['pg stat', 'pg stat'])
+
+    @patch.object(ceph.utils, 'time')
+    @patch.object(ceph.utils, 'log')
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, 'upgrade_osd')
+    @patch.object(ceph.utils, 'monitor_key_set')
+    def test_lock_and_roll_pg_stat_refused(self, monitor_key_set,
+                                           upgrade_osd, status_set, log,
+                                           mock_time):
+        # Keys created before 'pg stat' was added to their caps
+        mock_time.time.return_value = 100.0
+        self.fake.responses['pg stat'] = CalledProcessError(13, 'ceph')
+        ceph.utils.lock_and_roll(upgrade_key='osd-upgrade', service='osd',
+                                 my_name='node1', version='luminous')
+        keys = [c[0][1] for c in monitor_key_set.call_args_list]
+        self.assertEqual(keys, ['osd_node1_luminous_start',
+                                'osd_node1_luminous_recovering',
+                                'osd_node1_luminous_recovery',
+                                'osd_node1_luminous_done'])
+        self.assertFalse(mock_time.sleep.called)
+
+
+@patch.object(ceph.utils, 'log')
+class OsdMigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OsdMigrationTestCase, self).setUp()
+        self.fake = ceph.executor.FakeExecutor({
+            'osd dump': '{"flags": "noout,sortbitwise"}',
+            'pg stat': json.dumps({
+                'num_pg_by_state': [{'name': 'active+clean', 'num': 10}]})})
+        previous = ceph.executor.set_executor(self.fake)
+        self.addCleanup(ceph.executor.set_executor, previous)
+
+    def test_concurrency_with_noout(self, _log):
+        self.assertEqual(
+            ceph.utils._osd_migration_concurrency(24, 4), 4)
+        self.assertEqual(
+            ceph.utils._osd_migration_concurrency(2, 4), 2)
+        self.assertEqual(self.fake.commands[0].service, 'osd-upgrade')
+
+    def test_concurrency_without_noout(self, _log):
+        self.fake.responses['osd dump'] = '{"flags": "sortbitwise"}'
+        self.assertEqual(
+            ceph.utils._osd_migration_concurrency(24, 4), 1)
+        self.assertEqual(self.fake.prefixes(), ['osd dump'])
+
+    def test_concurrency_unhealthy(self, _log):
+        self.fake.responses['pg stat'] = json.dumps({
+            'num_pg_by_state': [{'name': 'active+clean', 'num': 9},
+                                {'name': 'peering', 'num': 1}]})
+        self.assertEqual(
+            ceph.utils._osd_migration_concurrency(24, 4), 1)
+
+    def test_concurrency_unknown(self, _log):
+        self.fake.responses['osd dump'] = CalledProcessError(1, 'ceph')
+        self.assertEqual(
+            ceph.utils._osd_migration_concurrency(24, 4), 1)
+
+    def test_single_osd_skips_checks(self, _log):
+        self.assertEqual(
+            ceph.utils._osd_migration_concurrency(1, 4), 1)
+        self.assertEqual(self.fake.commands, [])
+
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, '_upgrade_single_osd')
+    def test_upgrade_osds_parallel(self, _upgrade_single_osd, status_set,
+                                   _log):
+        osds = [(str(num), 'ceph-{}'.format(num)) for num in range(6)]
+        ceph.utils._upgrade_osds(osds, max_workers=3)
+        self.assertEqual(
+            sorted(c[0] for c in _upgrade_single_osd.call_args_list),
+            sorted(osds))
+        status_set.assert_called_with(
+            'maintenance', 'Updating ownership of OSDs: 6/6 done')
+        self.assertEqual(status_set.call_count, 12)
+
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, '_upgrade_single_osd')
+    def test_upgrade_osds_serial_progress(self, _upgrade_single_osd,
+                                          status_set, _log):
+        self.fake.responses['osd dump'] = '{"flags": ""}'
+        ceph.utils._upgrade_osds([('0', 'ceph-0'), ('1', 'ceph-1')])
+        _upgrade_single_osd.assert_has_calls([call('0', 'ceph-0'),
+                                              call('1', 'ceph-1')])
+        status_set.assert_has_calls([
+            call('maintenance',
+                 'Updating ownership of OSDs: 0/2 done, migrating osd.0'),
+            call('maintenance', 'Updating ownership of OSDs: 1/2 done'),
+            call('maintenance',
+                 'Updating ownership of OSDs: 1/2 done, migrating osd.1'),
+            call('maintenance', 'Updating ownership of OSDs: 2/2 done')])
+
+    @patch.object(ceph.utils, 'status_set')
+    @patch.object(ceph.utils, '_upgrade_single_osd')
+    def test_upgrade_osds_stops_after_failure(self, _upgrade_single_osd,
+                                              status_set, _log):
+        self.fake.responses['osd dump'] = '{"flags": ""}'
+        _upgrade_single_osd.side_effect = [CalledProcessError(1, 'chown'),
+                                           None]
+        with self.assertRaises(CalledProcessError):
+            ceph.utils._upgrade_osds([('0', 'ceph-0'), ('1', 'ceph-1')])
+        _upgrade_single_osd.assert_called_once_with('0', 'ceph-0')
+
+
+@patch.object(ceph.utils, 'log')
+class OwnershipFixerTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OwnershipFixerTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for rel in ['a/x/y', 'b']:
+            os.makedirs(os.path.join(self.root, rel))
+        for rel in ['f1', 'a/f2', 'a/x/y/f3', 'b/f4', 'b/f5']:
+            with open(os.path.join(self.root, rel), 'w') as f:
+                f.write('data')
+        os.symlink('f1', os.path.join(self.root, 'link'))
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        self.checkpoint = os.path.join(state_dir, 'state', 'cp.json')
+        self.uid = os.getuid() + 1
+        self.gid = os.getgid() + 1
+        patcher = patch.object(os, 'lchown')
+        self.lchown = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def changed(self):
+        return sorted(os.path.relpath(c[0][0], self.root)
+                      for c in self.lchown.call_args_list)
+
+    def fixer(self, **kwargs):
+        return ceph.utils.OwnershipFixer(self.root, self.uid, self.gid,
+                                         checkpoint=self.checkpoint,
+                                         **kwargs)
+
+    def test_changes_every_entry(self, _log):
+        fixer = self.fixer(workers=3, batch_size=2)
+        self.assertEqual(fixer.run(), 11)
+        self.assertEqual(self.changed(),
+                         ['.', 'a', 'a/f2', 'a/x', 'a/x/y', 'a/x/y/f3',
+                          'b', 'b/f4', 'b/f5', 'f1', 'link'])
+        for args in self.lchown.call_args_list:
+            self.assertEqual(args[0][1:], (self.uid, self.gid))
+        self.assertEqual(fixer.scanned, 10)
+        # Only the outermost finished subtrees are remembered
+        self.assertEqual(fixer._done, set(['a', 'b']))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_skips_matching_entries(self, _log):
+        fixer = ceph.utils.OwnershipFixer(self.root, os.getuid(),
+                                          os.getgid())
+        self.assertEqual(fixer.run(), 0)
+        self.assertFalse(self.lchown.called)
+        self.assertEqual(fixer.scanned, 10)
+
+    def test_resumes_from_checkpoint(self, _log):
+        os.makedirs(os.path.dirname(self.checkpoint))
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'path': self.root, 'uid': self.uid, 'gid': self.gid,
+                       'done': ['a']}, f)
+        self.fixer().run()
+        self.assertEqual(self.changed(),
+                         ['.', 'a', 'b', 'b/f4', 'b/f5', 'f1', 'link'])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_checkpoint_for_other_owner_ignored(self, _log):
+        os.makedirs(os.path.dirname(self.checkpoint))
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'path': self.root, 'uid': 0, 'gid': 0,
+                       'done': ['a']}, f)
+        self.assertEqual(self.fixer().run(), 11)
+
+    def test_failure_keeps_checkpoint(self, _log):
+        def lchown(path, uid, gid):
+            if path.endswith('f5'):
+                raise OSError(errno.EPERM, 'Operation not permitted')
+
+        self.lchown.side_effect = lchown
+        with self.assertRaises(OSError):
+            self.fixer(workers=1).run()
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.assertEqual((state['path'], state['uid'], state['gid']),
+                         (self.root, self.uid, self.gid))
+        self.assertNotIn('b', state['done'])
+
+    def test_vanished_entries_ignored(self, _log):
+        self.lchown.side_effect = OSError(errno.ENOENT, 'No such file')
+        self.fixer().run()
+
+
+@patch.object(ceph.utils, 'log')
+class OwnershipAuditTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OwnershipAuditTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for num in range(3):
+            os.makedirs(os.path.join(self.root, 'DIR_{}'.format(num)))
+            for name in range(5):
+                path = os.path.join(self.root, 'DIR_{}'.format(num),
+                                    'obj_{}'.format(name))
+                with open(path, 'w') as f:
+                    f.write('data')
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        patcher = patch.object(ceph.utils, 'OWNERSHIP_STATE_DIR', state_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+
+    def test_samples(self, _log):
+        self.assertEqual(ceph.utils._ownership_samples(0.99, 0.01), 459)
+        self.assertEqual(ceph.utils._ownership_samples(0.95, 0.05), 59)
+
+    def test_sampled_clean(self, _log):
+        self.assertIsNone(ceph.utils._sample_ownership(
+            self.root, self.uid, self.gid, 50))
+
+    def test_sampled_mismatch(self, _log):
+        found = ceph.utils._sample_ownership(self.root, self.uid + 1,
+                                             self.gid, 50)
+        self.assertTrue(found.startswith(self.root))
+
+    def test_descent_stops_at_first_mismatch(self, _log):
+        # The first entry of every descent is a child of the root
+        found = ceph.utils._sample_ownership(self.root, self.uid + 1,
+                                             self.gid, 1)
+        self.assertEqual(os.path.dirname(found), self.root)
+
+    def test_directories_listed_once(self, _log):
+        deep = os.path.join(self.root, 'DIR_0', 'a', 'b')
+        os.makedirs(deep)
+        with open(os.path.join(deep, 'obj'), 'w'):
+            pass
+        with patch.object(ceph.utils.os, 'listdir',
+                          wraps=os.listdir) as listdir:
+            self.assertIsNone(ceph.utils._sample_ownership(
+                self.root, self.uid, self.gid, 200))
+        listed = [c[0][0] for c in listdir.call_args_list]
+        self.assertEqual(len(listed), len(set(listed)))
+        self.assertIn(deep, listed)
+        self.assertLessEqual(len(listed), 6)
+
+    def test_sampled_empty_tree(self, _log):
+        empty = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, empty)
+        self.assertIsNone(ceph.utils._sample_ownership(
+            empty, self.uid, self.gid, 50))
+
+    def test_full(self, _log):
+        self.assertFalse(ceph.utils.audit_ownership(
+            self.root, self.uid, self.gid, mode='full', use_cache=False))
+        self.assertTrue(ceph.utils.audit_ownership(
+            self.root, self.uid, self.gid + 1, mode='full',
+            use_cache=False))
+
+    @patch.object(ceph.utils, '_sample_ownership')
+    def test_result_cached(self, _sample_ownership, _log):
+        _sample_ownership.return_value = None
+        self.assertFalse(ceph.utils.audit_ownership(self.root, self.uid,
+                                                    self.gid))
+        self.assertFalse(ceph.utils.audit_ownership(self.root, self.uid,
+                                                    self.gid))
+        self.assertEqual(_sample_ownership.call_count, 1)
+        # A sampled result does not answer a full audit
+        with patch.object(ceph.utils, 'OwnershipAuditor') as auditor:
+            auditor.return_value.run.return_value = True
+            self.assertTrue(ceph.utils.audit_ownership(
+                self.root, self.uid, self.gid, mode='full'))
+        # A tree needing an update needs it whatever the mode
+        self.assertTrue(ceph.utils.audit_ownership(self.root, self.uid,
+                                                   self.gid))
+        self.assertEqual(_sample_ownership.call_count, 1)
+
+    @patch.object(ceph.utils, '_sample_ownership')
+    def test_full_result_answers_sampled(self, _sample_ownership, _log):
+        ceph.utils._write_ownership_marker(self.root, self.uid, self.gid,
+                                           'full', False)
+        self.assertFalse(ceph.utils.audit_ownership(self.root, self.uid,
+                                                    self.gid))
+        self.assertFalse(_sample_ownership.called)
+        # Markers for another owner are ignored
+        _sample_ownership.return_value = self.root
+        self.assertTrue(ceph.utils.audit_ownership(self.root, self.uid + 1,
+                                                   self.gid))
+
+    @patch.object(ceph.utils, '_sample_ownership')
+    def test_marker_expires(self, _sample_ownership, _log):
+        _sample_ownership.return_value = None
+        ceph.utils._write_ownership_marker(self.root, self.uid, self.gid,
+                                           'full', False)
+        with patch.object(ceph.utils.time, 'time',
+                          return_value=time.time() + 2 * 24 * 60 * 60):
+            self.assertFalse(ceph.utils.audit_ownership(
+                self.root, self.uid, self.gid, use_cache=True))
+        self.assertEqual(_sample_ownership.call_count, 1)
+
+    @patch.object(ceph.utils, '_sample_ownership')
+    def test_marker_invalid_after_root_changes(self, _sample_ownership,
+                                               _log):
+        _sample_ownership.return_value = self.root
+        ceph.utils._write_ownership_marker(self.root, self.uid, self.gid,
+                                           'full', False)
+        marker = ceph.utils._ownership_marker(self.root)
+        with open(marker) as f:
+            state = json.load(f)
+        state['root_ctime'] -= 60
+        with open(marker, 'w') as f:
+            json.dump(state, f)
+        self.assertTrue(ceph.utils.audit_ownership(self.root, self.uid,
+                                                   self.gid))
+        self.assertEqual(_sample_ownership.call_count, 1)
+
+    @patch.object(ceph.utils, '_sample_ownership')
+    def test_markers_cleared(self, _sample_ownership, _log):
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        child = os.path.join(self.root, 'DIR_0')
+        for path in (self.root, child, other):
+            ceph.utils._write_ownership_marker(path, self.uid, self.gid,
+                                               'sampled', True)
+        ceph.utils._clear_ownership_markers(self.root)
+        self.assertFalse(os.path.exists(
+            ceph.utils._ownership_marker(self.root)))
+        self.assertFalse(os.path.exists(ceph.utils._ownership_marker(child)))
+        self.assertTrue(os.path.exists(ceph.utils._ownership_marker(other)))
+
+    @patch.object(ceph.utils, 'audit_ownership')
+    @patch.object(ceph.utils, 'owner')
+    @patch.object(ceph.utils, '_get_child_dirs')
+    @patch.object(ceph.utils, 'ceph_user')
+    def test_dirs_need_ownership_update(self, ceph_user, _get_child_dirs,
+                                        owner, audit_ownership, _log):
+        ceph_user.return_value = 'root'
+        _get_child_dirs.return_value = ['/var/lib/ceph/osd/ceph-0',
+                                        '/var/lib/ceph/osd/ceph-1']
+        owner.return_value = ('root', 'root')
+        audit_ownership.side_effect = [False, True]
+        self.assertTrue(ceph.utils.dirs_need_ownership_update(
+            'osd', mode='sampled'))
+        audit_ownership.assert_called_with('/var/lib/ceph/osd/ceph-1', 0, 0,
+                                           mode='sampled')
+        audit_ownership.reset_mock()
+        audit_ownership.side_effect = None
+        audit_ownership.return_value = False
+        self.assertFalse(ceph.utils.dirs_need_ownership_update('osd'))
+        audit_ownership.assert_called_with('/var/lib/ceph/osd/ceph-1', 0, 0,
+                                           mode='sampled')
+        audit_ownership.reset_mock()
+        self.assertFalse(ceph.utils.dirs_need_ownership_update('osd',
+                                                               mode='top'))
+        self.assertFalse(audit_ownership.called)
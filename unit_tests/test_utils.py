@@ -12,6 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 from mock import (
@@ -21,6 +25,7 @@ from mock import (
     patch,
 )
 
+import ceph.executor as executor
 import ceph.utils as utils
 
 from subprocess import CalledProcessError
@@ -465,20 +470,23 @@ class CephTestCase(unittest.TestCase):
         mock_ceph_user.return_value = 'ceph'
 
         test_calls = [
-            call(
-                ['ceph', 'auth', 'get-or-create',
-                 'mgr.{}'.format(test_hostname), 'mon',
-                 'allow profile mgr', 'osd', 'allow *',
-                 'mds', 'allow *', '--out-file',
-                 test_keyring]
-            ),
             call(['systemctl', 'enable', test_unit]),
         ]
+        fake = executor.FakeExecutor({'auth get-or-create': 'keyring\n'})
+        previous = executor.set_executor(fake)
+        self.addCleanup(executor.set_executor, previous)
 
         fake_open = mock_open()
-        with patch('ceph.open', fake_open, create=True):
+        with patch.object(utils, 'open', fake_open, create=True):
             utils.bootstrap_manager()
 
+        self.assertEqual(fake.commands[0].argv(),
+                         ['ceph', 'auth', 'get-or-create',
+                          'mgr.{}'.format(test_hostname), 'mon',
+                          'allow profile mgr', 'osd', 'allow *',
+                          'mds', 'allow *'])
+        fake_open.assert_called_once_with(test_keyring, 'w')
+        fake_open().write.assert_called_once_with('keyring\n')
         self.assertEqual(
             mock_subprocess.check_call.mock_calls,
             test_calls
@@ -516,6 +524,353 @@ class CephTestCase(unittest.TestCase):
         self.assertEqual(utils.pretty_print_upgrade_paths(), expected)
 
 
+class OsdizeManyTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OsdizeManyTestCase, self).setUp()
+        patcher = patch.object(utils.BlockInventory, 'cached')
+        self.scan = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scan.return_value = None
+
+    @patch.object(utils.os.path, 'realpath')
+    def test_get_device_controller(self, _realpath):
+        paths = {
+            '/dev/disk/by-id/wwn-1': '/dev/sdc',
+            '/sys/class/block/sdc': (
+                '/sys/devices/pci0000:00/0000:00:03.0/0000:03:00.0/host2/'
+                'target2:0:1/2:0:1:0/block/sdc'),
+            '/dev/vda': '/dev/vda',
+            '/sys/class/block/vda': '/sys/devices/virtual/block/vda'}
+        _realpath.side_effect = lambda path: paths[path]
+        self.assertEqual(utils.get_device_controller('/dev/disk/by-id/wwn-1'),
+                         '0000:03:00.0')
+        self.assertIsNone(utils.get_device_controller('/dev/vda'))
+
+    @patch.object(utils, 'get_partitions')
+    def test_plan_utility_devices(self, _partitions):
+        _partitions.side_effect = lambda dev, inventory: {
+            '/dev/nvme0n1': ['1', '2'], '/dev/nvme1n1': []}[dev]
+        plan = utils.plan_utility_devices(
+            ['/dev/sdb', '/dev/sdc', '/dev/sdd', '/dev/sde'],
+            ['/dev/nvme0n1', '/dev/nvme1n1'])
+        self.assertEqual(plan, {'/dev/sdb': '/dev/nvme1n1',
+                                '/dev/sdc': '/dev/nvme1n1',
+                                '/dev/sdd': '/dev/nvme0n1',
+                                '/dev/sde': '/dev/nvme1n1'})
+        self.assertEqual(utils.plan_utility_devices(['/dev/sdb'], []), {})
+
+    @patch.object(utils, 'get_partitions')
+    @patch.object(utils, 'get_devices')
+    def test_plan_osd_placement(self, _devices, _partitions):
+        _devices.side_effect = lambda name: {
+            'bluestore-wal': ['/dev/nvme0n1'], 'bluestore-db': []}[name]
+        _partitions.return_value = []
+        plan = utils.plan_osd_placement(['/dev/sdb'], None, bluestore=True)
+        self.assertEqual(plan, {'/dev/sdb': {'wal': '/dev/nvme0n1'}})
+        plan = utils.plan_osd_placement(['/dev/sdb'], ['/dev/sdx'])
+        self.assertEqual(plan, {'/dev/sdb': {'journal': '/dev/sdx'}})
+
+    @patch.object(utils, 'log')
+    @patch.object(utils, 'cmp_pkgrevno')
+    @patch.object(utils, 'get_partitions')
+    @patch.object(utils, 'get_device_controller')
+    @patch.object(utils, '_prepare_osd_dev')
+    @patch.object(utils, '_osdize_dev_skip_reason')
+    def test_osdize_many(self, _skip, _prepare, _controller, _partitions,
+                         _cmp, _log):
+        _skip.side_effect = lambda dev, reformat, inventory: (
+            'in use' if dev == '/dev/sdd' else None)
+        _controller.return_value = '0000:03:00.0'
+        _partitions.return_value = []
+        _cmp.return_value = 1
+
+        def prepare(dev, *args):
+            if dev == '/dev/sdc':
+                raise CalledProcessError(1, 'ceph-disk')
+        _prepare.side_effect = prepare
+
+        results = utils.osdize_many(
+            ['/dev/sdb', '/dev/sdc', '/dev/sdd'], 'xfs', ['/dev/sdx'])
+        self.assertEqual(list(results), ['/dev/sdb', '/dev/sdc', '/dev/sdd'])
+        self.assertEqual(results['/dev/sdb']['status'], 'prepared')
+        self.assertEqual(results['/dev/sdb']['placement'],
+                         {'journal': '/dev/sdx'})
+        self.assertEqual(results['/dev/sdc']['status'], 'failed')
+        self.assertEqual(results['/dev/sdd'],
+                         {'status': 'skipped', 'reason': 'in use'})
+        self.assertEqual(sorted(c[0][0] for c in _prepare.call_args_list),
+                         ['/dev/sdb', '/dev/sdc'])
+
+    @patch.object(utils, 'log')
+    @patch.object(utils, 'cmp_pkgrevno')
+    @patch.object(utils, 'get_device_controller')
+    @patch.object(utils, '_prepare_osd_dev')
+    @patch.object(utils, '_osdize_dev_skip_reason')
+    def test_osdize_many_per_controller(self, _skip, _prepare, _controller,
+                                        _cmp, _log):
+        devices = ['/dev/sd{}'.format(c) for c in 'bcdefgh']
+        controllers = dict((dev, 'hba{}'.format(i % 2))
+                           for i, dev in enumerate(devices))
+        _skip.return_value = None
+        _controller.side_effect = lambda dev: controllers[dev]
+        _cmp.return_value = 1
+        lock = utils.threading.Lock()
+        running = {'hba0': 0, 'hba1': 0}
+        peak = {'hba0': 0, 'hba1': 0}
+
+        def prepare(dev, *args):
+            with lock:
+                running[controllers[dev]] += 1
+                peak[controllers[dev]] = max(peak[controllers[dev]],
+                                             running[controllers[dev]])
+            utils.time.sleep(0.01)
+            with lock:
+                running[controllers[dev]] -= 1
+        _prepare.side_effect = prepare
+
+        results = utils.osdize_many(devices, 'xfs', None, max_workers=8,
+                                    per_controller=2)
+        self.assertEqual(set(r['status'] for r in results.values()),
+                         set(['prepared']))
+        self.assertTrue(max(peak.values()) <= 2)
+
+    @patch.object(utils, 'get_partitions')
+    @patch.object(utils, '_read_block_attr')
+    def test_utility_planner_weights(self, _attr, _partitions):
+        attrs = {
+            ('/dev/nvme0n1', 'size'): '2000',
+            ('/dev/sdx', 'size'): '2000',
+            ('/dev/sdx', 'queue/rotational'): '0',
+            ('/dev/sdy', 'size'): '1000',
+            ('/dev/sdy', 'queue/rotational'): '0'}
+        _attr.side_effect = lambda dev, attr: attrs.get((dev, attr))
+        _partitions.return_value = []
+        planner = utils.UtilityDevicePlanner(
+            ['/dev/nvme0n1', '/dev/sdx', '/dev/sdy'])
+        self.assertEqual(planner.weights, {'/dev/nvme0n1': 4.0,
+                                           '/dev/sdx': 2.0,
+                                           '/dev/sdy': 1.0})
+        planned = [planner.assign('/dev/sd{}'.format(c)) for c in 'abcdefg']
+        self.assertEqual(planned.count('/dev/nvme0n1'), 4)
+        self.assertEqual(planned.count('/dev/sdx'), 2)
+        self.assertEqual(planned.count('/dev/sdy'), 1)
+        self.assertEqual(planner.assign('/dev/sda'), planned[0])
+        self.assertEqual(_partitions.call_count, 3)
+
+    @patch.object(utils, 'get_partitions')
+    @patch.object(utils, '_read_block_attr')
+    def test_find_least_used_reserves_nothing(self, _attr, _partitions):
+        _attr.return_value = None
+        partitions = {'/dev/sdx': ['1'], '/dev/sdy': []}
+        _partitions.side_effect = lambda dev, inventory: partitions[dev]
+        for c in 'bcd':
+            self.assertEqual(utils.find_least_used_utility_device(
+                ['/dev/sdx', '/dev/sdy']), '/dev/sdy')
+        # Partitions are counted afresh on every call
+        partitions['/dev/sdy'] = ['1', '2']
+        self.assertEqual(utils.find_least_used_utility_device(
+            ['/dev/sdx', '/dev/sdy']), '/dev/sdx')
+
+    @patch.object(utils, 'get_partitions')
+    @patch.object(utils, '_read_block_attr')
+    @patch.object(utils, 'get_devices')
+    def test_planner_shared_within_placement(self, _devices, _attr,
+                                             _partitions):
+        _devices.return_value = ['/dev/sdy', '/dev/sdx']
+        _attr.return_value = None
+        _partitions.return_value = []
+        plan = utils.plan_osd_placement(['/dev/sde'], bluestore=True)
+        # WAL and DB share the devices and are balanced as a whole
+        self.assertEqual(plan, {'/dev/sde': {'wal': '/dev/sdx',
+                                             'db': '/dev/sdy'}})
+        self.assertEqual(_partitions.call_count, 2)
+        # A later call starts from a fresh count
+        self.assertEqual(utils.plan_osd_placement(['/dev/sde'],
+                                                  bluestore=True), plan)
+
+    def test_interleave_by_controller(self):
+        controllers = {'a': 1, 'b': 1, 'c': 1, 'd': 2}
+        self.assertEqual(
+            utils._interleave_by_controller(['a', 'b', 'c', 'd'],
+                                            controllers),
+            ['a', 'd', 'b', 'c'])
+
+
+LSBLK = {'blockdevices': [
+    {'name': '/dev/sda', 'type': 'disk', 'size': '480103981056',
+     'rota': '0', 'mountpoint': None, 'children': [
+         {'name': '/dev/sda1', 'type': 'part', 'size': 1073741824,
+          'rota': False, 'uuid': 'fs-uuid-1', 'mountpoint': '/boot',
+          'partlabel': None, 'partuuid': 'part-uuid-1',
+          'parttype': '0fc63daf-8483-4772-8e79-3d69d8477de4'}]},
+    {'name': '/dev/sdb', 'type': 'disk', 'size': 4000787030016,
+     'rota': True, 'mountpoints': [None], 'children': [
+         {'name': '/dev/sdb1', 'type': 'part', 'size': 3221225472,
+          'partlabel': 'ceph data', 'partuuid': 'part-uuid-2',
+          'parttype': '4fbd7e29-9d25-41b8-afd0-062c0ceff05d',
+          'mountpoints': [None]},
+         {'name': '/dev/sdb2', 'type': 'part', 'size': 1073741824,
+          'partlabel': 'ceph journal', 'partuuid': 'part-uuid-3',
+          'parttype': '45b0969e-9b03-4f30-b4c6-b4b80ceff106',
+          'mountpoints': [None], 'children': [
+              {'name': '/dev/mapper/crypt', 'type': 'crypt',
+               'mountpoints': ['/srv']}]}]},
+    {'name': '/dev/sdc', 'type': 'disk', 'size': '4000787030016',
+     'rota': '1', 'mountpoint': None},
+    {'name': '/dev/loop0', 'type': 'loop', 'size': '0', 'rota': '1'}]}
+
+UDEV = [
+    ('/dev/sda', {'DEVTYPE': 'disk'}, None),
+    ('/dev/sda1', {'DEVTYPE': 'partition', 'ID_PART_ENTRY_NUMBER': '1',
+                   'ID_PART_ENTRY_OFFSET': '2048',
+                   'ID_PART_ENTRY_SIZE': '2097152'}, '/dev/sda'),
+    ('/dev/sdb', {'DEVTYPE': 'disk'}, None),
+    ('/dev/sdb1', {'DEVTYPE': 'partition', 'ID_PART_ENTRY_NUMBER': '1',
+                   'ID_PART_ENTRY_OFFSET': '2099200',
+                   'ID_PART_ENTRY_SIZE': '6291456'}, '/dev/sdb'),
+    ('/dev/sdb2', {'DEVTYPE': 'partition', 'ID_PART_ENTRY_NUMBER': '2',
+                   'ID_PART_ENTRY_OFFSET': '2048',
+                   'ID_PART_ENTRY_SIZE': '2097152'}, '/dev/sdb'),
+    ('/dev/sdc', {'DEVTYPE': 'disk'}, None),
+    ('/dev/loop0', {'DEVTYPE': 'disk'}, None)]
+
+
+class BlockInventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        super(BlockInventoryTestCase, self).setUp()
+        self.inventory = utils.BlockInventory(LSBLK['blockdevices'], UDEV)
+
+    @patch.object(utils, 'log')
+    def test_unmounted_disks(self, _log):
+        self.assertEqual(utils.unmounted_disks(self.inventory), ['/dev/sdc'])
+
+    def test_is_device_mounted(self):
+        self.assertTrue(self.inventory.is_device_mounted('/dev/sda'))
+        self.assertTrue(self.inventory.is_device_mounted('/dev/sdb'))
+        self.assertFalse(self.inventory.is_device_mounted('/dev/sdb1'))
+        self.assertFalse(self.inventory.is_device_mounted('/dev/sdz'))
+
+    def test_is_osd_disk(self):
+        self.assertTrue(utils.is_osd_disk('/dev/sdb', self.inventory))
+        self.assertFalse(utils.is_osd_disk('/dev/sda', self.inventory))
+        self.assertFalse(utils.is_osd_disk('/dev/sdc', self.inventory))
+
+    def test_get_partitions_like_partx(self):
+        self.assertEqual(
+            utils.get_partitions('/dev/sdb', self.inventory),
+            ['1 2099200 8390655 6291456 3G ceph\\x20data part-uuid-2',
+             '2 2048 2099199 2097152 1G ceph\\x20journal part-uuid-3'])
+        partitions = utils.get_partition_list('/dev/sda', self.inventory)
+        self.assertEqual(len(partitions), 1)
+        self.assertEqual(partitions[0].number, '1')
+        self.assertEqual(partitions[0].uuid, 'part-uuid-1')
+
+    def test_block_uuid_rotational_and_size(self):
+        self.assertEqual(utils.get_block_uuid('/dev/sda1', self.inventory),
+                         'fs-uuid-1')
+        self.assertFalse(self.inventory.is_rotational('/dev/sda'))
+        self.assertTrue(self.inventory.is_rotational('/dev/sdb'))
+        self.assertEqual(self.inventory.get_size('/dev/sdc'), 4000787030016)
+        self.assertEqual(utils.get_device_class('/dev/sda', self.inventory),
+                         'ssd')
+
+    def test_udev_only(self):
+        inventory = utils.BlockInventory([], UDEV, {'/dev/sda1': '/boot'})
+        self.assertTrue(inventory.is_device_mounted('/dev/sda'))
+        self.assertEqual(inventory.get_partitions('/dev/sdb')[1],
+                         '2 2048 2099199 2097152 1G  ')
+        self.assertIsNone(inventory.is_rotational('/dev/sdb'))
+
+    @patch.object(utils, 'pyudev')
+    @patch.object(utils.subprocess, 'check_output')
+    def test_scan(self, _check_output, _pyudev):
+        _check_output.return_value = utils.json.dumps(LSBLK).encode('UTF-8')
+        disk = MagicMock(device_node='/dev/sdc', properties={
+            'DEVTYPE': 'disk'})
+        disk.parent.device_node = None
+        _pyudev.Context.return_value.list_devices.return_value = [disk]
+        inventory = utils.BlockInventory.scan()
+        _check_output.assert_called_once_with(
+            ['lsblk', '--json', '--output-all', '--bytes', '--paths'])
+        self.assertEqual(inventory.device('/dev/sdc')['type'], 'disk')
+        self.assertEqual(len(inventory.get_partition_list('/dev/sdb')), 2)
+
+
+class BlockInventoryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        super(BlockInventoryCacheTestCase, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.cache_file = os.path.join(tmpdir, 'devices', 'inventory.json')
+        self.udev = [(node, dict(properties), parent)
+                     for node, properties, parent in UDEV]
+        self.mounts = {'/dev/sda1': '/boot'}
+        self.sizes = {}
+        for name, side_effect in (
+                ('_udev_block_devices', lambda: self.udev),
+                ('_lsblk_json', self.lsblk),
+                ('_proc_mounts', lambda: self.mounts),
+                ('_block_holders', lambda node: []),
+                ('_read_block_attr',
+                 lambda node, attr: self.sizes.get(node, '1000')),
+                ('log', None)):
+            patcher = patch.object(utils, name, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.lsblk_calls = []
+
+    def lsblk(self, devices):
+        self.lsblk_calls.append(list(devices))
+        return [entry for entry in LSBLK['blockdevices']
+                if entry['name'] in devices]
+
+    def test_unchanged_devices_not_listed_again(self):
+        first = utils.BlockInventory.cached(self.cache_file)
+        self.assertEqual(first.changed,
+                         ['/dev/sda', '/dev/sdb', '/dev/sdc', '/dev/loop0'])
+        second = utils.BlockInventory.cached(self.cache_file)
+        self.assertEqual(second.changed, [])
+        self.assertEqual(len(self.lsblk_calls), 1)
+        self.assertTrue(second.is_osd_disk('/dev/sdb'))
+        self.assertEqual(second.get_partitions('/dev/sdb'),
+                         first.get_partitions('/dev/sdb'))
+        self.assertEqual(second.get_size('/dev/sdc'), 4000787030016)
+
+    def test_mounts_read_afresh(self):
+        utils.BlockInventory.cached(self.cache_file)
+        self.mounts = {}
+        inventory = utils.BlockInventory.cached(self.cache_file)
+        self.assertFalse(inventory.is_device_mounted('/dev/sda'))
+        self.mounts = {'/dev/sdc': '/mnt'}
+        inventory = utils.BlockInventory.cached(self.cache_file)
+        self.assertEqual(inventory.unmounted_disks(), ['/dev/sda', '/dev/sdb'])
+
+    def test_changed_udev_properties(self):
+        utils.BlockInventory.cached(self.cache_file)
+        self.udev[5][1]['ID_PART_TABLE_UUID'] = 'new-table'
+        inventory = utils.BlockInventory.cached(self.cache_file)
+        self.assertEqual(inventory.changed, ['/dev/sdc'])
+        self.assertEqual(self.lsblk_calls[-1], ['/dev/sdc'])
+
+    def test_new_partition_changes_disk(self):
+        utils.BlockInventory.cached(self.cache_file)
+        self.udev.append(('/dev/sdc1', {'DEVTYPE': 'partition'}, '/dev/sdc'))
+        inventory = utils.BlockInventory.cached(self.cache_file)
+        self.assertEqual(inventory.changed, ['/dev/sdc'])
+
+    def test_resized_disk(self):
+        utils.BlockInventory.cached(self.cache_file)
+        self.sizes['/dev/sdb'] = '2000'
+        inventory = utils.BlockInventory.cached(self.cache_file)
+        self.assertEqual(inventory.changed, ['/dev/sdb'])
+
+    def test_lsblk_failure_scans(self):
+        with patch.object(utils.BlockInventory, 'scan') as _scan:
+            utils._lsblk_json.side_effect = OSError('no lsblk')
+            self.assertEqual(utils.BlockInventory.cached(self.cache_file),
+                             _scan.return_value)
+
+
 class CephVersionTestCase(unittest.TestCase):
     @patch.object(utils, 'get_os_codename_install_source')
     def test_resolve_ceph_version_trusty(self, get_os_codename_install_source):
@@ -537,3 +892,77 @@ class CephVersionTestCase(unittest.TestCase):
         get_os_codename_install_source.return_value = 'ocata'
         self.assertEqual(utils.resolve_ceph_version(
                          'cloud:xenial-ocata'), 'jewel')
+
+
+OSD_TREE = json.dumps({
+    'nodes': [
+        {'id': -1, 'name': 'default', 'type': 'root', 'children': [-3, -2]},
+        {'id': -2, 'name': 'node1', 'type': 'host', 'children': [1, 0]},
+        {'id': 0, 'name': 'osd.0', 'type': 'osd', 'crush_weight': 0.5},
+        {'id': 1, 'name': 'osd.1', 'type': 'osd', 'crush_weight': 1.5},
+        {'id': -3, 'name': 'node2', 'type': 'host', 'children': [2]},
+        {'id': 2, 'name': 'osd.2', 'type': 'osd', 'crush_weight': 2.0}],
+    'stray': []})
+
+
+class OsdTreeSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OsdTreeSnapshotTestCase, self).setUp()
+        self.fake = executor.FakeExecutor({
+            'osd stat': '{"epoch": 10}',
+            'osd tree': OSD_TREE})
+        previous = executor.set_executor(self.fake)
+        self.addCleanup(executor.set_executor, previous)
+        patcher = patch.dict(utils._osd_tree_snapshots, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_indexes(self):
+        snapshot = utils.get_osd_tree_snapshot()
+        self.assertEqual(snapshot.osd_weight('osd.1'), 1.5)
+        self.assertIsNone(snapshot.osd_weight('node1'))
+        self.assertIsNone(snapshot.osd_weight('osd.9'))
+        self.assertEqual(snapshot.parent('osd.2')['name'], 'node2')
+        self.assertEqual([n['name'] for n in snapshot.host_osds('node1')],
+                         ['osd.1', 'osd.0'])
+        self.assertEqual([n['name'] for n in snapshot.children('default')],
+                         ['node2', 'node1'])
+        self.assertEqual(snapshot.by_id[-3]['name'], 'node2')
+
+    def test_first_load_skips_epoch_probe(self):
+        self.assertEqual(utils.get_osd_weight('osd.0'), 0.5)
+        self.assertEqual(self.fake.prefixes(), ['osd tree'])
+
+    def test_tree_read_once_per_epoch(self):
+        self.assertEqual(utils.get_osd_weight('osd.0'), 0.5)
+        self.assertEqual(utils.get_osd_weight('osd.2'), 2.0)
+        utils.get_osd_weight('osd.1')
+        self.assertEqual(self.fake.prefixes(),
+                         ['osd tree', 'osd stat', 'osd tree', 'osd stat'])
+        self.fake.responses['osd stat'] = '{"epoch": 11}'
+        utils.get_osd_weight('osd.0')
+        self.assertEqual(self.fake.prefixes()[4:], ['osd stat', 'osd tree'])
+
+    @patch.object(utils, 'log')
+    def test_unknown_epoch_always_reads_tree(self, _log):
+        self.fake.responses['osd stat'] = CalledProcessError(1, 'ceph')
+        utils.get_osd_weight('osd.0')
+        utils.get_osd_weight('osd.0')
+        self.assertEqual(self.fake.prefixes().count('osd tree'), 2)
+
+    def test_snapshot_per_service(self):
+        utils.get_osd_tree('osd-upgrade')
+        utils.get_osd_weight('osd.0')
+        self.assertEqual(self.fake.prefixes(), ['osd tree', 'osd tree'])
+        self.assertEqual(self.fake.commands[0].service, 'osd-upgrade')
+        self.assertIsNone(self.fake.commands[1].service)
+
+    def test_get_osd_tree(self):
+        # Buckets come in the order of the root's children list
+        locations = utils.get_osd_tree('osd-upgrade')
+        self.assertEqual([(loc.name, loc.identifier) for loc in locations],
+                         [('node2', -3), ('node1', -2)])
+
+    def test_get_osd_tree_empty(self):
+        self.fake.responses['osd tree'] = '{"nodes": [], "stray": []}'
+        self.assertIsNone(utils.get_osd_tree('osd-upgrade'))